@@ -0,0 +1,119 @@
+"""Shared response cache in S3"""
+
+import boto3
+import time
+
+from botocore.exceptions import ClientError
+
+from shared.cache import CACHE_META_NAME, decode_cache_meta, \
+    encode_cache_meta, get_cache_key, get_freshness_lifetime, \
+    get_validators, is_cacheable_request, is_cacheable_response
+from shared.proxy import open_single_request
+
+
+S3_CLIENT = boto3.client('s3')
+
+
+class CacheEntry(object):
+
+    def __init__(self, key, statusCode, headers, expireTime, size):
+        self.key = key
+        self.statusCode = statusCode
+        self.headers = headers
+        self.expireTime = expireTime
+        self.size = size
+
+    @property
+    def isFresh(self):
+        return self.expireTime > time.time()
+
+
+def head_cache_entry(bucketName, key):
+    """Return the CacheEntry for the key, or None if it is not cached"""
+    try:
+        result = S3_CLIENT.head_object(Bucket=bucketName, Key=key)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', '403'):
+            return None
+        raise
+    meta = result.get('Metadata', {}).get(CACHE_META_NAME)
+    if meta is None:
+        return None
+    statusCode, headers, expireTime = decode_cache_meta(meta)
+    return CacheEntry(key, statusCode, headers, expireTime,
+                      result['ContentLength'])
+
+
+def refresh_cache_entry(bucketName, entry, revalidatedHeaders):
+    """Extend the lifetime of an entry after the origin returned 304"""
+    lifetime = get_freshness_lifetime(revalidatedHeaders)
+    if lifetime == 0:
+        lifetime = get_freshness_lifetime(entry.headers)
+    entry.expireTime = time.time() + lifetime
+    meta = encode_cache_meta(entry.statusCode, entry.headers,
+                             entry.expireTime)
+    if meta is None:
+        return
+    # Objects cannot be modified, but may be copied onto themselves
+    S3_CLIENT.copy_object(Bucket=bucketName, Key=entry.key,
+                          CopySource={'Bucket': bucketName, 'Key': entry.key},
+                          Metadata={CACHE_META_NAME: meta},
+                          MetadataDirective='REPLACE',
+                          StorageClass='REDUCED_REDUNDANCY')
+
+
+def open_cached_request(bucketName, method, url, requestHeaders, body):
+    """
+    Return (entry, None) if the response can be served from the cache.
+    Otherwise, return (None, upstreamResponse), where the response may
+    have been opened while revalidating a stale entry.
+    """
+    if not is_cacheable_request(method, requestHeaders, body):
+        return None, None
+    entry = head_cache_entry(bucketName, get_cache_key(url, requestHeaders))
+    if entry is None:
+        return None, None
+    if entry.isFresh:
+        return entry, None
+
+    validators = get_validators(entry.headers)
+    if not validators:
+        return None, None
+    conditionalHeaders = dict(requestHeaders)
+    conditionalHeaders.update(validators)
+    upstreamResponse = open_single_request(method, url, conditionalHeaders,
+                                           body)
+    if upstreamResponse.status_code != 304:
+        return None, upstreamResponse
+    upstreamResponse.close()
+    refresh_cache_entry(bucketName, entry, dict(upstreamResponse.headers))
+    return entry, None
+
+
+def will_cache_response(method, requestHeaders, body, upstreamResponse):
+    return (is_cacheable_request(method, requestHeaders, body)
+            and is_cacheable_response(upstreamResponse.status_code,
+                                      dict(upstreamResponse.headers)))
+
+
+def read_cache_entry(bucketName, entry):
+    result = S3_CLIENT.get_object(Bucket=bucketName, Key=entry.key)
+    return result['Body'].read()
+
+
+def put_cache_entry(bucketName, method, url, requestHeaders, body, response):
+    """Cache the response if allowed. Returns the key, or None"""
+    if (not is_cacheable_request(method, requestHeaders, body)
+            or not is_cacheable_response(response.statusCode,
+                                         response.headers)):
+        return None
+    expireTime = time.time() + get_freshness_lifetime(response.headers)
+    meta = encode_cache_meta(response.statusCode, response.headers,
+                             expireTime)
+    if meta is None:
+        return None
+    key = get_cache_key(url, requestHeaders)
+    S3_CLIENT.put_object(Bucket=bucketName, Key=key, Body=response.content,
+                         Metadata={CACHE_META_NAME: meta},
+                         StorageClass='REDUCED_REDUNDANCY')
+    return key
@@ -0,0 +1,40 @@
+"""Session keys sent by the client, wrapped with the lambda's public key"""
+
+import os
+
+from collections import OrderedDict
+from Crypto.PublicKey import RSA
+from Crypto.Cipher import PKCS1_OAEP
+from threading import Lock
+
+from shared.crypto import PRIVATE_KEY_ENV_VAR, get_key_id
+
+
+rsaPrivKey = os.environ.get(PRIVATE_KEY_ENV_VAR, None)
+RSA_CIPHER = None
+if rsaPrivKey is not None:
+    RSA_CIPHER = PKCS1_OAEP.new(RSA.importKey(rsaPrivKey.decode('hex')))
+
+# Session keys unwrapped by this container, by key id
+MAX_CACHED_SESSION_KEYS = 16
+SESSION_KEYS = OrderedDict()
+SESSION_KEYS_LOCK = Lock()
+
+
+def unwrap_key(encryptedKey):
+    """Decrypt a key that is used for a single request"""
+    return RSA_CIPHER.decrypt(encryptedKey)
+
+
+def unwrap_session_key(encryptedKey):
+    """Decrypt the key with RSA, unless it has been seen before"""
+    keyId = get_key_id(encryptedKey)
+    with SESSION_KEYS_LOCK:
+        sessionKey = SESSION_KEYS.get(keyId)
+    if sessionKey is None:
+        sessionKey = RSA_CIPHER.decrypt(encryptedKey)
+        with SESSION_KEYS_LOCK:
+            SESSION_KEYS[keyId] = sessionKey
+            while len(SESSION_KEYS) > MAX_CACHED_SESSION_KEYS:
+                SESSION_KEYS.popitem(last=False)
+    return sessionKey
@@ -7,11 +7,23 @@ import os
 import time
 import traceback
 
-from base64 import b64encode
+from base64 import b64encode, b64decode
 from concurrent.futures import ThreadPoolExecutor
 from threading import Semaphore
 
-from shared.proxy import proxy_single_request
+from impl.cache import open_cached_request, put_cache_entry, \
+    read_cache_entry
+from impl.keys import unwrap_session_key
+from impl.stream import connect_stream_server
+from shared.channel import MessageChannel, DRAIN_CONTROL, DRAINED_CONTROL, \
+    WORKER_CHANNEL_PATH
+from shared.crypto import REQUEST_META_NONCE, RESPONSE_META_NONCE, \
+    REQUEST_BODY_NONCE, RESPONSE_BODY_NONCE, RequestCipher
+from shared.proxy import ProxyResponse, proxy_single_request, \
+    read_proxy_response
+from shared.timing import TIMING_KEY, PhaseTimer
+from shared.transport import FRAGMENTS_TRANSPORT, S3_TRANSPORT, \
+    choose_transport
 from shared.workers import LambdaSqsResult, LambdaSqsTask
 
 
@@ -25,6 +37,7 @@ MAX_QUEUED_REQUESTS = int(os.environ.get('MAX_QUEUED_REQUESTS', 10))
 MAX_IDLE_POLLS = int(os.environ.get('MAX_IDLE_POLLS', 1))
 MAX_NUM_FRAGMENTS = int(os.environ.get('MAX_NUM_FRAGMENTS', 20))
 MAX_NUM_THREADS = min(MAX_QUEUED_REQUESTS, 10)
+MAX_CHANNEL_IDLE_SECONDS = float(os.environ.get('MAX_CHANNEL_IDLE_SECONDS', 2))
 
 # This leaves 4KB
 MAX_PAYLOAD_PER_SQS_MESSAGE = 252 * 1024
@@ -81,16 +94,27 @@ def send_response_as_fragments(task, response, responseQueue,
 
 
 def send_response_via_s3(task, response, responseQueue, s3Bucket,
-                         encodedMessageBody):
-    md5 = hashlib.md5()
-    md5.update(response.content)
-    key = md5.hexdigest()
-
-    s3Bucket.put_object(Key=key, Body=response.content,
-                        StorageClass='REDUCED_REDUNDANCY')
+                         encodedMessageBody, cacheKey=None):
+    if cacheKey is None:
+        md5 = hashlib.md5()
+        md5.update(response.content)
+        key = md5.hexdigest()
+
+        putStartTime = time.time()
+        s3Bucket.put_object(Key=key, Body=response.content,
+                            StorageClass='REDUCED_REDUNDANCY')
+        putMillis = int((time.time() - putStartTime) * 1000)
+    else:
+        # The body is already in the cache
+        key = cacheKey
+        putMillis = 0
 
     result = LambdaSqsResult(taskId=task.taskId)
     result.add_string_attribute('s3', key)
+    # The client counts the upload in its estimate of the transport
+    result.add_string_attribute('s3PutMillis', str(putMillis))
+    if cacheKey is not None:
+        result.add_string_attribute('s3Cached', 'true')
     result.set_body(encodedMessageBody)
     responseQueue.send_message(MessageBody=result.body,
                                MessageAttributes=result.messageAttributes)
@@ -106,17 +130,45 @@ def send_response_directly(task, response, responseQueue,
                                MessageAttributes=result.messageAttributes)
 
 
-def send_response_to_message(task, response, responseQueue, s3Bucket):
+def encode_message_body(statusCode, headers, cipher=None, timing=None):
     messageBody = {
-        'statusCode': response.statusCode,
-        'headers': response.headers,
+        'statusCode': statusCode,
+        'headers': headers,
     }
-    encodedMessageBody = b64encode(json.dumps(messageBody).encode('zlib'))
+    if timing is not None:
+        messageBody[TIMING_KEY] = timing
+    if cipher is not None:
+        return b64encode(cipher.encrypt_framed(RESPONSE_META_NONCE,
+                                               json.dumps(messageBody)))
+    return b64encode(json.dumps(messageBody).encode('zlib'))
+
+
+def send_response_to_message(task, response, responseQueue, s3Bucket,
+                             transports=None, cacheKey=None, cipher=None,
+                             timing=None):
+    encodedMessageBody = encode_message_body(response.statusCode,
+                                             response.headers, cipher, timing)
+    if cipher is not None and response.content:
+        # The ciphertext is sent in binary attributes, or via s3
+        response = response._replace(content=cipher.encrypt_framed(
+            RESPONSE_BODY_NONCE, response.content))
     estimatedLength = len(encodedMessageBody) + len(response.content)
-    if estimatedLength <= MAX_PAYLOAD_PER_SQS_MESSAGE:
+    if (estimatedLength <= MAX_PAYLOAD_PER_SQS_MESSAGE
+            or isinstance(responseQueue, MessageChannel)):
+        # Channels do not have a message size limit
         send_response_directly(task, response, responseQueue, encodedMessageBody)
+    elif cacheKey is not None:
+        send_response_via_s3(task, response, responseQueue, s3Bucket,
+                             encodedMessageBody, cacheKey=cacheKey)
     else:
+        candidates = []
         if s3Bucket:
+            candidates.append(S3_TRANSPORT)
+        if (estimatedLength / MAX_PAYLOAD_PER_SQS_MESSAGE + 2
+                <= MAX_NUM_FRAGMENTS):
+            candidates.append(FRAGMENTS_TRANSPORT)
+        transport = choose_transport(estimatedLength, candidates, transports)
+        if transport == S3_TRANSPORT:
             send_response_via_s3(task, response, responseQueue, s3Bucket,
                                  encodedMessageBody)
         else:
@@ -124,11 +176,40 @@ def send_response_to_message(task, response, responseQueue, s3Bucket):
                                        encodedMessageBody)
 
 
+def send_cached_response(task, entry, responseQueue, s3Bucket):
+    """Large cached bodies are read by the client from the cache itself"""
+    if entry.size > MAX_PAYLOAD_PER_SQS_MESSAGE:
+        encodedMessageBody = encode_message_body(entry.statusCode,
+                                                 entry.headers)
+        send_response_via_s3(task, None, responseQueue, s3Bucket,
+                             encodedMessageBody, cacheKey=entry.key)
+    else:
+        content = read_cache_entry(s3Bucket.name, entry)
+        response = ProxyResponse(statusCode=entry.statusCode,
+                                 headers=entry.headers, content=content)
+        send_response_to_message(task, response, responseQueue, s3Bucket)
+
+
+def decrypt_task_params(requestParams):
+    """Only the wrapped session key and nonce are sent in the clear"""
+    cipher = RequestCipher(
+        unwrap_session_key(b64decode(requestParams['key'])),
+        b64decode(requestParams['nonce']))
+    meta = cipher.decrypt_framed(REQUEST_META_NONCE,
+                                 b64decode(requestParams['meta64']))
+    return cipher, json.loads(meta)
+
+
 def process_single_message(message, responseQueue, s3Bucket, queuedRequestsSemaphore):
     """Proxy a single message in the thread pool"""
     try:
+        timer = PhaseTimer()
         task = LambdaSqsTask.from_message(message)
         requestParams = json.loads(task.body)
+        cipher = None
+        if 'key' in requestParams:
+            with timer.phase('decrypt'):
+                cipher, requestParams = decrypt_task_params(requestParams)
 
         method = requestParams['method']
         url = requestParams['url']
@@ -139,16 +220,94 @@ def process_single_message(message, responseQueue, s3Bucket, queuedRequestsSemap
         requestBody = None
         if task.has_attribute('data'):
             requestBody = task.get_binary_attribute('data')
-
-        response = proxy_single_request(method, url, requestHeaders,
-                                        requestBody, gzipResult=True)
-        send_response_to_message(task, response, responseQueue, s3Bucket)
+            if cipher is not None:
+                with timer.phase('decrypt'):
+                    requestBody = cipher.decrypt_framed(REQUEST_BODY_NONCE,
+                                                        requestBody)
+
+        # Cached objects are stored in the clear
+        cacheEnabled = (requestParams.get('s3Cache', False) and s3Bucket
+                        and cipher is None)
+        upstreamResponse = None
+        if cacheEnabled:
+            with timer.phase('cache'):
+                cacheEntry, upstreamResponse = open_cached_request(
+                    s3Bucket.name, method, url, requestHeaders, requestBody)
+            if cacheEntry is not None:
+                send_cached_response(task, cacheEntry, responseQueue,
+                                     s3Bucket)
+                return
+
+        if upstreamResponse is not None:
+            with upstreamResponse:
+                response = read_proxy_response(upstreamResponse,
+                                               gzipResult=True, timer=timer)
+        else:
+            response = proxy_single_request(method, url, requestHeaders,
+                                            requestBody, gzipResult=True,
+                                            timer=timer)
+        cacheKey = None
+        if cacheEnabled:
+            with timer.phase('cache put'):
+                cacheKey = put_cache_entry(s3Bucket.name, method, url,
+                                           requestHeaders, requestBody,
+                                           response)
+        # Sending the response is timed by the client
+        timing = timer.to_dict() if requestParams.get('trace') else None
+        send_response_to_message(task, response, responseQueue, s3Bucket,
+                                 requestParams.get('transports'),
+                                 cacheKey=cacheKey, cipher=cipher,
+                                 timing=timing)
     except Exception as e:
         print traceback.format_exc(e)
     finally:
         queuedRequestsSemaphore.release()
 
 
+def connect_worker_channel(workerServer, workerId, workerSecret):
+    host, port = workerServer.split(':')
+    sock = connect_stream_server(host, int(port), '%s%d/%s' % (
+        WORKER_CHANNEL_PATH, workerId, workerSecret))
+    return MessageChannel(sock)
+
+
+def serve_worker_channel(channel, context, s3Bucket):
+    """Handle requests pushed over the channel until it is drained"""
+    numRequestsProxied = 0
+    queuedRequestsSemaphore = Semaphore(MAX_QUEUED_REQUESTS)
+
+    exitReason = None
+    while True:
+        if exitReason is None:
+            millisRemaining = context.get_remaining_time_in_millis()
+            if millisRemaining < MIN_MILLIS_REMAINING:
+                exitReason = 'Remaining time low: %d' % millisRemaining
+            elif not channel.poll(MAX_CHANNEL_IDLE_SECONDS):
+                exitReason = 'Idle timeout reached'
+            if exitReason is not None:
+                # The server replies once it stops pushing requests to us
+                if DEBUG: print 'Draining channel:', exitReason
+                channel.send_control(DRAIN_CONTROL)
+
+        queuedRequestsSemaphore.acquire()
+        message = channel.receive_message()
+        if message is None or message.control == DRAINED_CONTROL:
+            queuedRequestsSemaphore.release()
+            if exitReason is None:
+                exitReason = 'Channel closed by server'
+            break
+
+        pool.submit(process_single_message, message, channel, s3Bucket,
+                    queuedRequestsSemaphore)
+        numRequestsProxied += 1
+
+    # Wait for any straggling requests
+    for _ in xrange(MAX_QUEUED_REQUESTS):
+        queuedRequestsSemaphore.acquire()
+    channel.close()
+    return numRequestsProxied, exitReason
+
+
 def long_lived_handler(event, context):
     """"Handle multiple requests using SQS as a task queue"""
     startTime = time.time()
@@ -158,6 +317,12 @@ def long_lived_handler(event, context):
     requestQueueName = event['taskQueue']
     responseQueueName = event['resultQueue']
     s3BucketName = event.get('s3Bucket', None)
+    workerServer = event.get('workerServer', None)
+    workerSecret = event.get('workerSecret', '')
+
+    if 'key' in event:
+        # Unwrap the client's session key before any tasks arrive
+        unwrap_session_key(b64decode(event['key']))
 
     if DEBUG:
         print 'Running long-lived as: worker', workerId
@@ -170,6 +335,25 @@ def long_lived_handler(event, context):
         if DEBUG:
             print 'Serving large responses from s3:', s3BucketName
 
+    if workerServer is not None:
+        try:
+            channel = connect_worker_channel(workerServer, workerId,
+                                             workerSecret)
+        except Exception as e:
+            # Fall back to polling SQS
+            print 'Failed to connect to %s: %s' % (workerServer, e)
+            channel = None
+        if channel is not None:
+            if DEBUG: print 'Receiving requests from:', workerServer
+            numRequestsProxied, exitReason = serve_worker_channel(
+                channel, context, s3Bucket)
+            return {
+                'workerId': workerId,
+                'workerLifetime': int((time.time() - startTime) * 1000),
+                'numRequestsProxied': numRequestsProxied,
+                'exitReason': exitReason
+            }
+
     requestQueue = sqs.get_queue_by_name(QueueName=requestQueueName)
     responseQueue = sqs.get_queue_by_name(QueueName=responseQueueName)
 
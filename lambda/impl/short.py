@@ -2,61 +2,163 @@ import boto3
 import hashlib
 import json
 import os
+import time
 
 from base64 import b64encode, b64decode
-from Crypto.PublicKey import RSA
-from Crypto.Cipher import PKCS1_OAEP
-from requests import post
+from collections import deque
+from requests import get, post
 
+from impl.cache import open_cached_request, put_cache_entry, \
+    read_cache_entry, will_cache_response
+from impl.keys import unwrap_key, unwrap_session_key
 from shared.crypto import REQUEST_META_NONCE, RESPONSE_META_NONCE, \
     REQUEST_BODY_NONCE, RESPONSE_BODY_NONCE, \
-    decrypt_with_gcm, encrypt_with_gcm, PRIVATE_KEY_ENV_VAR
-from shared.proxy import proxy_single_request, MAX_LAMBDA_BODY_SIZE
+    RequestCipher, get_framed_length
+from shared.proxy import open_single_request, read_proxy_response, \
+    get_content_length, get_streamed_response_headers, iter_raw_content, \
+    MAX_LAMBDA_BODY_SIZE, STREAM_CHUNK_SIZE
+from shared.timing import NULL_TIMER, TIMING_KEY, PhaseTimer
+from shared.transport import MESSAGE_TRANSPORT, S3_TRANSPORT, \
+    choose_transport
 
 DEBUG = os.environ.get('VERBOSE', False)
 
 
 S3_RESOURCE = boto3.resource('s3')
 
-rsaPrivKey = os.environ.get(PRIVATE_KEY_ENV_VAR, None)
-RSA_CIPHER = None
-if rsaPrivKey is not None:
-    RSA_CIPHER = PKCS1_OAEP.new(RSA.importKey(rsaPrivKey.decode('hex')))
-
 
 def decrypt_encrypted_metadata(event):
     encryptedKey = b64decode(event['key'])
     ciphertext = b64decode(event['meta64'])
     tag = b64decode(event['metaTag'])
 
-    sessionKey = RSA_CIPHER.decrypt(encryptedKey)
+    if 'nonce' in event:
+        # The key is reused by the client for many requests
+        cipher = RequestCipher(unwrap_session_key(encryptedKey),
+                               b64decode(event['nonce']))
+    else:
+        cipher = RequestCipher(unwrap_key(encryptedKey))
+
+    cleartext = cipher.decrypt(REQUEST_META_NONCE, ciphertext, tag)
+    return cipher, json.loads(cleartext)
 
-    cleartext = decrypt_with_gcm(sessionKey, ciphertext, tag,
-                                 REQUEST_META_NONCE)
-    return sessionKey, json.loads(cleartext)
 
+def decrypt_request_body(event, tagName, bodyData, cipher):
+    """Bodies with a tag were encrypted as a whole by older clients"""
+    if tagName in event:
+        tag = b64decode(event[tagName])
+        return cipher.decrypt(REQUEST_BODY_NONCE, bodyData, tag)
+    return cipher.decrypt_framed(REQUEST_BODY_NONCE, bodyData)
 
-def decrypt_encrypted_body(event, sessionKey, s3BucketName):
+
+def decrypt_encrypted_body(event, cipher, s3BucketName,
+                           messageServerHostAndPort):
     if 'body64' in event:
         bodyData = b64decode(event['body64'])
-        if sessionKey is not None:
-            tag = b64decode(event['bodyTag'])
-            requestBody = decrypt_with_gcm(sessionKey, bodyData, tag,
-                                           REQUEST_BODY_NONCE)
+        if cipher is not None:
+            requestBody = decrypt_request_body(event, 'bodyTag', bodyData,
+                                               cipher)
         else:
             requestBody = bodyData
     elif 's3Key' in event:
         assert s3BucketName is not None
         requestBody = get_request_body_from_s3(s3BucketName, event['s3Key'])
-        if sessionKey is not None:
-            tag = b64decode(event['s3Tag'])
-            requestBody = decrypt_with_gcm(sessionKey, requestBody, tag,
-                                           REQUEST_BODY_NONCE)
+        if cipher is not None:
+            requestBody = decrypt_request_body(event, 's3Tag', requestBody,
+                                               cipher)
+    elif 'bodyMessageId' in event:
+        assert messageServerHostAndPort is not None
+        requestBody = get_request_body_from_server(messageServerHostAndPort,
+                                                   event['bodyMessageId'])
+        if cipher is not None:
+            if 'bodyMessageTag' in event:
+                requestBody = decrypt_request_body(
+                    event, 'bodyMessageTag', requestBody.read(), cipher)
+            else:
+                requestBody = DecryptedRequestBody(requestBody, cipher)
     else:
         requestBody = None
     return requestBody
 
 
+class ServerRequestBody(object):
+    """
+    A request body that is read from the message server while it is being
+    sent upstream. The length lets requests send it with Content-Length.
+    """
+
+    def __init__(self, response):
+        self.__response = response
+        self.__length = int(response.headers['Content-Length'])
+
+    def __len__(self):
+        return self.__length
+
+    def read(self, size=-1):
+        data = self.__response.raw.read(None if size < 0 else size)
+        if not data:
+            self.__response.close()
+        return data
+
+
+class DecryptedRequestBody(object):
+    """Decrypts a framed request body while it is being sent upstream"""
+
+    def __init__(self, framedBody, cipher):
+        self.__framedBody = framedBody
+        self.__decryptor = cipher.decryptor(REQUEST_BODY_NONCE)
+        self.__length = get_framed_length(len(framedBody))
+        # Decrypted chunks, and the offset that is read up to in the first
+        self.__chunks = deque()
+        self.__offset = 0
+        self.__bufferLength = 0
+        self.__done = False
+
+    def __len__(self):
+        return self.__length
+
+    def __fill(self, size):
+        while not self.__done and (size < 0 or self.__bufferLength < size):
+            data = self.__framedBody.read(STREAM_CHUNK_SIZE)
+            if not data:
+                self.__decryptor.finish()
+                self.__done = True
+                break
+            cleartext = self.__decryptor.update(data)
+            if cleartext:
+                self.__chunks.append(cleartext)
+                self.__bufferLength += len(cleartext)
+
+    def read(self, size=-1):
+        self.__fill(size)
+        if size < 0 or size > self.__bufferLength:
+            size = self.__bufferLength
+        parts = []
+        remaining = size
+        while remaining > 0:
+            chunk = self.__chunks[0]
+            end = min(self.__offset + remaining, len(chunk))
+            parts.append(chunk[self.__offset:end])
+            remaining -= end - self.__offset
+            if end == len(chunk):
+                self.__chunks.popleft()
+                self.__offset = 0
+            else:
+                self.__offset = end
+        self.__bufferLength -= size
+        return b''.join(parts)
+
+
+def get_request_body_from_server(messageServerHostAndPort, messageId):
+    response = get('http://%s/%s' % (messageServerHostAndPort, messageId),
+                   stream=True)
+    if response.status_code != 200:
+        response.close()
+        raise IOError('Failed to get message from server: %s' %
+                      messageServerHostAndPort)
+    return ServerRequestBody(response)
+
+
 def get_request_body_from_s3(bucketName, key):
     s3Object = S3_RESOURCE.Object(Bucket=bucketName, Key=key)
     return s3Object.get()['Body'].read()
@@ -87,51 +189,130 @@ def post_message_to_server(messageServerHostAndPort, messageData):
     return messageId
 
 
-def encrypt_response_metadata(metadata, sessionKey):
-    ciphertext, tag = encrypt_with_gcm(sessionKey, json.dumps(metadata),
-                                       RESPONSE_META_NONCE)
+def stream_response_to_server(messageServerHostAndPort, messageId,
+                              response, cipher=None):
+    """Post the response to the server while it is being downloaded"""
+    metadata = {
+        'statusCode': response.status_code,
+        'headers': get_streamed_response_headers(response)
+    }
+    content = iter_raw_content(response)
+    if cipher is not None:
+        metadata = encrypt_response_metadata(metadata, cipher)
+        content = cipher.encrypt_frames(RESPONSE_BODY_NONCE, content)
+
+    def generate_message():
+        yield json.dumps(metadata) + '\n'
+        for chunk in content:
+            yield chunk
+
+    # Sent with chunked transfer encoding
+    serverResponse = post('http://%s/%s' % (messageServerHostAndPort,
+                                            messageId),
+                          headers={'Content-Type': 'application/binary'},
+                          data=generate_message())
+    if serverResponse.status_code != 204:
+        raise IOError('Failed to stream message to server: %s' %
+                      messageServerHostAndPort)
+    return metadata
+
+
+def encrypt_response_metadata(metadata, cipher):
+    ciphertext, tag = cipher.encrypt(RESPONSE_META_NONCE, json.dumps(metadata))
     return {'meta64': b64encode(ciphertext), 'metaTag': b64encode(tag)}
 
 
-def prepare_response_content(content, sessionKey, s3BucketName,
-                             messageServerHostAndPort):
+def choose_large_body_transport(size, s3BucketName,
+                                messageServerHostAndPort, transports):
+    """Return the transport for a body that cannot be returned inline"""
+    candidates = []
+    if s3BucketName is not None:
+        candidates.append(S3_TRANSPORT)
+    if messageServerHostAndPort is not None:
+        candidates.append(MESSAGE_TRANSPORT)
+    return choose_transport(size, candidates, transports)
+
+
+def encrypt_response_body(content, cipher, framed, tagName, ret):
+    """Older clients expect the body to be encrypted as a whole"""
+    if framed:
+        return cipher.encrypt_framed(RESPONSE_BODY_NONCE, content)
+    data, tag = cipher.encrypt(RESPONSE_BODY_NONCE, content)
+    ret[tagName] = b64encode(tag)
+    return data
+
+
+def prepare_response_content(content, cipher, s3BucketName,
+                             messageServerHostAndPort, transports=None,
+                             framed=False, timer=NULL_TIMER):
     ret = {}
-    if s3BucketName is not None and len(content) >= MAX_LAMBDA_BODY_SIZE:
-        if sessionKey is None:
+    transport = None
+    if len(content) >= MAX_LAMBDA_BODY_SIZE:
+        transport = choose_large_body_transport(len(content), s3BucketName,
+                                                messageServerHostAndPort,
+                                                transports)
+    if transport == S3_TRANSPORT:
+        if cipher is None:
             s3Data = content
         else:
-            s3Data, tag = encrypt_with_gcm(sessionKey, content,
-                                           RESPONSE_BODY_NONCE)
-            ret['s3Tag'] = b64encode(tag)
-        ret['s3Key'] = put_response_body_in_s3(s3BucketName, s3Data)
-    elif messageServerHostAndPort is not None \
-            and len(content) >= MAX_LAMBDA_BODY_SIZE:
-        if sessionKey is None:
+            with timer.phase('encrypt'):
+                s3Data = encrypt_response_body(content, cipher, framed,
+                                               's3Tag', ret)
+        putStartTime = time.time()
+        with timer.phase('s3 put'):
+            ret['s3Key'] = put_response_body_in_s3(s3BucketName, s3Data)
+        # The client counts the upload in its estimate of the transport
+        ret['s3PutMillis'] = int((time.time() - putStartTime) * 1000)
+    elif transport == MESSAGE_TRANSPORT:
+        if cipher is None:
             messageData = content
         else:
-            messageData, tag = encrypt_with_gcm(sessionKey, content,
-                                                RESPONSE_BODY_NONCE)
-            ret['messageTag'] = b64encode(tag)
-        ret['messageId'] = post_message_to_server(messageServerHostAndPort,
-                                                  messageData)
+            with timer.phase('encrypt'):
+                messageData = encrypt_response_body(content, cipher, framed,
+                                                    'messageTag', ret)
+        with timer.phase('message post'):
+            ret['messageId'] = post_message_to_server(
+                messageServerHostAndPort, messageData)
     else:
-        if sessionKey is not None:
-            data, tag = encrypt_with_gcm(sessionKey,
-                                         content,
-                                         RESPONSE_BODY_NONCE)
-            ret['contentTag'] = b64encode(tag)
+        if cipher is not None:
+            with timer.phase('encrypt'):
+                data = encrypt_response_body(content, cipher, framed,
+                                             'contentTag', ret)
             ret['content64'] = b64encode(data)
         else:
             ret['content64'] = b64encode(content)
     return ret
 
 
+def prepare_cached_response(entry, s3BucketName):
+    """Large cached bodies are read by the client from the cache itself"""
+    ret = {
+        'statusCode': entry.statusCode,
+        'headers': entry.headers
+    }
+    if entry.size >= MAX_LAMBDA_BODY_SIZE:
+        ret['s3Key'] = entry.key
+        ret['s3Cached'] = True
+    elif entry.size > 0:
+        ret['content64'] = b64encode(read_cache_entry(s3BucketName, entry))
+    return ret
+
+
 def short_lived_handler(event, context):
     """Handle a single request and return it immediately"""
+    timer = PhaseTimer()
+    ret = handle_single_request(event, timer)
+    if event.get('trace', False):
+        ret[TIMING_KEY] = timer.to_dict()
+    return ret
+
+
+def handle_single_request(event, timer):
     if 'key' in event:
-        sessionKey, requestMeta = decrypt_encrypted_metadata(event)
+        with timer.phase('decrypt'):
+            cipher, requestMeta = decrypt_encrypted_metadata(event)
     else:
-        sessionKey, requestMeta = None, event
+        cipher, requestMeta = None, event
 
     # Unpack request metadata
     method = requestMeta['method']
@@ -140,20 +321,73 @@ def short_lived_handler(event, context):
     s3BucketName = requestMeta.get('s3Bucket', None)
     messageServerHostAndPort = requestMeta.get('messageServer', None)
 
+    streamMessageId = requestMeta.get('streamMessageId', None)
+    transports = requestMeta.get('transports', None)
+
+    # Encrypted bodies can be streamed if the client understands frames
+    framed = cipher is not None and requestMeta.get('framedBodies', False)
+
+    # Cached objects are stored in the clear, so encrypted requests skip it
+    cacheEnabled = (requestMeta.get('s3Cache', False)
+                    and s3BucketName is not None and cipher is None)
+
     # Unpack request body
-    requestBody = decrypt_encrypted_body(event, sessionKey, s3BucketName)
-    response = proxy_single_request(method, url, requestHeaders,
-                                    requestBody, gzipResult=True)
+    with timer.phase('request body'):
+        requestBody = decrypt_encrypted_body(event, cipher, s3BucketName,
+                                             messageServerHostAndPort)
+    upstreamResponse = None
+    if cacheEnabled:
+        with timer.phase('cache'):
+            cacheEntry, upstreamResponse = open_cached_request(
+                s3BucketName, method, url, requestHeaders, requestBody)
+        if cacheEntry is not None:
+            with timer.phase('cache read'):
+                return prepare_cached_response(cacheEntry, s3BucketName)
+    if upstreamResponse is None:
+        with timer.phase('fetch'):
+            upstreamResponse = open_single_request(method, url,
+                                                   requestHeaders, requestBody)
+    with upstreamResponse:
+        contentLength = get_content_length(upstreamResponse)
+        if (streamMessageId is not None
+                and (cipher is None or framed)
+                and not (cacheEnabled and will_cache_response(
+                    method, requestHeaders, requestBody, upstreamResponse))
+                and contentLength is not None
+                and contentLength >= MAX_LAMBDA_BODY_SIZE
+                and choose_large_body_transport(
+                    contentLength, s3BucketName, messageServerHostAndPort,
+                    transports) == MESSAGE_TRANSPORT):
+            with timer.phase('stream'):
+                ret = stream_response_to_server(messageServerHostAndPort,
+                                                streamMessageId,
+                                                upstreamResponse, cipher)
+            ret['streamed'] = True
+            return ret
+        response = read_proxy_response(upstreamResponse, gzipResult=True,
+                                       timer=timer)
+
     ret = {
         'statusCode': response.statusCode,
         'headers': response.headers
     }
 
-    if sessionKey is not None:
-        ret = encrypt_response_metadata(ret, sessionKey)
+    if cipher is not None:
+        ret = encrypt_response_metadata(ret, cipher)
+
+    cacheKey = None
+    if cacheEnabled:
+        with timer.phase('cache put'):
+            cacheKey = put_cache_entry(s3BucketName, method, url,
+                                       requestHeaders, requestBody, response)
 
-    if response.content:
-        ret.update(prepare_response_content(response.content, sessionKey,
+    if cacheKey is not None and len(response.content) >= MAX_LAMBDA_BODY_SIZE:
+        # The body is already in s3
+        ret['s3Key'] = cacheKey
+        ret['s3Cached'] = True
+    elif response.content:
+        ret.update(prepare_response_content(response.content, cipher,
                                             s3BucketName,
-                                            messageServerHostAndPort))
+                                            messageServerHostAndPort,
+                                            transports, framed, timer))
     return ret
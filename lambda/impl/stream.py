@@ -6,7 +6,9 @@ from Crypto.PublicKey import RSA
 from Crypto.Cipher import PKCS1_OAEP
 
 from shared.crypto import PRIVATE_KEY_ENV_VAR
+from shared.http import read_head_unbuffered
 from shared.proxy import proxy_sockets
+from shared.timing import TIMING_KEY, PhaseTimer
 
 DEBUG = os.environ.get('VERBOSE', False)
 
@@ -19,24 +21,12 @@ if rsaPrivKey is not None:
 ASYNC_EXECUTORS = ThreadPoolExecutor()
 
 
-def receive_stream_connection_headers(sock):
-    data = []
-    while True:
-        b = sock.recv(1)
-        if b == b'':
-            raise IOError('Could not parse response')
-        data.append(b)
-        if ''.join(data[-4:]) == '\r\n\r\n':
-            headers = ''.join(data[:len(data) - 4]).splitlines()
-            return headers
-
-
 def connect_stream_server(host, port, socketId):
     sock = create_connection((host, port))
     sock.sendall('CONNECT /%s HTTP/1.1\r\n\r\n' % socketId)
-    headers = receive_stream_connection_headers(sock)
-    _, statusCode, message = headers[0].split(' ', 2)
-    statusCode = int(statusCode)
+    # The tunneled stream starts right after the head
+    head = read_head_unbuffered(sock)
+    _, statusCode, message = head.parse_status_line()
     if statusCode != 200:
         raise IOError('Stream server refused connection (%d): %s' %
                       (statusCode, message))
@@ -45,6 +35,7 @@ def connect_stream_server(host, port, socketId):
 
 def stream_handler(event, context):
     """Handle a single request and return it immediately"""
+    timer = PhaseTimer()
 
     socketId = event['socketId']
     streamServerHost, streamServerPort = event['streamServer'].split(':')
@@ -56,20 +47,25 @@ def stream_handler(event, context):
     externServerFuture = ASYNC_EXECUTORS.submit(
         lambda: create_connection((host, port)))
     try:
-        streamServerSock = connect_stream_server(streamServerHost,
-                                                 streamServerPort,
-                                                 socketId)
-        externServerSock = externServerFuture.result(5)
+        with timer.phase('connect'):
+            streamServerSock = connect_stream_server(streamServerHost,
+                                                     streamServerPort,
+                                                     socketId)
+            externServerSock = externServerFuture.result(5)
     except:
         externServerFuture.cancel()
         raise
 
     # TODO: gracefully handle lambda out of time
     try:
-        proxy_sockets(externServerSock, streamServerSock, idleTimeout)
+        with timer.phase('proxy'):
+            proxy_sockets(externServerSock, streamServerSock, idleTimeout)
     except:
         pass
     finally:
         externServerSock.close()
         streamServerSock.close()
-    return {'status': 'OK'}
+    ret = {'status': 'OK'}
+    if event.get('trace', False):
+        ret[TIMING_KEY] = timer.to_dict()
+    return ret
@@ -0,0 +1,102 @@
+"""
+Clients for the AWS services used by the proxies. They come from boto3,
+unless a backend such as lib.local_aws.LocalAwsBackend is set, so that the
+proxies can run without AWS.
+
+boto3 is only imported when the first client is made, since it takes a
+while to load. Proxies that make their clients with deferred_client can
+start listening in the meantime.
+"""
+
+import logging
+
+from threading import Event, Lock, Thread
+
+logger = logging.getLogger(__name__)
+
+_backend = None
+
+_boto3 = None
+_boto3Lock = Lock()
+
+
+def set_backend(backend):
+    """Serve clients and resources from the backend, or boto3 if None"""
+    global _backend
+    _backend = backend
+
+
+def get_backend():
+    return _backend
+
+
+def _get_boto3():
+    global _boto3
+    with _boto3Lock:
+        if _boto3 is None:
+            try:
+                import boto3
+            except ImportError:
+                logger.error('Failed to import boto3')
+                raise
+            _boto3 = boto3
+        return _boto3
+
+
+def client(service, **kwargs):
+    if _backend is not None:
+        return _backend.client(service, **kwargs)
+    boto3 = _get_boto3()
+    # The default session is not safe to make clients from concurrently
+    with _boto3Lock:
+        return boto3.client(service, **kwargs)
+
+
+def resource(service, **kwargs):
+    if _backend is not None:
+        return _backend.resource(service, **kwargs)
+    boto3 = _get_boto3()
+    with _boto3Lock:
+        return boto3.resource(service, **kwargs)
+
+
+class DeferredClient(object):
+    """
+    A client or resource that is made on a background thread. Using it
+    waits until it exists, and raises if it could not be made.
+    """
+
+    def __init__(self, factory, service, kwargs):
+        self.__ready = Event()
+        self.__value = None
+        self.__error = None
+        thread = Thread(target=self.__create,
+                        args=(factory, service, kwargs))
+        thread.daemon = True
+        thread.start()
+
+    def __create(self, factory, service, kwargs):
+        try:
+            self.__value = factory(service, **kwargs)
+        except Exception as e:
+            logger.exception('Failed to make a %s client', service)
+            self.__error = e
+        finally:
+            self.__ready.set()
+
+    def get(self):
+        self.__ready.wait()
+        if self.__error is not None:
+            raise self.__error
+        return self.__value
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+
+def deferred_client(service, **kwargs):
+    return DeferredClient(client, service, kwargs)
+
+
+def deferred_resource(service, **kwargs):
+    return DeferredClient(resource, service, kwargs)
@@ -0,0 +1,222 @@
+"""
+Records the traffic through the proxy to a JSONL trace: the metadata of each
+request, how long it took and the size and shape of its response. Tunnels
+from CONNECT are recorded with the bytes sent each way. The trace can be
+replayed against a synthetic origin with lib/replay.py.
+"""
+
+import json
+import logging
+import time
+
+from threading import Lock
+
+from lib.proxy import AbstractRequestProxy, AbstractStreamProxy, \
+    ProxyResponse, StreamedContent
+
+logger = logging.getLogger(__name__)
+
+# Values of these are replaced by as many x's, to keep only their size
+REDACTED_HEADERS = {'authorization', 'cookie', 'proxy-authorization',
+                    'set-cookie'}
+
+
+def _to_text(value):
+    if isinstance(value, unicode):
+        return value
+    return str(value).decode('utf-8', 'replace')
+
+
+def _get_recorded_headers(headers):
+    recorded = {}
+    for header, value in headers.iteritems():
+        value = _to_text(value)
+        if header.lower() in REDACTED_HEADERS:
+            value = 'x' * len(value)
+        recorded[_to_text(header)] = value
+    return recorded
+
+
+def read_traffic_trace(fileName):
+    """Return the entries of a trace, in the order that they started"""
+    entries = []
+    with open(fileName) as ifs:
+        for line in ifs:
+            line = line.strip()
+            if line:
+                entries.append(json.loads(line))
+    entries.sort(key=lambda x: x['startMillis'])
+    return entries
+
+
+class TrafficRecorder(object):
+    """Appends an entry for each request to a JSONL file"""
+
+    def __init__(self, fileName):
+        self.__ofs = open(fileName, 'w')
+        self.__lock = Lock()
+        self.__startTime = time.time()
+        self.numRecorded = 0
+
+    def record(self, startTime, entry):
+        entry['startMillis'] = (startTime - self.__startTime) * 1000.0
+        line = json.dumps(entry)
+        with self.__lock:
+            if self.__ofs.closed:
+                return
+            self.__ofs.write(line + '\n')
+            self.__ofs.flush()
+            self.numRecorded += 1
+
+    def close(self):
+        with self.__lock:
+            self.__ofs.close()
+
+
+class _RecordedContent(StreamedContent):
+    """Counts the bytes of a streamed body, and records it once closed"""
+
+    def __init__(self, content, recorder, startTime, entry):
+        self.__content = content
+        self.__recorder = recorder
+        self.__startTime = startTime
+        self.__entry = entry
+        self.__bytesRead = 0
+        self.__recorded = False
+
+    def __iter__(self):
+        for chunk in self.__content:
+            self.__bytesRead += len(chunk)
+            yield chunk
+
+    def close(self):
+        self.__content.close()
+        if not self.__recorded:
+            self.__recorded = True
+            self.__entry['responseBytes'] = self.__bytesRead
+            self.__entry['durationMillis'] = \
+                (time.time() - self.__startTime) * 1000.0
+            self.__recorder.record(self.__startTime, self.__entry)
+
+
+class RecordingRequestProxy(AbstractRequestProxy):
+
+    def __init__(self, requestProxy, recorder):
+        self.__requestProxy = requestProxy
+        self.__recorder = recorder
+
+    def request(self, method, url, headers, body):
+        startTime = time.time()
+        entry = {
+            'method': method,
+            'url': _to_text(url),
+            'requestHeaders': _get_recorded_headers(headers),
+            'requestBytes': len(body) if body else 0,
+        }
+        try:
+            response = self.__requestProxy.request(method, url, headers,
+                                                   body)
+        except Exception as e:
+            entry['error'] = type(e).__name__
+            entry['durationMillis'] = (time.time() - startTime) * 1000.0
+            self.__recorder.record(startTime, entry)
+            raise
+
+        entry['statusCode'] = response.statusCode
+        entry['responseHeaders'] = _get_recorded_headers(response.headers)
+        # Until the status and headers are known
+        entry['waitMillis'] = (time.time() - startTime) * 1000.0
+        content = response.content
+        if isinstance(content, StreamedContent):
+            entry['streamed'] = True
+            return ProxyResponse(
+                statusCode=response.statusCode, headers=response.headers,
+                content=_RecordedContent(content, self.__recorder, startTime,
+                                         entry))
+        entry['responseBytes'] = len(content) if content else 0
+        entry['durationMillis'] = entry['waitMillis']
+        self.__recorder.record(startTime, entry)
+        return response
+
+
+class _CountingSocket(object):
+    """A client socket that counts the bytes received and sent"""
+
+    def __init__(self, sock):
+        self.__sock = sock
+        self.bytesUp = 0
+        self.bytesDown = 0
+
+    def __getattr__(self, name):
+        return getattr(self.__sock, name)
+
+    def recv(self, *args):
+        data = self.__sock.recv(*args)
+        self.bytesUp += len(data)
+        return data
+
+    def send(self, data, *args):
+        numBytes = self.__sock.send(data, *args)
+        self.bytesDown += numBytes
+        return numBytes
+
+    def sendall(self, data, *args):
+        self.__sock.sendall(data, *args)
+        self.bytesDown += len(data)
+
+
+class RecordingStreamProxy(AbstractStreamProxy):
+    """
+    Records each tunnel. It should not wrap the MITM proxy, since the
+    requests in its tunnels are recorded by the request proxy.
+    """
+
+    class Connection(AbstractStreamProxy.Connection):
+
+        def __init__(self, conn, host, port):
+            self.conn = conn
+            self.hostAndPort = '%s:%s' % (host, port)
+
+        def close(self):
+            self.conn.close()
+
+    def __init__(self, streamProxy, recorder):
+        self.__streamProxy = streamProxy
+        self.__recorder = recorder
+
+    def connect(self, host, port):
+        return RecordingStreamProxy.Connection(
+            self.__streamProxy.connect(host, port), host, port)
+
+    def stream(self, cliSock, servConn):
+        assert isinstance(servConn, RecordingStreamProxy.Connection)
+        startTime = time.time()
+        countingSock = _CountingSocket(cliSock)
+        entry = {
+            'method': 'CONNECT',
+            'url': _to_text(servConn.hostAndPort),
+        }
+        try:
+            return self.__streamProxy.stream(countingSock, servConn.conn)
+        except Exception as e:
+            entry['error'] = type(e).__name__
+            raise
+        finally:
+            entry['requestBytes'] = countingSock.bytesUp
+            entry['responseBytes'] = countingSock.bytesDown
+            entry['durationMillis'] = (time.time() - startTime) * 1000.0
+            self.__recorder.record(startTime, entry)
+
+
+def record_requests(requestProxy, recorder):
+    """Wrap the proxy if there is a recorder"""
+    if recorder is None:
+        return requestProxy
+    return RecordingRequestProxy(requestProxy, recorder)
+
+
+def record_streams(streamProxy, recorder):
+    """Wrap the proxy if there is a recorder"""
+    if recorder is None:
+        return streamProxy
+    return RecordingStreamProxy(streamProxy, recorder)
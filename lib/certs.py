@@ -0,0 +1,274 @@
+import atexit
+import calendar
+import logging
+import os
+import re
+import shutil
+import ssl
+import tempfile
+import time
+
+from collections import OrderedDict
+from OpenSSL import crypto
+from Queue import Queue, Empty
+from random import SystemRandom
+from threading import Lock, Thread
+
+logger = logging.getLogger(__name__)
+
+LEAF_KEY_BITS = 2048
+DEFAULT_KEY_POOL_SIZE = 4
+DEFAULT_MAX_CONTEXTS = 256
+
+# Leaf certificates are reissued when they are close to expiring
+CERT_LIFETIME = 7 * 24 * 60 * 60
+MIN_CERT_LIFETIME_REMAINING = 60 * 60
+
+# Tolerate some clock skew on the client
+CERT_BACKDATE = 60 * 60
+
+IP_ADDRESS_RE = re.compile(r'^[0-9.]+$|:')
+
+# Names that certificates are issued and saved under. Anything else, such as
+# a host with a '/', is rejected rather than used in a file name.
+CERT_NAME_RE = re.compile(
+    r'^(\*\.)?[a-z0-9_-]+(\.[a-z0-9_-]+)*\.?$|^[0-9a-f:.]+$')
+
+# Second level labels under which a country code TLD sells domains. This is
+# only an approximation of the public suffix list.
+SECOND_LEVEL_SUFFIXES = {'ac', 'co', 'com', 'edu', 'gov', 'net', 'org'}
+
+
+def get_registrable_domain(host):
+    """Approximate the domain that the host was registered under"""
+    labels = host.split('.')
+    if (len(labels) >= 3 and len(labels[-1]) == 2
+            and labels[-2] in SECOND_LEVEL_SUFFIXES):
+        return '.'.join(labels[-3:])
+    return '.'.join(labels[-2:])
+
+
+def get_cert_name(host, wildcard=False):
+    """
+    Return the name of the certificate to use for the host. With wildcard,
+    hosts directly under a registrable domain share a certificate.
+    """
+    if isinstance(host, unicode):
+        # Server names from SNI are decoded
+        host = host.encode('idna')
+    host = host.lower()
+    if not wildcard or IP_ADDRESS_RE.search(host):
+        return host
+    domain = get_registrable_domain(host)
+    if host.count('.') != domain.count('.') + 1:
+        return host
+    return '*.' + domain
+
+
+def is_valid_cert_name(name):
+    return CERT_NAME_RE.match(name) is not None and '..' not in name
+
+
+class KeyPool(object):
+    """Generates leaf keys in the background, ahead of when they are needed"""
+
+    def __init__(self, size=DEFAULT_KEY_POOL_SIZE, bits=LEAF_KEY_BITS):
+        self.__bits = bits
+        self.__keys = Queue(maxsize=size)
+
+        t = Thread(target=self.__generate_daemon)
+        t.daemon = True
+        t.start()
+
+    def __len__(self):
+        return self.__keys.qsize()
+
+    def __generate_key(self):
+        key = crypto.PKey()
+        key.generate_key(crypto.TYPE_RSA, self.__bits)
+        return key
+
+    def __generate_daemon(self):
+        while True:
+            try:
+                self.__keys.put(self.__generate_key())
+            except Exception as e:
+                logger.exception(e)
+
+    def get(self):
+        """Take a key from the pool, or generate one if the pool is empty"""
+        try:
+            return self.__keys.get_nowait()
+        except Empty:
+            logger.debug('Key pool is empty')
+            return self.__generate_key()
+
+
+class CertificateStore(object):
+    """
+    Issues leaf certificates signed by the MITM CA, and caches an SSLContext
+    for each. Certificates are kept in a directory for the CA under certDir
+    so that they outlive the process, and are reissued if they expire or the
+    CA changes.
+    """
+
+    __secureRandom = SystemRandom()
+
+    def __init__(self, caCertFile, caKeyFile, certDir=None, wildcard=False,
+                 maxContexts=DEFAULT_MAX_CONTEXTS, keyPool=None,
+                 alpnProtocols=None):
+        with open(caCertFile) as ifs:
+            self.__caCert = crypto.load_certificate(crypto.FILETYPE_PEM,
+                                                    ifs.read())
+        with open(caKeyFile) as ifs:
+            self.__caKey = crypto.load_privatekey(crypto.FILETYPE_PEM,
+                                                  ifs.read())
+
+        if certDir is None:
+            certDir = tempfile.mkdtemp(suffix='mitmproxy')
+            atexit.register(lambda: shutil.rmtree(certDir))
+        else:
+            # Certificates signed by an earlier CA with the same subject
+            # are in another directory, so they are never served
+            certDir = os.path.join(
+                certDir, self.__caCert.digest('sha256').replace(':', '')[:16])
+            if not os.path.isdir(certDir):
+                os.makedirs(certDir)
+        self.__certDir = certDir
+
+        self.__wildcard = wildcard
+        self.__alpnProtocols = alpnProtocols
+        self.__maxContexts = maxContexts
+        self.__keyPool = keyPool if keyPool is not None else KeyPool()
+
+        # Least recently used contexts come first
+        self.__contexts = OrderedDict()
+        self.__contextsLock = Lock()
+
+        # Only one thread issues the certificate for a name at a time, and
+        # other names are not held up
+        self.__pendingLocks = {}
+
+    @property
+    def certDir(self):
+        return self.__certDir
+
+    def __get_cert_path(self, name):
+        assert is_valid_cert_name(name)
+        return os.path.join(self.__certDir,
+                            name.replace('*', '_wildcard') + '.pem')
+
+    def __is_usable(self, cert):
+        if cert.get_issuer() != self.__caCert.get_subject():
+            return False
+        notAfter = calendar.timegm(time.strptime(cert.get_notAfter(),
+                                                 '%Y%m%d%H%M%SZ'))
+        return notAfter - time.time() > MIN_CERT_LIFETIME_REMAINING
+
+    def __load_cert(self, certPath):
+        """Return True if a usable certificate was saved at the path"""
+        if not os.path.exists(certPath):
+            return False
+        try:
+            with open(certPath) as ifs:
+                cert = crypto.load_certificate(crypto.FILETYPE_PEM,
+                                               ifs.read())
+            return self.__is_usable(cert)
+        except Exception as e:
+            logger.warn('Failed to load %s: %s', certPath, e)
+            return False
+
+    def __sign_cert(self, name, certPath):
+        key = self.__keyPool.get()
+
+        cert = crypto.X509()
+        cert.set_version(2)
+        cert.get_subject().C = 'US'
+        cert.get_subject().ST = 'California'
+        cert.get_subject().L = 'Palo Alto'
+        cert.get_subject().O = 'DIY Project'
+        cert.get_subject().OU = 'Lambda MITM Proxy'
+        cert.get_subject().CN = name
+        altNames = ['DNS:' + name]
+        if name.startswith('*.'):
+            altNames.append('DNS:' + name[2:])
+        elif IP_ADDRESS_RE.search(name):
+            altNames = ['IP:' + name]
+        cert.add_extensions([
+            crypto.X509Extension('subjectAltName', False, ','.join(altNames))
+        ])
+        cert.gmtime_adj_notBefore(-CERT_BACKDATE)
+        cert.gmtime_adj_notAfter(CERT_LIFETIME)
+        cert.set_serial_number(self.__secureRandom.getrandbits(64))
+        cert.set_issuer(self.__caCert.get_subject())
+        cert.set_pubkey(key)
+        cert.sign(self.__caKey, 'sha256')
+
+        # Write the key and certificate together, and rename the file into
+        # place so that a partial file is never loaded
+        fd, tempPath = tempfile.mkstemp(dir=self.__certDir)
+        with os.fdopen(fd, 'wb') as ofs:
+            ofs.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, key))
+            ofs.write(crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
+        os.rename(tempPath, certPath)
+        logger.debug('Issued certificate for %s', name)
+
+    def __create_context(self, name):
+        certPath = self.__get_cert_path(name)
+        if not self.__load_cert(certPath):
+            self.__sign_cert(name, certPath)
+        context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        context.load_cert_chain(certPath)
+        if hasattr(context, 'set_servername_callback'):
+            context.set_servername_callback(self.__on_server_name)
+        if self.__alpnProtocols and ssl.HAS_ALPN:
+            context.set_alpn_protocols(self.__alpnProtocols)
+        return context
+
+    def get_context(self, host):
+        """Return a server side SSLContext with a certificate for the host"""
+        name = get_cert_name(host, self.__wildcard)
+        if not is_valid_cert_name(name):
+            raise ValueError('Invalid host for a certificate: %r' % host)
+        with self.__contextsLock:
+            context = self.__contexts.pop(name, None)
+            if context is not None:
+                self.__contexts[name] = context
+                return context
+            nameLock = self.__pendingLocks.setdefault(name, Lock())
+
+        with nameLock:
+            try:
+                with self.__contextsLock:
+                    context = self.__contexts.get(name)
+                if context is not None:
+                    return context
+                context = self.__create_context(name)
+                with self.__contextsLock:
+                    self.__contexts[name] = context
+                    while len(self.__contexts) > self.__maxContexts:
+                        self.__contexts.popitem(last=False)
+            finally:
+                # Also if issuing failed, so the lock is not kept forever
+                with self.__contextsLock:
+                    self.__pendingLocks.pop(name, None)
+        return context
+
+    def wrap_server_socket(self, sock, host):
+        """
+        Wrap the client's socket, presenting a certificate for the host it
+        sent in CONNECT until the client names another host with SNI.
+        """
+        return self.get_context(host).wrap_socket(sock, server_side=True)
+
+    def __on_server_name(self, sslSock, serverName, context):
+        if serverName is None:
+            return
+        try:
+            sniContext = self.get_context(serverName)
+        except Exception as e:
+            logger.warn('Failed to issue certificate for %s: %s',
+                        serverName, e)
+            return
+        if sniContext is not context:
+            sslSock.context = sniContext
@@ -0,0 +1,388 @@
+import gzip
+import heapq
+import json
+import logging
+import os
+import random
+import time
+import uuid
+
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from httplib import responses
+from robotparser import RobotFileParser
+from threading import Condition, Lock
+from urlparse import urlsplit
+
+from lib.headers import DEFAULT_USER_AGENT
+from lib.proxy import StreamedContent, write_content
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ORIGIN_CONCURRENCY = 4
+DEFAULT_ORIGIN_RATE = 10.0
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_RETRY_BACKOFF = 1.0
+
+# Statuses that are retried, in case the origin recovers
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+ROBOTS_PATH = '/robots.txt'
+
+# Tasks read ahead of the ones running, per concurrent request
+READ_AHEAD_FACTOR = 4
+
+CrawlTask = namedtuple('CrawlTask', [
+    'lineNum', 'url', 'method', 'headers', 'body', 'attempt'
+])
+
+
+def read_crawl_tasks(fileName):
+    """
+    Yield a CrawlTask for each line of a JSONL file. Lines are either a URL
+    string, or an object with a url and optionally a method, headers and
+    body.
+    """
+    with open(fileName) as ifs:
+        for lineNum, line in enumerate(ifs):
+            line = line.strip()
+            if not line:
+                continue
+            entry = json.loads(line)
+            if not isinstance(entry, dict):
+                entry = {'url': entry}
+            body = entry.get('body')
+            yield CrawlTask(lineNum=lineNum, url=str(entry['url']),
+                            method=str(entry.get('method', 'GET')).upper(),
+                            headers=entry.get('headers', {}),
+                            body=body.encode('utf-8') if body else None,
+                            attempt=0)
+
+
+def get_origin(url):
+    parts = urlsplit(url)
+    return '%s://%s' % (parts.scheme.lower(), parts.netloc.lower())
+
+
+class CrawlCheckpoint(object):
+    """
+    Line numbers of the tasks that are done, appended to a file. A record
+    is written before its task is checkpointed, so a resumed crawl may
+    repeat the records of tasks that were in flight, but never skips any.
+    """
+
+    def __init__(self, fileName):
+        self.__done = set()
+        if os.path.exists(fileName):
+            with open(fileName) as ifs:
+                for line in ifs:
+                    line = line.strip()
+                    if line:
+                        self.__done.add(int(line))
+        self.__ofs = open(fileName, 'a')
+        self.__lock = Lock()
+
+    def __len__(self):
+        return len(self.__done)
+
+    def __contains__(self, lineNum):
+        return lineNum in self.__done
+
+    def mark_done(self, lineNum):
+        with self.__lock:
+            self.__done.add(lineNum)
+            self.__ofs.write('%d\n' % lineNum)
+            self.__ofs.flush()
+
+    def close(self):
+        self.__ofs.close()
+
+
+class CrawlRecordWriter(object):
+    """
+    Appends WARC style response records to a file. Each record is a separate
+    gzip member, so records can be read back individually, and a file may be
+    appended to after a restart.
+    """
+
+    def __init__(self, fileName):
+        self.__ofs = open(fileName, 'ab')
+        self.__lock = Lock()
+
+    def write_response(self, task, response, content):
+        statusCode = response.statusCode
+        httpLines = ['HTTP/1.1 %d %s' % (statusCode,
+                                         responses.get(statusCode, ''))]
+        for header, value in response.headers.iteritems():
+            httpLines.append('%s: %s' % (header, value))
+        httpLines.append('')
+        httpLines.append('')
+        block = '\r\n'.join(httpLines) + content
+
+        recordLines = [
+            'WARC/1.0',
+            'WARC-Type: response',
+            'WARC-Record-ID: <urn:uuid:%s>' % uuid.uuid4(),
+            'WARC-Date: %s' % datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'WARC-Target-URI: %s' % task.url,
+            'Content-Type: application/http; msgtype=response',
+            'Content-Length: %d' % len(block),
+            '',
+            ''
+        ]
+        record = '\r\n'.join(recordLines) + block + '\r\n\r\n'
+        with self.__lock:
+            gz = gzip.GzipFile(fileobj=self.__ofs, mode='wb')
+            try:
+                gz.write(record)
+            finally:
+                gz.close()
+            self.__ofs.flush()
+        return len(record)
+
+    def close(self):
+        self.__ofs.close()
+
+
+class RobotsCache(object):
+    """Fetches robots.txt once per origin through the request proxy"""
+
+    def __init__(self, requestProxy, userAgent):
+        self.__requestProxy = requestProxy
+        self.__userAgent = userAgent
+        self.__parsers = {}
+        self.__locks = {}
+        self.__lock = Lock()
+
+    def __fetch(self, origin):
+        parser = RobotFileParser()
+        try:
+            response = self.__requestProxy.request(
+                'GET', origin + ROBOTS_PATH,
+                {'User-Agent': self.__userAgent}, None)
+            content = _read_content(response.content)
+        except Exception as e:
+            logger.warn('Failed to fetch robots.txt for %s: %s', origin, e)
+            parser.allow_all = True
+            return parser
+        if response.statusCode in (401, 403):
+            parser.disallow_all = True
+        elif response.statusCode >= 400:
+            parser.allow_all = True
+        else:
+            parser.parse(content.splitlines())
+        return parser
+
+    def can_fetch(self, url):
+        origin = get_origin(url)
+        with self.__lock:
+            parser = self.__parsers.get(origin)
+            if parser is None:
+                originLock = self.__locks.setdefault(origin, Lock())
+        if parser is None:
+            with originLock:
+                with self.__lock:
+                    parser = self.__parsers.get(origin)
+                if parser is None:
+                    parser = self.__fetch(origin)
+                    with self.__lock:
+                        self.__parsers[origin] = parser
+        return parser.can_fetch(self.__userAgent, url)
+
+
+def _read_content(content):
+    if not isinstance(content, StreamedContent):
+        return str(content) if content else b''
+    chunks = []
+    write_content(chunks.append, content)
+    return b''.join(chunks)
+
+
+class _OriginState(object):
+
+    def __init__(self):
+        self.tasks = deque()
+        self.active = 0
+        self.nextStartTime = 0.0
+
+
+class Crawler(object):
+    """
+    Fetches tasks through a request proxy with up to maxConcurrency requests
+    in flight. Each origin is limited to originConcurrency requests at once,
+    and to starting originRate requests per second. Origins take turns, so
+    one slow origin does not hold up the others.
+    """
+
+    def __init__(self, requestProxy, writer, checkpoint, stats,
+                 maxConcurrency, originConcurrency=DEFAULT_ORIGIN_CONCURRENCY,
+                 originRate=DEFAULT_ORIGIN_RATE,
+                 maxRetries=DEFAULT_MAX_RETRIES,
+                 retryBackoff=DEFAULT_RETRY_BACKOFF,
+                 userAgent=DEFAULT_USER_AGENT, obeyRobots=True):
+        self.__requestProxy = requestProxy
+        self.__writer = writer
+        self.__checkpoint = checkpoint
+        self.__crawlModel = stats.get_model('crawl')
+        self.__tracer = stats.tracer
+        self.__maxConcurrency = maxConcurrency
+        self.__originConcurrency = originConcurrency
+        self.__originInterval = 1.0 / originRate if originRate > 0 else 0.0
+        self.__maxRetries = maxRetries
+        self.__retryBackoff = retryBackoff
+        self.__userAgent = userAgent
+        self.__robots = RobotsCache(requestProxy, userAgent) \
+            if obeyRobots else None
+
+        self.__pool = ThreadPoolExecutor(maxConcurrency)
+        self.__cond = Condition(Lock())
+        self.__origins = OrderedDict()
+        self.__retries = []
+        self.__numQueued = 0
+        self.__numActive = 0
+
+        stats.register_gauge('crawl_tasks_queued',
+                             lambda: self.__numQueued,
+                             'Crawl tasks read and waiting to start')
+        stats.register_gauge('crawl_tasks_active',
+                             lambda: self.__numActive,
+                             'Crawl requests in flight')
+        stats.register_gauge('crawl_retries_pending',
+                             lambda: len(self.__retries),
+                             'Crawl tasks waiting to be retried')
+
+    def __queue_task(self, task):
+        origin = get_origin(task.url)
+        state = self.__origins.get(origin)
+        if state is None:
+            state = _OriginState()
+            self.__origins[origin] = state
+        state.tasks.append(task)
+        self.__numQueued += 1
+
+    def __next_task(self, now):
+        """Return (task, None), or (None, seconds until one may start)"""
+        wait = None
+        for origin in self.__origins.keys():
+            state = self.__origins[origin]
+            if not state.tasks:
+                if state.active == 0:
+                    del self.__origins[origin]
+                continue
+            if state.active >= self.__originConcurrency:
+                continue
+            if state.nextStartTime > now:
+                delay = state.nextStartTime - now
+                wait = delay if wait is None else min(wait, delay)
+                continue
+            task = state.tasks.popleft()
+            state.active += 1
+            state.nextStartTime = now + self.__originInterval
+            self.__numQueued -= 1
+            # Rotate the origin to the back
+            del self.__origins[origin]
+            self.__origins[origin] = state
+            return task, None
+        return None, wait
+
+    def run(self, tasks):
+        """Crawl the tasks, skipping those already in the checkpoint"""
+        tasks = iter(tasks)
+        inputDone = False
+        readAhead = self.__maxConcurrency * READ_AHEAD_FACTOR
+        with self.__cond:
+            while True:
+                while not inputDone and self.__numQueued < readAhead:
+                    task = next(tasks, None)
+                    if task is None:
+                        inputDone = True
+                    elif task.lineNum in self.__checkpoint:
+                        self.__crawlModel.record_resumed()
+                    else:
+                        self.__queue_task(task)
+
+                now = time.time()
+                while self.__retries and self.__retries[0][0] <= now:
+                    _, task = heapq.heappop(self.__retries)
+                    self.__queue_task(task)
+
+                wait = None
+                if self.__numActive < self.__maxConcurrency:
+                    task, wait = self.__next_task(now)
+                    if task is not None:
+                        self.__numActive += 1
+                        self.__pool.submit(self.__run_task, task)
+                        continue
+
+                if (inputDone and self.__numQueued == 0
+                        and self.__numActive == 0 and not self.__retries):
+                    break
+                if self.__retries:
+                    retryWait = self.__retries[0][0] - now
+                    wait = retryWait if wait is None else min(wait, retryWait)
+                # Finished tasks notify the condition
+                self.__cond.wait(wait)
+        self.__pool.shutdown()
+
+    def __run_task(self, task):
+        retry = False
+        try:
+            retry = not self.__fetch(task)
+        except Exception as e:
+            logger.exception(e)
+        finally:
+            with self.__cond:
+                self.__origins[get_origin(task.url)].active -= 1
+                self.__numActive -= 1
+                if retry:
+                    backoff = self.__retryBackoff * (2 ** task.attempt)
+                    readyTime = time.time() + random.uniform(0.5, 1.0) * backoff
+                    heapq.heappush(self.__retries,
+                                   (readyTime,
+                                    task._replace(attempt=task.attempt + 1)))
+                self.__cond.notify()
+
+    def __request(self, task, headers):
+        response = self.__requestProxy.request(task.method, task.url,
+                                               headers, task.body)
+        return response, _read_content(response.content)
+
+    def __fetch(self, task):
+        """Returns False if the task should be retried"""
+        if self.__robots is not None and not self.__robots.can_fetch(task.url):
+            logger.info('Disallowed by robots.txt: %s', task.url)
+            self.__crawlModel.record_skipped()
+            self.__checkpoint.mark_done(task.lineNum)
+            return True
+
+        headers = {'User-Agent': self.__userAgent}
+        headers.update(task.headers)
+        canRetry = task.attempt < self.__maxRetries
+        try:
+            if self.__tracer is None:
+                response, content = self.__request(task, headers)
+            else:
+                with self.__tracer.trace(task.method, url=task.url,
+                                         attempt=task.attempt):
+                    response, content = self.__request(task, headers)
+        except Exception as e:
+            if canRetry:
+                logger.info('Retrying %s: %s', task.url, e)
+                self.__crawlModel.record_retry()
+                return False
+            logger.warn('Failed to fetch %s: %s', task.url, e)
+            self.__crawlModel.record_error()
+            self.__checkpoint.mark_done(task.lineNum)
+            return True
+
+        if response.statusCode in RETRY_STATUS_CODES and canRetry:
+            logger.info('Retrying %s: status %d', task.url,
+                        response.statusCode)
+            self.__crawlModel.record_retry()
+            return False
+
+        recordSize = self.__writer.write_response(task, response, content)
+        self.__crawlModel.record_response(response.statusCode, recordSize)
+        self.__checkpoint.mark_done(task.lineNum)
+        return True
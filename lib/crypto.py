@@ -0,0 +1,97 @@
+import logging
+import time
+
+from base64 import b64encode
+from threading import Lock
+
+from Crypto.Cipher import PKCS1_OAEP
+from Crypto.PublicKey import RSA
+from Crypto.Random import get_random_bytes
+
+from lib.proxy import StreamedContent, WRITE_BUFFER_CHUNK_SIZE
+from shared.crypto import REQUEST_NONCE_LENGTH, RequestCipher, get_key_id
+
+logger = logging.getLogger(__name__)
+
+SESSION_KEY_LENGTH = 16
+
+# Each request derives 96 bit GCM nonces for its unframed parts from a
+# random 128 bit nonce, so the chance of any repeating under one key stays
+# below 2^-40 at this many requests. Framed bodies get keys of their own.
+MAX_SESSION_KEY_REQUESTS = 2 ** 24
+MAX_SESSION_KEY_LIFETIME = 3600
+
+
+class EncryptionSession(object):
+    """
+    Holds a symmetric key that is reused across requests. The key is
+    wrapped with the lambda's public key once, and lambdas cache it after
+    unwrapping it, so RSA is not needed on every request.
+    """
+
+    def __init__(self, pubKeyFile, maxRequests=MAX_SESSION_KEY_REQUESTS,
+                 maxLifetime=MAX_SESSION_KEY_LIFETIME):
+        with open(pubKeyFile, 'rb') as ifs:
+            self.__rsaCipher = PKCS1_OAEP.new(RSA.importKey(ifs.read()))
+        self.__maxRequests = maxRequests
+        self.__maxLifetime = maxLifetime
+        self.__lock = Lock()
+        self.__rotate_key()
+
+    def __rotate_key(self):
+        self.__key = get_random_bytes(SESSION_KEY_LENGTH)
+        wrappedKey = self.__rsaCipher.encrypt(self.__key)
+        self.__wrappedKey64 = b64encode(wrappedKey)
+        self.__keyId = get_key_id(wrappedKey)
+        self.__keyCreateTime = time.time()
+        self.__numRequests = 0
+        logger.info('New session key: %s', self.__keyId[:16])
+
+    @property
+    def keyId(self):
+        return self.__keyId
+
+    def new_request(self):
+        """Return (RequestCipher, wrapped key in base64) for a request"""
+        with self.__lock:
+            if (self.__numRequests >= self.__maxRequests or
+                    time.time() - self.__keyCreateTime > self.__maxLifetime):
+                self.__rotate_key()
+            self.__numRequests += 1
+            cipher = RequestCipher(self.__key,
+                                   get_random_bytes(REQUEST_NONCE_LENGTH))
+            return cipher, self.__wrappedKey64
+
+
+class DecryptedContent(StreamedContent):
+    """
+    Decrypts a framed body as it is read. The content may be a buffer or
+    StreamedContent, so only a frame at a time is held in memory.
+    """
+
+    def __init__(self, cipher, label, content):
+        self.__cipher = cipher
+        self.__label = label
+        self.__content = content
+
+    def __iter_framed(self):
+        if isinstance(self.__content, StreamedContent):
+            return iter(self.__content)
+        return (str(self.__content[i:i + WRITE_BUFFER_CHUNK_SIZE])
+                for i in xrange(0, len(self.__content),
+                                WRITE_BUFFER_CHUNK_SIZE))
+
+    def __iter__(self):
+        return self.__cipher.decrypt_frames(self.__label,
+                                            self.__iter_framed())
+
+    def close(self):
+        if isinstance(self.__content, StreamedContent):
+            self.__content.close()
+
+
+def decrypt_framed_content(cipher, label, content):
+    """Decrypt strings right away, and everything else as it is read"""
+    if isinstance(content, str):
+        return cipher.decrypt_framed(label, content)
+    return DecryptedContent(cipher, label, content)
@@ -1,4 +1,10 @@
 
+import logging
+
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
 FILTERED_REQUEST_HEADERS = {
     'Proxy-Connection',
     'Proxy-Authorization',
@@ -9,4 +15,64 @@ FILTERED_RESPONSE_HEADERS = {
     'Connection'
 }
 
+_FILTERED_REQUEST_HEADERS_LOWER = {x.lower() for x in FILTERED_REQUEST_HEADERS}
+_FILTERED_RESPONSE_HEADERS_LOWER = {x.lower() for x in FILTERED_RESPONSE_HEADERS}
+
 DEFAULT_USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/61.0.3163.100 Safari/537.36'
+
+
+def filter_request_headers(headerItems, chunked=False):
+    """
+    Return the headers to forward from (header, value) pairs, ignoring the
+    case of the names. Chunked bodies are decoded before they are proxied,
+    so their Transfer-Encoding is dropped too. Repeated headers are joined.
+    """
+    headers = {}
+    for header, value in headerItems:
+        lowerHeader = header.lower()
+        if lowerHeader in _FILTERED_REQUEST_HEADERS_LOWER:
+            continue
+        if chunked and lowerHeader == 'transfer-encoding':
+            continue
+        if header in headers:
+            headers[header] += ', ' + value
+        else:
+            headers[header] = value
+    return headers
+
+
+def is_filtered_response_header(header):
+    return header.lower() in _FILTERED_RESPONSE_HEADERS_LOWER
+
+
+class RandomUserAgent(object):
+    """
+    Random browser user agents from fake_useragent, which is only loaded
+    when the first one is needed, since it may fetch its data from the
+    network. Falls back to DEFAULT_USER_AGENT if that fails.
+    """
+
+    def __init__(self):
+        self.__userAgent = None
+        self.__loaded = False
+        self.__lock = Lock()
+
+    def __load(self):
+        try:
+            from fake_useragent import UserAgent
+            self.__userAgent = UserAgent()
+        except Exception as e:
+            logger.error('Failed to load fake_useragent: %s', e)
+        self.__loaded = True
+
+    def get(self):
+        if not self.__loaded:
+            with self.__lock:
+                if not self.__loaded:
+                    self.__load()
+        if self.__userAgent is None:
+            return DEFAULT_USER_AGENT
+        try:
+            return self.__userAgent.random
+        except Exception:
+            return DEFAULT_USER_AGENT
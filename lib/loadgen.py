@@ -0,0 +1,274 @@
+"""
+An open loop load generator. Requests are sent at a target rate whether or
+not the earlier ones have finished, and their latency is measured from when
+they were due, so that a slow proxy cannot hold back the load it is given.
+"""
+
+import json
+import logging
+import random
+import time
+
+from bisect import bisect_right
+from collections import Counter, OrderedDict, namedtuple
+from Queue import Queue
+from threading import Lock, Thread
+
+import requests
+
+from lib.stats import LatencyHistogram
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_CONNECTIONS = 64
+DEFAULT_REQUEST_TIMEOUT = 60
+
+LoadRequest = namedtuple('LoadRequest', [
+    'url', 'method', 'headers', 'body', 'weight'
+])
+
+
+def read_load_trace(fileName):
+    """
+    Return a LoadRequest for each line of a JSONL file. Lines are either a
+    URL string, or an object with a url and optionally a method, headers,
+    body and weight, as in the URL files of main.py crawl.
+    """
+    loadRequests = []
+    with open(fileName) as ifs:
+        for line in ifs:
+            line = line.strip()
+            if not line:
+                continue
+            entry = json.loads(line)
+            if not isinstance(entry, dict):
+                entry = {'url': entry}
+            body = entry.get('body')
+            loadRequests.append(LoadRequest(
+                url=str(entry['url']),
+                method=str(entry.get('method', 'GET')).upper(),
+                headers=entry.get('headers', {}),
+                body=body.encode('utf-8') if body else None,
+                weight=float(entry.get('weight', 1))))
+    return loadRequests
+
+
+def parse_size_mix(mix):
+    """Return [(size, weight)] from size:weight,..."""
+    sizes = []
+    for item in mix.split(','):
+        size, _, weight = item.partition(':')
+        sizes.append((int(size), float(weight or 1)))
+    return sizes
+
+
+def get_size_mix_requests(baseUrl, mix):
+    """Requests for baseUrl/<size>, as served by measurements/*/server.py"""
+    return [LoadRequest(url='%s/%d' % (baseUrl.rstrip('/'), size),
+                        method='GET', headers={}, body=None, weight=weight)
+            for size, weight in parse_size_mix(mix)]
+
+
+class RequestMix(object):
+    """Chooses requests at random, in proportion to their weights"""
+
+    def __init__(self, loadRequests, seed=None):
+        if not loadRequests:
+            raise ValueError('No requests to choose from')
+        self.__requests = list(loadRequests)
+        self.__totals = []
+        total = 0.0
+        for request in self.__requests:
+            total += request.weight
+            self.__totals.append(total)
+        self.__random = random.Random(seed)
+
+    def next(self):
+        x = self.__random.random() * self.__totals[-1]
+        index = bisect_right(self.__totals, x)
+        return self.__requests[min(index, len(self.__requests) - 1)]
+
+
+def _histogram_to_dict(histogram):
+    snapshot = histogram.snapshot()
+    ret = OrderedDict([
+        ('count', snapshot.count),
+        ('meanMillis', snapshot.mean),
+        ('maxMillis', snapshot.max),
+    ])
+    for p, ms in snapshot.percentiles():
+        ret['p%gMillis' % p] = ms
+    ret['buckets'] = snapshot.buckets
+    return ret
+
+
+class LoadResult(object):
+    """What happened to the requests sent at one rate"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.seconds = 0.0
+
+        # From when each request was due, and from when it was sent
+        self.latency = LatencyHistogram()
+        self.serviceTime = LatencyHistogram()
+
+        self.__lock = Lock()
+        self.numSent = 0
+        self.numErrors = 0
+        self.bytesReceived = 0
+        self.maxBacklog = 0
+        self.statusCounts = Counter()
+
+    def record_response(self, statusCode, contentLength, dueTime, sendTime):
+        endTime = time.time()
+        self.latency.record(endTime - dueTime)
+        self.serviceTime.record(endTime - sendTime)
+        with self.__lock:
+            self.statusCounts[statusCode] += 1
+            self.bytesReceived += contentLength
+
+    def record_error(self):
+        with self.__lock:
+            self.numErrors += 1
+
+    def record_sent(self, backlog):
+        self.numSent += 1
+        self.maxBacklog = max(self.maxBacklog, backlog)
+
+    @property
+    def numCompleted(self):
+        return self.latency.count
+
+    @property
+    def achievedRate(self):
+        """Responses per second"""
+        if self.seconds == 0:
+            return 0.0
+        return self.numCompleted / self.seconds
+
+    def to_dict(self):
+        seconds = self.seconds or float('inf')
+        return OrderedDict([
+            ('offeredRate', self.rate),
+            ('achievedRate', self.achievedRate),
+            ('seconds', self.seconds),
+            ('sent', self.numSent),
+            ('completed', self.numCompleted),
+            ('errors', self.numErrors),
+            ('statusCounts', self.statusCounts),
+            ('mbPerSec', self.bytesReceived / float(2 ** 20) / seconds),
+            ('maxBacklog', self.maxBacklog),
+            ('latency', _histogram_to_dict(self.latency)),
+            ('serviceTime', _histogram_to_dict(self.serviceTime)),
+        ])
+
+
+class OpenLoopLoad(object):
+    """
+    Sends requests from a RequestMix at a rate, through a proxy if given.
+    Arrivals are Poisson unless uniform is set. Each of up to maxConnections
+    threads keeps its connection alive between requests, where the server
+    allows it, and requests wait in a backlog while all of them are busy.
+    """
+
+    def __init__(self, mix, proxyUrl=None,
+                 maxConnections=DEFAULT_MAX_CONNECTIONS, verify=True,
+                 timeout=DEFAULT_REQUEST_TIMEOUT, uniform=False, seed=None,
+                 onResponse=None):
+        self.__mix = mix
+        self.__proxies = {'http': proxyUrl, 'https': proxyUrl} \
+            if proxyUrl else {}
+        self.__maxConnections = maxConnections
+        self.__verify = verify
+        self.__timeout = timeout
+        self.__uniform = uniform
+        self.__random = random.Random(seed)
+
+        # Called with each request and response
+        self.__onResponse = onResponse
+
+    def __send_forever(self, queue, result):
+        session = requests.Session()
+        session.trust_env = False
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            dueTime, request = item
+            sendTime = time.time()
+            try:
+                response = session.request(
+                    request.method, request.url, headers=request.headers,
+                    data=request.body, proxies=self.__proxies,
+                    verify=self.__verify, timeout=self.__timeout)
+                contentLength = len(response.content)
+                result.record_response(response.status_code, contentLength,
+                                       dueTime, sendTime)
+                if self.__onResponse is not None:
+                    self.__onResponse(request, response)
+            except Exception as e:
+                logger.debug('%s: %s', request.url, e)
+                result.record_error()
+        session.close()
+
+    def __get_arrivals(self, rate, duration, numRequests):
+        """Yield (seconds from the start, LoadRequest) at the rate"""
+        offset = 0.0
+        numSent = 0
+        while True:
+            if numRequests is not None and numSent >= numRequests:
+                break
+            if duration is not None and offset >= duration:
+                break
+            yield offset, self.__mix.next()
+            numSent += 1
+            if self.__uniform:
+                offset += 1.0 / rate
+            else:
+                offset += self.__random.expovariate(rate)
+
+    def __send_all(self, arrivals, result):
+        queue = Queue()
+        threads = [Thread(target=self.__send_forever, args=(queue, result))
+                   for _ in xrange(self.__maxConnections)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+        startTime = time.time()
+        for offset, request in arrivals:
+            dueTime = startTime + offset
+            delay = dueTime - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            queue.put((dueTime, request))
+            result.record_sent(queue.qsize())
+
+        for _ in threads:
+            queue.put(None)
+        for t in threads:
+            t.join()
+        result.seconds = time.time() - startTime
+        return result
+
+    def run(self, rate, duration=None, numRequests=None):
+        """
+        Send requests at the rate, per second, until the duration passes or
+        numRequests are sent. Returns a LoadResult once all are done.
+        """
+        if duration is None and numRequests is None:
+            raise ValueError('Either a duration or numRequests is required')
+        return self.__send_all(
+            self.__get_arrivals(rate, duration, numRequests),
+            LoadResult(rate))
+
+    def run_schedule(self, schedule):
+        """
+        Send each LoadRequest of [(seconds from the start, LoadRequest)] at
+        its time. The mix is not used. Returns a LoadResult once all are done.
+        """
+        schedule = sorted(schedule, key=lambda x: x[0])
+        lastOffset = schedule[-1][0] if schedule else 0.0
+        rate = len(schedule) / lastOffset if lastOffset > 0 else 0.0
+        return self.__send_all(schedule, LoadResult(rate))
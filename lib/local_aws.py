@@ -0,0 +1,852 @@
+"""
+A stand-in for Lambda, SQS and S3 that runs on one machine, so the lambda
+proxies can be driven, load tested and profiled without AWS.
+
+Functions run lambda/proxy.handler in subprocess containers, which are
+reused while warm, like Lambda's. Invocations beyond a function's
+concurrency are throttled. SQS queues and S3 buckets are kept in memory by
+the daemon, and served to the containers over a multiprocessing manager;
+boto3 is patched in the containers to use them.
+"""
+
+import hashlib
+import heapq
+import json
+import logging
+import os
+import random
+import resource as rusage
+import select
+import subprocess
+import sys
+import time
+import traceback
+import uuid
+
+from base64 import b64encode
+from collections import deque
+from importlib import import_module
+from multiprocessing.managers import BaseManager
+from StringIO import StringIO
+from threading import Condition, Lock, Thread
+
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger(__name__)
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAMBDA_DIR = os.path.join(REPO_DIR, 'lambda')
+
+DEFAULT_HANDLER = 'proxy.handler'
+DEFAULT_CONCURRENCY = 10
+DEFAULT_COLD_START_DELAY = 0.0
+DEFAULT_TIMEOUT = 30
+DEFAULT_MEMORY_SIZE = 256
+DEFAULT_IDLE_TIMEOUT = 300
+
+# Lambda bills in increments of 100ms, and returns the end of the log
+BILLING_INCREMENT_MILLIS = 100
+MAX_LOG_TAIL_SIZE = 4096
+
+# Responses are read from the containers in chunks of up to this size
+CONTAINER_READ_SIZE = 64 * 1024
+
+# Throttled invocations are retried by the client, as botocore does
+MAX_THROTTLE_RETRIES = 4
+THROTTLE_BACKOFF = 0.05
+
+DEFAULT_VISIBILITY_TIMEOUT = 30
+MAX_RECEIVE_MESSAGES = 10
+MAX_MESSAGE_SIZE = 256 * 1024
+
+# Passed to the containers
+ADDRESS_ENV_VAR = 'LOCAL_AWS_ADDRESS'
+AUTHKEY_ENV_VAR = 'LOCAL_AWS_AUTHKEY'
+HANDLER_ENV_VAR = 'LOCAL_AWS_HANDLER'
+CODE_DIR_ENV_VAR = 'LOCAL_AWS_CODE_DIR'
+COLD_START_ENV_VAR = 'LOCAL_AWS_COLD_START_DELAY'
+
+
+class LocalAwsError(Exception):
+    """Raised by the local services, and converted to a ClientError"""
+
+    def __init__(self, code, message):
+        super(LocalAwsError, self).__init__(code, message)
+        self.code = code
+        self.message = message
+
+
+def _client_error(e, operationName):
+    return ClientError({'Error': {'Code': e.code, 'Message': e.message}},
+                       operationName)
+
+
+def _read_body(body):
+    if hasattr(body, 'read'):
+        return body.read()
+    return str(body)
+
+
+class LocalS3(object):
+    """Buckets of objects in memory. Buckets are created when first used."""
+
+    def __init__(self):
+        self.__buckets = {}
+        self.__lock = Lock()
+
+    def put_object(self, bucket, key, data, metadata=None):
+        with self.__lock:
+            self.__buckets.setdefault(bucket, {})[key] = (data,
+                                                          metadata or {})
+
+    def __get(self, bucket, key):
+        with self.__lock:
+            obj = self.__buckets.get(bucket, {}).get(key)
+        if obj is None:
+            raise LocalAwsError('NoSuchKey', 'No such key: %s' % key)
+        return obj
+
+    def get_object(self, bucket, key, start=None, end=None):
+        """Return (data, size, metadata), with data in the range if given"""
+        data, metadata = self.__get(bucket, key)
+        if start is not None:
+            if start >= len(data):
+                raise LocalAwsError('InvalidRange', 'Range not satisfiable')
+            return data[start:end + 1], len(data), metadata
+        return data, len(data), metadata
+
+    def head_object(self, bucket, key):
+        """Return (size, metadata)"""
+        data, metadata = self.__get(bucket, key)
+        return len(data), metadata
+
+    def copy_object(self, bucket, key, sourceBucket, sourceKey,
+                    metadata=None):
+        data, sourceMetadata = self.__get(sourceBucket, sourceKey)
+        self.put_object(bucket, key, data,
+                        sourceMetadata if metadata is None else metadata)
+
+    def delete_objects(self, bucket, keys):
+        with self.__lock:
+            objects = self.__buckets.get(bucket, {})
+            for key in keys:
+                objects.pop(key, None)
+
+    def list_keys(self, bucket):
+        with self.__lock:
+            return sorted(self.__buckets.get(bucket, {}))
+
+
+class _LocalQueue(object):
+
+    def __init__(self, attributes):
+        self.attributes = attributes
+        self.messages = deque()
+        # Received messages: receiptHandle -> (visibleTime, message)
+        self.inFlight = {}
+        self.visibleTimes = []
+        self.cond = Condition(Lock())
+        self.deleted = False
+
+    def get_attribute(self, name, default):
+        return float(self.attributes.get(name, default))
+
+    def requeue_expired(self, now):
+        while self.visibleTimes and self.visibleTimes[0][0] <= now:
+            _, receiptHandle = heapq.heappop(self.visibleTimes)
+            entry = self.inFlight.pop(receiptHandle, None)
+            if entry is not None:
+                self.messages.appendleft(entry[1])
+
+
+class LocalSqs(object):
+    """
+    Queues in memory, with long polling and visibility timeouts. Messages
+    are dicts in the shape of the SQS API's.
+    """
+
+    def __init__(self):
+        self.__queues = {}
+        self.__lock = Lock()
+
+    def __get_queue(self, name):
+        with self.__lock:
+            queue = self.__queues.get(name)
+        if queue is None:
+            raise LocalAwsError('AWS.SimpleQueueService.NonExistentQueue',
+                                'The specified queue does not exist: %s'
+                                % name)
+        return queue
+
+    def create_queue(self, name, attributes=None):
+        with self.__lock:
+            if name not in self.__queues:
+                self.__queues[name] = _LocalQueue(dict(attributes or {}))
+
+    def has_queue(self, name):
+        with self.__lock:
+            return name in self.__queues
+
+    def delete_queue(self, name):
+        with self.__lock:
+            queue = self.__queues.pop(name, None)
+        if queue is not None:
+            with queue.cond:
+                queue.deleted = True
+                queue.cond.notify_all()
+
+    def send_message(self, name, body, attributes=None):
+        """Return the message id"""
+        attributes = attributes or {}
+        size = len(body) + sum(
+            len(k) + len(v['DataType'])
+            + len(v.get('StringValue') or v.get('BinaryValue') or '')
+            for k, v in attributes.iteritems())
+        if size > MAX_MESSAGE_SIZE:
+            raise LocalAwsError('InvalidParameterValue',
+                                'Message of %d bytes exceeds %d'
+                                % (size, MAX_MESSAGE_SIZE))
+        queue = self.__get_queue(name)
+        messageId = str(uuid.uuid4())
+        message = {
+            'MessageId': messageId,
+            'Body': body,
+            'MD5OfBody': hashlib.md5(body).hexdigest(),
+            'MessageAttributes': attributes
+        }
+        with queue.cond:
+            queue.messages.append(message)
+            queue.cond.notify()
+        return messageId
+
+    def receive_messages(self, name, maxMessages=1, waitSeconds=None):
+        """
+        Return up to maxMessages, waiting up to waitSeconds, or the queue's
+        ReceiveMessageWaitTimeSeconds, for at least one
+        """
+        if not 1 <= maxMessages <= MAX_RECEIVE_MESSAGES:
+            raise LocalAwsError('InvalidParameterValue',
+                                'MaxNumberOfMessages must be 1 to %d'
+                                % MAX_RECEIVE_MESSAGES)
+        queue = self.__get_queue(name)
+        if waitSeconds is None:
+            waitSeconds = queue.get_attribute(
+                'ReceiveMessageWaitTimeSeconds', 0)
+        visibilityTimeout = queue.get_attribute('VisibilityTimeout',
+                                                DEFAULT_VISIBILITY_TIMEOUT)
+        endTime = time.time() + waitSeconds
+        with queue.cond:
+            while True:
+                if queue.deleted:
+                    raise LocalAwsError(
+                        'AWS.SimpleQueueService.NonExistentQueue',
+                        'The queue was deleted: %s' % name)
+                now = time.time()
+                queue.requeue_expired(now)
+                if queue.messages or now >= endTime:
+                    break
+                waitTime = endTime - now
+                if queue.visibleTimes:
+                    waitTime = min(waitTime, queue.visibleTimes[0][0] - now)
+                queue.cond.wait(waitTime)
+
+            received = []
+            while queue.messages and len(received) < maxMessages:
+                message = queue.messages.popleft()
+                receiptHandle = uuid.uuid4().hex
+                visibleTime = now + visibilityTimeout
+                queue.inFlight[receiptHandle] = (visibleTime, message)
+                heapq.heappush(queue.visibleTimes,
+                               (visibleTime, receiptHandle))
+                received.append(dict(message, ReceiptHandle=receiptHandle))
+            return received
+
+    def delete_messages(self, name, receiptHandles):
+        """Return the receipt handles that were not in flight"""
+        queue = self.__get_queue(name)
+        failed = []
+        with queue.cond:
+            for receiptHandle in receiptHandles:
+                if queue.inFlight.pop(receiptHandle, None) is None:
+                    failed.append(receiptHandle)
+        return failed
+
+
+class _S3Client(object):
+    """The parts of boto3's S3 client that are used, over LocalS3"""
+
+    def __init__(self, s3):
+        self.__s3 = s3
+
+    def get_object(self, Bucket, Key, Range=None):
+        start = end = None
+        if Range is not None:
+            start, end = Range.split('=', 1)[1].split('-')
+            start = int(start)
+        try:
+            data, size, metadata = self.__s3.get_object(
+                Bucket, Key, start, int(end) if end else None)
+        except LocalAwsError as e:
+            raise _client_error(e, 'GetObject')
+        result = {
+            'Body': StringIO(data),
+            'ContentLength': len(data),
+            'Metadata': metadata
+        }
+        if start is not None:
+            result['ContentRange'] = 'bytes %d-%d/%d' % (
+                start, start + len(data) - 1, size)
+        return result
+
+    def put_object(self, Bucket, Key, Body, Metadata=None, **kwargs):
+        self.__s3.put_object(Bucket, Key, _read_body(Body), Metadata)
+        return {}
+
+    def head_object(self, Bucket, Key):
+        try:
+            size, metadata = self.__s3.head_object(Bucket, Key)
+        except LocalAwsError:
+            raise ClientError({'Error': {'Code': '404',
+                                         'Message': 'Not Found'}},
+                              'HeadObject')
+        return {'ContentLength': size, 'Metadata': metadata}
+
+    def copy_object(self, Bucket, Key, CopySource, Metadata=None,
+                    MetadataDirective='COPY', **kwargs):
+        try:
+            self.__s3.copy_object(
+                Bucket, Key, CopySource['Bucket'], CopySource['Key'],
+                Metadata if MetadataDirective == 'REPLACE' else None)
+        except LocalAwsError as e:
+            raise _client_error(e, 'CopyObject')
+        return {}
+
+    def delete_objects(self, Bucket, Delete):
+        self.__s3.delete_objects(Bucket,
+                                 [obj['Key'] for obj in Delete['Objects']])
+        return {}
+
+
+class _S3Object(object):
+
+    def __init__(self, client, bucket, key):
+        self.__client = client
+        self.bucket_name = bucket
+        self.key = key
+
+    def get(self):
+        return self.__client.get_object(Bucket=self.bucket_name, Key=self.key)
+
+
+class _S3Bucket(object):
+
+    def __init__(self, client, name):
+        self.__client = client
+        self.name = name
+
+    def put_object(self, Key, Body, **kwargs):
+        self.__client.put_object(Bucket=self.name, Key=Key, Body=Body,
+                                 **kwargs)
+        return _S3Object(self.__client, self.name, Key)
+
+
+class _S3Resource(object):
+
+    def __init__(self, s3):
+        self.__client = _S3Client(s3)
+
+    def Bucket(self, name):
+        return _S3Bucket(self.__client, name)
+
+    def Object(self, Bucket, Key):
+        return _S3Object(self.__client, Bucket, Key)
+
+
+class _SqsMessage(object):
+
+    def __init__(self, queueUrl, message, attributeNames):
+        self.queue_url = queueUrl
+        self.message_id = message['MessageId']
+        self.receipt_handle = message['ReceiptHandle']
+        self.body = message['Body']
+        self.md5_of_body = message['MD5OfBody']
+        attributes = message['MessageAttributes']
+        if attributeNames and 'All' not in attributeNames:
+            attributes = {k: v for k, v in attributes.iteritems()
+                          if k in attributeNames}
+        # boto3 returns None rather than an empty dict
+        self.message_attributes = attributes or None
+
+
+class _SqsQueue(object):
+
+    def __init__(self, sqs, name):
+        self.__sqs = sqs
+        self.name = name
+        self.url = 'local://sqs/%s' % name
+
+    def send_message(self, MessageBody, MessageAttributes=None, **kwargs):
+        try:
+            messageId = self.__sqs.send_message(self.name, MessageBody,
+                                                MessageAttributes)
+        except LocalAwsError as e:
+            raise _client_error(e, 'SendMessage')
+        return {'MessageId': messageId,
+                'MD5OfMessageBody': hashlib.md5(MessageBody).hexdigest()}
+
+    def receive_messages(self, MessageAttributeNames=None,
+                         MaxNumberOfMessages=1, WaitTimeSeconds=None,
+                         **kwargs):
+        try:
+            messages = self.__sqs.receive_messages(
+                self.name, MaxNumberOfMessages, WaitTimeSeconds)
+        except LocalAwsError as e:
+            raise _client_error(e, 'ReceiveMessage')
+        return [_SqsMessage(self.url, m, MessageAttributeNames)
+                for m in messages]
+
+    def delete_messages(self, Entries):
+        try:
+            failed = set(self.__sqs.delete_messages(
+                self.name, [e['ReceiptHandle'] for e in Entries]))
+        except LocalAwsError as e:
+            raise _client_error(e, 'DeleteMessageBatch')
+        result = {'Successful': [], 'Failed': []}
+        for entry in Entries:
+            if entry['ReceiptHandle'] in failed:
+                result['Failed'].append({
+                    'Id': entry['Id'], 'SenderFault': True,
+                    'Code': 'ReceiptHandleIsInvalid'})
+            else:
+                result['Successful'].append({'Id': entry['Id']})
+        return result
+
+    def delete(self):
+        self.__sqs.delete_queue(self.name)
+        return {}
+
+
+class _SqsResource(object):
+
+    def __init__(self, sqs):
+        self.__sqs = sqs
+
+    def create_queue(self, QueueName, Attributes=None):
+        self.__sqs.create_queue(QueueName, Attributes)
+        return _SqsQueue(self.__sqs, QueueName)
+
+    def get_queue_by_name(self, QueueName):
+        if not self.__sqs.has_queue(QueueName):
+            raise ClientError({'Error': {
+                'Code': 'AWS.SimpleQueueService.NonExistentQueue',
+                'Message': 'The specified queue does not exist'}},
+                'GetQueueUrl')
+        return _SqsQueue(self.__sqs, QueueName)
+
+
+class _LocalServices(object):
+    """Hands out boto3 style clients and resources over S3 and SQS"""
+
+    def __init__(self, s3, sqs):
+        self._s3 = s3
+        self._sqs = sqs
+
+    def _lambda_client(self):
+        raise NotImplementedError('No local lambda client')
+
+    def client(self, service, **kwargs):
+        if service == 's3':
+            return _S3Client(self._s3)
+        if service == 'lambda':
+            return self._lambda_client()
+        raise NotImplementedError('No local %s client' % service)
+
+    def resource(self, service, **kwargs):
+        if service == 's3':
+            return _S3Resource(self._s3)
+        if service == 'sqs':
+            return _SqsResource(self._sqs)
+        raise NotImplementedError('No local %s resource' % service)
+
+
+class _Container(object):
+    """A subprocess that runs the handler for one invocation at a time"""
+
+    def __init__(self, process):
+        self.process = process
+        self.lastUsedTime = time.time()
+        self.numInvocations = 0
+        self.__leftover = ''
+
+    @property
+    def isAlive(self):
+        return self.process.poll() is None
+
+    def read_line(self, timeout):
+        """
+        Return the next line from the container, '' if it exited first, or
+        None if the timeout passed. A partial line never blocks past the
+        timeout.
+        """
+        deadline = time.time() + timeout
+        fd = self.process.stdout.fileno()
+        chunks = [self.__leftover]
+        while '\n' not in chunks[-1]:
+            remaining = deadline - time.time()
+            if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                self.__leftover = ''.join(chunks)
+                return None
+            data = os.read(fd, CONTAINER_READ_SIZE)
+            if not data:
+                self.__leftover = ''
+                return ''
+            chunks.append(data)
+        line, _, self.__leftover = ''.join(chunks).partition('\n')
+        return line + '\n'
+
+    def kill(self):
+        if self.isAlive:
+            self.process.kill()
+        self.process.wait()
+
+
+class LocalFunction(object):
+    """
+    Runs a handler in a pool of containers. Warm containers are reused, and
+    those idle for idleTimeout seconds are stopped. An invocation that would
+    exceed the function's concurrency is throttled.
+    """
+
+    def __init__(self, name, backendEnv, handler=DEFAULT_HANDLER,
+                 codeDir=LAMBDA_DIR, environment=None,
+                 concurrency=DEFAULT_CONCURRENCY,
+                 coldStartDelay=DEFAULT_COLD_START_DELAY,
+                 timeout=DEFAULT_TIMEOUT, memorySize=DEFAULT_MEMORY_SIZE,
+                 idleTimeout=DEFAULT_IDLE_TIMEOUT, verbose=False):
+        self.__name = name
+        self.__concurrency = concurrency
+        self.__timeout = timeout
+        self.__memorySize = memorySize
+        self.__idleTimeout = idleTimeout
+        self.__verbose = verbose
+
+        env = dict(os.environ)
+        env.update(environment or {})
+        env.update(backendEnv)
+        env.update({
+            HANDLER_ENV_VAR: handler,
+            CODE_DIR_ENV_VAR: codeDir,
+            COLD_START_ENV_VAR: str(coldStartDelay),
+            'AWS_LAMBDA_FUNCTION_NAME': name,
+            'AWS_LAMBDA_FUNCTION_MEMORY_SIZE': str(memorySize)
+        })
+        self.__env = env
+
+        self.__lock = Lock()
+        self.__idle = []
+        self.__busy = set()
+        self.__numRunning = 0
+        self.__numColdStarts = 0
+        self.__numThrottles = 0
+        self.__closed = False
+
+    @property
+    def name(self):
+        return self.__name
+
+    @property
+    def numColdStarts(self):
+        return self.__numColdStarts
+
+    @property
+    def numThrottles(self):
+        return self.__numThrottles
+
+    @property
+    def numContainers(self):
+        with self.__lock:
+            return self.__numRunning + len(self.__idle)
+
+    def __start_container(self):
+        with open(os.devnull, 'w') as devnull:
+            process = subprocess.Popen(
+                [sys.executable, '-m', 'lib.local_aws'], cwd=REPO_DIR,
+                env=self.__env, bufsize=-1, stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=None if self.__verbose else devnull)
+        return _Container(process)
+
+    def __acquire_container(self):
+        with self.__lock:
+            if self.__closed:
+                raise LocalAwsError('ResourceNotFoundException',
+                                    'Function not found: %s' % self.__name)
+            if self.__numRunning >= self.__concurrency:
+                self.__numThrottles += 1
+                raise LocalAwsError('TooManyRequestsException',
+                                    'Rate Exceeded.')
+            self.__numRunning += 1
+            now = time.time()
+            expired = [c for c in self.__idle
+                       if now - c.lastUsedTime > self.__idleTimeout]
+            self.__idle = [c for c in self.__idle if c not in expired]
+            # The most recently used container is the warmest
+            container = self.__idle.pop() if self.__idle else None
+        for c in expired:
+            c.kill()
+        if container is None or not container.isAlive:
+            self.__numColdStarts += 1
+            try:
+                container = self.__start_container()
+            except Exception:
+                with self.__lock:
+                    self.__numRunning -= 1
+                raise
+        with self.__lock:
+            self.__busy.add(container)
+        return container
+
+    def __release_container(self, container, reuse):
+        container.lastUsedTime = time.time()
+        with self.__lock:
+            self.__numRunning -= 1
+            self.__busy.discard(container)
+            if reuse and not self.__closed:
+                self.__idle.append(container)
+                return
+        container.kill()
+
+    def __format_log(self, requestId, log, durationMillis, maxMemoryUsed):
+        billedMillis = max(1, int(
+            (durationMillis + BILLING_INCREMENT_MILLIS - 1)
+            / BILLING_INCREMENT_MILLIS)) * BILLING_INCREMENT_MILLIS
+        log = 'START RequestId: %s Version: $LATEST\n%sEND RequestId: %s\n' \
+              'REPORT RequestId: %s\tDuration: %.2f ms\t' \
+              'Billed Duration: %d ms \tMemory Size: %d MB\t' \
+              'Max Memory Used: %d MB\t\n' % (
+                  requestId, log, requestId, requestId, durationMillis,
+                  billedMillis, self.__memorySize, maxMemoryUsed)
+        return log[-MAX_LOG_TAIL_SIZE:]
+
+    def invoke(self, payload):
+        """Return (payload, functionError or None, log)"""
+        requestId = str(uuid.uuid4())
+        container = self.__acquire_container()
+        startTime = time.time()
+        reuse = False
+        try:
+            container.process.stdin.write(json.dumps({
+                'requestId': requestId,
+                'payload': payload,
+                'deadline': startTime + self.__timeout
+            }) + '\n')
+            container.process.stdin.flush()
+            # Each request gets one line
+            line = container.read_line(self.__timeout)
+            if line:
+                response = json.loads(line)
+                reuse = True
+                payload = response['payload']
+                functionError = response['error']
+                log = response['log']
+                maxMemoryUsed = response['maxMemoryUsed']
+            else:
+                # The container is stopped, as Lambda does on a timeout
+                if line is not None:
+                    message = 'Process exited before completing request'
+                else:
+                    message = 'Task timed out after %.2f seconds' % \
+                              self.__timeout
+                payload = json.dumps({'errorMessage': message})
+                functionError = 'Unhandled'
+                log = message + '\n'
+                maxMemoryUsed = 0
+        finally:
+            durationMillis = (time.time() - startTime) * 1000
+            self.__release_container(container, reuse)
+        return payload, functionError, self.__format_log(
+            requestId, log, durationMillis, maxMemoryUsed)
+
+    def close(self):
+        """Stop every container, including those that are running"""
+        with self.__lock:
+            self.__closed = True
+            containers = self.__idle + list(self.__busy)
+            self.__idle = []
+        for container in containers:
+            container.kill()
+
+
+class _LambdaClient(object):
+    """The parts of boto3's Lambda client that are used"""
+
+    def __init__(self, backend):
+        self.__backend = backend
+
+    def invoke(self, FunctionName, Payload, LogType=None, **kwargs):
+        # Functions in other regions are found by name
+        function = self.__backend.get_function(FunctionName.split(':')[-1])
+        if function is None:
+            raise ClientError({'Error': {
+                'Code': 'ResourceNotFoundException',
+                'Message': 'Function not found: %s' % FunctionName}},
+                'Invoke')
+        for attempt in xrange(MAX_THROTTLE_RETRIES + 1):
+            try:
+                payload, functionError, log = function.invoke(
+                    _read_body(Payload))
+                break
+            except LocalAwsError as e:
+                if (e.code != 'TooManyRequestsException'
+                        or attempt == MAX_THROTTLE_RETRIES):
+                    raise _client_error(e, 'Invoke')
+                time.sleep(random.uniform(0, THROTTLE_BACKOFF * 2 ** attempt))
+        response = {
+            'StatusCode': 200,
+            'Payload': StringIO(payload),
+            'ExecutedVersion': '$LATEST'
+        }
+        if LogType == 'Tail':
+            response['LogResult'] = b64encode(log)
+        if functionError is not None:
+            response['FunctionError'] = functionError
+        return response
+
+
+class LocalAwsBackend(_LocalServices):
+    """
+    Lambda, SQS and S3 on this machine. Set it with lib.aws.set_backend, and
+    add the functions to invoke.
+    """
+
+    def __init__(self):
+        super(LocalAwsBackend, self).__init__(LocalS3(), LocalSqs())
+        self.__functions = {}
+        self.__authkey = os.urandom(16)
+
+        # A class per backend, since the registry is kept on the class
+        class Manager(BaseManager):
+            pass
+        Manager.register('s3', callable=lambda: self._s3)
+        Manager.register('sqs', callable=lambda: self._sqs)
+        manager = Manager(address=('127.0.0.1', 0), authkey=self.__authkey)
+        self.__server = manager.get_server()
+        t = Thread(target=self.__server.serve_forever)
+        t.daemon = True
+        t.start()
+
+    @property
+    def s3(self):
+        return self._s3
+
+    @property
+    def sqs(self):
+        return self._sqs
+
+    def __get_env(self):
+        host, port = self.__server.address
+        return {
+            ADDRESS_ENV_VAR: '%s:%d' % (host, port),
+            AUTHKEY_ENV_VAR: self.__authkey.encode('hex')
+        }
+
+    def add_function(self, name, **kwargs):
+        """Takes the arguments of LocalFunction"""
+        function = LocalFunction(name, self.__get_env(), **kwargs)
+        self.__functions[name] = function
+        return function
+
+    def get_function(self, name):
+        return self.__functions.get(name)
+
+    def _lambda_client(self):
+        return _LambdaClient(self)
+
+    def shutdown(self):
+        for function in self.__functions.itervalues():
+            function.close()
+
+
+class _ContainerManager(BaseManager):
+    pass
+
+
+_ContainerManager.register('s3')
+_ContainerManager.register('sqs')
+
+
+class _Context(object):
+    """The parts of the Lambda context object that are used"""
+
+    def __init__(self, requestId, deadline):
+        self.aws_request_id = requestId
+        self.function_name = os.environ['AWS_LAMBDA_FUNCTION_NAME']
+        self.memory_limit_in_mb = \
+            os.environ['AWS_LAMBDA_FUNCTION_MEMORY_SIZE']
+        self.__deadline = deadline
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self.__deadline - time.time()) * 1000))
+
+
+def _run_container():
+    # Responses go to the original stdout, and prints to a log per request
+    responses = os.fdopen(os.dup(1), 'w')
+    os.dup2(2, 1)
+
+    host, port = os.environ[ADDRESS_ENV_VAR].split(':')
+    manager = _ContainerManager(
+        address=(host, int(port)),
+        authkey=os.environ[AUTHKEY_ENV_VAR].decode('hex'))
+    manager.connect()
+    services = _LocalServices(manager.s3(), manager.sqs())
+
+    import boto3
+    boto3.client = services.client
+    boto3.resource = services.resource
+
+    # The code of the function shadows the daemon's
+    sys.path.insert(0, os.environ[CODE_DIR_ENV_VAR])
+    moduleName, handlerName = os.environ[HANDLER_ENV_VAR].rsplit('.', 1)
+    handler = getattr(import_module(moduleName), handlerName)
+    time.sleep(float(os.environ[COLD_START_ENV_VAR]))
+
+    for line in iter(sys.stdin.readline, ''):
+        request = json.loads(line)
+        log = StringIO()
+        sys.stdout = log
+        error = None
+        try:
+            payload = json.dumps(handler(
+                json.loads(request['payload']),
+                _Context(request['requestId'], request['deadline'])))
+        except Exception as e:
+            traceback.print_exc(file=log)
+            error = 'Unhandled'
+            payload = json.dumps({
+                'errorMessage': str(e),
+                'errorType': type(e).__name__,
+                'stackTrace': traceback.format_exc().splitlines()
+            })
+        finally:
+            sys.stdout = sys.__stdout__
+        try:
+            responses.write(json.dumps({
+                'payload': payload,
+                'error': error,
+                'log': log.getvalue(),
+                # Kilobytes on Linux
+                'maxMemoryUsed':
+                    rusage.getrusage(rusage.RUSAGE_SELF).ru_maxrss / 1024
+            }) + '\n')
+            responses.flush()
+        except IOError:
+            # The daemon stopped
+            break
+
+
+if __name__ == '__main__':
+    # Run from the module, so errors unpickled from the manager are the
+    # classes that the services catch
+    from lib.local_aws import _run_container as run_container
+    run_container()
@@ -0,0 +1,237 @@
+"""Export the Stats registry over HTTP for Prometheus and other scrapers"""
+
+import json
+import logging
+import time
+
+from BaseHTTPServer import BaseHTTPRequestHandler
+from collections import OrderedDict
+from threading import Thread
+from urlparse import parse_qs
+
+from lib.stats import CrawlStatsModel, _AbstractCostModel, \
+    _AbstractCountModel, _AbstractDataModel, _AbstractLatencyModel, \
+    _AbstractTimeModel
+from lib.utils import ThreadedHTTPServer
+
+logger = logging.getLogger(__name__)
+
+METRIC_PREFIX = 'pod_'
+
+PROMETHEUS_PATH = '/metrics'
+JSON_PATH = '/metrics.json'
+TRACE_PATH = '/trace.json'
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in labels)
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class _Family(object):
+    """The samples of one metric, written under a single HELP and TYPE"""
+
+    def __init__(self, name, metricType, description):
+        self.name = name
+        self.metricType = metricType
+        self.description = description
+        self.samples = []
+
+    def add(self, value, labels=(), suffix=''):
+        self.samples.append((suffix, labels, value))
+
+
+class _Families(object):
+
+    def __init__(self):
+        self.__families = OrderedDict()
+
+    def get(self, name, metricType, description=''):
+        name = METRIC_PREFIX + name
+        family = self.__families.get(name)
+        if family is None:
+            family = _Family(name, metricType, description)
+            self.__families[name] = family
+        return family
+
+    def format(self):
+        lines = []
+        for family in self.__families.itervalues():
+            if family.description:
+                lines.append('# HELP %s %s' % (family.name, family.description))
+            lines.append('# TYPE %s %s' % (family.name, family.metricType))
+            for suffix, labels, value in family.samples:
+                lines.append('%s%s%s %s' % (family.name, suffix,
+                                            _format_labels(labels),
+                                            _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+def format_prometheus(stats):
+    """Return every model and gauge in the Prometheus text format"""
+    families = _Families()
+    for name in stats.models:
+        model = stats.get_model(name)
+        modelLabel = ('model', name)
+        if isinstance(model, _AbstractCostModel):
+            families.get('cost_dollars', 'gauge',
+                         'Estimated AWS cost so far').add(
+                model.cost, [modelLabel])
+        if isinstance(model, _AbstractTimeModel):
+            families.get('billed_seconds_total', 'counter',
+                         'Billed compute time').add(
+                model.time / 1000.0, [modelLabel])
+        if isinstance(model, _AbstractDataModel):
+            family = families.get('bytes_total', 'counter',
+                                  'Bytes transferred')
+            family.add(model.bytesUp, [modelLabel, ('direction', 'up')])
+            family.add(model.bytesDown, [modelLabel, ('direction', 'down')])
+        if isinstance(model, _AbstractCountModel):
+            for countName, value in model.counts.iteritems():
+                families.get('%s_%s_total' % (name, countName),
+                             'counter').add(value)
+        if isinstance(model, CrawlStatsModel):
+            family = families.get('%s_status_total' % name, 'counter',
+                                  'Responses by status code')
+            for statusCode, value in sorted(model.statusCounts.iteritems()):
+                family.add(value, [('code', statusCode)])
+        if isinstance(model, _AbstractLatencyModel):
+            family = families.get('latency_seconds', 'summary',
+                                  'Latency percentiles since start')
+            for latencyName, histogram in model.latencies.iteritems():
+                snapshot = histogram.snapshot()
+                labels = [modelLabel, ('name', latencyName)]
+                for p, ms in snapshot.percentiles():
+                    family.add(ms / 1000.0,
+                               labels + [('quantile', '%g' % (p / 100))])
+                family.add(snapshot.sum / 1000.0, labels, suffix='_sum')
+                family.add(snapshot.count, labels, suffix='_count')
+
+    for name, (getter, description) in stats.gauges.iteritems():
+        try:
+            value = getter()
+        except Exception as e:
+            logger.warn('Failed to read gauge %s: %s', name, e)
+            continue
+        families.get(name, 'gauge', description).add(value)
+    return families.format()
+
+
+def get_snapshot(stats):
+    """Return every model and gauge as a dict that can be dumped to JSON"""
+    models = OrderedDict()
+    for name in stats.models:
+        model = stats.get_model(name)
+        values = OrderedDict()
+        if isinstance(model, _AbstractCostModel):
+            values['cost'] = model.cost
+        if isinstance(model, _AbstractTimeModel):
+            values['billedMillis'] = model.time
+            values['meanMillis'] = model.mean
+        if isinstance(model, _AbstractDataModel):
+            values['bytesUp'] = model.bytesUp
+            values['bytesDown'] = model.bytesDown
+        if isinstance(model, _AbstractCountModel):
+            values['counts'] = model.counts
+        if isinstance(model, CrawlStatsModel):
+            values['statusCounts'] = model.statusCounts
+        if isinstance(model, _AbstractLatencyModel):
+            latencies = OrderedDict()
+            for latencyName, histogram in model.latencies.iteritems():
+                snapshot = histogram.snapshot()
+                latency = OrderedDict([
+                    ('count', snapshot.count),
+                    ('meanMillis', snapshot.mean),
+                    ('maxMillis', snapshot.max),
+                ])
+                for p, ms in snapshot.percentiles():
+                    latency['p%gMillis' % p] = ms
+                latencies[latencyName] = latency
+            values['latencies'] = latencies
+        models[name] = values
+
+    gauges = OrderedDict()
+    for name, (getter, _) in stats.gauges.iteritems():
+        try:
+            gauges[name] = getter()
+        except Exception as e:
+            logger.warn('Failed to read gauge %s: %s', name, e)
+    return OrderedDict([('time', time.time()), ('models', models),
+                        ('gauges', gauges)])
+
+
+def get_trace_window(query):
+    """
+    Return (startTime, endTime) from a query string with start and end in
+    seconds since the epoch, or the last number of seconds
+    """
+    params = parse_qs(query)
+    startTime = endTime = None
+    if 'last' in params:
+        startTime = time.time() - float(params['last'][0])
+    if 'start' in params:
+        startTime = float(params['start'][0])
+    if 'end' in params:
+        endTime = float(params['end'][0])
+    return startTime, endTime
+
+
+def start_metrics_server(stats, host, port):
+    """
+    Serve the Prometheus text format at /metrics and a JSON snapshot at
+    /metrics.json, in a daemon thread. If requests are traced, their spans
+    are served at /trace.json. Returns the server.
+    """
+
+    class RequestHandler(BaseHTTPRequestHandler):
+
+        def log_message(self, format, *args):
+            """Override the default logging to not print to stdout"""
+            logger.debug('%s - [%s] %s' %
+                         (self.client_address[0],
+                          self.log_date_time_string(),
+                          format % args))
+
+        def do_GET(self):
+            path, _, query = self.path.partition('?')
+            try:
+                if path == PROMETHEUS_PATH:
+                    contentType = PROMETHEUS_CONTENT_TYPE
+                    body = format_prometheus(stats)
+                elif path == JSON_PATH:
+                    contentType = 'application/json'
+                    body = json.dumps(get_snapshot(stats), indent=2)
+                elif path == TRACE_PATH and stats.tracer is not None:
+                    contentType = 'application/json'
+                    body = json.dumps(stats.tracer.to_chrome_trace(
+                        *get_trace_window(query)))
+                else:
+                    self.send_error(404)
+                    return
+            except Exception as e:
+                logger.exception(e)
+                self.send_error(500)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', contentType)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadedHTTPServer((host, port), RequestHandler)
+    server.daemon_threads = True
+    t = Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return server
@@ -0,0 +1,223 @@
+"""
+A sampling profiler for every thread of the daemon. Stacks are written in
+the collapsed format of flamegraph.pl, which speedscope and Perfetto can
+also open.
+"""
+
+import logging
+import os
+import signal
+import sys
+import time
+
+from collections import Counter, OrderedDict
+from thread import get_ident
+from threading import Lock, Thread
+
+from lib.stats import LatencyHistogram
+from shared.profiling import set_hook_listener
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SAMPLE_INTERVAL = 0.005
+DEFAULT_MAX_STACK_DEPTH = 128
+
+# Threads whose innermost frame is in these files are waiting for work, so
+# their samples are dropped unless idle stacks are kept
+IDLE_FILES = {'threading.py', 'Queue.py', 'SocketServer.py'}
+
+
+def _get_frame_name(frame):
+    code = frame.f_code
+    module = frame.f_globals.get('__name__')
+    if module is None:
+        module = os.path.basename(code.co_filename)
+    return '%s:%s' % (module, code.co_name)
+
+
+class _HookTimer(object):
+
+    def __init__(self, profiler, name):
+        self.__profiler = profiler
+        self.__name = name
+
+    def __enter__(self):
+        # The frame of the block, under which the hook is shown
+        self.__entry = (self.__name, sys._getframe(1))
+        self.__hooks = self.__profiler._enter_hook(self.__entry)
+        self.__startTime = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.__profiler._exit_hook(self.__name, self.__hooks, self.__entry,
+                                   time.time() - self.__startTime)
+
+
+class SamplingProfiler(object):
+    """
+    Samples the stack of every thread at an interval, in a background
+    thread. While it runs, the hook points in shared.profiling are shown as
+    frames named [name] in the stacks, and the time spent in each is kept.
+    """
+
+    def __init__(self, interval=DEFAULT_SAMPLE_INTERVAL,
+                 maxStackDepth=DEFAULT_MAX_STACK_DEPTH, keepIdle=False):
+        self.__interval = interval
+        self.__maxStackDepth = maxStackDepth
+        self.__keepIdle = keepIdle
+
+        self.__lock = Lock()
+        self.__stacks = Counter()
+        self.__numSamples = 0
+        self.__hookLatencies = OrderedDict()
+
+        # Hooks each thread is in, innermost last
+        self.__activeHooks = {}
+
+        self.__thread = None
+        self.__running = False
+
+    @property
+    def running(self):
+        return self.__running
+
+    @property
+    def numSamples(self):
+        return self.__numSamples
+
+    def start(self):
+        if self.__running:
+            return
+        self.__running = True
+        set_hook_listener(self.__hook)
+        self.__thread = Thread(target=self.__sample_forever)
+        self.__thread.daemon = True
+        self.__thread.start()
+        logger.info('Started profiling')
+
+    def stop(self):
+        if not self.__running:
+            return
+        self.__running = False
+        set_hook_listener(None)
+        self.__thread.join()
+        self.__thread = None
+        logger.info('Stopped profiling after %d samples', self.__numSamples)
+
+    def reset(self):
+        with self.__lock:
+            self.__stacks.clear()
+            self.__numSamples = 0
+            self.__hookLatencies.clear()
+
+    def __hook(self, name):
+        return _HookTimer(self, name)
+
+    def _enter_hook(self, entry):
+        hooks = self.__activeHooks.get(get_ident())
+        if hooks is None:
+            hooks = self.__activeHooks.setdefault(get_ident(), [])
+        hooks.append(entry)
+        return hooks
+
+    def _exit_hook(self, name, hooks, entry, seconds):
+        if hooks and hooks[-1] is entry:
+            hooks.pop()
+        elif entry in hooks:
+            hooks.remove(entry)
+        histogram = self.__hookLatencies.get(name)
+        if histogram is None:
+            with self.__lock:
+                histogram = self.__hookLatencies.setdefault(
+                    name, LatencyHistogram())
+        histogram.record(seconds)
+
+    def __get_stack(self, frame, hooks):
+        if not self.__keepIdle and \
+                os.path.basename(frame.f_code.co_filename) in IDLE_FILES:
+            return None
+        hookNames = {}
+        for name, hookFrame in hooks or ():
+            hookNames.setdefault(id(hookFrame), []).append('[%s]' % name)
+        names = []
+        while frame is not None and len(names) < self.__maxStackDepth:
+            names.extend(reversed(hookNames.get(id(frame), ())))
+            names.append(_get_frame_name(frame))
+            frame = frame.f_back
+        if frame is not None:
+            names.append('...')
+        names.reverse()
+        return ';'.join(names)
+
+    def __sample(self, ownId):
+        stacks = []
+        for threadId, frame in sys._current_frames().iteritems():
+            if threadId == ownId:
+                continue
+            hooks = self.__activeHooks.get(threadId)
+            stack = self.__get_stack(frame, list(hooks) if hooks else None)
+            if stack is not None:
+                stacks.append(stack)
+        with self.__lock:
+            self.__stacks.update(stacks)
+            self.__numSamples += 1
+
+    def __sample_forever(self):
+        ownId = get_ident()
+        while self.__running:
+            try:
+                self.__sample(ownId)
+            except Exception as e:
+                logger.exception(e)
+            time.sleep(self.__interval)
+
+    def get_collapsed(self):
+        """Return the stacks as lines of 'frame;frame;... count'"""
+        with self.__lock:
+            stacks = self.__stacks.most_common()
+        return ''.join('%s %d\n' % (stack, count) for stack, count in stacks)
+
+    def get_hook_summary(self):
+        """Return the calls to each hook point and the time spent in them"""
+        with self.__lock:
+            hookLatencies = self.__hookLatencies.items()
+        lines = []
+        for name, histogram in hookLatencies:
+            snapshot = histogram.snapshot()
+            lines.append('%-24s %8d calls %10.1fms total %8.2fms mean '
+                         '%8.2fms p99' % (name, snapshot.count, snapshot.sum,
+                                          snapshot.mean,
+                                          snapshot.percentile(99)))
+        return lines
+
+    def dump(self, fileName):
+        with open(fileName, 'w') as ofs:
+            ofs.write(self.get_collapsed())
+        for line in self.get_hook_summary():
+            logger.info(line)
+
+
+def install_toggle_signal(profiler, fileName, signum=None):
+    """
+    Start and stop the profiler each time the process receives the signal,
+    SIGUSR2 by default. The samples are written when it stops.
+    """
+    if signum is None:
+        signum = getattr(signal, 'SIGUSR2', None)
+        if signum is None:
+            # Not available on Windows
+            return False
+
+    def toggle(signum, frame):
+        if profiler.running:
+            profiler.stop()
+            profiler.dump(fileName)
+            print 'Wrote %d profile samples to %s' % (profiler.numSamples,
+                                                      fileName)
+        else:
+            profiler.reset()
+            profiler.start()
+            print 'Profiling, send the signal again to stop'
+
+    signal.signal(signum, toggle)
+    return True
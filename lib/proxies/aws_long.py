@@ -1,14 +1,21 @@
-import boto3
 import json
 import logging
+import time
 
-from base64 import b64decode
+from base64 import b64decode, b64encode
 from random import SystemRandom
 
-from concurrent.futures import ThreadPoolExecutor
+from lib.crypto import EncryptionSession, decrypt_framed_content
 from lib.proxy import AbstractRequestProxy, ProxyResponse
+from lib.s3 import S3PayloadStore
 from lib.stats import LambdaStatsModel, S3StatsModel
+from lib.trace import current_trace
+from lib.transport import TransportSelector
 from lib.workers import LambdaSqsTaskConfig, LambdaSqsTask, WorkerManager
+from shared.crypto import REQUEST_META_NONCE, RESPONSE_META_NONCE, \
+    REQUEST_BODY_NONCE, RESPONSE_BODY_NONCE
+from shared.profiling import hook
+from shared.transport import FRAGMENTS_TRANSPORT, S3_TRANSPORT
 
 logger = logging.getLogger(__name__)
 
@@ -18,7 +25,8 @@ random = SystemRandom()
 class LongLivedLambdaProxy(AbstractRequestProxy):
     """Return a function that queues requests in SQS"""
 
-    def __init__(self, functions, maxLambdas, s3Bucket, stats, verbose):
+    def __init__(self, functions, maxLambdas, s3Bucket, stats, verbose,
+                 workerServer=None, s3Cache=False, pubKeyFile=None):
 
         # Supporting this across regions is not a priority since that would
         # incur costs for SQS and S3, and be error prone.
@@ -28,7 +36,6 @@ class LongLivedLambdaProxy(AbstractRequestProxy):
                 'long lived proxy')
 
         self.__verbose = verbose
-        self.__s3Bucket = s3Bucket
 
         if 'lambda' not in stats.models:
             stats.register_model('lambda', LambdaStatsModel())
@@ -38,8 +45,25 @@ class LongLivedLambdaProxy(AbstractRequestProxy):
             if 's3' not in stats.models:
                 stats.register_model('s3', S3StatsModel())
             self.__s3Stats = stats.get_model('s3')
-            self.__s3 = boto3.client('s3')
-            self.__s3DeletePool = ThreadPoolExecutor(1)
+            self.__s3Store = S3PayloadStore(s3Bucket, self.__s3Stats)
+
+        self.__encryption = None
+        if pubKeyFile is not None:
+            self.__encryption = EncryptionSession(pubKeyFile)
+        encryption = self.__encryption
+
+        # Let workers serve and store responses in a cache in the bucket.
+        # Cached objects are stored in the clear, so not with encryption.
+        self.__enableS3Cache = (s3Cache and s3Bucket is not None
+                                and encryption is None)
+
+        # Workers choose between SQS fragments and s3 for large responses
+        self.__transports = None
+        if s3Bucket is not None:
+            self.__transports = TransportSelector()
+            self.__transports.register(FRAGMENTS_TRANSPORT)
+            self.__transports.register(S3_TRANSPORT,
+                                       self.__s3Stats.getTransfers)
 
         class ProxyTask(LambdaSqsTaskConfig):
 
@@ -64,6 +88,9 @@ class LongLivedLambdaProxy(AbstractRequestProxy):
                 workerArgs['longLived'] = True
                 if s3Bucket:
                     workerArgs['s3Bucket'] = s3Bucket
+                if encryption is not None:
+                    # Workers unwrap the session key when they start
+                    _, workerArgs['key'] = encryption.new_request()
 
             def post_return_callback(self, workerId, workerResponse):
                 if workerResponse is not None:
@@ -74,28 +101,54 @@ class LongLivedLambdaProxy(AbstractRequestProxy):
                                  workerResponse['numRequestsProxied'],
                                  workerResponse['exitReason'])
 
-        self.workerManager = WorkerManager(ProxyTask(), stats)
-
-    def __delete_object_from_s3(self, key):
-        self.__s3.delete_object(Bucket=self.__s3Bucket, Key=key)
+        # Push tasks to workers over the reverse connection server, with
+        # SQS as the fallback
+        self.workerManager = WorkerManager(ProxyTask(), stats,
+                                           workerServer=workerServer)
 
-    def __load_object_from_s3(self, key):
-        result = self.__s3.get_object(Bucket=self.__s3Bucket, Key=key)
-        ret = result['Body'].read()
-        self.__s3DeletePool.submit(self.__delete_object_from_s3, key)
-        self.__s3Stats.record_get(len(ret))
-        return ret
+    def __decode_payload(self, body, cipher):
+        with hook('encoding'):
+            if cipher is not None:
+                return json.loads(cipher.decrypt_framed(RESPONSE_META_NONCE,
+                                                        b64decode(body)))
+            return json.loads(b64decode(body).decode('zlib'))
 
     def request(self, method, url, headers, data):
+        cipher = None
+        if self.__encryption is not None:
+            cipher, wrappedKey64 = self.__encryption.new_request()
+
         task = LambdaSqsTask()
         if data:
+            if cipher is not None:
+                data = cipher.encrypt_framed(REQUEST_BODY_NONCE, data)
             task.add_binary_attribute('data', data)
-        task.set_body(json.dumps({
+        requestParams = {
             'method': method,
             'url': url,
             'headers': headers
-        }))
+        }
+        if self.__transports is not None:
+            requestParams['transports'] = self.__transports.estimates()
+        if self.__enableS3Cache:
+            requestParams['s3Cache'] = True
+        trace = current_trace()
+        if trace is not None:
+            # The worker returns the timing of its phases
+            requestParams['trace'] = True
+        if cipher is not None:
+            requestParams = {
+                'key': wrappedKey64,
+                'nonce': b64encode(cipher.requestNonce),
+                'meta64': b64encode(cipher.encrypt_framed(
+                    REQUEST_META_NONCE, json.dumps(requestParams)))
+            }
+        task.set_body(json.dumps(requestParams))
+        startTime = time.time()
         result = self.workerManager.execute(task, timeout=10)
+        endTime = time.time()
+        if trace is not None:
+            trace.add_span('worker task', startTime, endTime)
         if result is None:
             return ProxyResponse(statusCode=500, headers={}, content='')
 
@@ -108,19 +161,30 @@ class LongLivedLambdaProxy(AbstractRequestProxy):
                     dataChunks.append(part.get_binary_attribute('data'))
                 if len(part.body) > 1:
                     # We use a hack to send practically empty bodies
-                    decodedBody = b64decode(part.body).decode('zlib')
-                    payload.update(json.loads(decodedBody))
+                    payload.update(self.__decode_payload(part.body, cipher))
             content = b''.join(dataChunks)
         else:
             # Single message
-            payload = json.loads(b64decode(result.body).decode('zlib'))
+            payload = self.__decode_payload(result.body, cipher)
             if result.has_attribute('s3'):
                 key = result.get_string_attribute('s3')
-                content = self.__load_object_from_s3(key)
+                uploadSeconds = 0.0
+                if result.has_attribute('s3PutMillis'):
+                    uploadSeconds = int(result.get_string_attribute(
+                        's3PutMillis')) / 1000.0
+                # Cached objects are left for the bucket's lifecycle rules
+                content = self.__s3Store.load(
+                    key, delete=not result.has_attribute('s3Cached'),
+                    uploadSeconds=uploadSeconds)
             elif result.has_attribute('data'):
                 content = result.get_binary_attribute('data')
             else:
                 content = b''
+        if trace is not None:
+            trace.add_lambda_timing(payload, startTime, endTime)
+        if cipher is not None and content:
+            content = decrypt_framed_content(cipher, RESPONSE_BODY_NONCE,
+                                             content)
         statusCode = payload['statusCode']
         responseHeaders = payload['headers']
         return ProxyResponse(statusCode=statusCode, headers=responseHeaders,
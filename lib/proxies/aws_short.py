@@ -1,28 +1,32 @@
-import boto3
-import hashlib
 import json
 import logging
+import time
 from base64 import b64encode, b64decode
 from random import SystemRandom
 from threading import Semaphore
 
 from concurrent.futures import ThreadPoolExecutor
-from Crypto.PublicKey import RSA
-from Crypto.Cipher import PKCS1_OAEP
-from Crypto.Random import get_random_bytes
-from lib.proxy import AbstractRequestProxy, ProxyResponse
-from lib.stats import LambdaStatsModel, S3StatsModel
+from lib import aws
+from lib.crypto import EncryptionSession, decrypt_framed_content
+from lib.proxy import AbstractRequestProxy, ProxyResponse, StreamedContent
+from lib.s3 import S3PayloadStore
+from lib.stats import LambdaStatsModel, S3StatsModel, ShardedCounter
+from lib.trace import current_trace, span
+from lib.transport import TransportSelector
 
 from shared.crypto import REQUEST_META_NONCE, RESPONSE_META_NONCE, \
-    REQUEST_BODY_NONCE, RESPONSE_BODY_NONCE, \
-    decrypt_with_gcm, encrypt_with_gcm
+    REQUEST_BODY_NONCE, RESPONSE_BODY_NONCE
+from shared.profiling import hook
 from shared.proxy import MAX_LAMBDA_BODY_SIZE
+from shared.transport import MESSAGE_TRANSPORT, S3_TRANSPORT, \
+    choose_transport
 
 logger = logging.getLogger(__name__)
 
 random = SystemRandom()
 
-SESSION_KEY_LENGTH = 16
+# Seconds a staged request body waits on the message server for the lambda
+REQUEST_BODY_MESSAGE_TIMEOUT = 60
 
 
 def _get_region_from_arn(arn):
@@ -34,19 +38,30 @@ class ShortLivedLambdaProxy(AbstractRequestProxy):
     """Invoke a lambda for each request"""
 
     def __init__(self, functions, maxParallelRequests, s3Bucket,
-                 pubKeyFile, messageServer, stats):
-        assert not (messageServer is not None and s3Bucket is not None)
-
+                 pubKeyFile, messageServer, stats, s3Cache=False):
         self.__functions = functions
         self.__functionToClient = {}
         self.__regionToClient = {}
         self.__lambdaRateSemaphore = Semaphore(maxParallelRequests)
-        self.__lambda = boto3.client('lambda')
+        self.__lambda = aws.deferred_client('lambda')
 
         if 'lambda' not in stats.models:
             stats.register_model('lambda', LambdaStatsModel())
         self.__lambdaStats = stats.get_model('lambda')
 
+        # Invocations holding and waiting for the semaphore
+        self.__numInvoking = ShardedCounter()
+        self.__numWaiting = ShardedCounter()
+        stats.register_gauge('lambda_invocations_running',
+                             lambda: self.__numInvoking.value,
+                             'Lambda invocations in progress')
+        stats.register_gauge('lambda_invocations_waiting',
+                             lambda: self.__numWaiting.value,
+                             'Requests waiting for a lambda invocation')
+        stats.register_gauge('lambda_invocations_limit',
+                             lambda: maxParallelRequests,
+                             'Max lambda invocations in progress')
+
         # Use local message server to receive large payloads
         self.__enableMessageServer = messageServer is not None
         self.__messageServer = messageServer
@@ -58,16 +73,33 @@ class ShortLivedLambdaProxy(AbstractRequestProxy):
             if 's3' not in stats.models:
                 stats.register_model('s3', S3StatsModel())
             self.__s3Stats = stats.get_model('s3')
-            self.__s3 = boto3.client('s3')
-            self.__s3DeletePool = ThreadPoolExecutor(1)
+            self.__s3Store = S3PayloadStore(s3Bucket, self.__s3Stats)
             self.__enableS3 = True
 
+        # Let the lambda serve and store responses in a cache in the bucket
+        self.__enableS3Cache = s3Cache and self.__enableS3
+
         # Enable encryption
         self.__enableEncryption = False
         if pubKeyFile is not None:
-            with open(pubKeyFile, 'rb') as ifs:
-                self.__rsaCipher = PKCS1_OAEP.new(RSA.importKey(ifs.read()))
-                self.__enableEncryption = True
+            self.__encryptionSession = EncryptionSession(pubKeyFile)
+            self.__enableEncryption = True
+
+        # Stream large responses through the message server
+        self.__enableMessageStreams = False
+        if self.__enableMessageServer:
+            self.__invokePool = ThreadPoolExecutor(maxParallelRequests)
+            self.__enableMessageStreams = True
+
+        # Bodies too large for the invocation go over the transport that
+        # is expected to be fastest, based on the transfers so far
+        self.__transports = TransportSelector()
+        if self.__enableS3:
+            self.__transports.register(S3_TRANSPORT,
+                                       self.__s3Stats.getTransfers)
+        if self.__enableMessageServer:
+            self.__transports.register(MESSAGE_TRANSPORT,
+                                       messageServer.messageTransfers)
 
     def __get_lambda_client(self, function):
         """Get a lambda client from the right region"""
@@ -82,108 +114,181 @@ class ShortLivedLambdaProxy(AbstractRequestProxy):
             region = _get_region_from_arn(function)
             client = self.__regionToClient.get(region)
             if client is None:
-                client = boto3.client('lambda', region_name=region)
+                client = aws.client('lambda', region_name=region)
                 self.__regionToClient[region] = client
             self.__functionToClient[function] = client
         return client
 
-    def __delete_object_from_s3(self, key):
-        assert self.__enableS3 is True
-        self.__s3.delete_object(Bucket=self.__s3Bucket, Key=key)
-
-    def __load_object_from_s3(self, key):
-        assert self.__enableS3 is True
-        result = self.__s3.get_object(Bucket=self.__s3Bucket, Key=key)
-        ret = result['Body'].read()
-        self.__s3DeletePool.submit(self.__delete_object_from_s3, key)
-        self.__s3Stats.record_get(len(ret))
-        return ret
-
-    def __put_object_into_s3(self, data):
-        assert self.__enableS3 is True
-        md5 = hashlib.md5()
-        md5.update(data)
-        key = md5.hexdigest()
-        s3Bucket = boto3.resource('s3').Bucket(self.__s3Bucket)
-        s3Bucket.put_object(Key=key, Body=data,
-                            StorageClass='REDUCED_REDUNDANCY')
-        self.__s3Stats.record_get(len(data))
-        return key
-
-    def __prepare_request_body(self, body, sessionKey):
+    def __prepare_request_body(self, body, cipher, estimates):
         bodyArgs = {}
+        candidates = []
+        if self.__enableS3:
+            candidates.append(S3_TRANSPORT)
+        if self.__enableMessageServer:
+            candidates.append(MESSAGE_TRANSPORT)
+        transport = choose_transport(len(body), candidates, estimates)
         if len(body) <= MAX_LAMBDA_BODY_SIZE:
             if self.__enableEncryption:
-                bodyData, bodyTag = encrypt_with_gcm(sessionKey, body,
-                                                     REQUEST_BODY_NONCE)
-                bodyArgs['bodyTag'] = b64encode(bodyTag)
+                bodyData = cipher.encrypt_framed(REQUEST_BODY_NONCE, body)
                 bodyArgs['body64'] = b64encode(bodyData)
             else:
                 bodyArgs['body64'] = b64encode(body)
-        elif self.__enableS3:
+        elif transport == S3_TRANSPORT:
             if self.__enableEncryption:
-                assert sessionKey is not None
-                s3Data, s3Tag = encrypt_with_gcm(sessionKey, body,
-                                                 REQUEST_BODY_NONCE)
-                bodyArgs['s3Tag'] = b64encode(s3Tag)
+                assert cipher is not None
+                s3Data = cipher.encrypt_framed(REQUEST_BODY_NONCE, body)
             else:
                 s3Data = body
-            requestS3Key = self.__put_object_into_s3(s3Data)
+            requestS3Key = self.__s3Store.put(s3Data)
             bodyArgs['s3Key'] = requestS3Key
+        elif transport == MESSAGE_TRANSPORT:
+            if self.__enableEncryption:
+                assert cipher is not None
+                messageData = cipher.encrypt_framed(REQUEST_BODY_NONCE, body)
+            else:
+                messageData = body
+            # The lambda fetches the body with a GET to the message server
+            messageId = '%032x' % random.getrandbits(128)
+            self.__messageServer.put_message(
+                messageId, messageData, timeout=REQUEST_BODY_MESSAGE_TIMEOUT)
+            bodyArgs['bodyMessageId'] = messageId
+        else:
+            return None
         return bodyArgs
 
-    def __prepare_encrypted_metadata(self, metaArgs, sessionKey):
-        assert sessionKey is not None
-        ciphertext, tag = encrypt_with_gcm(sessionKey,
-                                           json.dumps(metaArgs),
-                                           REQUEST_META_NONCE)
-        key = self.__rsaCipher.encrypt(sessionKey)
+    def __prepare_encrypted_metadata(self, metaArgs, cipher, wrappedKey64):
+        assert cipher is not None
+        ciphertext, tag = cipher.encrypt(REQUEST_META_NONCE,
+                                         json.dumps(metaArgs))
         return {
             'meta64': b64encode(ciphertext),
             'metaTag': b64encode(tag),
-            'key': b64encode(key)
+            'key': wrappedKey64,
+            'nonce': b64encode(cipher.requestNonce)
         }
 
-    def __handle_encrypted_metadata(self, response, sessionKey):
-        assert sessionKey is not None
+    def __handle_encrypted_body(self, response, tagName, content, cipher):
+        """Bodies with a tag were encrypted as a whole by older lambdas"""
+        assert cipher is not None
+        if tagName in response:
+            if isinstance(content, StreamedContent):
+                try:
+                    content = b''.join(content)
+                finally:
+                    content.close()
+            elif not isinstance(content, str):
+                # Spilled messages are buffers, which must be copied
+                content = str(content)
+            tag = b64decode(response[tagName])
+            return cipher.decrypt(RESPONSE_BODY_NONCE, content, tag)
+        return decrypt_framed_content(cipher, RESPONSE_BODY_NONCE, content)
+
+    def __handle_encrypted_metadata(self, response, cipher):
+        assert cipher is not None
         ciphertext = b64decode(response['meta64'])
         tag = b64decode(response['metaTag'])
-        plaintext = decrypt_with_gcm(sessionKey, ciphertext, tag,
-                                     RESPONSE_META_NONCE)
+        plaintext = cipher.decrypt(RESPONSE_META_NONCE, ciphertext, tag)
         return json.loads(plaintext)
 
-    def __handle_response_body(self, response, sessionKey):
+    def __handle_response_body(self, response, cipher):
         content = b''
         if 'content64' in response:
-            content = b64decode(response['content64'])
+            with hook('encoding'):
+                content = b64decode(response['content64'])
             if self.__enableEncryption:
-                assert sessionKey is not None
-                tag = b64decode(response['contentTag'])
-                content = decrypt_with_gcm(sessionKey, content, tag,
-                                           RESPONSE_BODY_NONCE)
+                content = self.__handle_encrypted_body(response, 'contentTag',
+                                                       content, cipher)
         elif 's3Key' in response:
-            content = self.__load_object_from_s3(response['s3Key'])
+            # Large objects are streamed while the parts arrive. Cached
+            # objects are left for the bucket's lifecycle rules.
+            content = self.__s3Store.load(
+                response['s3Key'], delete=not response.get('s3Cached'),
+                uploadSeconds=response.get('s3PutMillis', 0) / 1000.0)
             if self.__enableEncryption:
-                assert sessionKey is not None
-                tag = b64decode(response['s3Tag'])
-                content = decrypt_with_gcm(sessionKey, content, tag,
-                                           RESPONSE_BODY_NONCE)
+                content = self.__handle_encrypted_body(response, 's3Tag',
+                                                       content, cipher)
         elif 'messageId' in response:
-            content = self.__messageServer.get_message(response['messageId']).content
+            content = self.__messageServer.get_message(
+                response['messageId']).open_content()
             if self.__enableEncryption:
-                assert sessionKey is not None
-                tag = b64decode(response['messageTag'])
-                content = decrypt_with_gcm(sessionKey, content, tag,
-                                           RESPONSE_BODY_NONCE)
+                content = self.__handle_encrypted_body(response, 'messageTag',
+                                                       content, cipher)
         return content
 
+    def __handle_message_stream(self, stream, cipher):
+        if not self.__enableEncryption:
+            return ProxyResponse(statusCode=stream.statusCode,
+                                 headers=stream.headers, content=stream)
+        try:
+            responseMeta = self.__handle_encrypted_metadata(stream.meta,
+                                                            cipher)
+        except:
+            stream.close()
+            raise
+        content = decrypt_framed_content(cipher, RESPONSE_BODY_NONCE, stream)
+        return ProxyResponse(statusCode=responseMeta['statusCode'],
+                             headers=responseMeta['headers'],
+                             content=content)
+
+    def __invoke_lambda(self, invokeArgs, trace=None):
+        """Return (invokeResponse, (startTime, endTime) of the invoke)"""
+        function = random.choice(self.__functions)
+        lambdaClient = self.__get_lambda_client(function)
+
+        waitStartTime = time.time()
+        self.__numWaiting.add()
+        self.__lambdaRateSemaphore.acquire()
+        self.__numWaiting.add(-1)
+        self.__numInvoking.add()
+        startTime = time.time()
+        try:
+            with self.__lambdaStats.record() as billingObject:
+                invokeResponse = lambdaClient.invoke(
+                    FunctionName=function,
+                    Payload=json.dumps(invokeArgs),
+                    LogType='Tail')
+                billingObject.parse_log(invokeResponse['LogResult'])
+        finally:
+            self.__numInvoking.add(-1)
+            self.__lambdaRateSemaphore.release()
+            endTime = time.time()
+            if trace is not None:
+                trace.add_span('semaphore wait', waitStartTime, startTime)
+                trace.add_span('invoke', startTime, endTime)
+        return invokeResponse, (startTime, endTime)
+
+    def __invoke_lambda_with_stream(self, invokeArgs, messageId, trace=None):
+        """
+        Return (None, stream) as soon as the lambda starts posting the
+        message stream, or ((invokeResponse, invokeTime), None) if the
+        lambda returned without streaming the body
+        """
+        messageServer = self.__messageServer
+        messageServer.expect_message_stream(messageId)
+
+        def invoke_done(future):
+            messageServer.abandon_message_stream(messageId)
+            if future.exception() is not None:
+                logger.error('Failed to invoke lambda: %s',
+                             future.exception())
+
+        invokeFuture = self.__invokePool.submit(self.__invoke_lambda,
+                                                invokeArgs, trace)
+        invokeFuture.add_done_callback(invoke_done)
+        stream = messageServer.get_message_stream(messageId)
+        if stream is not None:
+            return None, stream
+        return invokeFuture.result(), None
+
     def request(self, method, url, headers, body):
         logger.debug('Proxying %s %s with Lamdba', method, url)
-        sessionKey = None
+        trace = current_trace()
+        cipher = None
         if self.__enableEncryption:
-            sessionKey = get_random_bytes(SESSION_KEY_LENGTH)
+            cipher, wrappedKey64 = self.__encryptionSession.new_request()
 
         requestS3Key = None
+        requestMessageId = None
         try:
             invokeArgs = {
                 'method': method,
@@ -192,31 +297,56 @@ class ShortLivedLambdaProxy(AbstractRequestProxy):
             }
             if self.__enableS3:
                 invokeArgs['s3Bucket'] = self.__s3Bucket
+            if self.__enableS3Cache:
+                invokeArgs['s3Cache'] = True
             if self.__enableMessageServer:
                 invokeArgs['messageServer'] = self.__messageServer.publicHostAndPort
+            streamMessageId = None
+            if self.__enableMessageStreams:
+                # Large responses are streamed to the message server
+                streamMessageId = '%032x' % random.getrandbits(128)
+                invokeArgs['streamMessageId'] = streamMessageId
+            estimates = None
+            if self.__enableS3 or self.__enableMessageServer:
+                # The lambda picks the transport for large responses
+                estimates = self.__transports.estimates()
+                invokeArgs['transports'] = estimates
             if self.__enableEncryption:
-                invokeArgs = self.__prepare_encrypted_metadata(invokeArgs,
-                                                               sessionKey)
+                # Bodies are encrypted in frames, so they can be streamed
+                invokeArgs['framedBodies'] = True
+                invokeArgs = self.__prepare_encrypted_metadata(
+                    invokeArgs, cipher, wrappedKey64)
+            if trace is not None:
+                # The lambda returns the timing of its phases
+                invokeArgs['trace'] = True
             if body is not None:
-                invokeArgs.update(self.__prepare_request_body(body, sessionKey))
-
-            function = random.choice(self.__functions)
-            lambdaClient = self.__get_lambda_client(function)
-
-            self.__lambdaRateSemaphore.acquire()
-            try:
-                with self.__lambdaStats.record() as billingObject:
-                    invokeResponse = lambdaClient.invoke(
-                        FunctionName=function,
-                        Payload=json.dumps(invokeArgs),
-                        LogType='Tail')
-                    billingObject.parse_log(invokeResponse['LogResult'])
-            finally:
-                self.__lambdaRateSemaphore.release()
+                bodyArgs = self.__prepare_request_body(body, cipher,
+                                                       estimates)
+                if bodyArgs is None:
+                    logger.error('No transport for %dB request body: %s',
+                                 len(body), url)
+                    return ProxyResponse(statusCode=413, headers={},
+                                         content='')
+                requestS3Key = bodyArgs.get('s3Key')
+                requestMessageId = bodyArgs.get('bodyMessageId')
+                invokeArgs.update(bodyArgs)
+
+            if streamMessageId is not None:
+                invokeResult, stream = self.__invoke_lambda_with_stream(
+                    invokeArgs, streamMessageId, trace)
+                if stream is not None:
+                    return self.__handle_message_stream(stream, cipher)
+            else:
+                invokeResult = self.__invoke_lambda(invokeArgs, trace)
+            invokeResponse, invokeTime = invokeResult
         finally:
             if requestS3Key is not None:
-                self.__s3DeletePool.submit(self.__delete_object_from_s3,
-                                           requestS3Key)
+                self.__s3Store.delete(requestS3Key)
+            if requestMessageId is not None:
+                # In case the lambda never fetched it
+                message = self.__messageServer.get_message(requestMessageId)
+                if message is not None:
+                    message.close()
 
         if invokeResponse['StatusCode'] != 200:
             logger.error('%s: status=%d', invokeResponse['FunctionError'],
@@ -227,15 +357,20 @@ class ShortLivedLambdaProxy(AbstractRequestProxy):
                          invokeResponse['Payload'].read())
             return ProxyResponse(statusCode=500, headers={}, content='')
 
-        response = json.loads(invokeResponse['Payload'].read())
+        payload = invokeResponse['Payload'].read()
+        with hook('encoding'):
+            response = json.loads(payload)
+        if trace is not None:
+            trace.add_lambda_timing(response, *invokeTime)
         if self.__enableEncryption:
             responseMeta = (self.__handle_encrypted_metadata(response,
-                                                             sessionKey))
+                                                             cipher))
             statusCode = responseMeta['statusCode']
             headers = responseMeta['headers']
         else:
             statusCode = response['statusCode']
             headers = response['headers']
-        content = self.__handle_response_body(response, sessionKey)
+        with span('response body'):
+            content = self.__handle_response_body(response, cipher)
         return ProxyResponse(statusCode=statusCode, headers=headers,
                              content=content)
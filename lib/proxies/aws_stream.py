@@ -1,18 +1,22 @@
-import boto3
 import json
 import logging
+import time
 from random import SystemRandom
 from threading import Semaphore
 
 from Crypto.PublicKey import RSA
 from Crypto.Cipher import PKCS1_OAEP
+from lib import aws
 from lib.proxy import AbstractStreamProxy
-from lib.stats import LambdaStatsModel
+from lib.stats import LambdaStatsModel, ShardedCounter
+from lib.trace import current_trace
 
 logger = logging.getLogger(__name__)
 
 random = SystemRandom()
 
+STREAM_CLOSE_TIMEOUT = 5
+
 
 def _get_region_from_arn(arn):
     elements = arn.split(':')
@@ -41,12 +45,25 @@ class StreamLambdaProxy(AbstractStreamProxy):
         self.__functionToClient = {}
         self.__regionToClient = {}
         self.__lambdaRateSemaphore = Semaphore(maxParallelRequests)
-        self.__lambda = boto3.client('lambda')
+        self.__lambda = aws.deferred_client('lambda')
 
         if 'lambda' not in stats.models:
             stats.register_model('lambda', LambdaStatsModel())
         self.__lambdaStats = stats.get_model('lambda')
 
+        # Streams holding and waiting for the semaphore
+        self.__numStreaming = ShardedCounter()
+        self.__numWaiting = ShardedCounter()
+        stats.register_gauge('lambda_streams_running',
+                             lambda: self.__numStreaming.value,
+                             'Lambdas streaming a connection')
+        stats.register_gauge('lambda_streams_waiting',
+                             lambda: self.__numWaiting.value,
+                             'Connections waiting for a lambda')
+        stats.register_gauge('lambda_streams_limit',
+                             lambda: maxParallelRequests,
+                             'Max lambdas streaming at once')
+
         self.__streamServer = streamServer
 
         # Enable encryption
@@ -69,7 +86,7 @@ class StreamLambdaProxy(AbstractStreamProxy):
             region = _get_region_from_arn(function)
             client = self.__regionToClient.get(region)
             if client is None:
-                client = boto3.client('lambda', region_name=region)
+                client = aws.client('lambda', region_name=region)
                 self.__regionToClient[region] = client
             self.__functionToClient[function] = client
         return client
@@ -88,22 +105,39 @@ class StreamLambdaProxy(AbstractStreamProxy):
             'port': int(servInfo.port),
             'idleTimeout': self.__connIdleTimeout
         }
+        trace = current_trace()
+        if trace is not None:
+            invokeArgs['trace'] = True
 
         function = random.choice(self.__functions)
         lambdaClient = self.__get_lambda_client(function)
 
+        waitStartTime = time.time()
+        self.__numWaiting.add()
         self.__lambdaRateSemaphore.acquire()
+        self.__numWaiting.add(-1)
+        self.__numStreaming.add()
+        startTime = time.time()
         try:
-            self.__streamServer.take_ownership_of_socket(socketId, cliSock,
-                                                         self.__connIdleTimeout)
+            sockObj = self.__streamServer.take_ownership_of_socket(
+                socketId, cliSock, self.__connIdleTimeout)
             with self.__lambdaStats.record() as billingObject:
                 invokeResponse = lambdaClient.invoke(
                     FunctionName=function,
                     Payload=json.dumps(invokeArgs),
                     LogType='Tail')
                 billingObject.parse_log(invokeResponse['LogResult'])
+            if not self.__streamServer.release_socket(socketId):
+                # The reverse connection can still be writing the last bytes
+                # from the lambda, and the client is closed once this returns
+                sockObj.wait_closed(STREAM_CLOSE_TIMEOUT)
         finally:
+            self.__numStreaming.add(-1)
             self.__lambdaRateSemaphore.release()
+            endTime = time.time()
+            if trace is not None:
+                trace.add_span('semaphore wait', waitStartTime, startTime)
+                trace.add_span('invoke', startTime, endTime)
 
         if invokeResponse['StatusCode'] != 200:
             logger.error('%s: status=%d', invokeResponse['FunctionError'],
@@ -111,3 +145,7 @@ class StreamLambdaProxy(AbstractStreamProxy):
         if 'FunctionError' in invokeResponse:
             logger.error('%s error: %s', invokeResponse['FunctionError'],
                          invokeResponse['Payload'].read())
+        elif trace is not None:
+            trace.add_lambda_timing(
+                json.loads(invokeResponse['Payload'].read()), startTime,
+                endTime)
@@ -1,23 +1,41 @@
-import atexit
 import logging
-import os
-import shutil
+import select
 import socket
 import ssl
-import tempfile
 
+from collections import deque, namedtuple
+from concurrent import futures
+from concurrent.futures import ThreadPoolExecutor
 from httplib import responses
-from OpenSSL import crypto
-from random import SystemRandom
 from termcolor import colored
-from threading import Lock
 
-from lib.headers import FILTERED_REQUEST_HEADERS, FILTERED_RESPONSE_HEADERS, \
-    DEFAULT_USER_AGENT
-from lib.proxy import AbstractRequestProxy, AbstractStreamProxy
+from lib.certs import CertificateStore
+from lib.headers import DEFAULT_USER_AGENT, filter_request_headers, \
+    is_filtered_response_header
+from lib.proxies.mitm_h2 import H2_ALPN_PROTOCOL, H2MitmConnection, \
+    is_h2_available
+from lib.proxy import AbstractRequestProxy, AbstractStreamProxy, \
+    ProxyResponse, StreamedContent, close_content, write_content
+from shared.http import HttpParseError, HttpParser
 
 logger = logging.getLogger(__name__)
 
+# Connections are closed after waiting this long for a request
+DEFAULT_IDLE_TIMEOUT = 60
+
+# Requests on a connection that may be proxied ahead of the response that is
+# being sent
+DEFAULT_MAX_PIPELINED_REQUESTS = 8
+DEFAULT_MAX_REQUEST_THREADS = 128
+
+# How often to check for pipelined requests while waiting for a response
+PIPELINE_POLL_INTERVAL = 0.05
+
+NO_BODY_STATUS_CODES = {204, 304}
+
+# The MITM frames responses itself
+FRAMING_HEADERS = {'content-length', 'transfer-encoding'}
+
 
 def _print_mitm_request(method, url, headers):
     print colored('command (https): %s %s' % (method, url), 'white', 'on_red')
@@ -30,7 +48,16 @@ def _print_mitm_response(url, response):
     print 'status:', response.statusCode
     for k, v in response.headers.iteritems():
         print '  %s: %s' % (k, v)
-    print 'content-len:', len(response.content)
+    if isinstance(response.content, StreamedContent):
+        print 'content-len: (streamed)'
+    else:
+        print 'content-len:', len(response.content)
+
+
+def _close_response(future):
+    """Close the content of a proxied response that will not be sent"""
+    if not future.cancelled() and future.exception() is None:
+        close_content(future.result().content)
 
 
 class MitmHttpsProxy(AbstractStreamProxy):
@@ -48,32 +75,37 @@ class MitmHttpsProxy(AbstractStreamProxy):
         def __str__(self):
             return self.host + ':' + self.port
 
-    __secureRandom = SystemRandom()
-
     def __init__(self, requestProxy, certfile, keyfile, stats,
-                 overrideUserAgent=False, verbose=False):
+                 overrideUserAgent=False, verbose=False, certDir=None,
+                 wildcardCerts=False, idleTimeout=DEFAULT_IDLE_TIMEOUT,
+                 maxPipelinedRequests=DEFAULT_MAX_PIPELINED_REQUESTS,
+                 enableHttp2=False):
         assert isinstance(requestProxy, AbstractRequestProxy)
         self.__proxyModel = stats.get_model('proxy')
-
-        self.__certCache = {}
-        self.__certCacheLock = Lock()
+        self.__tracer = stats.tracer
 
         # Config
         self.__verbose = verbose
         self.__overrideUserAgent = overrideUserAgent
+        self.__idleTimeout = idleTimeout
+        self.__maxPipelinedRequests = maxPipelinedRequests
 
         # Single request proxy
         self.__requestProxy = requestProxy
+        self.__requestPool = ThreadPoolExecutor(DEFAULT_MAX_REQUEST_THREADS)
 
-        # Load root CA certificate and key
-        self.__caCert = crypto.load_certificate(crypto.FILETYPE_PEM,
-                                                open(certfile).read())
-        self.__caKey = crypto.load_privatekey(crypto.FILETYPE_PEM,
-                                              open(keyfile).read())
+        # Browsers may negotiate HTTP/2 to multiplex requests
+        alpnProtocols = None
+        if enableHttp2:
+            if is_h2_available():
+                alpnProtocols = [H2_ALPN_PROTOCOL, 'http/1.1']
+            else:
+                logger.warn('HTTP/2 requires the h2 package')
 
-        tempCertDir = tempfile.mkdtemp(suffix='mitmproxy')
-        atexit.register(lambda: shutil.rmtree(tempCertDir))
-        self.__tempCertDir = tempCertDir
+        # Issues certificates signed by the root CA
+        self.__certStore = CertificateStore(certfile, keyfile, certDir,
+                                            wildcard=wildcardCerts,
+                                            alpnProtocols=alpnProtocols)
 
     def connect(self, host, port):
         return MitmHttpsProxy.Connection(host, port)
@@ -81,116 +113,147 @@ class MitmHttpsProxy(AbstractStreamProxy):
     def stream(self, cliSock, servConn):
         assert isinstance(servConn, MitmHttpsProxy.Connection)
 
-        certFile, keyFile = self.__get_cert_for_host(servConn.host)
-        context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
-        context.load_cert_chain(certFile, keyFile)
-        cliSslSock = context.wrap_socket(cliSock, server_side=True)
+        cliSslSock = self.__certStore.wrap_server_socket(cliSock,
+                                                         servConn.host)
+        cliSslSock.settimeout(self.__idleTimeout)
         try:
-            self.__stream_one_request(cliSslSock, servConn)
+            if cliSslSock.selected_alpn_protocol() == H2_ALPN_PROTOCOL:
+                H2MitmConnection(cliSslSock, servConn,
+                                 self.__dispatch_request, self.__get_response,
+                                 MitmRequest, self.__proxyModel,
+                                 self.__idleTimeout).serve()
+            else:
+                self.__serve_requests(cliSslSock, servConn)
+        except socket.timeout:
+            logger.debug('Closing idle connection: %s', servConn)
+        except ssl.SSLError as e:
+            # Python 2 reports timeouts on SSL sockets as SSLErrors
+            if 'timed out' in str(e):
+                logger.debug('Closing idle connection: %s', servConn)
+            else:
+                logger.exception(e)
         except Exception as e:
             logger.exception(e)
         finally:
-            cliSslSock.shutdown(socket.SHUT_RDWR)
-
-    def __sign_cert_for_host(self, host):
-        serial = self.__secureRandom.getrandbits(32)
-
-        key = crypto.PKey()
-        key.generate_key(crypto.TYPE_RSA, 2048)
-
-        cert = crypto.X509()
-        cert.get_subject().C = 'US'
-        cert.get_subject().ST = 'California'
-        cert.get_subject().L = 'Palo Alto'
-        cert.get_subject().O = 'DIY Project'
-        cert.get_subject().OU = 'Lambda MITM Proxy'
-        cert.get_subject().CN = host
-        cert.gmtime_adj_notBefore(0)
-        cert.gmtime_adj_notAfter(24 * 60 * 60)
-        cert.set_serial_number(serial)
-        cert.set_issuer(self.__caCert.get_subject())
-        cert.set_pubkey(key)
-        cert.sign(self.__caKey, 'sha1')
-
-        keyPath = os.path.join(self.__tempCertDir,
-                               host.replace('.', '_') + '.key')
-        certPath = os.path.join(self.__tempCertDir,
-                                host.replace('.', '_') + '.pem')
-        with open(keyPath, 'wb') as ofs:
-            ofs.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, key))
-        with open(certPath, 'wb') as ofs:
-            ofs.write(crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
-        return (certPath, keyPath)
-
-    def __get_cert_for_host(self, host):
-        with self.__certCacheLock:
-            resp = self.__certCache.get(host)
-            if resp is None:
-                resp = self.__sign_cert_for_host(host)
-                self.__certCache[host] = resp
-        return resp
-
-    def __stream_one_request(self, cliSslSock, servSock):
-        # Read until the end of the headers
-        totalRequestLen = 0
-        data = b''
-        while True:
-            chunk = cliSslSock.recv(8192)
-            if chunk == '':
-                raise IOError('Unable to parse request: %s' % servSock)
-            data += chunk
-            totalRequestLen += len(chunk)
-            if '\r\n\r\n' in data:
-                splitIdx = data.index('\r\n\r\n')
-                request = data[:splitIdx]
-                data = data[splitIdx + 4:]
-                break
-
-        # Parse the headers
-        contentLength = 0
-        requestLines = request.splitlines()
-        method, path, httpVersion = requestLines[0].split(' ', 2)
-        url = 'https://%s:%s%s' % (servSock.host, servSock.port, path)
-        headers = {}
-        for headerLine in requestLines[1:]:
-            header, value = headerLine.split(': ', 1)
-            if header in FILTERED_REQUEST_HEADERS:
-                continue
-            if header == 'Content-Length':
-                contentLength = int(value)
-            headers[header] = value
+            try:
+                cliSslSock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def __serve_requests(self, cliSslSock, servConn):
+        """
+        Serve requests until either side closes the connection. Requests
+        that the client pipelines are proxied concurrently, and responses
+        are sent in order.
+        """
+        reader = _RequestReader(cliSslSock)
+        pending = deque()
+        try:
+            while True:
+                if not pending:
+                    # Idle until the next request, or the socket timeout
+                    request = reader.read_request(servConn)
+                    if request is None:
+                        break
+                    self.__enqueue_request(request, reader, pending)
+                request, future = pending[0]
+                while not future.done():
+                    if (reader.closed
+                            or len(pending) >= self.__maxPipelinedRequests):
+                        futures.wait([future])
+                        continue
+                    # A partly received request must not hold up the
+                    # response that is ready to be sent
+                    nextRequest = reader.poll_request(servConn,
+                                                      PIPELINE_POLL_INTERVAL)
+                    if nextRequest is not None:
+                        self.__enqueue_request(nextRequest, reader, pending)
+                pending.popleft()
+                keepAlive = self.__send_response(
+                    cliSslSock, request, self.__get_response(request, future))
+                if not keepAlive:
+                    break
+                if reader.closed and not pending:
+                    break
+        finally:
+            # Responses to requests that are still queued are never sent
+            for _, future in pending:
+                if not future.cancel():
+                    future.add_done_callback(_close_response)
+
+    def __enqueue_request(self, request, reader, pending):
+        """Start proxying a request behind those that are pending"""
+        if not request.keepAlive:
+            # Nothing more is read after the last request
+            reader.closed = True
+        pending.append((request, self.__dispatch_request(request)))
+
+    def __dispatch_request(self, request):
+        """Start proxying a MitmRequest, returning a future"""
+        self.__proxyModel.record_bytes_up(request.size)
         if self.__overrideUserAgent:
-            headers['User-Agent'] = DEFAULT_USER_AGENT
-        headers['Connection'] = 'keep-alive'
-
-        # Read the rest of the body
-        if contentLength > 0:
-            while len(data) < contentLength:
-                chunk = cliSslSock.recv(8192)
-                if chunk == '':
-                    raise IOError('Failed to read all data: %s' % servSock)
-                data += chunk
-                totalRequestLen += len(chunk)
-        else:
-            data = None
-
-        self.__proxyModel.record_bytes_up(totalRequestLen)
-
+            request.headers['User-Agent'] = DEFAULT_USER_AGENT
+        request.headers['Connection'] = 'keep-alive'
         if self.__verbose:
-            _print_mitm_request(method, url, headers)
-        response = self.__requestProxy.request(method, url, headers, data)
+            _print_mitm_request(request.method, request.url, request.headers)
+        return self.__requestPool.submit(self.__proxy_request, request)
+
+    def __proxy_request(self, request):
+        if self.__tracer is None:
+            return self.__requestProxy.request(request.method, request.url,
+                                               request.headers, request.body)
+        with self.__tracer.trace(request.method, url=request.url,
+                                 httpVersion=request.httpVersion):
+            return self.__requestProxy.request(request.method, request.url,
+                                               request.headers, request.body)
+
+    def __get_response(self, request, future):
+        try:
+            response = future.result()
+        except Exception as e:
+            logger.exception(e)
+            response = ProxyResponse(statusCode=502, headers={}, content='')
         if self.__verbose:
-            _print_mitm_response(url, response)
+            _print_mitm_response(request.url, response)
+        return response
+
+    def __send_response(self, cliSslSock, request, response):
+        """Returns whether the connection may be reused"""
+        keepAlive = request.keepAlive
+        statusCode = response.statusCode
+        content = response.content
+        hasBody = (request.method != 'HEAD' and statusCode >= 200
+                   and statusCode not in NO_BODY_STATUS_CODES)
 
         responseLines = []
         responseLines.append('%s %d %s' %
-                             (httpVersion, response.statusCode,
-                              responses[response.statusCode]))
-        for header in response.headers:
-            if header in FILTERED_RESPONSE_HEADERS:
+                             (request.httpVersion, statusCode,
+                              responses.get(statusCode, '')))
+        for header, value in response.headers.iteritems():
+            if is_filtered_response_header(header):
                 continue
-            responseLines.append('%s: %s' % (header, response.headers[header]))
-        responseLines.append('Connection: close')
+            # Responses to HEAD keep the length of the body they omit
+            if hasBody and header.lower() in FRAMING_HEADERS:
+                continue
+            responseLines.append('%s: %s' % (header, value))
+
+        chunked = False
+        if not hasBody:
+            if isinstance(content, StreamedContent):
+                content.close()
+            content = None
+        elif isinstance(content, StreamedContent):
+            if request.httpVersion == 'HTTP/1.1':
+                responseLines.append('Transfer-Encoding: chunked')
+                chunked = True
+            else:
+                # The end of the body is marked by closing the connection
+                keepAlive = False
+        else:
+            responseLines.append('Content-Length: %d' %
+                                 (len(content) if content else 0))
+        responseLines.append('Connection: %s' %
+                             ('keep-alive' if keepAlive else 'close'))
         responseLines.append('')
         responseLines.append('')
 
@@ -199,10 +262,105 @@ class MitmHttpsProxy(AbstractStreamProxy):
             responseHeaders = '\r\n'.join(responseLines)
             responseSize += len(responseHeaders)
             cliSslSock.sendall(responseHeaders)
-            if response.content:
-                responseSize += len(response.content)
-                cliSslSock.sendall(response.content)
+            if content is None:
+                pass
+            elif chunked:
+                def write_chunk(chunk):
+                    if chunk:
+                        cliSslSock.sendall('%x\r\n%s\r\n' %
+                                           (len(chunk), chunk))
+                responseSize += write_content(write_chunk, content)
+                cliSslSock.sendall('0\r\n\r\n')
+            else:
+                responseSize += write_content(cliSslSock.sendall, content)
         except socket.error as e:
             logger.warn('Error sending response: %s', e)
+            keepAlive = False
         finally:
+            # Unless it was written, as when the client went away
+            close_content(response.content)
             self.__proxyModel.record_bytes_down(responseSize)
+        return keepAlive
+
+
+MitmRequest = namedtuple('MitmRequest', [
+    'method', 'url', 'headers', 'body', 'httpVersion', 'keepAlive', 'size'
+])
+
+
+class _RequestReader(object):
+    """Reads consecutive requests from a socket"""
+
+    def __init__(self, sock):
+        self.__sock = sock
+        self.__parser = HttpParser()
+        self.__head = None
+        self.closed = False
+
+    def read_request(self, servSock):
+        """Return a MitmRequest, or None if the client closed cleanly"""
+        try:
+            while True:
+                request = self.__parse_request(servSock)
+                if request is not None or not self.__recv():
+                    return request
+        except HttpParseError:
+            self.closed = True
+            raise
+
+    def poll_request(self, servSock, timeout):
+        """
+        Return a MitmRequest if it is fully received within the timeout, or
+        None. Never waits for the rest of a request that is partly received.
+        """
+        try:
+            request = self.__parse_request(servSock)
+            if request is None and not self.closed:
+                if self.__sock.pending() == 0:
+                    readable, _, _ = select.select([self.__sock], [], [],
+                                                   timeout)
+                    if not readable:
+                        return None
+                if self.__recv():
+                    request = self.__parse_request(servSock)
+            return request
+        except HttpParseError:
+            self.closed = True
+            raise
+
+    def __recv(self):
+        """Receive more of the stream. Returns False at a clean EOF."""
+        if self.__parser.recv_from(self.__sock) > 0:
+            return True
+        self.closed = True
+        if self.__head is not None or len(self.__parser) > 0:
+            raise HttpParseError('Connection closed in a request')
+        return False
+
+    def __parse_request(self, servSock):
+        """Return the next MitmRequest if it is buffered, or None"""
+        if self.__head is None:
+            self.__head = self.__parser.parse_head()
+            if self.__head is None:
+                return None
+        head = self.__head
+        body = self.__parser.parse_body(head.contentLength, head.isChunked)
+        if body is None:
+            return None
+        self.__head = None
+
+        method, path, httpVersion = head.parse_request_line()
+        url = 'https://%s:%s%s' % (servSock.host, servSock.port, path)
+        chunked = head.isChunked
+        headers = filter_request_headers(head.headers, chunked)
+
+        # HTTP/1.1 connections persist unless the client asks to close
+        connection = (head.get_header('Connection') or '').lower()
+        if httpVersion == 'HTTP/1.1':
+            keepAlive = connection != 'close'
+        else:
+            keepAlive = connection == 'keep-alive'
+
+        return MitmRequest(method=method, url=url, headers=headers,
+                           body=body or None, httpVersion=httpVersion,
+                           keepAlive=keepAlive, size=head.size + len(body))
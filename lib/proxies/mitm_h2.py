@@ -0,0 +1,351 @@
+"""HTTP/2 for browsers that negotiate it with the MITM through ALPN"""
+
+import logging
+import os
+import select
+import time
+
+from collections import deque
+from threading import Condition, Lock, Thread
+
+try:
+    import h2.config
+    import h2.connection
+    import h2.events
+    import h2.exceptions
+    import h2.settings
+except ImportError:
+    h2 = None
+
+from lib.headers import filter_request_headers
+from lib.proxy import ProxyResponse, StreamedContent
+
+logger = logging.getLogger(__name__)
+
+H2_ALPN_PROTOCOL = 'h2'
+
+# Chunks of a streamed response that are read ahead of the flow control
+# window, per stream
+STREAM_BUFFER_CHUNKS = 4
+
+MAX_CONCURRENT_STREAMS = 128
+
+# Headers that are specific to HTTP/1.1 connections
+CONNECTION_HEADERS = {
+    'connection', 'keep-alive', 'proxy-connection', 'transfer-encoding',
+    'upgrade'
+}
+
+
+def is_h2_available():
+    return h2 is not None
+
+
+# Marks the end of a response in a stream's buffer
+_END_OF_STREAM = object()
+
+
+class _H2Stream(object):
+
+    def __init__(self, streamId, headers):
+        self.streamId = streamId
+        self.headers = headers
+        self.body = []
+        self.bodySize = 0
+
+        # Filled by the thread that reads the response
+        self.__buffered = deque()
+        self.__bufferedCond = Condition(Lock())
+        self.reset = False
+
+        # Owned by the connection's thread
+        self.method = None
+        self.pending = deque()
+        self.ended = False
+
+    def put(self, item):
+        """Wait for room in the buffer. Returns False if the stream was reset"""
+        with self.__bufferedCond:
+            while (len(self.__buffered) >= STREAM_BUFFER_CHUNKS
+                   and not self.reset):
+                self.__bufferedCond.wait()
+            if self.reset:
+                return False
+            self.__buffered.append(item)
+            return True
+
+    def get(self):
+        """Return the next buffered item, or None"""
+        with self.__bufferedCond:
+            if not self.__buffered:
+                return None
+            self.__bufferedCond.notify()
+            return self.__buffered.popleft()
+
+    def cancel(self):
+        with self.__bufferedCond:
+            self.reset = True
+            self.__bufferedCond.notify_all()
+
+
+class H2MitmConnection(object):
+    """
+    Serves the streams of a HTTP/2 connection. Each request is proxied
+    concurrently with dispatch, which returns a future, and responses are
+    sent as their content arrives. All socket IO happens on the thread that
+    calls serve, and other threads wake it through a pipe.
+    """
+
+    def __init__(self, sslSock, servConn, dispatch, get_response,
+                 makeRequest, proxyModel, idleTimeout):
+        self.__sock = sslSock
+        self.__servConn = servConn
+        self.__dispatch = dispatch
+        self.__get_response = get_response
+        self.__makeRequest = makeRequest
+        self.__proxyModel = proxyModel
+        self.__idleTimeout = idleTimeout
+
+        # Headers are left as byte strings
+        config = h2.config.H2Configuration(client_side=False)
+        self.__conn = h2.connection.H2Connection(config=config)
+        self.__streams = {}
+
+        self.__wakeupRead, self.__wakeupWrite = os.pipe()
+        self.__wakeupLock = Lock()
+        self.__wokenUp = False
+        self.__closed = False
+
+    def __wakeup(self):
+        with self.__wakeupLock:
+            # The pipe's descriptors may be reused once it is closed
+            if self.__wokenUp or self.__closed:
+                return
+            self.__wokenUp = True
+            os.write(self.__wakeupWrite, b'x')
+
+    def __clear_wakeup(self):
+        with self.__wakeupLock:
+            self.__wokenUp = False
+            os.read(self.__wakeupRead, 4096)
+
+    def __send_pending(self):
+        data = self.__conn.data_to_send()
+        if data:
+            self.__sock.sendall(data)
+
+    def serve(self):
+        try:
+            self.__conn.update_settings({
+                h2.settings.SettingCodes.MAX_CONCURRENT_STREAMS:
+                    MAX_CONCURRENT_STREAMS
+            })
+            self.__conn.initiate_connection()
+            self.__send_pending()
+            self.__serve_loop()
+        finally:
+            for stream in self.__streams.itervalues():
+                stream.cancel()
+            with self.__wakeupLock:
+                self.__closed = True
+                os.close(self.__wakeupRead)
+                os.close(self.__wakeupWrite)
+
+    def __serve_loop(self):
+        lastActive = time.time()
+        while True:
+            if self.__sock.pending() > 0:
+                readable = [self.__sock]
+            else:
+                readable, _, _ = select.select(
+                    [self.__sock, self.__wakeupRead], [], [],
+                    self.__idleTimeout)
+
+            if self.__wakeupRead in readable:
+                self.__clear_wakeup()
+            if self.__sock in readable:
+                data = self.__sock.recv(65535)
+                if not data:
+                    return
+                try:
+                    events = self.__conn.receive_data(data)
+                except h2.exceptions.ProtocolError as e:
+                    logger.warn('HTTP/2 protocol error: %s', e)
+                    self.__send_pending()
+                    return
+                for event in events:
+                    if isinstance(event, h2.events.ConnectionTerminated):
+                        self.__send_pending()
+                        return
+                    self.__handle_event(event)
+
+            self.__send_responses()
+            self.__send_pending()
+
+            if readable or self.__streams:
+                lastActive = time.time()
+            elif time.time() - lastActive >= self.__idleTimeout:
+                logger.debug('Closing idle connection: %s', self.__servConn)
+                self.__conn.close_connection()
+                self.__send_pending()
+                return
+
+    def __handle_event(self, event):
+        if isinstance(event, h2.events.RequestReceived):
+            self.__streams[event.stream_id] = _H2Stream(event.stream_id,
+                                                        event.headers)
+        elif isinstance(event, h2.events.DataReceived):
+            stream = self.__streams.get(event.stream_id)
+            if stream is not None:
+                stream.body.append(event.data)
+                stream.bodySize += len(event.data)
+            # Open the window again right away, the body is not processed
+            # until it is complete
+            self.__conn.acknowledge_received_data(
+                event.flow_controlled_length, event.stream_id)
+        elif isinstance(event, h2.events.StreamEnded):
+            stream = self.__streams.get(event.stream_id)
+            if stream is not None:
+                self.__start_request(stream)
+        elif isinstance(event, h2.events.StreamReset):
+            stream = self.__streams.pop(event.stream_id, None)
+            if stream is not None:
+                stream.cancel()
+
+    def __start_request(self, stream):
+        pseudoHeaders = {}
+        headerItems = []
+        cookies = []
+        headersSize = 0
+        for header, value in stream.headers:
+            headersSize += len(header) + len(value)
+            if header.startswith(':'):
+                pseudoHeaders[header] = value
+            elif header == 'cookie':
+                # Cookies may be split into several headers
+                cookies.append(value)
+            elif header not in CONNECTION_HEADERS:
+                headerItems.append(
+                    ('-'.join(x.capitalize() for x in header.split('-')),
+                     value))
+        # Drop the same headers as for HTTP/1.1, such as Proxy-Authorization
+        headers = filter_request_headers(headerItems)
+        if cookies:
+            headers['Cookie'] = '; '.join(cookies)
+
+        authority = pseudoHeaders.get(':authority')
+        if authority:
+            headers['Host'] = authority
+        else:
+            authority = '%s:%s' % (self.__servConn.host,
+                                   self.__servConn.port)
+        url = 'https://%s%s' % (authority, pseudoHeaders.get(':path', '/'))
+        request = self.__makeRequest(
+            method=pseudoHeaders.get(':method', 'GET'), url=url,
+            headers=headers,
+            body=b''.join(stream.body) if stream.body else None,
+            httpVersion='HTTP/2', keepAlive=True,
+            size=headersSize + stream.bodySize)
+        stream.body = None
+        stream.method = request.method
+
+        def on_done(future):
+            # Runs on a thread of the shared request pool, or on the IO
+            # thread if the request finished before the callback was added
+            response = self.__get_response(request, future)
+            if isinstance(response.content, StreamedContent):
+                # Reading it blocks while the client's window is closed, so
+                # it gets a thread of its own
+                t = Thread(target=self.__read_response,
+                           args=(stream, request, response))
+                t.daemon = True
+                t.start()
+            else:
+                # At most three items, which fit in the empty buffer
+                self.__read_response(stream, request, response)
+
+        self.__dispatch(request).add_done_callback(on_done)
+
+    def __put(self, stream, item):
+        """Returns False if the stream was reset"""
+        if not stream.put(item):
+            return False
+        self.__wakeup()
+        return True
+
+    def __read_response(self, stream, request, response):
+        content = response.content
+        try:
+            if not self.__put(stream, response):
+                return
+            if request.method == 'HEAD':
+                return
+            if isinstance(content, StreamedContent):
+                for chunk in content:
+                    if chunk and not self.__put(stream, chunk):
+                        return
+            elif content:
+                self.__put(stream, content)
+        except Exception as e:
+            logger.exception(e)
+        finally:
+            if isinstance(content, StreamedContent):
+                content.close()
+            self.__put(stream, _END_OF_STREAM)
+
+    def __send_headers(self, stream, response):
+        headers = [(':status', str(response.statusCode))]
+        for header, value in response.headers.iteritems():
+            header = header.lower()
+            if header in CONNECTION_HEADERS:
+                continue
+            # Responses to HEAD keep the length of the body they omit
+            if header == 'content-length' and stream.method != 'HEAD':
+                continue
+            headers.append((header, str(value)))
+        if (stream.method != 'HEAD'
+                and not isinstance(response.content, StreamedContent)):
+            headers.append(('content-length',
+                            str(len(response.content or b''))))
+        self.__conn.send_headers(stream.streamId, headers)
+
+    def __send_responses(self):
+        """Send what each stream has ready, within the flow control window"""
+        for stream in self.__streams.values():
+            try:
+                # Keep taking chunks while the window has room for them
+                while self.__send_data(stream) and not stream.ended:
+                    item = stream.get()
+                    if item is None:
+                        break
+                    elif item is _END_OF_STREAM:
+                        stream.ended = True
+                    elif isinstance(item, ProxyResponse):
+                        self.__send_headers(stream, item)
+                    else:
+                        stream.pending.append(item)
+                if stream.ended and not stream.pending:
+                    self.__conn.end_stream(stream.streamId)
+                    del self.__streams[stream.streamId]
+            except h2.exceptions.StreamClosedError:
+                stream.cancel()
+                del self.__streams[stream.streamId]
+
+    def __send_data(self, stream):
+        """Returns False if the flow control window is exhausted"""
+        conn = self.__conn
+        streamId = stream.streamId
+        while stream.pending:
+            window = min(conn.local_flow_control_window(streamId),
+                         conn.max_outbound_frame_size)
+            if window <= 0:
+                return False
+            chunk = stream.pending[0]
+            if len(chunk) > window:
+                stream.pending[0] = chunk[window:]
+                chunk = chunk[:window]
+            else:
+                stream.pending.popleft()
+            conn.send_data(streamId, str(chunk))
+            self.__proxyModel.record_bytes_down(len(chunk))
+        return True
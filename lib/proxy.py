@@ -9,6 +9,56 @@ ProxyResponse = __ProxyResponse
 proxy_single_request = __proxy_single_request
 proxy_sockets = __proxy_sockets
 
+# Response content that arrives incrementally. It may be used in place of a
+# string as the content of a ProxyResponse.
+#   [__iter__] yields the chunks of the body as they arrive
+#   [close] is called when the consumer is done, even if iteration stopped
+class StreamedContent(object):
+
+    @abstractmethod
+    def __iter__(self):
+        pass
+
+    @abstractmethod
+    def close(self):
+        pass
+
+
+# Buffers are written in slices to avoid copying the whole view at once
+WRITE_BUFFER_CHUNK_SIZE = 64 * 1024
+
+
+def write_content(write, content):
+    """Write the content of a ProxyResponse, returning the bytes written"""
+    if isinstance(content, buffer):
+        for i in xrange(0, len(content), WRITE_BUFFER_CHUNK_SIZE):
+            write(content[i:i + WRITE_BUFFER_CHUNK_SIZE])
+        return len(content)
+
+    if not isinstance(content, StreamedContent):
+        if content:
+            write(content)
+        return len(content) if content else 0
+
+    bytesWritten = 0
+    try:
+        for chunk in content:
+            write(chunk)
+            bytesWritten += len(chunk)
+    finally:
+        content.close()
+    return bytesWritten
+
+
+def close_content(content):
+    """
+    Close the content of a ProxyResponse that may not have been written, so
+    that the stream or transfer behind it is released
+    """
+    if isinstance(content, StreamedContent):
+        content.close()
+
+
 # For non-CONNECT requests:
 #   [request] makes a request for a single URL
 class AbstractRequestProxy(object):
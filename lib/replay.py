@@ -0,0 +1,205 @@
+"""
+Replays a trace from lib/capture.py. A synthetic origin answers each request
+of the trace with the recorded status, headers and size of response, after
+the recorded delays, and the requests are scheduled at their recorded
+times for OpenLoopLoad.run_schedule.
+"""
+
+import logging
+import os
+import ssl
+import time
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from threading import Thread
+
+from lib.loadgen import LoadRequest
+
+logger = logging.getLogger(__name__)
+
+# Not replayed as recorded, since the origin sends its own framing and
+# random bytes, and redirects would leave the origin
+DROPPED_RESPONSE_HEADERS = {
+    'connection', 'content-encoding', 'content-length', 'keep-alive',
+    'location', 'proxy-connection', 'transfer-encoding',
+}
+DROPPED_REQUEST_HEADERS = {
+    'connection', 'content-length', 'host', 'keep-alive', 'proxy-connection',
+    'transfer-encoding',
+}
+
+NO_BODY_STATUS_CODES = {204, 304}
+
+# Bodies are sent in up to this many writes, spread over the recorded time
+# of the transfer
+MAX_PACED_WRITES = 10
+
+RANDOM_BLOCK_SIZE = 1 << 20
+
+_randomBlock = None
+
+
+def _get_random_block():
+    global _randomBlock
+    if _randomBlock is None:
+        _randomBlock = os.urandom(RANDOM_BLOCK_SIZE)
+    return _randomBlock
+
+
+def is_replayed(entry):
+    """Failed requests are not replayed"""
+    if 'error' in entry:
+        return False
+    return entry['method'] == 'CONNECT' or 'statusCode' in entry
+
+
+def get_expected_response(entry):
+    """Return the status and number of bytes that the origin will send"""
+    if entry['method'] == 'CONNECT':
+        return 200, entry.get('responseBytes', 0)
+    statusCode = entry['statusCode']
+    if entry['method'] == 'HEAD' or statusCode < 200 or \
+            statusCode in NO_BODY_STATUS_CODES:
+        return statusCode, 0
+    return statusCode, entry.get('responseBytes', 0)
+
+
+class _ReplayHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _replay(self):
+        try:
+            entry = self.server.entries[int(self.path.strip('/'))]
+        except (ValueError, IndexError):
+            self.send_error(404)
+            return
+        contentLength = int(self.headers.get('Content-Length') or 0)
+        if contentLength > 0:
+            self.rfile.read(contentLength)
+
+        delayScale = self.server.delayScale
+        statusCode, size = get_expected_response(entry)
+        if entry['method'] == 'CONNECT':
+            # Only the bytes of a tunnel are known
+            headers = {'Content-Type': 'application/octet-stream'}
+            waitSeconds = transferSeconds = 0.0
+        else:
+            headers = {k: v for k, v in
+                       entry.get('responseHeaders', {}).iteritems()
+                       if k.lower() not in DROPPED_RESPONSE_HEADERS}
+            waitSeconds = entry.get('waitMillis', 0.0) / 1000.0 * delayScale
+            transferSeconds = (entry.get('durationMillis', 0.0) -
+                               entry.get('waitMillis', 0.0)) / 1000.0 * \
+                delayScale
+        if waitSeconds > 0:
+            time.sleep(waitSeconds)
+
+        self.send_response(statusCode)
+        for header, value in headers.iteritems():
+            self.send_header(header.encode('utf-8'), value.encode('utf-8'))
+        if statusCode >= 200 and statusCode not in NO_BODY_STATUS_CODES:
+            self.send_header('Content-Length', size)
+        self.end_headers()
+        if size > 0:
+            self.__write_body(size, transferSeconds)
+
+    def __write_body(self, size, transferSeconds):
+        block = _get_random_block()
+        numWrites = MAX_PACED_WRITES if transferSeconds > 0 else 1
+        bytesSent = 0
+        for i in xrange(numWrites):
+            if i > 0:
+                time.sleep(transferSeconds / numWrites)
+            endOfWrite = size * (i + 1) / numWrites
+            while bytesSent < endOfWrite:
+                numBytes = min(endOfWrite - bytesSent, RANDOM_BLOCK_SIZE)
+                self.wfile.write(block[:numBytes])
+                bytesSent += numBytes
+
+    do_GET = _replay
+    do_POST = _replay
+    do_HEAD = _replay
+    do_DELETE = _replay
+    do_PUT = _replay
+    do_PATCH = _replay
+    do_OPTIONS = _replay
+
+
+class _ReplayServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def handle_error(self, request, clientAddress):
+        # Clients close idle connections whenever they like
+        logger.debug('Error serving %s', clientAddress, exc_info=True)
+
+
+class ReplayOrigin(object):
+    """
+    Serves the response of entry i of the trace at /i, over TLS if given a
+    certFile. Delays are multiplied by delayScale.
+    """
+
+    def __init__(self, entries, certFile=None, delayScale=1.0):
+        self.__server = _ReplayServer(('localhost', 0), _ReplayHandler)
+        self.__server.entries = entries
+        self.__server.delayScale = delayScale
+        self.__scheme = 'http'
+        if certFile is not None:
+            self.__scheme = 'https'
+            # Handshake in the thread of each request, not while accepting
+            self.__server.socket = ssl.wrap_socket(
+                self.__server.socket, certfile=certFile, server_side=True,
+                do_handshake_on_connect=False)
+        self.__thread = Thread(target=self.__server.serve_forever)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    @property
+    def url(self):
+        return '%s://localhost:%d' % (self.__scheme,
+                                      self.__server.server_address[1])
+
+    def shutdown(self):
+        self.__server.shutdown()
+        self.__server.server_close()
+
+
+def get_replay_schedule(entries, httpUrl, httpsUrl=None, speed=1.0):
+    """
+    Return [(seconds from the start, LoadRequest)] for the entries of a
+    trace, as served by ReplayOrigins at the URLs. Requests for https URLs
+    and tunnels go to httpsUrl, or to httpUrl without one. A speed of 2
+    replays twice as fast, and 0 sends everything at once.
+    """
+    schedule = []
+    if not entries:
+        return schedule
+    firstMillis = entries[0]['startMillis']
+    for i, entry in enumerate(entries):
+        if not is_replayed(entry):
+            continue
+        isHttps = entry['method'] == 'CONNECT' or \
+            entry['url'].startswith('https:')
+        baseUrl = httpsUrl if isHttps and httpsUrl is not None else httpUrl
+        if entry['method'] == 'CONNECT':
+            method, headers, body = 'GET', {}, None
+        else:
+            method = entry['method'].encode('utf-8')
+            headers = {k.encode('utf-8'): v.encode('utf-8') for k, v in
+                       entry.get('requestHeaders', {}).iteritems()
+                       if k.lower() not in DROPPED_REQUEST_HEADERS}
+            body = 'x' * entry['requestBytes'] \
+                if entry.get('requestBytes') else None
+        offset = 0.0
+        if speed > 0:
+            offset = (entry['startMillis'] - firstMillis) / 1000.0 / speed
+        schedule.append((offset, LoadRequest(
+            url='%s/%d' % (baseUrl, i), method=method, headers=headers,
+            body=body, weight=1)))
+    return schedule
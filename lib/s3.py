@@ -0,0 +1,264 @@
+import hashlib
+import logging
+import time
+
+from collections import deque
+from threading import Condition, Lock, Thread
+
+from concurrent.futures import ThreadPoolExecutor
+from lib import aws
+from lib.proxy import StreamedContent
+from lib.trace import span
+
+logger = logging.getLogger(__name__)
+
+MEGABYTE = 2 ** 20
+
+# Objects larger than a part are fetched with concurrent ranged gets
+DEFAULT_PART_SIZE = 8 * MEGABYTE
+DEFAULT_PARTS_IN_FLIGHT = 4
+DEFAULT_GET_THREADS = 16
+
+# delete_objects takes at most 1000 keys per request
+MAX_KEYS_PER_DELETE = 1000
+DEFAULT_DELETE_INTERVAL = 1.0
+
+
+def _parse_content_range(contentRange):
+    """Return the object size from 'bytes <start>-<end>/<size>'"""
+    return int(contentRange.rsplit('/', 1)[1])
+
+
+class BatchedS3Deleter(object):
+    """
+    Deletes keys in the background. Keys are flushed with delete_objects
+    when a full batch is queued, or after flushInterval seconds.
+    """
+
+    def __init__(self, s3, bucket, flushInterval=DEFAULT_DELETE_INTERVAL):
+        self.__s3 = s3
+        self.__bucket = bucket
+        self.__flushInterval = flushInterval
+
+        self.__keys = deque()
+        self.__keysCond = Condition(Lock())
+
+        t = Thread(target=self.__delete_daemon)
+        t.daemon = True
+        t.start()
+
+    def __len__(self):
+        return len(self.__keys)
+
+    def delete(self, key):
+        with self.__keysCond:
+            self.__keys.append(key)
+            if len(self.__keys) >= MAX_KEYS_PER_DELETE:
+                self.__keysCond.notify()
+
+    def __take_batch(self):
+        with self.__keysCond:
+            deadline = time.time() + self.__flushInterval
+            while len(self.__keys) < MAX_KEYS_PER_DELETE:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.__keysCond.wait(remaining)
+            numKeys = min(len(self.__keys), MAX_KEYS_PER_DELETE)
+            return [self.__keys.popleft() for _ in xrange(numKeys)]
+
+    def __delete_batch(self, keys):
+        response = self.__s3.delete_objects(
+            Bucket=self.__bucket,
+            Delete={
+                'Objects': [{'Key': key} for key in keys],
+                'Quiet': True
+            })
+        for error in response.get('Errors', []):
+            logger.error('Failed to delete %s: %s', error.get('Key'),
+                         error.get('Message'))
+
+    def __delete_daemon(self):
+        while True:
+            keys = self.__take_batch()
+            if not keys:
+                continue
+            try:
+                self.__delete_batch(keys)
+                logger.debug('Deleted %d objects', len(keys))
+            except Exception as e:
+                logger.exception(e)
+
+
+class RangedS3Content(StreamedContent):
+    """
+    An object that is fetched in parts with concurrent ranged gets, and
+    yielded in order. At most partsInFlight parts are buffered. The time
+    that no get is running, as when waiting for the reader to make room,
+    is not counted in the transfer.
+    """
+
+    def __init__(self, getPart, firstPart, size, partSize, partsInFlight,
+                 pool, transfer, onClose):
+        self.__getPart = getPart
+        self.__firstPart = firstPart
+        self.__size = size
+        self.__partSize = partSize
+        self.__partsInFlight = partsInFlight
+        self.__pool = pool
+        self.__transfer = transfer
+        self.__onClose = onClose
+        self.__futures = deque()
+        self.__nextOffset = len(firstPart)
+        self.__bytesYielded = 0
+        self.__closed = False
+
+        self.__activeLock = Lock()
+        self.__numActive = 0
+        self.__idleSince = time.time()
+        self.__idleSeconds = 0.0
+        self.__fill()
+
+    def __len__(self):
+        return self.__size
+
+    def __fill(self):
+        while (len(self.__futures) < self.__partsInFlight
+               and self.__nextOffset < self.__size):
+            end = min(self.__nextOffset + self.__partSize, self.__size) - 1
+            self.__futures.append(self.__pool.submit(self.__get_part,
+                                                     self.__nextOffset, end))
+            self.__nextOffset = end + 1
+
+    def __get_part(self, start, end):
+        with self.__activeLock:
+            if self.__numActive == 0:
+                self.__idleSeconds += time.time() - self.__idleSince
+            self.__numActive += 1
+        try:
+            return self.__getPart(start, end)
+        finally:
+            with self.__activeLock:
+                self.__numActive -= 1
+                if self.__numActive == 0:
+                    self.__idleSince = time.time()
+
+    def __iter__(self):
+        if self.__firstPart:
+            firstPart, self.__firstPart = self.__firstPart, None
+            self.__bytesYielded += len(firstPart)
+            yield firstPart
+        while self.__futures:
+            part = self.__futures.popleft().result()
+            self.__fill()
+            self.__bytesYielded += len(part)
+            yield part
+
+    def close(self):
+        if self.__closed:
+            return
+        self.__closed = True
+        for future in self.__futures:
+            future.cancel()
+        if self.__bytesYielded == self.__size:
+            self.__transfer.size = self.__size
+        with self.__activeLock:
+            idleSeconds = self.__idleSeconds
+            if self.__numActive == 0:
+                idleSeconds += time.time() - self.__idleSince
+        self.__transfer.adjust(-idleSeconds)
+        self.__transfer.finish()
+        self.__onClose()
+
+    def __del__(self):
+        # Content that was dropped without being closed would otherwise stay
+        # in flight, and its object would never be deleted
+        if not self.__closed:
+            logger.warn('Closing unread s3 content of %dB', self.__size)
+            self.close()
+
+
+class S3PayloadStore(object):
+    """Stages large request and response bodies in a bucket"""
+
+    def __init__(self, bucket, stats, partSize=DEFAULT_PART_SIZE,
+                 partsInFlight=DEFAULT_PARTS_IN_FLIGHT,
+                 maxGetThreads=DEFAULT_GET_THREADS):
+        self.__bucket = bucket
+        self.__stats = stats
+        self.__partSize = partSize
+        self.__partsInFlight = partsInFlight
+        self.__s3 = aws.deferred_client('s3')
+        self.__getPool = ThreadPoolExecutor(maxGetThreads)
+        self.__deleter = BatchedS3Deleter(self.__s3, bucket)
+
+    @property
+    def bucket(self):
+        return self.__bucket
+
+    def __get_range(self, key, start, end):
+        with span('s3 get'), self.__stats.getLatency.time():
+            return self.__s3.get_object(Bucket=self.__bucket, Key=key,
+                                        Range='bytes=%d-%d' % (start, end))
+
+    def delete(self, key):
+        self.__deleter.delete(key)
+
+    def put(self, data):
+        md5 = hashlib.md5()
+        md5.update(data)
+        key = md5.hexdigest()
+        with span('s3 put'):
+            self.__s3.put_object(Bucket=self.__bucket, Key=key, Body=data,
+                                 StorageClass='REDUCED_REDUNDANCY')
+        self.__stats.record_put(len(data))
+        return key
+
+    def load(self, key, delete=True, uploadSeconds=0.0):
+        """
+        Return the object as a string if it fits in a single part, or as
+        RangedS3Content otherwise. Unless delete is False, the object is
+        deleted once it is read. The uploadSeconds that the lambda took to
+        put the object are counted in the transfer.
+        """
+        transfer = self.__stats.getTransfers.record()
+        transfer.start()
+        transfer.adjust(uploadSeconds)
+        try:
+            result = self.__get_range(key, 0, self.__partSize - 1)
+            transfer.first_byte()
+            firstPart = result['Body'].read()
+            size = _parse_content_range(result['ContentRange'])
+        except:
+            transfer.finish(failed=True)
+            raise
+        numParts = (size + self.__partSize - 1) / self.__partSize
+        self.__stats.record_get(size, numRequests=numParts)
+
+        if len(firstPart) == size:
+            transfer.size = size
+            transfer.finish()
+            if delete:
+                self.delete(key)
+            return firstPart
+
+        def get_part(start, end):
+            return self.__get_range(key, start, end)['Body'].read()
+
+        def on_close():
+            if delete:
+                self.delete(key)
+
+        return RangedS3Content(get_part, firstPart, size, self.__partSize,
+                               self.__partsInFlight, self.__getPool,
+                               transfer, on_close)
+
+    def load_bytes(self, key, delete=True):
+        """Return the whole object as a string"""
+        content = self.load(key, delete)
+        if not isinstance(content, RangedS3Content):
+            return content
+        try:
+            return b''.join(content)
+        finally:
+            content.close()
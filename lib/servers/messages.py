@@ -0,0 +1,233 @@
+import heapq
+import logging
+import mmap
+import tempfile
+import time
+
+from threading import Lock
+
+from lib.proxy import StreamedContent, WRITE_BUFFER_CHUNK_SIZE
+
+logger = logging.getLogger(__name__)
+
+MEGABYTE = 2 ** 20
+
+DEFAULT_MAX_MEMORY_BYTES = 256 * MEGABYTE
+DEFAULT_SPILL_THRESHOLD = 32 * MEGABYTE
+
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class Message(object):
+
+    def __init__(self, content):
+        self.__content = content
+        self.__receiveTime = time.time()
+
+    @property
+    def content(self):
+        return self.__content
+
+    @property
+    def receiveTime(self):
+        return self.__receiveTime
+
+    @property
+    def size(self):
+        return len(self.__content)
+
+    @property
+    def isSpilled(self):
+        return False
+
+    def open_content(self):
+        """The content to write once, which closes the message after"""
+        return self.__content
+
+    def close(self):
+        pass
+
+
+class _SpilledContent(StreamedContent):
+
+    def __init__(self, message):
+        self.__message = message
+
+    def __iter__(self):
+        content = self.__message.content
+        for i in xrange(0, len(content), WRITE_BUFFER_CHUNK_SIZE):
+            yield content[i:i + WRITE_BUFFER_CHUNK_SIZE]
+
+    def close(self):
+        self.__message.close()
+
+
+class SpilledMessage(Message):
+    """
+    A message that is stored in a memory mapped temporary file. The
+    content is a read-only buffer over the mapping, so it is not copied
+    into memory unless the consumer does so.
+    """
+
+    def __init__(self, tempFile, size):
+        self.__file = tempFile
+        self.__mmap = mmap.mmap(tempFile.fileno(), size,
+                                access=mmap.ACCESS_READ)
+        super(SpilledMessage, self).__init__(buffer(self.__mmap))
+
+    @property
+    def isSpilled(self):
+        return True
+
+    def open_content(self):
+        return _SpilledContent(self)
+
+    def close(self):
+        """Unmap and delete the file. The content can't be read after"""
+        self.__mmap.close()
+        self.__file.close()
+
+
+class MessageStore(object):
+    """
+    Holds messages until they are fetched or expire. Messages are kept in
+    memory while the total stays under maxMemoryBytes, and are spilled to
+    disk otherwise, or if they are larger than spillThreshold.
+    """
+
+    def __init__(self, messageTimeout, maxMemoryBytes=DEFAULT_MAX_MEMORY_BYTES,
+                 spillThreshold=DEFAULT_SPILL_THRESHOLD, spillDir=None):
+        self.__messageTimeout = messageTimeout
+        self.__maxMemoryBytes = maxMemoryBytes
+        self.__spillThreshold = spillThreshold
+        self.__spillDir = spillDir
+
+        # MessageId -> (message, expireTime)
+        self.__messages = {}
+        self.__memoryBytes = 0
+        self.__spilledBytes = 0
+
+        # Heap of (expireTime, messageId)
+        self.__expiryHeap = []
+        self.__lock = Lock()
+
+    @property
+    def memoryBytes(self):
+        return self.__memoryBytes
+
+    @property
+    def spilledBytes(self):
+        return self.__spilledBytes
+
+    def __len__(self):
+        return len(self.__messages)
+
+    def __reserve_memory(self, size):
+        """
+        Count the bytes against the memory budget if they fit. Returns
+        False if the message should be spilled instead.
+        """
+        if size > 0 and size > self.__spillThreshold:
+            return False
+        with self.__lock:
+            if size > 0 and self.__memoryBytes + size > self.__maxMemoryBytes:
+                return False
+            self.__memoryBytes += size
+            return True
+
+    def __release_memory(self, size):
+        with self.__lock:
+            self.__memoryBytes -= size
+
+    def __new_spill_file(self):
+        return tempfile.TemporaryFile(prefix='message', dir=self.__spillDir)
+
+    def __add(self, messageId, message, timeout):
+        if timeout is None:
+            timeout = self.__messageTimeout
+        expireTime = message.receiveTime + timeout
+        with self.__lock:
+            replaced = self.__remove(messageId)
+            self.__messages[messageId] = (message, expireTime)
+            heapq.heappush(self.__expiryHeap, (expireTime, messageId))
+            # The memory of messages that are not spilled is reserved
+            if message.isSpilled:
+                self.__spilledBytes += message.size
+        if replaced is not None:
+            replaced.close()
+
+    def __remove(self, messageId):
+        entry = self.__messages.pop(messageId, None)
+        if entry is None:
+            return None
+        message = entry[0]
+        if message.isSpilled:
+            self.__spilledBytes -= message.size
+        else:
+            self.__memoryBytes -= message.size
+        return message
+
+    def put(self, messageId, content, timeout=None):
+        if self.__reserve_memory(len(content)):
+            message = Message(content)
+        else:
+            spillFile = self.__new_spill_file()
+            spillFile.write(content)
+            spillFile.flush()
+            message = SpilledMessage(spillFile, len(content))
+        self.__add(messageId, message, timeout)
+        return message
+
+    def receive(self, messageId, ifs, length, timeout=None):
+        """Read the message from a file, without buffering it if spilled"""
+        if self.__reserve_memory(length):
+            content = ifs.read(length)
+            if len(content) != length:
+                self.__release_memory(length)
+                raise IOError('Message ended early: %s' % messageId)
+            message = Message(content)
+        else:
+            spillFile = self.__new_spill_file()
+            try:
+                bytesRead = 0
+                while bytesRead < length:
+                    chunk = ifs.read(min(READ_CHUNK_SIZE, length - bytesRead))
+                    if not chunk:
+                        raise IOError('Message ended early: %s' % messageId)
+                    spillFile.write(chunk)
+                    bytesRead += len(chunk)
+                spillFile.flush()
+            except:
+                spillFile.close()
+                raise
+            message = SpilledMessage(spillFile, length)
+        self.__add(messageId, message, timeout)
+        return message
+
+    def get(self, messageId):
+        """
+        Remove and return the message, or None. The caller should close it,
+        or write its open_content, once done with it.
+        """
+        with self.__lock:
+            return self.__remove(messageId)
+
+    def expire(self, curTime=None):
+        """Drop expired messages. Returns the number dropped"""
+        if curTime is None:
+            curTime = time.time()
+        expired = []
+        with self.__lock:
+            while (len(self.__expiryHeap) > 0
+                   and self.__expiryHeap[0][0] <= curTime):
+                expireTime, messageId = heapq.heappop(self.__expiryHeap)
+                entry = self.__messages.get(messageId)
+                # The message may have been fetched, or replaced
+                if entry is not None and entry[1] == expireTime:
+                    expired.append(self.__remove(messageId))
+        for message in expired:
+            message.close()
+        numExpired = len(expired)
+        if numExpired > 0:
+            logger.info('Expired %d messages', numExpired)
+        return numExpired
@@ -1,29 +1,125 @@
+import json
 import logging
 import time
 
 from BaseHTTPServer import BaseHTTPRequestHandler
-from threading import Thread, Lock, Condition
+from collections import deque
+from threading import Thread, Lock, Condition, Event
 
-from lib.proxy import proxy_sockets
-from lib.stats import EC2StatsModel
+from lib.proxy import StreamedContent, proxy_sockets, write_content
+from lib.servers.messages import Message, MessageStore, \
+    DEFAULT_MAX_MEMORY_BYTES, DEFAULT_SPILL_THRESHOLD
+from lib.stats import EC2StatsModel, TransferCounter
 from lib.utils import ThreadedHTTPServer
+from shared.channel import MessageChannel, WORKER_CHANNEL_PATH
 
 logger = logging.getLogger(__name__)
 
 
-class Message(object):
+# Re-expose this class
+Message = Message
 
-    def __init__(self, content):
-        self.__content = content
-        self.__receiveTime = time.time()
+# Streams whose first line of metadata is longer than this are abandoned
+MAX_STREAM_META_LENGTH = 1 << 20
+
+# Streams are aborted once their buffer stays full for this many seconds,
+# so a reader that went away does not hold up the lambda
+DEFAULT_STREAM_WRITE_TIMEOUT = 60
+
+
+class MessageStream(StreamedContent):
+    """
+    A message that is piped from the poster to the consumer as it arrives.
+    Writes block once maxBufferSize bytes are waiting to be read, and fail
+    if nothing is read for writeTimeout seconds. The meta holds the status
+    code and headers, or their encrypted form.
+    """
+
+    def __init__(self, meta, maxBufferSize=4 * 2 ** 20,
+                 writeTimeout=DEFAULT_STREAM_WRITE_TIMEOUT):
+        self.__meta = meta
+        self.__maxBufferSize = maxBufferSize
+        self.__writeTimeout = writeTimeout
+
+        self.__chunks = deque()
+        self.__bufferSize = 0
+        self.__blockedSeconds = 0.0
+        self.__done = False
+        self.__closed = False
+        self.__error = None
+        self.__cond = Condition(Lock())
+
+    @property
+    def meta(self):
+        return self.__meta
+
+    @property
+    def statusCode(self):
+        return self.__meta.get('statusCode')
 
     @property
-    def content(self):
-        return self.__content
+    def headers(self):
+        return self.__meta.get('headers')
 
     @property
-    def receiveTime(self):
-        return self.__receiveTime
+    def blockedSeconds(self):
+        """Time that writes waited for the reader to make room"""
+        return self.__blockedSeconds
+
+    def write(self, chunk):
+        with self.__cond:
+            startTime = time.time()
+            deadline = startTime + self.__writeTimeout
+            while (self.__bufferSize >= self.__maxBufferSize
+                   and not self.__closed):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.__closed = True
+                    self.__chunks.clear()
+                    self.__bufferSize = 0
+                    raise IOError('Message stream not read for %ds' %
+                                  self.__writeTimeout)
+                self.__cond.wait(remaining)
+            self.__blockedSeconds += time.time() - startTime
+            if self.__closed:
+                raise IOError('Message stream closed by the reader')
+            self.__chunks.append(chunk)
+            self.__bufferSize += len(chunk)
+            self.__cond.notify_all()
+
+    def finish(self, error=None):
+        with self.__cond:
+            self.__done = True
+            self.__error = error
+            self.__cond.notify_all()
+
+    def read(self):
+        """Return the next chunk, or an empty string at the end"""
+        with self.__cond:
+            while len(self.__chunks) == 0 and not self.__done:
+                self.__cond.wait()
+            if len(self.__chunks) > 0:
+                chunk = self.__chunks.popleft()
+                self.__bufferSize -= len(chunk)
+                self.__cond.notify_all()
+                return chunk
+            if self.__error is not None:
+                raise IOError('Message stream failed: %s' % self.__error)
+            return b''
+
+    def __iter__(self):
+        while True:
+            chunk = self.read()
+            if not chunk:
+                break
+            yield chunk
+
+    def close(self):
+        with self.__cond:
+            self.__closed = True
+            self.__chunks.clear()
+            self.__bufferSize = 0
+            self.__cond.notify_all()
 
 
 class Socket(object):
@@ -32,6 +128,7 @@ class Socket(object):
         self.__sock = sock
         self.__idleTimeout = idleTimeout
         self.__openTime = time.time()
+        self.__closed = Event()
 
     @property
     def sock(self):
@@ -47,13 +144,28 @@ class Socket(object):
 
     def close(self):
         self.__sock.close()
+        self.__closed.set()
+
+    def wait_closed(self, timeout):
+        """Wait until the lambda is done with the socket, or it timed out"""
+        return self.__closed.wait(timeout)
 
 
 class ReverseConnectionServer(object):
 
-    def __init__(self, publicHostAndPort, messageTimeout=5, connTimeout=5):
-        self.__messages = {}
-        self.__messagesLock = Lock()
+    def __init__(self, publicHostAndPort, messageTimeout=5, connTimeout=5,
+                 maxMessageMemory=DEFAULT_MAX_MEMORY_BYTES,
+                 messageSpillThreshold=DEFAULT_SPILL_THRESHOLD):
+        self.__messages = MessageStore(messageTimeout,
+                                       maxMemoryBytes=maxMessageMemory,
+                                       spillThreshold=messageSpillThreshold)
+
+        # MessageId -> MessageStream, or None until the stream arrives
+        self.__messageStreams = {}
+        self.__messageStreamsCond = Condition(Lock())
+
+        # Timing of the messages posted by lambdas
+        self.__messageTransfers = TransferCounter()
 
         self.__sockets = {}
         self.__socketsLock = Lock()
@@ -63,13 +175,13 @@ class ReverseConnectionServer(object):
         self.__publicHostAndPort = publicHostAndPort
 
         self.__httpServer = None
+        self.__workerHandler = None
 
-        t = Thread(target=self.__timeout_sockets_and_messages,
-                   args=(messageTimeout,))
+        t = Thread(target=self.__timeout_sockets_and_messages)
         t.daemon = True
         t.start()
 
-    def __timeout_sockets_and_messages(self, messageTimeout, frequency=1):
+    def __timeout_sockets_and_messages(self, frequency=1):
         while True:
             time.sleep(frequency)
             curTime = time.time()
@@ -79,20 +191,26 @@ class ReverseConnectionServer(object):
                     if (curTime - sockObj.openTime > sockObj.idleTimeout):
                         sockObj.close()
                         del self.__sockets[socketId]
-            with self.__messagesLock:
-                for messageId in self.__messages.keys():
-                    if (curTime - self.__messages[messageId].receiveTime
-                            > messageTimeout):
-                        del self.__messages[messageId]
+            self.__messages.expire(curTime)
 
     @property
     def publicHostAndPort(self):
         return self.__publicHostAndPort
 
     def take_ownership_of_socket(self, socketId, sock, idleTimeout):
+        sockObj = Socket(sock, idleTimeout)
         with self.__socketsLock:
-            self.__sockets[socketId] = Socket(sock, idleTimeout)
+            self.__sockets[socketId] = sockObj
             self.__socketsCond.notify_all()
+        return sockObj
+
+    def release_socket(self, socketId):
+        """
+        Give up a socket that no connection has taken. Returns False if one
+        took it already.
+        """
+        with self.__socketsLock:
+            return self.__sockets.pop(socketId, None) is not None
 
     def get_socket(self, socketId):
         endTime = time.time() + self.__connTimeout
@@ -108,16 +226,72 @@ class ReverseConnectionServer(object):
                 if curTime > endTime: break
         return ret
 
+    @property
+    def messageStore(self):
+        return self.__messages
+
+    @property
+    def messageTransfers(self):
+        return self.__messageTransfers
+
     def get_message(self, messageId):
-        with self.__messagesLock:
-            ret = self.__messages.get(messageId)
-            if ret is not None:
-                del self.__messages[messageId]
-        return ret
+        return self.__messages.get(messageId)
+
+    def put_message(self, messageId, content, timeout=None):
+        return self.__messages.put(messageId, content, timeout)
+
+    def receive_message(self, messageId, ifs, length, timeout=None):
+        """Read a message of known length from a file"""
+        return self.__messages.receive(messageId, ifs, length, timeout)
 
-    def put_message(self, messageId, message):
-        with self.__messagesLock:
-            self.__messages[messageId] = message
+    def expect_message_stream(self, messageId):
+        """Must be called before the stream can be posted"""
+        with self.__messageStreamsCond:
+            self.__messageStreams[messageId] = None
+
+    def get_message_stream(self, messageId):
+        """Wait for the stream to be posted. Returns None if abandoned"""
+        with self.__messageStreamsCond:
+            while True:
+                if messageId not in self.__messageStreams:
+                    return None
+                ret = self.__messageStreams[messageId]
+                if ret is not None:
+                    del self.__messageStreams[messageId]
+                    return ret
+                self.__messageStreamsCond.wait()
+
+    def put_message_stream(self, messageId, stream):
+        """Returns False if no one is waiting for the stream"""
+        with self.__messageStreamsCond:
+            if self.__messageStreams.get(messageId, True) is not None:
+                return False
+            self.__messageStreams[messageId] = stream
+            self.__messageStreamsCond.notify_all()
+            return True
+
+    def abandon_message_stream(self, messageId):
+        """Stop waiting for a stream, unless it has already arrived"""
+        with self.__messageStreamsCond:
+            if (messageId in self.__messageStreams and
+                    self.__messageStreams[messageId] is None):
+                del self.__messageStreams[messageId]
+                self.__messageStreamsCond.notify_all()
+
+    def register_worker_handler(self, handler):
+        """
+        Handler is called with (workerId, workerSecret) for each worker that
+        connects. It returns None to refuse the worker, or a function that is
+        called with the channel, and owns it until it returns.
+        """
+        self.__workerHandler = handler
+
+    def accept_worker(self, workerId, workerSecret):
+        """Return the function that serves the worker's channel, or None"""
+        if self.__workerHandler is None:
+            logger.warn('No handler registered for worker: %s', workerId)
+            return None
+        return self.__workerHandler(workerId, workerSecret)
 
     def register_http_server(self, httpServer):
         self.__httpServer = httpServer
@@ -127,6 +301,23 @@ class ReverseConnectionServer(object):
         self.__httpServer.shutdown()
 
 
+def _iter_chunked_body(rfile):
+    """Decode a body sent with chunked transfer encoding"""
+    while True:
+        chunkSize = int(rfile.readline().split(';', 1)[0].strip(), 16)
+        if chunkSize == 0:
+            break
+        chunk = rfile.read(chunkSize)
+        if len(chunk) != chunkSize:
+            raise IOError('Chunked body ended early')
+        rfile.readline()
+        yield chunk
+
+    # Discard any trailers
+    while rfile.readline().strip():
+        pass
+
+
 def start_reverse_connection_server(localPort, publicHostAndPort, stats):
     proxyModel = stats.get_model('proxy')
     if 'ec2' not in stats.models:
@@ -134,6 +325,18 @@ def start_reverse_connection_server(localPort, publicHostAndPort, stats):
     ec2Model = stats.get_model('ec2')
 
     server = ReverseConnectionServer(publicHostAndPort)
+    messageStore = server.messageStore
+    stats.register_gauge('messages_stored', lambda: len(messageStore),
+                         'Messages waiting to be read')
+    stats.register_gauge('message_memory_bytes',
+                         lambda: messageStore.memoryBytes,
+                         'Bytes of messages held in memory')
+    stats.register_gauge('message_spilled_bytes',
+                         lambda: messageStore.spilledBytes,
+                         'Bytes of messages spilled to disk')
+    stats.register_gauge('message_transfers_in_flight',
+                         lambda: server.messageTransfers.inFlight,
+                         'Messages being posted by lambdas')
     testLivenessResponse = 'Server is live!\n'
 
     class RequestHandler(BaseHTTPRequestHandler):
@@ -153,23 +356,130 @@ def start_reverse_connection_server(localPort, publicHostAndPort, stats):
                           format % args))
 
         def do_GET(self):
+            if self.path == '/':
+                self.send_response(200)
+                self.send_header('Content-Length',
+                                 str(len(testLivenessResponse)))
+                self.end_headers()
+                self.wfile.write(testLivenessResponse)
+                return
+
+            # Serve a message staged for the lambda, such as a request body
+            messageId = self.path[1:]
+            message = server.get_message(messageId)
+            if message is None:
+                self.send_error(404, 'Resource not found')
+                return
+            logger.info('Sending: %s (%dB)', messageId, message.size)
             self.send_response(200)
-            self.send_header('Content-Length', str(len(testLivenessResponse)))
+            self.send_header('Content-Length', str(message.size))
+            self.send_header('Content-Type', 'application/binary')
+            self.end_headers()
+            bytesSent = write_content(self.wfile.write,
+                                      message.open_content())
+            proxyModel.record_bytes_up(bytesSent)
+            ec2Model.record_bytes_up(bytesSent)
+
+        def __receive_message_stream(self, messageId):
+            chunks = _iter_chunked_body(self.rfile)
+
+            # The first line holds the JSON metadata
+            headChunks = []
+            headLength = 0
+            for chunk in chunks:
+                headChunks.append(chunk)
+                headLength += len(chunk)
+                if '\n' in chunk or headLength > MAX_STREAM_META_LENGTH:
+                    break
+            head = b''.join(headChunks)
+            try:
+                metaLine, head = head.split('\n', 1)
+                if len(metaLine) > MAX_STREAM_META_LENGTH:
+                    raise ValueError('Metadata is too long')
+                meta = json.loads(metaLine)
+            except ValueError as e:
+                logger.error('Malformed message stream: %s: %s',
+                             messageId, e)
+                self.close_connection = 1
+                self.send_error(400, 'Malformed message stream')
+                return
+            stream = MessageStream(meta)
+            if not server.put_message_stream(messageId, stream):
+                self.send_error(404, 'Resource not found')
+                return
+
+            logger.info('Streaming: %s', messageId)
+            streamLength = len(metaLine) + 1
+            try:
+                with server.messageTransfers.record() as transfer:
+                    if head:
+                        transfer.first_byte()
+                        stream.write(head)
+                        streamLength += len(head)
+                    for chunk in chunks:
+                        transfer.first_byte()
+                        stream.write(chunk)
+                        streamLength += len(chunk)
+                    transfer.size = streamLength
+                    # The client's reads are not part of the transport
+                    transfer.adjust(-stream.blockedSeconds)
+                stream.finish()
+            except Exception as e:
+                stream.finish(error=str(e))
+                raise
+            finally:
+                logger.info('Streamed: %s (%dB)', messageId, streamLength)
+                proxyModel.record_bytes_down(streamLength)
+            self.send_response(204)
+            self.send_header('Content-Length', '0')
             self.end_headers()
-            self.wfile.write(testLivenessResponse)
 
         def do_POST(self):
             messageId = self.path[1:]
+            if self.headers.get('Transfer-Encoding') == 'chunked':
+                self.__receive_message_stream(messageId)
+                return
+
             messageLength = int(self.headers['Content-Length'])
-            messageBody = self.rfile.read(messageLength)
-            logger.info('Received: %s (%dB)', messageId, len(messageBody))
-            server.put_message(messageId, Message(messageBody))
-            proxyModel.record_bytes_down(len(messageBody))
+            with server.messageTransfers.record() as transfer:
+                message = server.receive_message(messageId, self.rfile,
+                                                 messageLength)
+                transfer.size = message.size
+            logger.info('Received: %s (%dB%s)', messageId, message.size,
+                        ', spilled' if message.isSpilled else '')
+            proxyModel.record_bytes_down(message.size)
             self.send_response(204)
             self.send_header('Content-Length', '0')
             self.end_headers()
 
+        def __serve_worker_channel(self):
+            workerPath = self.path[1 + len(WORKER_CHANNEL_PATH):]
+            workerId, _, workerSecret = workerPath.partition('/')
+            serve_channel = server.accept_worker(workerId, workerSecret)
+            if serve_channel is None:
+                # Tasks hold the client's requests, so only the workers that
+                # were started with a secret may receive them
+                logger.warn('Refused worker: %s', workerId)
+                self.send_error(403, 'Unknown worker')
+                return
+            logger.info('Worker connected: %s', workerId)
+            self.send_response(200)
+            self.end_headers()
+            channel = MessageChannel(self.connection)
+            try:
+                serve_channel(channel)
+            except Exception as e:
+                logger.exception(e)
+            finally:
+                logger.info('Worker disconnected: %s', workerId)
+                ec2Model.record_bytes_down(channel.bytesReceived)
+                ec2Model.record_bytes_up(channel.bytesSent)
+
         def do_CONNECT(self):
+            if self.path[1:].startswith(WORKER_CHANNEL_PATH):
+                self.__serve_worker_channel()
+                return
+
             socketId = self.path[1:]
             logger.info('Connect: %s', socketId)
             socketRequest = server.get_socket(socketId)
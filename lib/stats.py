@@ -1,5 +1,5 @@
-import json
 import logging
+import math
 import os
 import re
 import sys
@@ -7,15 +7,246 @@ import time
 
 from abc import abstractproperty
 from base64 import b64decode
-from collections import OrderedDict
+from collections import OrderedDict, deque
 from datetime import datetime
 from StringIO import StringIO
 from termcolor import colored
-from threading import Thread
+from threading import Lock, Thread, current_thread, local
 
 
 logger = logging.getLogger(__name__)
 
+# Shards of exited threads are folded after this many new shards, even if
+# nothing reads them
+SHARD_PRUNE_INTERVAL = 64
+
+
+class _ThreadShards(object):
+    """
+    State that each thread updates in its own shard, so that updates do not
+    contend on a lock. Only the owning thread writes to a shard. Readers merge
+    the shards, and the shards of threads that have exited are folded into
+    one, on reads and every SHARD_PRUNE_INTERVAL new shards, so short lived
+    threads do not accumulate.
+    """
+
+    def __init__(self, new_shard, merge):
+        self.__new_shard = new_shard
+        self.__merge = merge
+        self.__local = local()
+        self.__lock = Lock()
+        self.__shards = {}
+        self.__retired = new_shard()
+        self.__newShardsSincePrune = 0
+
+    def get(self):
+        """Return the calling thread's shard"""
+        try:
+            return self.__local.shard
+        except AttributeError:
+            shard = self.__new_shard()
+            with self.__lock:
+                self.__shards[current_thread()] = shard
+                self.__newShardsSincePrune += 1
+                if self.__newShardsSincePrune >= SHARD_PRUNE_INTERVAL:
+                    self.__prune()
+            self.__local.shard = shard
+            return shard
+
+    def __prune(self):
+        """Fold the shards of exited threads. Call with the lock held."""
+        for thread in self.__shards.keys():
+            if not thread.is_alive():
+                # The thread can no longer write to its shard
+                self.__merge(self.__retired, self.__shards.pop(thread))
+        self.__newShardsSincePrune = 0
+
+    def merged(self):
+        """Return a new shard with the state of all of them"""
+        total = self.__new_shard()
+        with self.__lock:
+            self.__prune()
+            self.__merge(total, self.__retired)
+            for shard in self.__shards.itervalues():
+                self.__merge(total, shard)
+        return total
+
+
+def _merge_counter(into, shard):
+    into[0] += shard[0]
+
+
+class ShardedCounter(object):
+    """A counter that many threads add to without locking"""
+
+    def __init__(self):
+        self.__shards = _ThreadShards(lambda: [0], _merge_counter)
+
+    def add(self, n=1):
+        self.__shards.get()[0] += n
+
+    @property
+    def value(self):
+        return self.__shards.merged()[0]
+
+
+# Values below 2 * SUB_BUCKET_COUNT get a bucket each. Above that, each power
+# of two is split into SUB_BUCKET_COUNT buckets, so a bucket is never wider
+# than 1/SUB_BUCKET_COUNT of the values in it.
+SUB_BUCKET_BITS = 5
+SUB_BUCKET_COUNT = 2 ** SUB_BUCKET_BITS
+
+DEFAULT_PERCENTILES = (50.0, 90.0, 99.0, 99.9)
+
+
+def _get_bucket_index(value):
+    if value < 2 * SUB_BUCKET_COUNT:
+        return value
+    shift = value.bit_length() - SUB_BUCKET_BITS - 1
+    return (shift << SUB_BUCKET_BITS) + (value >> shift)
+
+
+def _get_bucket_range(index):
+    """Return the lowest value in the bucket, and the lowest after it"""
+    if index < 2 * SUB_BUCKET_COUNT:
+        return index, index + 1
+    shift = (index >> SUB_BUCKET_BITS) - 1
+    subBucket = index - (shift << SUB_BUCKET_BITS)
+    return subBucket << shift, (subBucket + 1) << shift
+
+
+class _HistogramShard(object):
+
+    __slots__ = ('buckets', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+
+def _merge_histogram(into, shard):
+    # Copy the buckets first, the owner may be adding to them
+    for index, count in shard.buckets.items():
+        into.buckets[index] = into.buckets.get(index, 0) + count
+    into.count += shard.count
+    into.total += shard.total
+    into.max = max(into.max, shard.max)
+
+
+class LatencyHistogram(object):
+    """
+    Latencies in log sized buckets, in the manner of HdrHistogram. Values are
+    kept in microseconds and reported in milliseconds, and percentiles are
+    within about 2% of the value recorded.
+    """
+
+    def __init__(self):
+        self.__shards = _ThreadShards(_HistogramShard, _merge_histogram)
+
+    class Timer(object):
+
+        def __init__(self, histogram, counter=None):
+            self.__histogram = histogram
+            self.__counter = counter
+
+        def __enter__(self):
+            self.__startTime = time.time()
+            return self
+
+        def __exit__(self, exc_type, exc_val, exc_tb):
+            if exc_type is None:
+                self.__histogram.record(time.time() - self.__startTime)
+                if self.__counter is not None:
+                    self.__counter.add()
+
+    def time(self, counter=None):
+        """
+        Record the time taken by a block, unless it raises. A ShardedCounter
+        may be given to count the blocks recorded without reading the
+        histogram.
+        """
+        return LatencyHistogram.Timer(self, counter)
+
+    def record(self, seconds):
+        micros = max(0, int(seconds * 1000000))
+        shard = self.__shards.get()
+        index = _get_bucket_index(micros)
+        shard.buckets[index] = shard.buckets.get(index, 0) + 1
+        shard.count += 1
+        shard.total += micros
+        if micros > shard.max:
+            shard.max = micros
+
+    def snapshot(self):
+        return HistogramSnapshot(self.__shards.merged())
+
+    @property
+    def count(self):
+        return self.snapshot().count
+
+    @property
+    def mean(self):
+        return self.snapshot().mean
+
+
+class HistogramSnapshot(object):
+    """The merged state of a LatencyHistogram when it was read"""
+
+    def __init__(self, shard):
+        self.__buckets = sorted(shard.buckets.iteritems())
+        self.__count = shard.count
+        self.__total = shard.total
+        self.__max = shard.max
+
+    @property
+    def count(self):
+        return self.__count
+
+    @property
+    def sum(self):
+        """Milliseconds"""
+        return self.__total / 1000.0
+
+    @property
+    def mean(self):
+        """Milliseconds"""
+        if self.__count == 0:
+            return 0.0
+        return float(self.__total) / self.__count / 1000
+
+    @property
+    def max(self):
+        """Milliseconds"""
+        return self.__max / 1000.0
+
+    @property
+    def buckets(self):
+        """[(lowMillis, highMillis, count)] of the buckets with values"""
+        ret = []
+        for index, count in self.__buckets:
+            low, high = _get_bucket_range(index)
+            ret.append((low / 1000.0, high / 1000.0, count))
+        return ret
+
+    def percentile(self, percentile):
+        """Milliseconds, or 0.0 if nothing was recorded"""
+        if self.__count == 0:
+            return 0.0
+        rank = max(1, int(math.ceil(percentile / 100.0 * self.__count)))
+        seen = 0
+        for index, count in self.__buckets:
+            seen += count
+            if seen >= rank:
+                low, high = _get_bucket_range(index)
+                value = min((low + high - 1) / 2.0, self.__max)
+                return value / 1000
+        return self.max
+
+    def percentiles(self, percentiles=DEFAULT_PERCENTILES):
+        return [(p, self.percentile(p)) for p in percentiles]
+
 
 class _AbstractModel(object):
     pass
@@ -50,15 +281,129 @@ class _AbstractDataModel(_AbstractModel):
         return 0
 
 
+class _AbstractLatencyModel(_AbstractModel):
+
+    @abstractproperty
+    def latencies(self):
+        """OrderedDict of name -> LatencyHistogram"""
+        return OrderedDict()
+
+
+class _AbstractCountModel(_AbstractModel):
+
+    @abstractproperty
+    def counts(self):
+        """OrderedDict of name -> cumulative count"""
+        return OrderedDict()
+
+
+class TransferCounter(object):
+    """
+    Cumulative totals of the transfers made over one transport. The time of
+    each transfer is split into the time to its first byte, and the time
+    taken to move the rest.
+    """
+
+    def __init__(self):
+        self.__lock = Lock()
+        self.__totalBytes = 0
+        self.__totalFirstByteSeconds = 0.0
+        self.__totalTransferSeconds = 0.0
+        self.__totalTransfers = 0
+        self.__inFlight = 0
+
+    class Transfer(object):
+
+        def __init__(self, counter):
+            self.__counter = counter
+            # Transfers are only counted if size is set
+            self.size = None
+            self.__firstByteTime = None
+            self.__adjustment = 0.0
+
+        def start(self):
+            self.__startTime = time.time()
+            self.__counter._start()
+
+        def first_byte(self):
+            """Mark the arrival of the first byte. Later calls are ignored."""
+            if self.__firstByteTime is None:
+                self.__firstByteTime = time.time()
+
+        def adjust(self, seconds):
+            """
+            Add time that the bytes spent moving elsewhere, such as the
+            lambda's upload, or subtract time spent waiting for the reader
+            """
+            self.__adjustment += seconds
+
+        def finish(self, failed=False):
+            finishTime = time.time()
+            firstByteTime = self.__firstByteTime
+            if firstByteTime is None:
+                firstByteTime = self.__startTime
+            self.__counter._finish(
+                None if failed else self.size,
+                firstByteTime - self.__startTime,
+                max(finishTime - firstByteTime + self.__adjustment, 0.0))
+
+        def __enter__(self):
+            self.start()
+            return self
+
+        def __exit__(self, exc_type, exc_val, exc_tb):
+            self.finish(failed=exc_type is not None)
+
+    def _start(self):
+        with self.__lock:
+            self.__inFlight += 1
+
+    def _finish(self, size, firstByteSeconds, transferSeconds):
+        with self.__lock:
+            self.__inFlight -= 1
+            if size is not None:
+                self.__totalBytes += size
+                self.__totalFirstByteSeconds += firstByteSeconds
+                self.__totalTransferSeconds += transferSeconds
+                self.__totalTransfers += 1
+
+    def record(self):
+        """Time a transfer. Set size on the returned object to count it"""
+        return TransferCounter.Transfer(self)
+
+    @property
+    def inFlight(self):
+        return self.__inFlight
+
+    def snapshot(self):
+        """
+        Return (totalBytes, totalFirstByteSeconds, totalTransferSeconds,
+        totalTransfers)
+        """
+        with self.__lock:
+            return (self.__totalBytes, self.__totalFirstByteSeconds,
+                    self.__totalTransferSeconds, self.__totalTransfers)
+
+
 MEGABYTE = 2 ** 20
 DEFAULT_COLORS = ('green', 'yellow', 'cyan', 'red')
 def _cls(): os.system('cls' if os.name == 'nt' else 'clear')
 
+# Seconds over which the live summary computes rates
+RATE_WINDOW = 10
+
 
 class Stats(object):
 
-    def __init__(self):
+    def __init__(self, tracer=None):
         self.__models = OrderedDict()
+        self.__tracer = tracer
+
+        # (model, counter) -> deque of (time, value) within the window
+        self.__rateSamples = {}
+
+        # Name -> (function returning the current value, description)
+        self.__gauges = OrderedDict()
 
     def register_model(self, name, model):
         assert isinstance(model, _AbstractModel)
@@ -67,18 +412,56 @@ class Stats(object):
     def get_model(self, name):
         return self.__models[name]
 
+    def register_gauge(self, name, getter, description=''):
+        """Export a value that goes up and down, such as a queue depth"""
+        self.__gauges[name] = (getter, description)
+
+    @property
+    def gauges(self):
+        return OrderedDict(self.__gauges)
+
+    @property
+    def tracer(self):
+        """The Tracer that requests are recorded in, or None"""
+        return self.__tracer
+
+    def _get_rate(self, key, value, now=None):
+        """Per second rate of a cumulative value over the last RATE_WINDOW"""
+        if now is None:
+            now = time.time()
+        samples = self.__rateSamples.setdefault(key, deque())
+        samples.append((now, value))
+        while len(samples) > 2 and samples[1][0] <= now - RATE_WINDOW:
+            samples.popleft()
+        oldTime, oldValue = samples[0]
+        if now <= oldTime:
+            return 0.0
+        return (value - oldValue) / (now - oldTime)
+
     def _get_live_summary(self, minRefreshRate, colors=DEFAULT_COLORS):
         sio = StringIO()
         try:
             numColors = len(colors)
             totalCost = 0.0
+            now = time.time()
             for i, name in enumerate(self.__models):
                 model = self.__models[name]
                 color = colors[i % numColors]
                 values = []
                 if isinstance(model, ProxyStatsModel):
-                    values.append('reqs: {:9d}'.format(model.totalRequests))
-                    values.append('delay: {:6d}ms'.format(int(model.meanDelay)))
+                    totalRequests = model.totalRequests
+                    values.append('reqs: {:9d}'.format(totalRequests))
+                    values.append('rate: {:7.1f}/s'.format(
+                        self._get_rate((name, 'reqs'), totalRequests, now)))
+                if isinstance(model, CrawlStatsModel):
+                    totalResponses = model.totalResponses
+                    values.append('done: {:9d}'.format(totalResponses))
+                    values.append('rate: {:7.1f}/s'.format(
+                        self._get_rate((name, 'done'), totalResponses, now)))
+                    values.append('errors: {:6d}'.format(model.totalErrors))
+                    values.append('retries: {:6d}'.format(model.totalRetries))
+                    values.append('skipped: {:6d}'.format(
+                        model.totalSkipped + model.totalResumed))
                 if isinstance(model, _AbstractCostModel):
                     modelCost = model.cost
                     totalCost += modelCost
@@ -87,13 +470,26 @@ class Stats(object):
                     values.append('time: {:8d}s'.format(int(model.time) / 1000))
                     values.append('mean: {:7d}ms'.format(int(model.mean)))
                 if isinstance(model, _AbstractDataModel):
-                    MBDown = float(model.bytesDown) / MEGABYTE
+                    bytesDown = model.bytesDown
+                    MBDown = float(bytesDown) / MEGABYTE
                     MBUp = float(model.bytesUp) / MEGABYTE
                     values.append('up: {:9.3f}MB'.format(MBUp))
                     values.append('down: {:7.3f}MB'.format(MBDown))
+                    values.append('{:7.3f}MB/s'.format(
+                        self._get_rate((name, 'down'), MBDown, now)))
 
                 print >> sio, colored('[%#8s]' % name, color), '  '.join(values)
 
+                if isinstance(model, _AbstractLatencyModel):
+                    for label, histogram in model.latencies.iteritems():
+                        snapshot = histogram.snapshot()
+                        if snapshot.count == 0:
+                            continue
+                        values = ['{:>8s}'.format(label)]
+                        for p, ms in snapshot.percentiles():
+                            values.append('p{:g}: {:8.1f}ms'.format(p, ms))
+                        print >> sio, ' ' * 10, '  '.join(values)
+
             name = 'total'
             color = DEFAULT_COLORS[len(self.__models) % numColors]
             print >> sio, colored('[%#8s]' % name, color), \
@@ -139,7 +535,8 @@ class Stats(object):
         return self.__models.keys()
 
 
-class LambdaStatsModel(_AbstractCostModel, _AbstractTimeModel):
+class LambdaStatsModel(_AbstractCostModel, _AbstractTimeModel,
+                       _AbstractLatencyModel, _AbstractCountModel):
 
     class Constants:
         PER_REQUEST_COST = 0.2 / (10 ** 6)
@@ -153,23 +550,33 @@ class LambdaStatsModel(_AbstractCostModel, _AbstractTimeModel):
     BILLING_RE = re.compile('Billed Duration: (\d+) ms\s+Memory Size: (\d+) MB')
 
     def __init__(self):
-        self._totalMillis = 0
-        self._totalRequests = 0
-        self._timeBilledCost = 0.0
+        self._totalMillis = ShardedCounter()
+        self._totalRequests = ShardedCounter()
+        self._timeBilledCost = ShardedCounter()
+        self._invokeLatency = LatencyHistogram()
 
     @property
     def cost(self):
-        return (LambdaStatsModel.Constants.PER_REQUEST_COST * self._totalRequests
-                + self._timeBilledCost)
+        return (LambdaStatsModel.Constants.PER_REQUEST_COST *
+                self._totalRequests.value + self._timeBilledCost.value)
 
     @property
     def time(self):
-        return self._totalMillis
+        return self._totalMillis.value
 
     @property
     def mean(self):
-        if self._totalRequests == 0: return 0.0
-        return float(self._totalMillis) / self._totalRequests
+        totalRequests = self._totalRequests.value
+        if totalRequests == 0: return 0.0
+        return float(self._totalMillis.value) / totalRequests
+
+    @property
+    def latencies(self):
+        return OrderedDict([('invoke', self._invokeLatency)])
+
+    @property
+    def counts(self):
+        return OrderedDict([('invocations', self._totalRequests.value)])
 
     class Request(object):
 
@@ -183,24 +590,25 @@ class LambdaStatsModel(_AbstractCostModel, _AbstractTimeModel):
             return self
 
         def __exit__(self, exc_type, exc_val, exc_tb):
-            self.__model._totalRequests += 1
+            runTime = time.time() - self.__startTime
+            self.__model._invokeLatency.record(runTime)
+            self.__model._totalRequests.add()
             billingScale = float(self.__billedMemory) / \
                            LambdaStatsModel.Constants.PER_100MS_RAM
             if self.__billedMillis is None:
                 logging.warn('No billing info found. Using estimate instead')
-                runTime = time.time() - self.__startTime
                 estMillisBilled = min(
                     LambdaStatsModel.Constants.MAX_MILLIS_PER_RUN,
                     int(runTime * 1000))
                 if estMillisBilled % 100 != 0:
                     estMillisBilled += (100 - estMillisBilled % 100)
-                self.__model._totalMillis += estMillisBilled
-                self.__model._timeBilledCost += (
+                self.__model._totalMillis.add(estMillisBilled)
+                self.__model._timeBilledCost.add(
                     LambdaStatsModel.Constants.PER_100MS_COST * billingScale
                     * (estMillisBilled / 100))
             else:
-                self.__model._totalMillis += self.__billedMillis
-                self.__model._timeBilledCost += (
+                self.__model._totalMillis.add(self.__billedMillis)
+                self.__model._timeBilledCost.add(
                     LambdaStatsModel.Constants.PER_100MS_COST * billingScale
                     * (self.__billedMillis / 100))
 
@@ -230,30 +638,31 @@ class EC2StatsModel(_AbstractCostModel, _AbstractDataModel):
         PER_GB_COST = 0.09
 
     def __init__(self):
-        self.__totalBytesUp = 0
-        self.__totalBytesDown = 0
+        self.__totalBytesUp = ShardedCounter()
+        self.__totalBytesDown = ShardedCounter()
 
     @property
     def cost(self):
-        return float(self.__totalBytesDown) / (2 ** 30) * \
+        return float(self.__totalBytesDown.value) / (2 ** 30) * \
                EC2StatsModel.Constants.PER_GB_COST
 
     @property
     def bytesUp(self):
-        return self.__totalBytesUp
+        return self.__totalBytesUp.value
 
     @property
     def bytesDown(self):
-        return self.__totalBytesDown
+        return self.__totalBytesDown.value
 
     def record_bytes_up(self, n):
-        self.__totalBytesUp += n
+        self.__totalBytesUp.add(n)
 
     def record_bytes_down(self, n):
-        self.__totalBytesDown += n
+        self.__totalBytesDown.add(n)
 
 
-class SqsStatsModel(_AbstractCostModel, _AbstractDataModel):
+class SqsStatsModel(_AbstractCostModel, _AbstractDataModel,
+                    _AbstractLatencyModel, _AbstractCountModel):
 
     class Constants:
         PER_REQUEST_COST = 0.4 / (10 ** 6)
@@ -261,70 +670,95 @@ class SqsStatsModel(_AbstractCostModel, _AbstractDataModel):
         BILLING_UNIT_SIZE = 64 * 1024
 
     def __init__(self):
-        self.__totalMessagesReceived = 0
-        self.__totalMessagesSent = 0
-        self.__totalPolls = 0
+        self.__totalMessagesReceived = ShardedCounter()
+        self.__totalMessagesSent = ShardedCounter()
+        self.__totalPolls = ShardedCounter()
 
         # For computing cost
-        self.__totalRequests = 0
+        self.__totalRequests = ShardedCounter()
+
+        self.__totalBytesUp = ShardedCounter()
+        self.__totalBytesDown = ShardedCounter()
 
-        self.__totalBytesUp = 0
-        self.__totalBytesDown = 0
-        self.__totalMessagesReceived = 0
+        # From sending a task to receiving its result
+        self.__roundTripLatency = LatencyHistogram()
 
     @property
     def cost(self):
-        return self.__totalRequests * SqsStatsModel.Constants.PER_REQUEST_COST
+        return (self.__totalRequests.value *
+                SqsStatsModel.Constants.PER_REQUEST_COST)
 
     @property
     def bytesUp(self):
-        return self.__totalBytesUp
+        return self.__totalBytesUp.value
 
     @property
     def bytesDown(self):
-        return self.__totalBytesDown
+        return self.__totalBytesDown.value
+
+    @property
+    def roundTripLatency(self):
+        return self.__roundTripLatency
+
+    @property
+    def latencies(self):
+        return OrderedDict([('rtt', self.__roundTripLatency)])
+
+    @property
+    def counts(self):
+        return OrderedDict([
+            ('messages_sent', self.__totalMessagesSent.value),
+            ('messages_received', self.__totalMessagesReceived.value),
+            ('polls', self.__totalPolls.value),
+            ('requests', self.__totalRequests.value),
+        ])
 
     @staticmethod
     def estimate_message_size(message=None, messageAttributes=None,
                               messageBody=None):
-        size = 0
+        """
+        The body plus the name, type and value of each attribute, as SQS
+        counts them. Binary values are counted as bytes, not serialized.
+        """
         if message is not None:
-            if message.message_attributes is not None:
-                size += len(json.dumps(message.message_attributes))
-            size += len(message.body)
-        else:
-            if messageAttributes is not None:
-                size += len(json.dumps(messageAttributes))
-            size += len(messageBody)
+            messageAttributes = message.message_attributes
+            messageBody = message.body
+        size = len(messageBody)
+        if messageAttributes is not None:
+            for name, attribute in messageAttributes.iteritems():
+                size += len(name) + len(attribute.get('DataType', ''))
+                size += len(attribute.get('StringValue') or
+                            attribute.get('BinaryValue') or '')
         return size
 
     def record_poll(self):
-        self.__totalPolls += 1
-        self.__totalRequests += 1
+        self.__totalPolls.add()
+        self.__totalRequests.add()
 
     def record_send(self, size=Constants.MAX_REQUEST_SIZE):
-        self.__totalMessagesSent += 1
-        self.__totalBytesUp += size
+        self.__totalMessagesSent.add()
+        self.__totalBytesUp.add(size)
         requests = size / SqsStatsModel.Constants.BILLING_UNIT_SIZE
         if size % SqsStatsModel.Constants.BILLING_UNIT_SIZE != 0:
             requests += 1
         # Assume someone on the other side is receiving the request
         # by polling and deleting it when done
-        self.__totalRequests += 3 * requests
+        self.__totalRequests.add(3 * requests)
 
     def record_receive(self, size=Constants.MAX_REQUEST_SIZE):
-        self.__totalMessagesReceived += 1
-        self.__totalBytesDown += size
+        self.__totalMessagesReceived.add()
+        self.__totalBytesDown.add(size)
         requests = size / SqsStatsModel.Constants.BILLING_UNIT_SIZE
         if size % SqsStatsModel.Constants.BILLING_UNIT_SIZE != 0:
             requests += 1
 
         # Assume someone on the other side sent the request and
         # that we are deleting the message when done
-        self.__totalRequests += 2 * requests
+        self.__totalRequests.add(2 * requests)
 
 
-class S3StatsModel(_AbstractCostModel, _AbstractDataModel):
+class S3StatsModel(_AbstractCostModel, _AbstractDataModel,
+                   _AbstractLatencyModel, _AbstractCountModel):
 
     class Constants:
         PER_PUT_COST = 0.0055 / 1000
@@ -336,93 +770,204 @@ class S3StatsModel(_AbstractCostModel, _AbstractDataModel):
 
     def __init__(self, bothSides=True):
         self.__bothSides = bothSides
-        self.__totalPuts = 0
-        self.__totalGets = 0
-        self.__totalBytesUp = 0
-        self.__totalBytesDown = 0
+        self.__totalPuts = ShardedCounter()
+        self.__totalGets = ShardedCounter()
+        self.__totalBytesUp = ShardedCounter()
+        self.__totalBytesDown = ShardedCounter()
+
+        # Timing of the gets made locally
+        self.__getTransfers = TransferCounter()
+        self.__getLatency = LatencyHistogram()
 
     @property
     def cost(self):
-        return (self.__totalPuts * S3StatsModel.Constants.PER_PUT_COST +
-                self.__totalGets * S3StatsModel.Constants.PER_GET_COST +
-                self.__totalBytesDown * S3StatsModel.Constants.DATA_RETRIEVAL_COST +
-                self.__totalBytesUp * S3StatsModel.Constants.DATA_STORAGE_COST)
+        return (self.__totalPuts.value * S3StatsModel.Constants.PER_PUT_COST +
+                self.__totalGets.value * S3StatsModel.Constants.PER_GET_COST +
+                self.__totalBytesDown.value *
+                S3StatsModel.Constants.DATA_RETRIEVAL_COST +
+                self.__totalBytesUp.value *
+                S3StatsModel.Constants.DATA_STORAGE_COST)
     
     @property
     def bytesUp(self):
-        return self.__totalBytesUp
+        return self.__totalBytesUp.value
 
     @property
     def bytesDown(self):
-        return self.__totalBytesDown
+        return self.__totalBytesDown.value
+
+    @property
+    def getTransfers(self):
+        return self.__getTransfers
+
+    @property
+    def getLatency(self):
+        """Time of each GET request made locally"""
+        return self.__getLatency
+
+    @property
+    def latencies(self):
+        return OrderedDict([('get', self.__getLatency)])
+
+    @property
+    def counts(self):
+        return OrderedDict([
+            ('puts', self.__totalPuts.value),
+            ('gets', self.__totalGets.value),
+        ])
 
     def record_put(self, size):
-        self.__totalPuts += 1
+        self.__totalPuts.add()
 
         if self.__bothSides:
             # Someone on the other side is gets the object
-            self.__totalGets += 1
-            self.__totalBytesDown += size
+            self.__totalGets.add()
+            self.__totalBytesDown.add(size)
 
-        self.__totalBytesUp += size
+        self.__totalBytesUp.add(size)
 
-    def record_get(self, size):
-        self.__totalGets += 1
+    def record_get(self, size, numRequests=1):
+        self.__totalGets.add(numRequests)
 
         if self.__bothSides:
             # someone on the other side put the object
-            self.__totalPuts += 1
-            self.__totalBytesUp += size
+            self.__totalPuts.add()
+            self.__totalBytesUp.add(size)
 
-        self.__totalBytesDown += size
+        self.__totalBytesDown.add(size)
 
 
-class ProxyStatsModel(_AbstractDataModel):
+class ProxyStatsModel(_AbstractDataModel, _AbstractLatencyModel,
+                      _AbstractCountModel):
 
     def __init__(self):
         self.__startTime = time.time()
-        self._totalRequestsProxied = 0
-        self._totalRequestDelays = 0.0
-        self.__totalBytesDown = 0
-        self.__totalBytesUp = 0
+        self.__delayLatency = LatencyHistogram()
+        self.__totalRequests = ShardedCounter()
+        self.__totalBytesDown = ShardedCounter()
+        self.__totalBytesUp = ShardedCounter()
 
-    class Delay(object):
-
-        def __init__(self, model):
-            self.__model = model
+    @property
+    def totalRequests(self):
+        return self.__totalRequests.value
 
-        def __enter__(self):
-            self.__startTime = time.time()
+    @property
+    def meanDelay(self):
+        return self.__delayLatency.mean
 
-        def __exit__(self, exc_type, exc_val, exc_tb):
-            if exc_type is None:
-                delay = time.time() - self.__startTime
-                self.__model._totalRequestDelays += delay * 1000
-                self.__model._totalRequestsProxied += 1
+    @property
+    def delayLatency(self):
+        return self.__delayLatency
 
     @property
-    def totalRequests(self):
-        return self._totalRequestsProxied
+    def latencies(self):
+        return OrderedDict([('delay', self.__delayLatency)])
 
     @property
-    def meanDelay(self):
-        if self._totalRequestsProxied == 0:
-            return 0.0
-        return float(self._totalRequestDelays) / self._totalRequestsProxied
+    def counts(self):
+        return OrderedDict([('requests', self.totalRequests)])
 
     @property
     def bytesUp(self):
-        return self.__totalBytesUp
+        return self.__totalBytesUp.value
 
     @property
     def bytesDown(self):
-        return self.__totalBytesDown
+        return self.__totalBytesDown.value
 
     def record_delay(self):
-        return ProxyStatsModel.Delay(self)
+        """Time a request from end to end, unless it fails"""
+        return self.__delayLatency.time(self.__totalRequests)
 
     def record_bytes_up(self, n):
-        self.__totalBytesUp += n
+        self.__totalBytesUp.add(n)
 
     def record_bytes_down(self, n):
-        self.__totalBytesDown += n
+        self.__totalBytesDown.add(n)
+
+
+class CrawlStatsModel(_AbstractCountModel):
+
+    def __init__(self):
+        self.__startTime = time.time()
+        self.__totalResponses = ShardedCounter()
+        self.__totalErrors = ShardedCounter()
+        self.__totalRetries = ShardedCounter()
+        self.__totalSkipped = ShardedCounter()
+        self.__totalResumed = ShardedCounter()
+        self.__totalBytes = ShardedCounter()
+
+        # Status code -> ShardedCounter
+        self.__statusCounts = {}
+        self.__statusCountsLock = Lock()
+
+    @property
+    def totalResponses(self):
+        return self.__totalResponses.value
+
+    @property
+    def totalErrors(self):
+        return self.__totalErrors.value
+
+    @property
+    def totalRetries(self):
+        return self.__totalRetries.value
+
+    @property
+    def totalSkipped(self):
+        return self.__totalSkipped.value
+
+    @property
+    def totalResumed(self):
+        return self.__totalResumed.value
+
+    @property
+    def totalBytes(self):
+        return self.__totalBytes.value
+
+    @property
+    def counts(self):
+        return OrderedDict([
+            ('responses', self.totalResponses),
+            ('errors', self.totalErrors),
+            ('retries', self.totalRetries),
+            ('skipped', self.totalSkipped),
+            ('resumed', self.totalResumed),
+            ('bytes', self.totalBytes),
+        ])
+
+    @property
+    def statusCounts(self):
+        with self.__statusCountsLock:
+            statusCounts = self.__statusCounts.items()
+        return {k: v.value for k, v in statusCounts}
+
+    @property
+    def throughput(self):
+        """Responses per second since the crawl started"""
+        elapsed = time.time() - self.__startTime
+        if elapsed <= 0:
+            return 0.0
+        return self.totalResponses / elapsed
+
+    def record_response(self, statusCode, size):
+        self.__totalResponses.add()
+        self.__totalBytes.add(size)
+        counter = self.__statusCounts.get(statusCode)
+        if counter is None:
+            with self.__statusCountsLock:
+                counter = self.__statusCounts.setdefault(statusCode,
+                                                         ShardedCounter())
+        counter.add()
+
+    def record_error(self):
+        self.__totalErrors.add()
+
+    def record_retry(self):
+        self.__totalRetries.add()
+
+    def record_skipped(self):
+        self.__totalSkipped.add()
+
+    def record_resumed(self):
+        self.__totalResumed.add()
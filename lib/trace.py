@@ -0,0 +1,196 @@
+"""
+Per-request spans, kept in a ring buffer that can be dumped in the Chrome
+trace event format (load it in chrome://tracing or Perfetto)
+"""
+
+import json
+import logging
+import random
+import time
+
+from collections import deque, namedtuple
+from threading import Lock, local
+
+from shared.timing import TIMING_KEY
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TRACE_CAPACITY = 100000
+
+DAEMON_CATEGORY = 'daemon'
+LAMBDA_CATEGORY = 'lambda'
+
+# Process ids in the trace, so daemon and lambda spans are shown apart
+_CATEGORY_PIDS = {DAEMON_CATEGORY: 1, LAMBDA_CATEGORY: 2}
+
+Span = namedtuple('Span', [
+    'traceId', 'name', 'category', 'startTime', 'endTime', 'threadId',
+    'args'
+])
+
+# The trace of the request being handled by each thread
+_current = local()
+
+
+class _SpanTimer(object):
+
+    def __init__(self, trace, name, args):
+        self.__trace = trace
+        self.__name = name
+        self.__args = args
+
+    def __enter__(self):
+        self.__startTime = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        args = self.__args
+        if exc_type is not None:
+            args = dict(args, error=exc_type.__name__)
+        self.__trace.add_span(self.__name, self.__startTime, time.time(),
+                              args=args)
+
+
+class _NullSpanTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+_NULL_SPAN_TIMER = _NullSpanTimer()
+
+
+class Trace(object):
+    """
+    The spans of one request. It is the current trace of the thread that
+    handles the request, and may be passed to other threads to add spans.
+    """
+
+    def __init__(self, tracer, name, args):
+        self.__tracer = tracer
+        self.__traceId = '%016x' % random.getrandbits(64)
+        self.__name = name
+        self.__args = args
+        self.__threadId = _get_thread_id()
+
+    @property
+    def traceId(self):
+        return self.__traceId
+
+    def span(self, name, **args):
+        """Time a block as a span"""
+        return _SpanTimer(self, name, args)
+
+    def add_span(self, name, startTime, endTime, category=DAEMON_CATEGORY,
+                 args=None):
+        # Spans are shown on the request's row even if another thread
+        # added them
+        self.__tracer._add(Span(self.__traceId, name, category, startTime,
+                                endTime, self.__threadId, args or {}))
+
+    def add_lambda_timing(self, response, startTime, endTime):
+        """
+        Add the phases that a lambda returned in its response metadata.
+        Clocks differ, so the handler is centered within the time the
+        client waited for it.
+        """
+        timing = response.get(TIMING_KEY) if response else None
+        if not timing:
+            return
+        try:
+            handlerSeconds = timing['total'] / 1000000.0
+            offset = startTime + max(
+                0.0, (endTime - startTime - handlerSeconds) / 2)
+            coldStart = timing.get('coldStart', False)
+            self.add_span('handler (cold)' if coldStart else 'handler',
+                          offset, offset + handlerSeconds, LAMBDA_CATEGORY,
+                          {'coldStart': coldStart})
+            for name, start, duration in timing['phases']:
+                phaseStart = offset + start / 1000000.0
+                self.add_span(name, phaseStart,
+                              phaseStart + duration / 1000000.0,
+                              LAMBDA_CATEGORY)
+        except (KeyError, TypeError, ValueError) as e:
+            logger.warn('Bad lambda timing: %s', e)
+
+    def __enter__(self):
+        self.__prev = getattr(_current, 'trace', None)
+        _current.trace = self
+        self.__startTime = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        _current.trace = self.__prev
+        self.add_span(self.__name, self.__startTime, time.time(),
+                      args=self.__args)
+
+
+class Tracer(object):
+    """Keeps the most recent spans of every request, up to capacity"""
+
+    def __init__(self, capacity=DEFAULT_TRACE_CAPACITY):
+        self.__spans = deque(maxlen=capacity)
+        self.__lock = Lock()
+
+    def trace(self, name, **args):
+        """Start a trace that is current on this thread within the block"""
+        return Trace(self, name, args)
+
+    def _add(self, span):
+        with self.__lock:
+            self.__spans.append(span)
+
+    def get_spans(self, startTime=None, endTime=None):
+        """Return the spans that overlap the window"""
+        with self.__lock:
+            spans = list(self.__spans)
+        return [s for s in spans
+                if (startTime is None or s.endTime >= startTime)
+                and (endTime is None or s.startTime <= endTime)]
+
+    def to_chrome_trace(self, startTime=None, endTime=None):
+        events = []
+        for category, pid in sorted(_CATEGORY_PIDS.iteritems()):
+            events.append({'name': 'process_name', 'ph': 'M', 'pid': pid,
+                           'args': {'name': category}})
+        for span in self.get_spans(startTime, endTime):
+            args = dict(span.args, traceId=span.traceId)
+            events.append({
+                'name': span.name,
+                'cat': span.category,
+                'ph': 'X',
+                'ts': int(span.startTime * 1000000),
+                'dur': int((span.endTime - span.startTime) * 1000000),
+                'pid': _CATEGORY_PIDS[span.category],
+                'tid': span.threadId,
+                'args': args
+            })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def dump(self, fileName, startTime=None, endTime=None):
+        with open(fileName, 'w') as ofs:
+            json.dump(self.to_chrome_trace(startTime, endTime), ofs)
+
+
+def _get_thread_id():
+    # Thread idents are large, and the trace viewer expects small ints
+    threadId = getattr(_current, 'threadId', None)
+    if threadId is None:
+        threadId = _current.threadId = random.getrandbits(31)
+    return threadId
+
+
+def current_trace():
+    """Return the current thread's Trace, or None"""
+    return getattr(_current, 'trace', None)
+
+
+def span(name, **args):
+    """Time a block as a span of the current trace, if there is one"""
+    trace = current_trace()
+    if trace is None:
+        return _NULL_SPAN_TIMER
+    return trace.span(name, **args)
@@ -0,0 +1,104 @@
+import logging
+import time
+
+from collections import OrderedDict
+from threading import Lock
+
+from shared.transport import INLINE_TRANSPORT, FRAGMENTS_TRANSPORT, \
+    MESSAGE_TRANSPORT, S3_TRANSPORT
+
+logger = logging.getLogger(__name__)
+
+MEGABYTE = 2 ** 20
+
+# Starting (latency in seconds, throughput in bytes/s) of each transport
+DEFAULT_ESTIMATES = {
+    INLINE_TRANSPORT: (0.0, 40 * MEGABYTE),
+    FRAGMENTS_TRANSPORT: (0.1, 5 * MEGABYTE),
+    MESSAGE_TRANSPORT: (0.05, 20 * MEGABYTE),
+    S3_TRANSPORT: (0.2, 20 * MEGABYTE),
+}
+
+# Floor for the time attributed to moving the bytes of a batch of transfers
+MIN_TRANSFER_SECONDS = 0.001
+
+
+class TransportSelector(object):
+    """
+    Estimates the latency and throughput of each large payload transport
+    from the TransferCounter it records into. The estimates are sent with
+    each request, and whoever knows the body size picks the transport with
+    shared.transport.choose_transport.
+
+    The latency is the mean time to the first byte of recent transfers, and
+    the throughput is their bytes over the time taken to move the rest.
+    Both are measured where the body arrives on the daemon, without the
+    time spent waiting for the client to read it. Throughput is divided
+    among the transfers currently in flight.
+    """
+
+    def __init__(self, refreshInterval=1.0, smoothing=0.25):
+        self.__refreshInterval = refreshInterval
+        self.__smoothing = smoothing
+        self.__lastRefresh = 0
+
+        # Name -> [counter, latency, throughput, last snapshot]
+        self.__transports = OrderedDict()
+        self.__lock = Lock()
+
+    def register(self, name, counter=None, latency=None, throughput=None):
+        """Transports without a counter keep their initial estimate"""
+        defaultLatency, defaultThroughput = DEFAULT_ESTIMATES[name]
+        if latency is None:
+            latency = defaultLatency
+        if throughput is None:
+            throughput = defaultThroughput
+        snapshot = counter.snapshot() if counter is not None else None
+        with self.__lock:
+            self.__transports[name] = [counter, latency, throughput,
+                                       snapshot]
+
+    @property
+    def transports(self):
+        return self.__transports.keys()
+
+    def __refresh(self):
+        for name, entry in self.__transports.iteritems():
+            counter, latency, throughput, prevSnapshot = entry
+            if counter is None:
+                continue
+            snapshot = counter.snapshot()
+            entry[3] = snapshot
+            bytesMoved = snapshot[0] - prevSnapshot[0]
+            firstByteSeconds = snapshot[1] - prevSnapshot[1]
+            transferSeconds = snapshot[2] - prevSnapshot[2]
+            transfers = snapshot[3] - prevSnapshot[3]
+            if transfers == 0:
+                continue
+            entry[1] = ((1 - self.__smoothing) * latency +
+                        self.__smoothing * firstByteSeconds / transfers)
+            if bytesMoved > 0:
+                measured = bytesMoved / max(transferSeconds,
+                                            MIN_TRANSFER_SECONDS)
+                entry[2] = ((1 - self.__smoothing) * throughput +
+                            self.__smoothing * measured)
+            logger.debug('%s latency: %.3fs, throughput: %dB/s', name,
+                         entry[1], int(entry[2]))
+
+    def estimates(self):
+        """Current {transport: {'latency', 'throughput'}} estimates"""
+        with self.__lock:
+            curTime = time.time()
+            if curTime - self.__lastRefresh >= self.__refreshInterval:
+                self.__refresh()
+                self.__lastRefresh = curTime
+
+            ret = {}
+            for name, entry in self.__transports.iteritems():
+                counter, latency, throughput, _ = entry
+                inFlight = counter.inFlight if counter is not None else 0
+                ret[name] = {
+                    'latency': latency,
+                    'throughput': throughput / (1 + inFlight)
+                }
+            return ret
@@ -1,14 +1,20 @@
 import atexit
+import hmac
 import json
 import logging
+import os
 import random
 import time
 
 from abc import abstractproperty
 from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from threading import Condition, Event, Lock, Thread
 
+from lib import aws
 from lib.stats import Stats, LambdaStatsModel, SqsStatsModel
+from shared.channel import DRAIN_CONTROL, DRAINED_CONTROL
+from shared.profiling import hook
 from shared.workers import LambdaSqsResult, LambdaSqsTask
 
 # Re-expose these classes
@@ -17,12 +23,6 @@ LambdaSqsTask = LambdaSqsTask
 
 logger = logging.getLogger(__name__)
 
-try:
-    import boto3
-except ImportError as e:
-    logger.error('Failed to import boto3')
-    boto3 = None
-
 MAX_SQS_REQUEST_MESSAGES = 10
 
 DEFAULT_POLLING_THREADS = 4
@@ -35,12 +35,13 @@ class Future(object):
         self.__done = Event()
         self.__result = None
         self.__aborted = False
+        self.__lost = False
 
         self._partial = {}
 
     def get(self, timeout=None):
         self.__done.wait(timeout)
-        if self.__result is None:
+        if self.__result is None and not self.__lost:
             self.__aborted = True
         return self.__result
 
@@ -48,10 +49,19 @@ class Future(object):
         self.__result = result
         self.__done.set()
 
+    def set_lost(self):
+        """The worker holding the task exited, so it can be sent again"""
+        self.__lost = True
+        self.__done.set()
+
     @property
     def isAborted(self):
         return self.__aborted
 
+    @property
+    def isLost(self):
+        return self.__lost
+
 
 class LambdaSqsTaskConfig(object):
 
@@ -79,6 +89,14 @@ class LambdaSqsTaskConfig(object):
         """Number of seconds each worker will wait for work"""
         return 1
 
+    @property
+    def worker_connect_timeout(self):
+        """
+        Number of seconds to wait for a starting worker to connect to
+        the worker server before falling back to SQS
+        """
+        return 5
+
     @property
     def message_retention_period(self):
         """
@@ -101,7 +119,13 @@ class LambdaSqsTaskConfig(object):
 
 class WorkerManager(object):
 
-    def __init__(self, taskConfig, stats=None):
+    # Seconds to stop waiting for workers to connect after one fails to
+    PUSH_BACKOFF_SECONDS = 60
+
+    # Seconds for a task to wait for the queues to be created
+    INIT_TIMEOUT_SECONDS = 60
+
+    def __init__(self, taskConfig, stats=None, workerServer=None):
         self.__config = taskConfig
         if stats is None:
             stats = Stats()
@@ -115,30 +139,77 @@ class WorkerManager(object):
             stats.register_model('sqs', SqsStatsModel())
         self.__sqsStats = stats.get_model('sqs')
 
-        self.__lambda = boto3.client('lambda')
+        stats.register_gauge('workers_running', lambda: self.__numWorkers,
+                             'Long lived lambda workers running')
+        stats.register_gauge('worker_tasks_in_progress',
+                             lambda: self.__numTasksInProgress,
+                             'Tasks sent to workers without a result')
+        stats.register_gauge('worker_channels',
+                             lambda: len(self.__workerChannels),
+                             'Workers connected to the worker server')
 
         self.__numWorkers = 0
         self.__numWorkersLock = Lock()
 
-        # RequestId -> Future
+        # RequestId -> Future, for tasks pushed to workers and in SQS. Only
+        # the tasks in SQS keep the result queue polled.
         self.__numTasksInProgress = 0
+        self.__numQueuedTasks = 0
         self.__tasksInProgress = {}
         self.__tasksInProgressLock = Lock()
         self.__tasksInProgressCondition = Condition(self.__tasksInProgressLock)
 
-        self.__init_message_queues()
+        # Workers that hold a persistent channel to the worker server
+        # WorkerId -> (channel, set of taskIds pushed to the worker, lock
+        # held while sending tasks and until the channel is drained)
+        self.__workerServer = workerServer
+        self.__workerChannels = {}
+        self.__workerChannelsLock = Lock()
+        self.__workerChannelsCondition = Condition(self.__workerChannelsLock)
+        self.__pushBackoffUntil = 0
+
+        # WorkerId -> secret, for workers started but not yet connected
+        self.__pendingWorkers = {}
+        if workerServer is not None:
+            workerServer.register_worker_handler(self.__accept_worker)
 
-        # Start result fetcher thread
         self.__result_handler_pool = ThreadPoolExecutor(DEFAULT_POLLING_THREADS)
+
+        # The client and queues are made in the background, so that the
+        # proxy can listen in the meantime. Tasks wait for them.
+        self.__ready = Event()
+        self.__initError = None
+        initThread = Thread(target=self.__initialize)
+        initThread.daemon = True
+        initThread.start()
+
+    def __initialize(self):
+        try:
+            self.__lambda = aws.client('lambda')
+            self.__init_message_queues()
+        except Exception as e:
+            logger.exception(e)
+            self.__initError = e
+            self.__ready.set()
+            return
+        self.__ready.set()
+
+        # Start result fetcher thread
         for i in xrange(DEFAULT_POLLING_THREADS):
             rt = Thread(target=self.__result_daemon)
             rt.daemon = True
             rt.start()
 
+    def __wait_until_ready(self):
+        if not self.__ready.wait(self.INIT_TIMEOUT_SECONDS):
+            raise Exception('Timed out creating the message queues')
+        if self.__initError is not None:
+            raise Exception('Failed to create the message queues: %s' %
+                            self.__initError)
 
     def __init_message_queues(self):
         """Setup the message queues"""
-        sqs = boto3.resource('sqs')
+        sqs = aws.resource('sqs')
 
         currentTime = time.time()
         taskQueueAttributes = {
@@ -169,12 +240,52 @@ class WorkerManager(object):
         logger.info('Created result queue: %s', resultQueueName)
 
     def execute(self, task, timeout=None):
-        """Enqueue a message in the task queue"""
+        """Push the task to a connected worker, or enqueue it in SQS"""
         assert isinstance(task, LambdaSqsTask)
+        self.__wait_until_ready()
         with self.__numWorkersLock:
             if self.__should_spawn_worker():
                 self.__spawn_new_worker()
 
+        endTime = None if timeout is None else time.time() + timeout
+        if self.__workerServer is not None:
+            taskFuture = Future()
+            taskId = self.__push_task_to_worker(task, taskFuture)
+            if taskId is not None:
+                result = taskFuture.get(timeout=timeout)
+                self.__remove_task_in_progress(taskId, queued=False)
+                if not taskFuture.isLost:
+                    return result
+                # The worker exited before it returned a result
+                logger.warn('Sending lost task to SQS: %s', taskId)
+                if endTime is not None:
+                    timeout = max(endTime - time.time(), 0)
+
+        taskFuture = Future()
+        sentTime = time.time()
+        taskId = self.__send_task_to_queue(task, taskFuture)
+        result = taskFuture.get(timeout=timeout)
+        if result is not None:
+            self.__sqsStats.roundTripLatency.record(time.time() - sentTime)
+        self.__remove_task_in_progress(taskId, queued=True)
+        return result
+
+    def __add_task_in_progress(self, taskId, taskFuture, queued):
+        with self.__tasksInProgressLock:
+            self.__tasksInProgress[taskId] = taskFuture
+            self.__numTasksInProgress = len(self.__tasksInProgress)
+            if queued:
+                self.__numQueuedTasks += 1
+                self.__tasksInProgressCondition.notify()
+
+    def __remove_task_in_progress(self, taskId, queued):
+        with self.__tasksInProgressLock:
+            del self.__tasksInProgress[taskId]
+            self.__numTasksInProgress = len(self.__tasksInProgress)
+            if queued:
+                self.__numQueuedTasks -= 1
+
+    def __send_task_to_queue(self, task, taskFuture):
         kwargs = {}
         if task.messageAttributes:
             kwargs['MessageAttributes'] = task.messageAttributes
@@ -183,26 +294,119 @@ class WorkerManager(object):
 
         # Use the MessageId as taskId
         taskId = messageStatus['MessageId']
-
-        taskFuture = Future()
-        with self.__tasksInProgressLock:
-            self.__tasksInProgress[taskId] = taskFuture
-            self.__numTasksInProgress = len(self.__tasksInProgress)
-            self.__tasksInProgressCondition.notify()
+        self.__add_task_in_progress(taskId, taskFuture, queued=True)
 
         # Do this before sleeping
         self.__sqsStats.record_send(
             SqsStatsModel.estimate_message_size(
                 messageAttributes=task.messageAttributes,
                 messageBody=task.body))
+        return taskId
 
-        result = taskFuture.get(timeout=timeout)
-
-        with self.__tasksInProgressLock:
-            del self.__tasksInProgress[taskId]
-            self.__numTasksInProgress = len(self.__tasksInProgress)
-
-        return result
+    def __get_num_workers(self):
+        with self.__numWorkersLock:
+            return self.__numWorkers
+
+    def __get_worker_channel(self):
+        """Return the least loaded worker channel, or None"""
+        endTime = time.time() + self.__config.worker_connect_timeout
+        with self.__workerChannelsLock:
+            while len(self.__workerChannels) == 0:
+                curTime = time.time()
+                if (curTime < self.__pushBackoffUntil or
+                        self.__get_num_workers() == 0):
+                    return None
+                if curTime > endTime:
+                    logger.warn('No workers connected, falling back to SQS')
+                    self.__pushBackoffUntil = \
+                        curTime + WorkerManager.PUSH_BACKOFF_SECONDS
+                    return None
+                self.__workerChannelsCondition.wait(endTime - curTime)
+            workerId = min(self.__workerChannels,
+                           key=lambda x: len(self.__workerChannels[x][1]))
+            return workerId, self.__workerChannels[workerId]
+
+    def __push_task_to_worker(self, task, taskFuture):
+        ret = self.__get_worker_channel()
+        if ret is None:
+            return None
+        workerId, workerChannel = ret
+        channel, taskIds, sendLock = workerChannel
+
+        taskId = '%016x' % random.getrandbits(64)
+        with sendLock:
+            # The worker may have drained since it was chosen. It is removed
+            # while holding the sendLock, so no task can follow DRAINED.
+            with self.__workerChannelsLock:
+                if self.__workerChannels.get(workerId) is not workerChannel:
+                    return None
+                taskIds.add(taskId)
+            self.__add_task_in_progress(taskId, taskFuture, queued=False)
+            try:
+                channel.send_message(MessageBody=task.body,
+                                     MessageAttributes=task.messageAttributes,
+                                     MessageId=taskId)
+            except Exception as e:
+                logger.error('Failed to push task to worker: %s', workerId)
+                logger.exception(e)
+                self.__remove_worker_channel(workerId)
+                with self.__workerChannelsLock:
+                    taskIds.discard(taskId)
+                self.__remove_task_in_progress(taskId, queued=False)
+                return None
+        return taskId
+
+    def __remove_worker_channel(self, workerId):
+        with self.__workerChannelsLock:
+            return self.__workerChannels.pop(workerId, None)
+
+    def __accept_worker(self, workerId, workerSecret):
+        """
+        Return the function that serves the channel of a worker started by
+        this manager, or None. Each worker can connect once.
+        """
+        with self.__workerChannelsLock:
+            expectedSecret = self.__pendingWorkers.get(workerId)
+            if (expectedSecret is None or
+                    not hmac.compare_digest(expectedSecret, workerSecret)):
+                return None
+            del self.__pendingWorkers[workerId]
+        return partial(self.__serve_worker_channel, workerId)
+
+    def __serve_worker_channel(self, workerId, channel):
+        """Read results from a worker until it disconnects"""
+        taskIds = set()
+        sendLock = Lock()
+        with self.__workerChannelsLock:
+            self.__workerChannels[workerId] = (channel, taskIds, sendLock)
+            self.__workerChannelsCondition.notify_all()
+        try:
+            while True:
+                message = channel.receive_message()
+                if message is None:
+                    break
+                if message.control == DRAIN_CONTROL:
+                    # No tasks can be pushed after the channel is removed
+                    # and the worker exits once it sees the reply. Pushes in
+                    # progress finish first, so they are sent before it.
+                    with sendLock:
+                        self.__remove_worker_channel(workerId)
+                    channel.send_control(DRAINED_CONTROL)
+                    continue
+                taskId = self.__handle_result_message(message)
+                with self.__workerChannelsLock:
+                    taskIds.discard(taskId)
+        finally:
+            self.__remove_worker_channel(workerId)
+            with self.__workerChannelsLock:
+                lostTaskIds = list(taskIds)
+            with self.__tasksInProgressLock:
+                for taskId in lostTaskIds:
+                    taskFuture = self.__tasksInProgress.get(taskId)
+                    if taskFuture is not None:
+                        logger.warn('Worker %s exited with task: %s',
+                                    workerId, taskId)
+                        taskFuture.set_lost()
 
     def __should_spawn_worker(self):
         if self.__config.max_workers == 0:
@@ -220,6 +424,13 @@ class WorkerManager(object):
             'taskQueue': self.__taskQueueName,
             'resultQueue': self.__resultQueueName,
         }
+        if self.__workerServer is not None:
+            # Only the worker may connect to the worker server as workerId
+            workerSecret = os.urandom(16).encode('hex')
+            with self.__workerChannelsLock:
+                self.__pendingWorkers[str(workerId)] = workerSecret
+            workerArgs['workerServer'] = self.__workerServer.publicHostAndPort
+            workerArgs['workerSecret'] = workerSecret
         functionName = self.__config.lambda_function
         self.__config.pre_invoke_callback(workerId, workerArgs)
         t = Thread(target=self.__wait_for_worker,
@@ -251,34 +462,42 @@ class WorkerManager(object):
                 self.__config.post_return_callback(workerId, workerResponse)
 
         finally:
+            with self.__workerChannelsLock:
+                self.__pendingWorkers.pop(str(workerId), None)
             with self.__numWorkersLock:
                 self.__numWorkers -= 1
                 assert self.__numWorkers >= 0, 'Workers cannot be negative'
 
+    def __handle_result_message(self, message):
+        """Set the future for the result. Returns the taskId"""
+        with hook('sqs_parse'):
+            result = LambdaSqsResult.from_message(message)
+        taskId = result.taskId
+        with self.__tasksInProgressLock:
+            taskFuture = self.__tasksInProgress.get(taskId)
+
+        if taskFuture is None:
+            logger.info('No future for task: %s', taskId)
+            return taskId
+
+        # Handle fragmented
+        if result.isFragmented:
+            taskFuture._partial[result.fragmentId] = result
+            logger.info('Setting result: %s', taskId)
+            if len(taskFuture._partial) == result.numFragments:
+                taskFuture.set([
+                    taskFuture._partial[i]
+                    for i in xrange(result.numFragments)
+                ])
+        else:
+            logger.info('Setting result: %s', taskId)
+            taskFuture.set(result)
+        return taskId
+
     def __handle_single_result_message(self, message):
         # TODO: Fix me. Assume maximally sized messages for now
         try:
-            result = LambdaSqsResult.from_message(message)
-            taskId = result.taskId
-            with self.__tasksInProgressLock:
-                taskFuture = self.__tasksInProgress.get(taskId)
-
-            if taskFuture is None:
-                logger.info('No future for task: %s', taskId)
-                return
-
-            # Handle fragmented
-            if result.isFragmented:
-                taskFuture._partial[result.fragmentId] = result
-                logger.info('Setting result: %s', taskId)
-                if len(taskFuture._partial) == result.numFragments:
-                    taskFuture.set([
-                        taskFuture._partial[i]
-                        for i in xrange(result.numFragments)
-                    ])
-            else:
-                logger.info('Setting result: %s', taskId)
-                taskFuture.set(result)
+            self.__handle_result_message(message)
         except Exception as e:
             logger.error('Failed to parse message: %s', message)
             logger.exception(e)
@@ -289,12 +508,12 @@ class WorkerManager(object):
     def __result_daemon(self):
         """Poll SQS result queue and set futures"""
         requiredAttributes = ['All']
-        sqs = boto3.resource('sqs')
+        sqs = aws.resource('sqs')
         resultQueue = sqs.get_queue_by_name(QueueName=self.__resultQueueName)
         while True:
             # Don't poll SQS unless there is a task in progress
             with self.__tasksInProgressLock:
-                if self.__numTasksInProgress == 0:
+                if self.__numQueuedTasks == 0:
                     self.__tasksInProgressCondition.wait()
 
             # Poll for new messages
@@ -2,23 +2,23 @@
 
 import argparse
 import logging
+import os
 import sys
 
 from BaseHTTPServer import BaseHTTPRequestHandler
-from fake_useragent import UserAgent
 from termcolor import colored
 
-from lib.headers import FILTERED_REQUEST_HEADERS, FILTERED_RESPONSE_HEADERS,\
-    DEFAULT_USER_AGENT
-from lib.proxy import ProxyInstance
-from lib.proxies.local import LocalProxy
-from lib.proxies.aws_short import ShortLivedLambdaProxy
-from lib.proxies.aws_stream import StreamLambdaProxy
-from lib.proxies.aws_long import LongLivedLambdaProxy
-from lib.proxies.mitm import MitmHttpsProxy
-from lib.servers.reverse import start_reverse_connection_server
-from lib.stats import Stats, ProxyStatsModel
+# The proxies, the crawler, the local AWS stand-in and their dependencies
+# (boto3, pyOpenSSL, pycryptodome) take a while to import, so they are
+# imported by the functions that use them, only in the modes that need them
+from lib.headers import DEFAULT_USER_AGENT, RandomUserAgent, \
+    filter_request_headers, is_filtered_response_header
+from lib.proxy import ProxyInstance, StreamedContent, close_content, \
+    write_content
+from lib.stats import Stats, CrawlStatsModel, ProxyStatsModel
+from lib.trace import span
 from lib.utils import ThreadedHTTPServer
+from shared.http import read_chunked_body
 
 LOG_FILE = 'main.log'
 logging.basicConfig(filename=LOG_FILE, filemode='w', level=logging.INFO)
@@ -32,21 +32,29 @@ DEFAULT_MAX_LAMBDAS = 100
 
 MITM_CERT_PATH = 'mitm.ca.pem'
 MITM_KEY_PATH = 'mitm.key.pem'
+MITM_CERT_DIR = 'mitm.certs'
 
 LAMBDA_PUBLIC_KEY_PATH = 'lambda.public.pem'
+LAMBDA_PRIVATE_KEY_PATH = 'lambda.private.txt'
+
+# Function run by --local-aws, unless others are given
+LOCAL_FUNCTION_NAME = 'proxy'
 
 OVERRIDE_USER_AGENT = False
 
 REVERSE_CONNECTION_SERVER_PORT = 1081
 
+DEFAULT_CRAWL_OUTPUT = 'crawl.warc.gz'
 
-def get_args():
-    """Parse command line arguments"""
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--port', '-p', type=int, default=DEFAULT_PORT,
-                        help='Port to listen on')
-    parser.add_argument('--host', type=str, default='localhost',
-                        help='Address to bind to')
+TRACE_SPANS_FILE = 'spans.json'
+
+TRAFFIC_TRACE_FILE = 'trace.jsonl'
+
+PROFILE_FILE = 'profile.folded'
+
+
+def add_proxy_arguments(parser):
+    """Arguments to configure how requests are proxied"""
     parser.add_argument('--local', '-l', action='store_true',
                         dest='runLocal',
                         help='Run the proxy locally')
@@ -62,7 +70,8 @@ def get_args():
                         default='short', type=str,
                         help='Type of lambda workers to use')
 
-    dataTransfer = parser.add_mutually_exclusive_group()
+    # If both are given, large bodies use whichever is expected to be faster
+    dataTransfer = parser.add_argument_group('large payload transports')
     dataTransfer.add_argument('--s3-bucket', '-s3', dest='s3Bucket', type=str,
                               help='s3Bucket to use for large file transport')
     dataTransfer.add_argument('--public-host-and-port', '-pub', type=str,
@@ -72,6 +81,24 @@ def get_args():
                                    'be <public-ip>:%d. Otherwise, this should '
                                    'be the <host>:<port> for reverse port '
                                    'forwarding.' % REVERSE_CONNECTION_SERVER_PORT)
+    dataTransfer.add_argument('--s3-cache', action='store_true',
+                              dest='s3Cache',
+                              help='Share cacheable responses through the '
+                                   's3Bucket. Requires a lifecycle rule to '
+                                   'expire the cache/ prefix.')
+
+    localAws = parser.add_argument_group('local AWS stand-in')
+    localAws.add_argument('--local-aws', action='store_true',
+                          dest='localAws',
+                          help='Run the lambdas in local containers, with '
+                               'SQS and S3 in memory, instead of on AWS')
+    localAws.add_argument('--local-aws-concurrency', type=int,
+                          dest='localAwsConcurrency',
+                          help='Containers per function. Invocations beyond '
+                               'this are throttled.')
+    localAws.add_argument('--local-aws-cold-start', type=float,
+                          dest='localAwsColdStart',
+                          help='Seconds added to the start of each container')
 
     parser.add_argument('--max-lambdas', '-j', type=int,
                         default=DEFAULT_MAX_LAMBDAS, dest='maxLambdas',
@@ -79,39 +106,136 @@ def get_args():
     parser.add_argument('--enable-mitm', '-m', action='store_true',
                         dest='enableMitm',
                         help='Run as a MITM for TLS traffic')
+    parser.add_argument('--mitm-cert-dir', dest='mitmCertDir',
+                        default=MITM_CERT_DIR,
+                        help='Directory to keep issued MITM certificates in, '
+                             'so that they are reused across restarts')
+    parser.add_argument('--mitm-wildcard-certs', action='store_true',
+                        dest='mitmWildcardCerts',
+                        help='Share wildcard MITM certificates between hosts '
+                             'under the same domain')
+    parser.add_argument('--mitm-http2', action='store_true',
+                        dest='mitmHttp2',
+                        help='Offer HTTP/2 to browsers in MITM mode, so that '
+                             'their requests are multiplexed on one '
+                             'connection. Requires the h2 package.')
     parser.add_argument('--verbose', '-v', action='store_true')
     parser.add_argument('--no-stats', '-z', dest='disableStats',
                         action='store_true')
+    parser.add_argument('--metrics-port', type=int, dest='metricsPort',
+                        help='Serve stats for Prometheus at /metrics and as '
+                             'JSON at /metrics.json on this port')
+    parser.add_argument('--metrics-host', type=str, default='localhost',
+                        dest='metricsHost',
+                        help='Address to bind the metrics server to')
+    parser.add_argument('--trace-spans', action='store_true',
+                        dest='traceSpans',
+                        help='Record the phases of recent requests, on the '
+                             'daemon and in the lambdas. They are served at '
+                             '/trace.json on the metrics port, and written '
+                             'to %s on exit, in the Chrome trace format.'
+                             % TRACE_SPANS_FILE)
+    parser.add_argument('--record-trace', type=str, nargs='?',
+                        const=TRAFFIC_TRACE_FILE, dest='recordTrace',
+                        help='Write the metadata, timing and response size '
+                             'of every request to a JSONL trace (default: '
+                             '%s), to replay with benchmark.py --trace'
+                             % TRAFFIC_TRACE_FILE)
+    parser.add_argument('--profile', action='store_true',
+                        help='Sample the stacks of all threads from the '
+                             'start, and write them to %s on exit. Without '
+                             'it, SIGUSR2 starts and stops the profiler.'
+                             % PROFILE_FILE)
+
+
+def get_args():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', '-p', type=int, default=DEFAULT_PORT,
+                        help='Port to listen on')
+    parser.add_argument('--host', type=str, default='localhost',
+                        help='Address to bind to')
+    add_proxy_arguments(parser)
     return parser.parse_args()
 
 
-def build_local_proxy(args, stats):
+def get_crawl_args(argv):
+    """Parse command line arguments for main.py crawl"""
+    from lib.crawler import DEFAULT_MAX_RETRIES, DEFAULT_ORIGIN_CONCURRENCY, \
+        DEFAULT_ORIGIN_RATE
+
+    parser = argparse.ArgumentParser(
+        prog='main.py crawl',
+        description='Fetch the URLs in a JSONL file through the proxy')
+    parser.add_argument('urlFile', type=str,
+                        help='JSONL file with a URL string or an object with '
+                             'a url, method, headers and body on each line')
+    parser.add_argument('--output', '-o', dest='outputFile', type=str,
+                        default=DEFAULT_CRAWL_OUTPUT,
+                        help='Gzipped WARC style file to append responses to')
+    parser.add_argument('--checkpoint', dest='checkpointFile', type=str,
+                        help='File of completed lines to resume from. '
+                             'Defaults to <output>.checkpoint')
+    parser.add_argument('--origin-concurrency', type=int,
+                        default=DEFAULT_ORIGIN_CONCURRENCY,
+                        dest='originConcurrency',
+                        help='Max requests in flight to each origin')
+    parser.add_argument('--origin-rate', type=float,
+                        default=DEFAULT_ORIGIN_RATE, dest='originRate',
+                        help='Max requests started per second to each '
+                             'origin, or 0 for no limit')
+    parser.add_argument('--max-retries', type=int,
+                        default=DEFAULT_MAX_RETRIES, dest='maxRetries',
+                        help='Retries after errors and 429/5xx responses')
+    parser.add_argument('--user-agent', type=str, default=DEFAULT_USER_AGENT,
+                        dest='userAgent')
+    parser.add_argument('--ignore-robots', action='store_true',
+                        dest='ignoreRobots',
+                        help='Do not check robots.txt')
+    add_proxy_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def build_local_proxy(args, stats, recorder=None):
     """Request the resource locally"""
+    from lib.capture import record_requests, record_streams
+    from lib.proxies.local import LocalProxy
 
     print '  Running the proxy locally. This provides no privacy!'
 
     localProxy = LocalProxy(stats=stats)
+    requestProxy = record_requests(localProxy, recorder)
     if args.enableMitm:
         print '  MITM proxy enabled'
-        mitmProxy = MitmHttpsProxy(localProxy,
+        from lib.proxies.mitm import MitmHttpsProxy
+        mitmProxy = MitmHttpsProxy(requestProxy,
                                    certfile=MITM_CERT_PATH,
                                    keyfile=MITM_KEY_PATH,
                                    stats=stats,
                                    overrideUserAgent=OVERRIDE_USER_AGENT,
-                                   verbose=args.verbose)
-        return ProxyInstance(requestProxy=localProxy, streamProxy=mitmProxy)
+                                   verbose=args.verbose,
+                                   certDir=args.mitmCertDir,
+                                   wildcardCerts=args.mitmWildcardCerts,
+                                   enableHttp2=args.mitmHttp2)
+        return ProxyInstance(requestProxy=requestProxy, streamProxy=mitmProxy)
     else:
-        return ProxyInstance(requestProxy=localProxy, streamProxy=localProxy)
+        return ProxyInstance(requestProxy=requestProxy,
+                             streamProxy=record_streams(localProxy, recorder))
 
 
-def build_lambda_proxy(args, stats, reverseConnServer):
+def build_lambda_proxy(args, stats, reverseConnServer, recorder=None):
     """Request the resource using lambda"""
+    from lib.capture import record_requests, record_streams
     functions = args.functions
     lambdaType = args.lambdaType
     maxLambdas = args.maxLambdas
     s3Bucket = args.s3Bucket
     verbose = args.verbose
 
+    if args.s3Cache and s3Bucket is None:
+        print 'The s3 cache requires an s3Bucket'
+        sys.exit(-1)
+
     lambdaPubKeyFile = LAMBDA_PUBLIC_KEY_PATH if args.enableEncryption else None
 
     print '  Running the proxy with lambda'
@@ -123,62 +247,79 @@ def build_lambda_proxy(args, stats, reverseConnServer):
 
     if lambdaType == 'short':
         print '  Using short-lived lambdas'
+        from lib.proxies.aws_short import ShortLivedLambdaProxy
         lambdaProxy = ShortLivedLambdaProxy(functions=functions,
                                             maxParallelRequests=maxLambdas,
                                             s3Bucket=s3Bucket,
                                             pubKeyFile=lambdaPubKeyFile,
                                             messageServer=reverseConnServer,
-                                            stats=stats)
+                                            stats=stats,
+                                            s3Cache=args.s3Cache)
     elif lambdaType == 'long':
         print '  Using long-lived lambdas'
-        assert args.enableEncryption is False, \
-            'Full encryption is not supported for long lived proxies'
+        if reverseConnServer is not None:
+            print '  Pushing tasks to workers over the reverse connection ' \
+                  'server'
+        from lib.proxies.aws_long import LongLivedLambdaProxy
         lambdaProxy = LongLivedLambdaProxy(functions=functions,
                                            maxLambdas=maxLambdas,
                                            s3Bucket=s3Bucket,
                                            stats=stats,
-                                           verbose=verbose)
+                                           verbose=verbose,
+                                           workerServer=reverseConnServer,
+                                           s3Cache=args.s3Cache,
+                                           pubKeyFile=lambdaPubKeyFile)
     else:
         print '  Unsupported lambda type'
         sys.exit(-1)
+    lambdaProxy = record_requests(lambdaProxy, recorder)
 
     if args.enableMitm is True:
         print '  Enabling MITM proxy'
+        from lib.proxies.mitm import MitmHttpsProxy
         mitmProxy = MitmHttpsProxy(lambdaProxy,
                                    certfile=MITM_CERT_PATH,
                                    keyfile=MITM_KEY_PATH,
                                    stats=stats,
                                    overrideUserAgent=OVERRIDE_USER_AGENT,
-                                   verbose=verbose)
+                                   verbose=verbose,
+                                   certDir=args.mitmCertDir,
+                                   wildcardCerts=args.mitmWildcardCerts,
+                                   enableHttp2=args.mitmHttp2)
         return ProxyInstance(requestProxy=lambdaProxy, streamProxy=mitmProxy)
     elif args.publicServerHostAndPort is not None:
         print '  Enabling lambda stream proxy'
+        from lib.proxies.aws_stream import StreamLambdaProxy
         streamProxy = StreamLambdaProxy(functions=functions,
                                         maxParallelRequests=maxLambdas,
                                         pubKeyFile=lambdaPubKeyFile,
                                         streamServer=reverseConnServer,
                                         stats=stats)
-        return ProxyInstance(requestProxy=lambdaProxy, streamProxy=streamProxy)
+        return ProxyInstance(requestProxy=lambdaProxy,
+                             streamProxy=record_streams(streamProxy, recorder))
     else:
         print '  HTTPS will use the local proxy'
+        from lib.proxies.local import LocalProxy
         localProxy = LocalProxy(stats=stats)
-        return ProxyInstance(requestProxy=lambdaProxy, streamProxy=localProxy)
+        return ProxyInstance(requestProxy=lambdaProxy,
+                             streamProxy=record_streams(localProxy, recorder))
 
 
 def build_handler(proxy, stats, verbose):
     """Construct a request handler"""
-    if UserAgent:
-        ua = UserAgent()
-        get_user_agent = lambda: ua.random
-    else:
-        get_user_agent = lambda: DEFAULT_USER_AGENT
+    userAgent = RandomUserAgent()
 
     proxyStats = stats.get_model('proxy')
+    tracer = stats.tracer
 
     def log_request_delay(function):
-        def wrapper(*args, **kwargs):
+        def wrapper(self, *args, **kwargs):
             with proxyStats.record_delay():
-                function(*args, **kwargs)
+                if tracer is None:
+                    function(self, *args, **kwargs)
+                    return
+                with tracer.trace(self.command, url=self.path):
+                    function(self, *args, **kwargs)
         return wrapper
 
     handlerLogger = logging.getLogger('handler')
@@ -196,7 +337,10 @@ def build_handler(proxy, stats, verbose):
             print 'status:', response.statusCode
             for header in response.headers:
                 print '  %s: %s' % (header, response.headers[header])
-            print 'content-len:', len(response.content)
+            if isinstance(response.content, StreamedContent):
+                print 'content-len: (streamed)'
+            else:
+                print 'content-len:', len(response.content)
 
         def log_message(self, format, *args):
             """Override the default logging to not print ot stdout"""
@@ -218,23 +362,25 @@ def build_handler(proxy, stats, verbose):
 
             method = self.command.upper()
             url = self.path
-            headers = {}
 
             # Approximate the length of the request
             approxRequestLen = 2 +  len(url) + len(method) + \
                                len(self.version_string())
 
-            for header in self.headers:
-                value = self.headers[header]
+            chunked = self.headers.get('Transfer-Encoding', '').lower() \
+                == 'chunked'
+            for header, value in self.headers.items():
                 approxRequestLen += len(header) + len(str(value)) + 4
-                if header in FILTERED_REQUEST_HEADERS:
-                    continue
-                headers[header] = self.headers[header]
+            # The names from self.headers are lower case
+            headers = filter_request_headers(self.headers.items(), chunked)
             headers['Connection'] = 'keep-alive'
             if OVERRIDE_USER_AGENT:
-                headers['User-Agent'] = get_user_agent()
+                headers['User-Agent'] = userAgent.get()
 
-            if 'Content-Length' in self.headers:
+            if chunked:
+                requestBody = read_chunked_body(self.rfile.readline)
+                approxRequestLen += len(requestBody)
+            elif 'Content-Length' in self.headers:
                 contentLength = int(self.headers['Content-Length'])
                 requestBody = self.rfile.read(contentLength)
                 approxRequestLen += len(requestBody)
@@ -252,18 +398,22 @@ def build_handler(proxy, stats, verbose):
             try:
                 self.send_response(response.statusCode)
                 for header, value in response.headers.iteritems():
-                    if header in FILTERED_RESPONSE_HEADERS:
+                    if is_filtered_response_header(header):
                         continue
                     approxResponseLen = len(header) + len(str(value)) + 4
                     self.send_header(header, value)
                 self.send_header('Connection', 'close')
                 self.send_header('Proxy-Connection', 'close')
                 self.end_headers()
-                self.wfile.write(response.content)
-                approxResponseLen += len(response.content)
+                with span('client write'):
+                    approxResponseLen += write_content(self.wfile.write,
+                                                       response.content)
                 proxyStats.record_bytes_down(approxResponseLen)
             except Exception as e:
                 logger.exception(e)
+            finally:
+                # The client may have gone away before the body was written
+                close_content(response.content)
             return
 
         @log_request_delay
@@ -303,27 +453,127 @@ def build_handler(proxy, stats, verbose):
     return ProxyHandler
 
 
+def start_local_aws(args):
+    if not args.localAws:
+        return None
+    print '  Running lambdas in local containers, with SQS and S3 in memory'
+    from lib.aws import set_backend
+    from lib.local_aws import DEFAULT_COLD_START_DELAY, DEFAULT_CONCURRENCY, \
+        LocalAwsBackend
+    from shared.crypto import PRIVATE_KEY_ENV_VAR
+    if not args.functions:
+        args.functions = [LOCAL_FUNCTION_NAME]
+    environment = {}
+    if os.path.exists(LAMBDA_PRIVATE_KEY_PATH):
+        with open(LAMBDA_PRIVATE_KEY_PATH) as ifs:
+            environment[PRIVATE_KEY_ENV_VAR] = ifs.read().strip()
+    concurrency = args.localAwsConcurrency
+    if concurrency is None:
+        concurrency = DEFAULT_CONCURRENCY
+    coldStartDelay = args.localAwsColdStart
+    if coldStartDelay is None:
+        coldStartDelay = DEFAULT_COLD_START_DELAY
+    backend = LocalAwsBackend()
+    for function in args.functions:
+        backend.add_function(function.split(':')[-1],
+                             environment=environment,
+                             concurrency=concurrency,
+                             coldStartDelay=coldStartDelay,
+                             verbose=args.verbose)
+    set_backend(backend)
+    return backend
+
+
+def stop_local_aws(backend):
+    if backend is not None:
+        backend.shutdown()
+
+
+def start_reverse_server(args, stats):
+    if args.publicServerHostAndPort is None:
+        return None
+    print "Starting reverse connection server locally on port %d. " \
+          "Don't forget to set-up a reverse tunnel at %s for remote " \
+          "access" % (
+        REVERSE_CONNECTION_SERVER_PORT, args.publicServerHostAndPort)
+    from lib.servers.reverse import start_reverse_connection_server
+    return start_reverse_connection_server(
+        REVERSE_CONNECTION_SERVER_PORT, args.publicServerHostAndPort, stats)
+
+
+def new_stats(args):
+    if not args.traceSpans:
+        return Stats()
+    from lib.trace import Tracer
+    return Stats(tracer=Tracer())
+
+
+def dump_trace_spans(stats):
+    if stats.tracer is not None:
+        stats.tracer.dump(TRACE_SPANS_FILE)
+        print 'Wrote request spans to %s' % TRACE_SPANS_FILE
+
+
+def start_recorder(args):
+    if args.recordTrace is None:
+        return None
+    print 'Recording requests to %s' % args.recordTrace
+    from lib.capture import TrafficRecorder
+    return TrafficRecorder(args.recordTrace)
+
+
+def stop_recorder(args, recorder):
+    if recorder is not None:
+        recorder.close()
+        print 'Wrote %d requests to %s' % (recorder.numRecorded,
+                                           args.recordTrace)
+
+
+def start_profiler(args):
+    from lib.profiler import SamplingProfiler, install_toggle_signal
+    profiler = SamplingProfiler()
+    install_toggle_signal(profiler, PROFILE_FILE)
+    if args.profile:
+        print 'Profiling all threads'
+        profiler.start()
+    return profiler
+
+
+def stop_profiler(profiler):
+    if profiler.running:
+        profiler.stop()
+        profiler.dump(PROFILE_FILE)
+        print 'Wrote %d profile samples to %s' % (profiler.numSamples,
+                                                  PROFILE_FILE)
+
+
+def start_metrics(args, stats):
+    if args.metricsPort is None:
+        return None
+    print 'Serving metrics at http://%s:%d/metrics' % (args.metricsHost,
+                                                       args.metricsPort)
+    from lib.metrics import start_metrics_server
+    return start_metrics_server(stats, args.metricsHost, args.metricsPort)
+
+
 def main(host, port, args=None):
-    stats = Stats()
+    stats = new_stats(args)
     stats.register_model('proxy', ProxyStatsModel())
+    profiler = start_profiler(args)
+    localAws = start_local_aws(args)
 
-    reverseConnServer = None
-    if args.publicServerHostAndPort is not None:
-        print "Starting reverse connection server locally on port %d. " \
-              "Don't forget to set-up a reverse tunnel at %s for remote " \
-              "access" % (
-            REVERSE_CONNECTION_SERVER_PORT, args.publicServerHostAndPort)
-        reverseConnServer = start_reverse_connection_server(
-            REVERSE_CONNECTION_SERVER_PORT, args.publicServerHostAndPort, stats)
+    reverseConnServer = start_reverse_server(args, stats)
+    recorder = start_recorder(args)
 
     print 'Configuring proxy'
     if args.runLocal:
-        proxy = build_local_proxy(args, stats)
+        proxy = build_local_proxy(args, stats, recorder)
     else:
-        proxy = build_lambda_proxy(args, stats, reverseConnServer)
+        proxy = build_lambda_proxy(args, stats, reverseConnServer, recorder)
 
     handler = build_handler(proxy, stats, verbose=args.verbose)
     server = ThreadedHTTPServer((host, port), handler)
+    metricsServer = start_metrics(args, stats)
 
     print 'Starting proxy, use <Ctrl-C> to stop'
     if not args.disableStats:
@@ -334,11 +584,79 @@ def main(host, port, args=None):
         pass
     server.server_close()
     server.shutdown()
+    if metricsServer is not None:
+        metricsServer.shutdown()
     if reverseConnServer is not None:
         reverseConnServer.shutdown()
+    dump_trace_spans(stats)
+    stop_recorder(args, recorder)
+    stop_profiler(profiler)
+    stop_local_aws(localAws)
     print 'Exiting'
 
 
+def crawl(args):
+    from lib.crawler import Crawler, CrawlCheckpoint, CrawlRecordWriter, \
+        read_crawl_tasks
+
+    stats = new_stats(args)
+    stats.register_model('proxy', ProxyStatsModel())
+    stats.register_model('crawl', CrawlStatsModel())
+    profiler = start_profiler(args)
+    localAws = start_local_aws(args)
+
+    reverseConnServer = start_reverse_server(args, stats)
+    recorder = start_recorder(args)
+
+    print 'Configuring proxy'
+    if args.runLocal:
+        proxy = build_local_proxy(args, stats, recorder)
+    else:
+        proxy = build_lambda_proxy(args, stats, reverseConnServer, recorder)
+
+    checkpointFile = args.checkpointFile
+    if checkpointFile is None:
+        checkpointFile = args.outputFile + '.checkpoint'
+    checkpoint = CrawlCheckpoint(checkpointFile)
+    if len(checkpoint) > 0:
+        print '  Resuming after %d completed URLs' % len(checkpoint)
+    writer = CrawlRecordWriter(args.outputFile)
+
+    crawler = Crawler(proxy.requestProxy, writer, checkpoint, stats,
+                      maxConcurrency=args.maxLambdas,
+                      originConcurrency=args.originConcurrency,
+                      originRate=args.originRate,
+                      maxRetries=args.maxRetries,
+                      userAgent=args.userAgent,
+                      obeyRobots=not args.ignoreRobots)
+    metricsServer = start_metrics(args, stats)
+
+    print 'Crawling %s, use <Ctrl-C> to stop' % args.urlFile
+    if not args.disableStats:
+        stats.start_live_summary(refreshRate=1, logFileName=LOG_FILE)
+    try:
+        crawler.run(read_crawl_tasks(args.urlFile))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        writer.close()
+        checkpoint.close()
+    if metricsServer is not None:
+        metricsServer.shutdown()
+    if reverseConnServer is not None:
+        reverseConnServer.shutdown()
+    dump_trace_spans(stats)
+    stop_recorder(args, recorder)
+    stop_profiler(profiler)
+    stop_local_aws(localAws)
+    crawlStats = stats.get_model('crawl')
+    print '\nFetched %d URLs with %d errors' % (crawlStats.totalResponses,
+                                              crawlStats.totalErrors)
+
+
 if __name__ == '__main__':
-    args = get_args()
-    main(args.host, args.port, args)
+    if sys.argv[1:2] == ['crawl']:
+        crawl(get_crawl_args(sys.argv[2:]))
+    else:
+        args = get_args()
+        main(args.host, args.port, args)
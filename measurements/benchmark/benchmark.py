@@ -0,0 +1,680 @@
+#!/usr/bin/env python
+"""
+End-to-end benchmark of the proxy. Starts an origin that sends the number
+of random bytes requested, and the daemon in each mode, then drives it at
+each level of concurrency with a mix of payload sizes. The throughput,
+latency and resource use of every run are written as JSON, and compared to
+a baseline from an earlier run if one is given. With --trace, a trace recorded by main.py
+--record-trace is replayed in each mode instead, against an origin that
+reproduces its responses.
+"""
+
+import argparse
+import json
+import os
+import resource
+import shlex
+import shutil
+import signal
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from collections import OrderedDict, namedtuple
+from OpenSSL import crypto
+from SocketServer import ThreadingMixIn
+from threading import Lock, Thread
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, REPO_DIR)
+
+from gen_rsa_kp import generate_key_pair, PRIVATE_KEY_FILE, PUBLIC_KEY_FILE
+from lib.capture import read_traffic_trace
+from lib.loadgen import DEFAULT_MAX_CONNECTIONS, OpenLoopLoad, RequestMix, \
+    get_size_mix_requests
+from lib.replay import ReplayOrigin, get_expected_response, \
+    get_replay_schedule
+
+DEFAULT_PROXY_PORT = 1090
+REVERSE_CONNECTION_SERVER_PORT = 1081
+
+DEFAULT_CONCURRENCY = '1,8'
+DEFAULT_PAYLOAD_MIX = '1024:6,65536:3,1048576:1'
+DEFAULT_DURATION = 10.0
+DEFAULT_TOLERANCE = 0.1
+DEFAULT_OUTPUT = 'benchmark.json'
+
+DAEMON_START_TIMEOUT = 60
+DAEMON_STOP_TIMEOUT = 15
+REQUEST_TIMEOUT = 60
+RESOURCE_SAMPLE_INTERVAL = 0.25
+
+MITM_CERT_FILE = 'mitm.ca.pem'
+MITM_KEY_FILE = 'mitm.key.pem'
+ORIGIN_CERT_FILE = 'origin.pem'
+MAIN_LOG_FILE = 'main.log'
+
+ONE_MB = 1 << 20
+
+# https: the origin is fetched over TLS, through CONNECT. lambdas: the
+# lambdas run in the local stand-in, unless --aws is given.
+Mode = namedtuple('Mode', ['args', 'https', 'lambdas'])
+
+MODES = OrderedDict([
+    ('local', Mode(['--local'], False, False)),
+    ('short', Mode(['-t', 'short'], False, True)),
+    ('long', Mode(['-t', 'long'], False, True)),
+    ('mitm', Mode(['-m'], True, True)),
+    ('stream', Mode(['-pub', 'localhost:%d' % REVERSE_CONNECTION_SERVER_PORT],
+                    True, True)),
+    ('encrypted', Mode(['-e'], False, True)),
+])
+
+# Higher is better for these, and lower is better for the rest
+HIGHER_IS_BETTER = {'requestsPerSec', 'mbPerSec'}
+COMPARED_RESULTS = ['requestsPerSec', 'mbPerSec', 'p99Millis',
+                    'cpuMillisPerRequest', 'peakRssMb']
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--modes', type=str, default=','.join(MODES),
+                        help='Comma separated modes to run, from %s'
+                             % ', '.join(MODES))
+    parser.add_argument('--concurrency', '-c', type=str,
+                        default=DEFAULT_CONCURRENCY,
+                        help='Comma separated numbers of clients')
+    parser.add_argument('--mix', type=str, default=DEFAULT_PAYLOAD_MIX,
+                        help='Payload sizes in bytes and their weights, as '
+                             'size:weight,...')
+    parser.add_argument('--duration', '-d', type=float,
+                        default=DEFAULT_DURATION,
+                        help='Seconds to run at each level of concurrency')
+    parser.add_argument('--requests', '-n', type=int, dest='numRequests',
+                        help='Run this many requests at each level of '
+                             'concurrency instead of for a duration')
+    parser.add_argument('--warmup', type=int,
+                        help='Requests before measuring, to start the '
+                             'lambdas (default: the concurrency, or one to '
+                             'each origin with --trace)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed for the choice of payload sizes')
+    parser.add_argument('--trace', type=str, dest='traceFile',
+                        help='Replay this trace from main.py --record-trace '
+                             'once in each mode, instead of the mix. Its '
+                             'results have a concurrency of 0.')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='Speed up the replay of --trace by this factor, '
+                             'or send all of it at once with 0')
+    parser.add_argument('--port', '-p', type=int, default=DEFAULT_PROXY_PORT,
+                        help='Port for the daemon to listen on')
+    parser.add_argument('--aws', action='store_true', dest='useAws',
+                        help='Use the lambdas on AWS, given with -f in '
+                             '--daemon-args, instead of the local stand-in')
+    parser.add_argument('--daemon-args', type=str, default='',
+                        dest='daemonArgs',
+                        help='More arguments for main.py, in every mode')
+    parser.add_argument('--output', '-o', type=str, default=DEFAULT_OUTPUT,
+                        dest='outputFile', help='File to write results to')
+    parser.add_argument('--baseline', '-b', type=str, dest='baselineFile',
+                        help='Results of an earlier run to compare to. '
+                             'Exits with 1 if anything regressed.')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='Fraction by which a result may be worse than '
+                             'the baseline')
+    parser.add_argument('--keep-dir', action='store_true', dest='keepDir',
+                        help='Keep the directory with the keys and daemon '
+                             'logs')
+    return parser.parse_args()
+
+
+def generate_certs(workDir):
+    """
+    Write a CA for the MITM proxy, and a certificate for the origin that it
+    signed, so that both are trusted with the CA alone
+    """
+    caKey = crypto.PKey()
+    caKey.generate_key(crypto.TYPE_RSA, 2048)
+    caCert = crypto.X509()
+    caCert.set_version(2)
+    caCert.get_subject().O = 'DIY Project'
+    caCert.get_subject().CN = 'Benchmark CA'
+    caCert.set_serial_number(1)
+    caCert.gmtime_adj_notBefore(-60 * 60)
+    caCert.gmtime_adj_notAfter(24 * 60 * 60)
+    caCert.set_issuer(caCert.get_subject())
+    caCert.set_pubkey(caKey)
+    caCert.add_extensions([
+        crypto.X509Extension('basicConstraints', True, 'CA:TRUE'),
+    ])
+    caCert.sign(caKey, 'sha256')
+
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, 2048)
+    cert = crypto.X509()
+    cert.set_version(2)
+    cert.get_subject().CN = 'localhost'
+    cert.add_extensions([
+        crypto.X509Extension('subjectAltName', False,
+                             'DNS:localhost,IP:127.0.0.1'),
+    ])
+    cert.set_serial_number(2)
+    cert.gmtime_adj_notBefore(-60 * 60)
+    cert.gmtime_adj_notAfter(24 * 60 * 60)
+    cert.set_issuer(caCert.get_subject())
+    cert.set_pubkey(key)
+    cert.sign(caKey, 'sha256')
+
+    with open(os.path.join(workDir, MITM_CERT_FILE), 'wb') as ofs:
+        ofs.write(crypto.dump_certificate(crypto.FILETYPE_PEM, caCert))
+    with open(os.path.join(workDir, MITM_KEY_FILE), 'wb') as ofs:
+        ofs.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, caKey))
+    with open(os.path.join(workDir, ORIGIN_CERT_FILE), 'wb') as ofs:
+        ofs.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, key))
+        ofs.write(crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
+
+
+with open('/dev/urandom', 'rb') as ifs:
+    CACHED_RANDOM_MB = ifs.read(ONE_MB)
+
+
+class RandomHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        try:
+            sizeRequested = int(self.path.rsplit('/', 1)[-1])
+        except ValueError:
+            self.send_error(400, 'Invalid request size')
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', sizeRequested)
+        # Prevent compression by sending binary
+        self.send_header('Content-Type', 'application/binary')
+        self.end_headers()
+        bytesSent = 0
+        while bytesSent < sizeRequested:
+            bytesToSend = min(sizeRequested - bytesSent, ONE_MB)
+            self.wfile.write(CACHED_RANDOM_MB[:bytesToSend])
+            bytesSent += bytesToSend
+
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def start_origin(certFile=None):
+    """Serve random bytes on a free port, over TLS if given a certFile"""
+    server = ThreadedHTTPServer(('localhost', 0), RandomHandler)
+    if certFile is not None:
+        # Handshake in the thread of each request, not while accepting
+        server.socket = ssl.wrap_socket(server.socket, certfile=certFile,
+                                        server_side=True,
+                                        do_handshake_on_connect=False)
+    t = Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return server
+
+
+def wait_for_port(port, process, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            return False
+        try:
+            socket.create_connection(('localhost', port), 1).close()
+            return True
+        except socket.error:
+            time.sleep(0.01)
+    return False
+
+
+class Daemon(object):
+    """main.py in one mode, in its own session so that it can be cleaned up"""
+
+    def __init__(self, name, args, port, workDir):
+        self.__workDir = workDir
+        self.__name = name
+        self.__logFile = os.path.join(workDir, 'daemon-%s.log' % name)
+        command = [sys.executable, os.path.join(REPO_DIR, 'main.py'),
+                   '-p', str(port), '-z'] + args
+        env = dict(os.environ)
+        # Trust the origin, both in the daemon and the local lambdas
+        env['REQUESTS_CA_BUNDLE'] = os.path.join(workDir, MITM_CERT_FILE)
+        startTime = time.time()
+        with open(self.__logFile, 'wb') as log:
+            self.__process = subprocess.Popen(
+                command, cwd=workDir, env=env, stdout=log,
+                stderr=subprocess.STDOUT, preexec_fn=os.setsid)
+        if not wait_for_port(port, self.__process, DAEMON_START_TIMEOUT):
+            self.stop()
+            raise RuntimeError('Daemon failed to start, see %s'
+                               % self.__logFile)
+        # Until the daemon accepted a connection
+        self.startSeconds = time.time() - startTime
+
+    @property
+    def pid(self):
+        return self.__process.pid
+
+    def stop(self):
+        if self.__process.poll() is None:
+            self.__process.send_signal(signal.SIGINT)
+            deadline = time.time() + DAEMON_STOP_TIMEOUT
+            while self.__process.poll() is None and time.time() < deadline:
+                time.sleep(0.1)
+        # Lambda containers that outlived the daemon
+        try:
+            os.killpg(self.__process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        self.__process.wait()
+        # Keep the log of each mode
+        mainLog = os.path.join(self.__workDir, MAIN_LOG_FILE)
+        if os.path.exists(mainLog):
+            os.rename(mainLog, os.path.join(
+                self.__workDir, 'main-%s.log' % self.__name))
+
+
+def _get_proc_usage(sessionId):
+    """Return {pid: (cpuSeconds, rssBytes)} of every process in the session"""
+    ticksPerSecond = float(os.sysconf('SC_CLK_TCK'))
+    pageSize = resource.getpagesize()
+    usage = {}
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % pid) as ifs:
+                stat = ifs.read()
+        except IOError:
+            continue
+        # The command may contain spaces, so split after it
+        fields = stat[stat.rindex(')') + 2:].split()
+        if int(fields[3]) != sessionId:
+            continue
+        usage[int(pid)] = ((int(fields[11]) + int(fields[12])) /
+                           ticksPerSecond, int(fields[21]) * pageSize)
+    return usage
+
+
+def _get_psutil_usage(pid):
+    usage = {}
+    try:
+        parent = psutil.Process(pid)
+        processes = [parent] + parent.children(recursive=True)
+    except psutil.NoSuchProcess:
+        return usage
+    for process in processes:
+        try:
+            times = process.cpu_times()
+            usage[process.pid] = (times.user + times.system,
+                                  process.memory_info().rss)
+        except psutil.NoSuchProcess:
+            pass
+    return usage
+
+
+def get_usage(pid):
+    """Return {pid: (cpuSeconds, rssBytes)} of the daemon and its lambdas"""
+    if os.path.isdir('/proc/%d' % pid):
+        return _get_proc_usage(pid)
+    if psutil is not None:
+        return _get_psutil_usage(pid)
+    return {}
+
+
+class UsageSampler(object):
+    """
+    Keeps the CPU time and peak RSS of the daemon and its lambdas during a
+    run. Lambdas that exit count up to when they were last seen.
+    """
+
+    def __init__(self, pid):
+        self.__pid = pid
+        self.__running = True
+        self.__startCpu = {}
+        self.__lastCpu = {}
+        self.peakRss = 0
+        self.__sample(self.__startCpu)
+        self.__thread = Thread(target=self.__sample_forever)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def __sample(self, startCpu=None):
+        usage = get_usage(self.__pid)
+        for pid, (cpuSeconds, _) in usage.iteritems():
+            self.__lastCpu[pid] = cpuSeconds
+            if startCpu is not None:
+                startCpu[pid] = cpuSeconds
+        self.peakRss = max(self.peakRss,
+                           sum(rss for _, rss in usage.itervalues()))
+
+    def __sample_forever(self):
+        while self.__running:
+            self.__sample()
+            time.sleep(RESOURCE_SAMPLE_INTERVAL)
+
+    def stop(self):
+        """Return the CPU seconds used since the start"""
+        self.__running = False
+        self.__thread.join()
+        self.__sample()
+        return sum(cpuSeconds - self.__startCpu.get(pid, 0.0)
+                   for pid, cpuSeconds in self.__lastCpu.iteritems())
+
+
+class LoadGenerator(object):
+    """
+    Closed loop clients that each send a request as soon as the last one
+    finishes, until the duration passes or enough requests are sent
+    """
+
+    def __init__(self, proxyPort, originUrl, mix, caFile, seed):
+        proxyUrl = 'http://localhost:%d' % proxyPort
+        self.__proxies = {'http': proxyUrl, 'https': proxyUrl}
+        self.__loadRequests = get_size_mix_requests(originUrl, mix)
+        self.__caFile = caFile
+        self.__seed = seed
+        self.__lock = Lock()
+
+    def __request(self, session, request):
+        size = int(request.url.rsplit('/', 1)[-1])
+        startTime = time.time()
+        try:
+            response = session.get(request.url, proxies=self.__proxies,
+                                   verify=self.__caFile,
+                                   timeout=REQUEST_TIMEOUT)
+            ok = response.status_code == 200 and \
+                len(response.content) == size
+        except Exception as e:
+            print >> sys.stderr, e
+            ok = False
+        return ok, time.time() - startTime, size
+
+    def __client(self, index, deadline, results):
+        mix = RequestMix(self.__loadRequests, self.__seed * 1000 + index)
+        session = requests.Session()
+        session.trust_env = False
+        while time.time() < deadline:
+            with self.__lock:
+                if self.__remaining is not None:
+                    if self.__remaining <= 0:
+                        break
+                    self.__remaining -= 1
+            results.append(self.__request(session, mix.next()))
+
+    def run(self, concurrency, duration=None, numRequests=None):
+        """Return [(ok, seconds, size)] and the seconds taken"""
+        self.__remaining = numRequests
+        deadline = float('inf') if numRequests is not None \
+            else time.time() + duration
+        results = []
+        startTime = time.time()
+        threads = [Thread(target=self.__client,
+                          args=(i, deadline, results))
+                   for i in xrange(concurrency)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+        return results, time.time() - startTime
+
+
+def percentile(sortedValues, p):
+    if not sortedValues:
+        return 0.0
+    index = int(round(p / 100.0 * (len(sortedValues) - 1)))
+    return sortedValues[index]
+
+
+def summarize(mode, concurrency, results, seconds, cpuSeconds, peakRss):
+    latencies = sorted(latency * 1000 for ok, latency, _ in results if ok)
+    numOk = len(latencies)
+    bytesReceived = sum(size for ok, _, size in results if ok)
+    return OrderedDict([
+        ('mode', mode),
+        ('concurrency', concurrency),
+        ('requests', len(results)),
+        ('errors', len(results) - numOk),
+        ('seconds', seconds),
+        ('requestsPerSec', numOk / seconds if seconds else 0.0),
+        ('mbPerSec', bytesReceived / float(ONE_MB) / seconds
+            if seconds else 0.0),
+        ('p50Millis', percentile(latencies, 50)),
+        ('p90Millis', percentile(latencies, 90)),
+        ('p99Millis', percentile(latencies, 99)),
+        ('maxMillis', latencies[-1] if latencies else 0.0),
+        ('cpuSeconds', cpuSeconds),
+        ('cpuPercent', 100.0 * cpuSeconds / seconds if seconds else 0.0),
+        ('cpuMillisPerRequest', 1000.0 * cpuSeconds / numOk if numOk
+            else 0.0),
+        ('peakRssMb', peakRss / float(ONE_MB)),
+    ])
+
+
+def summarize_replay(mode, loadResult, numMismatched, cpuSeconds, peakRss):
+    latency = loadResult.latency.snapshot()
+    seconds = loadResult.seconds
+    numOk = loadResult.numCompleted - numMismatched
+    return OrderedDict([
+        ('mode', mode),
+        ('concurrency', 0),
+        ('requests', loadResult.numSent),
+        ('errors', loadResult.numErrors + numMismatched),
+        ('seconds', seconds),
+        ('requestsPerSec', numOk / seconds if seconds else 0.0),
+        ('mbPerSec', loadResult.bytesReceived / float(ONE_MB) / seconds
+            if seconds else 0.0),
+        ('p50Millis', latency.percentile(50)),
+        ('p90Millis', latency.percentile(90)),
+        ('p99Millis', latency.percentile(99)),
+        ('maxMillis', latency.max),
+        ('cpuSeconds', cpuSeconds),
+        ('cpuPercent', 100.0 * cpuSeconds / seconds if seconds else 0.0),
+        ('cpuMillisPerRequest', 1000.0 * cpuSeconds / numOk if numOk
+            else 0.0),
+        ('peakRssMb', peakRss / float(ONE_MB)),
+    ])
+
+
+def print_result(result):
+    print '  %-9s c=%-3d %7.1f req/s %7.2f MB/s  p50 %7.1fms  p99 %7.1fms  ' \
+          '%3d errors  cpu %5.1f%%  rss %6.1fMB' % (
+        result['mode'], result['concurrency'], result['requestsPerSec'],
+        result['mbPerSec'], result['p50Millis'], result['p99Millis'],
+        result['errors'], result['cpuPercent'], result['peakRssMb'])
+
+
+def replay_trace(name, args, daemon, caFile, origins, entries):
+    """Replay the trace, counting responses unlike the recorded ones"""
+    schedule = get_replay_schedule(entries, origins['http'].url,
+                                   origins['https'].url, args.speed)
+    mismatched = []
+
+    def check_response(request, response):
+        index = int(request.url.rsplit('/', 1)[-1])
+        expected = get_expected_response(entries[index])
+        if (response.status_code, len(response.content)) != expected:
+            mismatched.append(request.url)
+
+    proxyUrl = 'http://localhost:%d' % args.port
+    load = OpenLoopLoad(None, proxyUrl,
+                        maxConnections=DEFAULT_MAX_CONNECTIONS,
+                        verify=caFile, timeout=REQUEST_TIMEOUT,
+                        onResponse=check_response)
+    if args.warmup is not None:
+        warmupRequests = [request for _, request in schedule[:args.warmup]]
+    else:
+        # The first request to each origin, so that tunnels are warm too
+        firstRequests = OrderedDict()
+        for _, request in schedule:
+            firstRequests.setdefault(request.url.rsplit('/', 1)[0], request)
+        warmupRequests = firstRequests.values()
+    load.run_schedule([(0.0, request) for request in warmupRequests])
+    del mismatched[:]
+
+    sampler = UsageSampler(daemon.pid)
+    loadResult = load.run_schedule(schedule)
+    cpuSeconds = sampler.stop()
+    result = summarize_replay(name, loadResult, len(mismatched), cpuSeconds,
+                              sampler.peakRss)
+    print_result(result)
+    return result
+
+
+def run_mode(name, args, workDir, origins, entries=None):
+    mode = MODES[name]
+    daemonArgs = list(mode.args)
+    if mode.lambdas and not args.useAws:
+        daemonArgs.append('--local-aws')
+    daemonArgs.extend(shlex.split(args.daemonArgs))
+
+    print 'Starting %s: main.py %s' % (name, ' '.join(daemonArgs))
+    daemon = Daemon(name, daemonArgs, args.port, workDir)
+    results = []
+    try:
+        if entries is not None:
+            results.append(replay_trace(
+                name, args, daemon, os.path.join(workDir, MITM_CERT_FILE),
+                origins, entries))
+            return results
+
+        origin = origins['https' if mode.https else 'http']
+        originUrl = '%s://localhost:%d' % ('https' if mode.https else 'http',
+                                           origin.server_address[1])
+        load = LoadGenerator(args.port, originUrl, args.mix,
+                             os.path.join(workDir, MITM_CERT_FILE), args.seed)
+        for concurrency in [int(x) for x in args.concurrency.split(',')]:
+            warmup = args.warmup if args.warmup is not None else concurrency
+            load.run(concurrency, numRequests=warmup)
+            sampler = UsageSampler(daemon.pid)
+            runResults, seconds = load.run(concurrency, args.duration,
+                                           args.numRequests)
+            cpuSeconds = sampler.stop()
+            result = summarize(name, concurrency, runResults, seconds,
+                               cpuSeconds, sampler.peakRss)
+            print_result(result)
+            results.append(result)
+    finally:
+        daemon.stop()
+    return results
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    """Return a description of each result worse than the baseline"""
+    baselineResults = {(r['mode'], r['concurrency']): r
+                       for r in baseline['results']}
+    regressions = []
+    for result in results:
+        key = (result['mode'], result['concurrency'])
+        old = baselineResults.get(key)
+        if old is None:
+            continue
+        if result['errors'] > old['errors']:
+            regressions.append('%s c=%d: %d errors, was %d' % (
+                key + (result['errors'], old['errors'])))
+        for name in COMPARED_RESULTS:
+            if not old.get(name):
+                continue
+            if name in HIGHER_IS_BETTER:
+                worse = result[name] < old[name] * (1 - tolerance)
+            else:
+                worse = result[name] > old[name] * (1 + tolerance)
+            if worse:
+                regressions.append('%s c=%d: %s %.2f, was %.2f' % (
+                    key + (name, result[name], old[name])))
+    return regressions
+
+
+def main(args):
+    for name in args.modes.split(','):
+        if name not in MODES:
+            print >> sys.stderr, 'Unknown mode:', name
+            return 2
+
+    workDir = tempfile.mkdtemp(prefix='pod-benchmark')
+    print 'Writing keys and daemon logs to', workDir
+    generate_certs(workDir)
+    cwd = os.getcwd()
+    os.chdir(workDir)
+    try:
+        generate_key_pair(PRIVATE_KEY_FILE, PUBLIC_KEY_FILE)
+    finally:
+        os.chdir(cwd)
+
+    entries = None
+    if args.traceFile is not None:
+        entries = read_traffic_trace(args.traceFile)
+        print 'Replaying %d requests from %s' % (len(entries), args.traceFile)
+        origins = {
+            'http': ReplayOrigin(entries),
+            'https': ReplayOrigin(entries,
+                                  os.path.join(workDir, ORIGIN_CERT_FILE)),
+        }
+    else:
+        origins = {
+            'http': start_origin(),
+            'https': start_origin(os.path.join(workDir, ORIGIN_CERT_FILE)),
+        }
+    results = []
+    try:
+        for name in args.modes.split(','):
+            try:
+                results.extend(run_mode(name, args, workDir, origins,
+                                        entries))
+            except RuntimeError as e:
+                print >> sys.stderr, '%s: %s' % (name, e)
+    finally:
+        for origin in origins.itervalues():
+            origin.shutdown()
+        if not args.keepDir:
+            shutil.rmtree(workDir)
+
+    config = OrderedDict([
+        ('concurrency', args.concurrency),
+        ('mix', args.mix),
+        ('duration', args.duration),
+        ('requests', args.numRequests),
+        ('seed', args.seed),
+        ('trace', args.traceFile),
+        ('speed', args.speed),
+        ('aws', args.useAws),
+        ('daemonArgs', args.daemonArgs),
+    ])
+    with open(args.outputFile, 'w') as ofs:
+        json.dump(OrderedDict([('time', time.time()), ('config', config),
+                               ('results', results)]), ofs, indent=2)
+    print 'Wrote results to', args.outputFile
+
+    if args.baselineFile is not None:
+        with open(args.baselineFile) as ifs:
+            baseline = json.load(ifs)
+        regressions = compare_to_baseline(results, baseline, args.tolerance)
+        if regressions:
+            print 'Regressions against %s:' % args.baselineFile
+            for regression in regressions:
+                print '  ' + regression
+            return 1
+        print 'No regressions against', args.baselineFile
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(get_args()))
@@ -9,8 +9,7 @@ import numpy as np
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
-
-from subprocess import check_output
+import requests
 
 from collections import OrderedDict
 
@@ -42,20 +41,42 @@ def get_args():
     return parser.parse_args()
 
 
-def single_measurement(hostAndPort, size, proxyHostAndPort):
-    args = [
-        'curl', '-o', '/dev/null', '-s',
-        '-w', '%{time_total},%{speed_download}'
-    ]
-    if proxyHostAndPort is not None:
-        args.extend(['-x', proxyHostAndPort])
-    args.append('%s/%d' % (hostAndPort, size))
-    time, rate = check_output(args).split(',')
-    return float(time), float(rate)
+DEFAULT_PROXY_PORT = 1080
+
+
+def get_url(hostAndPort):
+    if '://' not in hostAndPort:
+        hostAndPort = 'http://' + hostAndPort
+    return hostAndPort.rstrip('/')
+
+
+def get_proxies(proxyHostAndPort):
+    if proxyHostAndPort is None:
+        return {}
+    if ':' not in proxyHostAndPort:
+        # Like curl -x
+        proxyHostAndPort = '%s:%d' % (proxyHostAndPort, DEFAULT_PROXY_PORT)
+    proxyUrl = get_url(proxyHostAndPort)
+    return {'http': proxyUrl, 'https': proxyUrl}
+
+
+def single_measurement(session, url, size, proxies):
+    """Return the seconds taken and the rate in bytes per second"""
+    startTime = time.time()
+    response = session.get('%s/%d' % (url, size), proxies=proxies)
+    response.raise_for_status()
+    seconds = time.time() - startTime
+    return seconds, len(response.content) / seconds
 
 
 def take_measurements(hostAndPort, proxyHostAndPort):
     print 'Fetching %s with proxy=%s' % (hostAndPort, str(proxyHostAndPort))
+    url = get_url(hostAndPort)
+    proxies = get_proxies(proxyHostAndPort)
+
+    # Connections are kept alive between requests, where the proxy allows
+    session = requests.Session()
+    session.trust_env = False
     power = 0
     results = OrderedDict()
     while True:
@@ -68,8 +89,8 @@ def take_measurements(hostAndPort, proxyHostAndPort):
         resultsForSize = []
         for _ in xrange(NUM_TRIALS_PER_SIZE):
             try:
-                resultsForSize.append(single_measurement(hostAndPort, size,
-                                                         proxyHostAndPort))
+                resultsForSize.append(single_measurement(session, url, size,
+                                                         proxies))
             except Exception as e:
                 print >> sys.stderr, e
             time.sleep(SECONDS_BETWEEN_REQUESTS)
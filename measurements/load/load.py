@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+"""
+Send requests through the proxy at each of several rates, with an open loop,
+and plot the latency percentiles against the load. Requests are for sizes
+from measurements/latency/server.py, or for the URLs in a trace file.
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+
+from collections import OrderedDict
+
+try:
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+except ImportError:
+    plt = None
+
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, REPO_DIR)
+
+from lib.loadgen import DEFAULT_MAX_CONNECTIONS, OpenLoopLoad, RequestMix, \
+    get_size_mix_requests, read_load_trace
+
+DEFAULT_RATES = '1,2,5,10,20'
+DEFAULT_DURATION = 30.0
+DEFAULT_PAYLOAD_MIX = '1024:6,65536:3,1048576:1'
+
+PLOTTED_PERCENTILES = ['p50Millis', 'p90Millis', 'p99Millis', 'p99.9Millis']
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--url', type=str,
+                        help='URL of a server that sends /<size> bytes')
+    parser.add_argument('--mix', type=str, default=DEFAULT_PAYLOAD_MIX,
+                        help='Sizes to request from --url and their weights, '
+                             'as size:weight,...')
+    parser.add_argument('--trace', type=str, dest='traceFile',
+                        help='JSONL file of URLs or objects with a url, '
+                             'method, headers, body and weight')
+    parser.add_argument('--proxy', '-p', type=str, dest='proxyHostAndPort',
+                        default='localhost:1080',
+                        help='Host and port of the proxy, or none')
+    parser.add_argument('--rates', '-r', type=str, default=DEFAULT_RATES,
+                        help='Comma separated requests per second')
+    parser.add_argument('--duration', '-d', type=float,
+                        default=DEFAULT_DURATION,
+                        help='Seconds to send requests at each rate')
+    parser.add_argument('--connections', '-c', type=int,
+                        default=DEFAULT_MAX_CONNECTIONS,
+                        help='Max requests in flight')
+    parser.add_argument('--uniform', action='store_true',
+                        help='Send at even intervals instead of as a '
+                             'Poisson process')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--ca-bundle', type=str, dest='caBundle',
+                        help='Certificates to verify HTTPS origins with, such '
+                             'as mitm.ca.pem')
+    parser.add_argument('--no-measure', '-nm', action='store_true',
+                        dest='noMeasure',
+                        help='Regenerate plot with cached measurements')
+    parser.add_argument('--output-prefix', type=str, default='load',
+                        dest='outputPrefix',
+                        help='File prefix to write the resulting plot and '
+                             'measurements to')
+    return parser.parse_args()
+
+
+def take_measurements(args):
+    if args.traceFile is not None:
+        loadRequests = read_load_trace(args.traceFile)
+    elif args.url is not None:
+        loadRequests = get_size_mix_requests(args.url, args.mix)
+    else:
+        raise ValueError('Either --url or --trace is required')
+
+    proxyUrl = None
+    if args.proxyHostAndPort != 'none':
+        proxyUrl = 'http://%s' % args.proxyHostAndPort
+    load = OpenLoopLoad(RequestMix(loadRequests, args.seed), proxyUrl,
+                        maxConnections=args.connections,
+                        verify=args.caBundle or True, uniform=args.uniform,
+                        seed=args.seed)
+
+    results = []
+    for rate in [float(x) for x in args.rates.split(',')]:
+        print 'Sending %g req/s for %gs' % (rate, args.duration)
+        sys.stdout.flush()
+        result = load.run(rate, duration=args.duration)
+        latency = result.latency.snapshot()
+        print '  %.1f req/s done, %d errors, p50 %.1fms, p99 %.1fms, ' \
+              'max backlog %d' % (result.achievedRate, result.numErrors,
+                                  latency.percentile(50),
+                                  latency.percentile(99), result.maxBacklog)
+        results.append(result.to_dict())
+    return results
+
+
+def plot_measurements(results, outputFile):
+    x = [result['offeredRate'] for result in results]
+
+    fig, (ax0, ax1) = plt.subplots(nrows=2, sharex=True)
+    for name in PLOTTED_PERCENTILES:
+        ax0.plot(x, [result['latency'].get(name, 0) for result in results],
+                 '-o', label=name[:-len('Millis')])
+    ax0.set_title('Latency percentiles vs. offered load')
+    ax0.set_ylabel('milliseconds')
+    ax0.set_yscale('log')
+    ax0.legend(loc=0)
+
+    ax1.plot(x, [result['achievedRate'] for result in results], '-bo',
+             label='completed')
+    ax1.plot(x, x, '--', color='gray', label='offered')
+    ax1.set_title('Throughput vs. offered load')
+    ax1.set_xlabel('requests per second')
+    ax1.set_ylabel('requests per second')
+    ax1.legend(loc=0)
+
+    plt.savefig(outputFile)
+
+
+def main(args):
+    logging.basicConfig(level=logging.WARN)
+    if args.noMeasure:
+        with open(args.outputPrefix + '.json', 'r') as ifs:
+            results = json.load(ifs, object_pairs_hook=OrderedDict)
+    else:
+        results = take_measurements(args)
+        with open(args.outputPrefix + '.json', 'w') as ofs:
+            json.dump(results, ofs, indent=4)
+
+    if plt is None:
+        print >> sys.stderr, 'Install matplotlib to plot the measurements'
+        return
+    plot_measurements(results, args.outputPrefix + '.pdf')
+
+
+if __name__ == '__main__':
+    main(get_args())
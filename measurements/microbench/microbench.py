@@ -0,0 +1,451 @@
+#!/usr/bin/env python
+"""
+Microbenchmarks of the code that costs CPU per byte or per message on the
+proxy: socket proxying, AES-GCM, the aws_short envelopes, SQS result parsing
+and fragment assembly, SQS size estimates and header filtering. Inputs are
+fixed for each payload size, so runs on the same machine are comparable, and
+results can be saved as a baseline for later runs to be checked against.
+"""
+
+import argparse
+import gc
+import hashlib
+import json
+import os
+import platform
+import re
+import socket
+import sys
+import time
+
+from base64 import b64decode, b64encode
+from collections import OrderedDict, namedtuple
+from Queue import Queue
+from threading import Thread
+from timeit import default_timer
+
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, REPO_DIR)
+
+from lib.headers import filter_request_headers, is_filtered_response_header
+from lib.stats import SqsStatsModel
+from shared.crypto import REQUEST_NONCE_LENGTH, RESPONSE_BODY_NONCE, \
+    RequestCipher, decrypt_with_gcm, encrypt_with_gcm
+from shared.proxy import proxy_sockets
+from shared.workers import LambdaSqsResult
+
+DEFAULT_SIZES = '1024,65536,1048576'
+DEFAULT_MIN_TIME = 0.2
+DEFAULT_REPEATS = 7
+DEFAULT_TOLERANCE = 0.1
+
+# As in lambda/impl/long.py
+MAX_PAYLOAD_PER_SQS_MESSAGE = 252 * 1024
+
+KEY = hashlib.sha256('microbench key').digest()[:16]
+NONCE = hashlib.sha256('microbench nonce').digest()[:12]
+REQUEST_NONCE = hashlib.sha256('microbench request').digest()[
+    :REQUEST_NONCE_LENGTH]
+
+# Headers of a typical browser request and response, as parsed by
+# BaseHTTPRequestHandler (lower case) and by requests (as sent)
+REQUEST_HEADERS = [
+    ('host', 'www.example.com'),
+    ('user-agent', 'Mozilla/5.0 (X11; Linux x86_64; rv:56.0) '
+                   'Gecko/20100101 Firefox/56.0'),
+    ('accept', 'text/html,application/xhtml+xml,application/xml;q=0.9,'
+               '*/*;q=0.8'),
+    ('accept-language', 'en-US,en;q=0.5'),
+    ('accept-encoding', 'gzip, deflate'),
+    ('referer', 'http://www.example.com/index.html'),
+    ('cookie', 'session=0123456789abcdef0123456789abcdef; theme=dark'),
+    ('proxy-connection', 'keep-alive'),
+    ('connection', 'keep-alive'),
+    ('upgrade-insecure-requests', '1'),
+]
+RESPONSE_HEADERS = OrderedDict([
+    ('Date', 'Thu, 19 Oct 2017 00:00:00 GMT'),
+    ('Server', 'Apache'),
+    ('Last-Modified', 'Wed, 18 Oct 2017 00:00:00 GMT'),
+    ('ETag', '"2d-55bd7c0b4b7c0"'),
+    ('Accept-Ranges', 'bytes'),
+    ('Content-Length', '45'),
+    ('Cache-Control', 'max-age=3600'),
+    ('Connection', 'keep-alive'),
+    ('Content-Type', 'text/html; charset=UTF-8'),
+])
+
+Case = namedtuple('Case', ['name', 'sized', 'setup'])
+
+CASES = OrderedDict()
+
+
+def case(name, sized=True):
+    """
+    Register a setup function, which is called with a payload size (or None)
+    and a list to append cleanup functions to, and returns the function to
+    time.
+    """
+    def register(setup):
+        CASES[name] = Case(name, sized, setup)
+        return setup
+    return register
+
+
+def get_payload(size):
+    """The same incompressible bytes for a size on every run"""
+    blocks = []
+    for i in xrange(size / 64 + 1):
+        blocks.append(hashlib.sha512(str(i)).digest())
+    return b''.join(blocks)[:size]
+
+
+class FakeSqsMessage(object):
+    """The parts of a boto3 SQS message that are read by the proxy"""
+
+    def __init__(self, messageId, body, messageAttributes):
+        self.message_id = messageId
+        self.body = body
+        self.message_attributes = messageAttributes
+
+
+def get_result_messages(taskId, content, encodedMessageBody):
+    """Fragments of a response, as lambda/impl/long.py sends them"""
+    contentLen = len(content)
+    numFragments = contentLen / MAX_PAYLOAD_PER_SQS_MESSAGE + 1
+    messages = []
+    for i in xrange(numFragments):
+        part = LambdaSqsResult(taskId=taskId, numFragments=numFragments,
+                               fragmentId=i)
+        baseIdx = i * MAX_PAYLOAD_PER_SQS_MESSAGE
+        if baseIdx < contentLen:
+            part.add_binary_attribute(
+                'data', content[baseIdx:baseIdx + MAX_PAYLOAD_PER_SQS_MESSAGE])
+        if i == numFragments - 1:
+            part.set_body(encodedMessageBody)
+        else:
+            part.set_body(' ')
+        messages.append(FakeSqsMessage('%s-%d' % (taskId, i), part.body,
+                                       part.messageAttributes))
+    return messages
+
+
+def get_short_response(size):
+    """A JSON response of lambda/impl/short.py"""
+    return json.dumps({
+        'statusCode': 200,
+        'headers': dict(RESPONSE_HEADERS),
+        'content64': b64encode(get_payload(size)),
+    })
+
+
+@case('proxy_sockets')
+def setup_proxy_sockets(size, cleanups):
+    """Bytes sent through a connection that is proxied by a thread"""
+    payload = get_payload(size)
+    client, proxyIn = socket.socketpair()
+    proxyOut, server = socket.socketpair()
+    proxyThread = Thread(target=proxy_sockets,
+                         args=(proxyIn, proxyOut, 3600))
+    proxyThread.daemon = True
+    proxyThread.start()
+
+    # Write from another thread so that large payloads cannot fill the
+    # buffers of both sockets
+    writes = Queue()
+
+    def write_forever():
+        while True:
+            data = writes.get()
+            if data is None:
+                break
+            client.sendall(data)
+    writerThread = Thread(target=write_forever)
+    writerThread.daemon = True
+    writerThread.start()
+
+    def cleanup():
+        writes.put(None)
+        writerThread.join()
+        client.close()
+        proxyThread.join()
+        for sock in (proxyIn, proxyOut, server):
+            sock.close()
+    cleanups.append(cleanup)
+
+    def run():
+        writes.put(payload)
+        remaining = size
+        while remaining > 0:
+            remaining -= len(server.recv(65536))
+    return run
+
+
+@case('encrypt_with_gcm')
+def setup_encrypt_with_gcm(size, cleanups):
+    payload = get_payload(size)
+    return lambda: encrypt_with_gcm(KEY, payload, NONCE)
+
+
+@case('decrypt_with_gcm')
+def setup_decrypt_with_gcm(size, cleanups):
+    ciphertext, tag = encrypt_with_gcm(KEY, get_payload(size), NONCE)
+    return lambda: decrypt_with_gcm(KEY, ciphertext, tag, NONCE)
+
+
+@case('encrypt_framed')
+def setup_encrypt_framed(size, cleanups):
+    payload = get_payload(size)
+    cipher = RequestCipher(KEY, REQUEST_NONCE)
+    return lambda: cipher.encrypt_framed(RESPONSE_BODY_NONCE, payload)
+
+
+@case('decrypt_framed')
+def setup_decrypt_framed(size, cleanups):
+    cipher = RequestCipher(KEY, REQUEST_NONCE)
+    framed = cipher.encrypt_framed(RESPONSE_BODY_NONCE, get_payload(size))
+    return lambda: cipher.decrypt_framed(RESPONSE_BODY_NONCE, framed)
+
+
+@case('short_encode_request')
+def setup_short_encode_request(size, cleanups):
+    """The invocation payload of aws_short for a request with a body"""
+    payload = get_payload(size)
+    headers = filter_request_headers(REQUEST_HEADERS)
+
+    def run():
+        return json.dumps({
+            'method': 'POST',
+            'url': 'http://www.example.com/upload',
+            'headers': headers,
+            'body64': b64encode(payload),
+        })
+    return run
+
+
+@case('short_decode_response')
+def setup_short_decode_response(size, cleanups):
+    """The response of the short lived lambda, as read by aws_short"""
+    response = get_short_response(size)
+
+    def run():
+        decoded = json.loads(response)
+        return b64decode(decoded['content64'])
+    return run
+
+
+@case('sqs_from_message')
+def setup_sqs_from_message(size, cleanups):
+    """Parsing the results of the long lived lambda, as the workers do"""
+    messages = get_result_messages('task', get_payload(size), '{}')
+
+    def run():
+        for message in messages:
+            LambdaSqsResult.from_message(message)
+    return run
+
+
+@case('sqs_assemble_fragments')
+def setup_sqs_assemble_fragments(size, cleanups):
+    """Parsing, ordering and joining fragments as the workers and aws_long"""
+    messages = get_result_messages('task', get_payload(size), '{}')
+    messages.reverse()
+
+    def run():
+        partial = {}
+        for message in messages:
+            result = LambdaSqsResult.from_message(message)
+            partial[result.fragmentId] = result
+        dataChunks = []
+        for i in xrange(len(partial)):
+            part = partial[i]
+            if part.has_attribute('data'):
+                dataChunks.append(part.get_binary_attribute('data'))
+        return b''.join(dataChunks)
+    return run
+
+
+@case('sqs_estimate_message_size')
+def setup_sqs_estimate_message_size(size, cleanups):
+    messages = get_result_messages('task', get_payload(size), '{}')
+
+    def run():
+        for message in messages:
+            SqsStatsModel.estimate_message_size(message=message)
+    return run
+
+
+@case('filter_request_headers', sized=False)
+def setup_filter_request_headers(size, cleanups):
+    return lambda: filter_request_headers(REQUEST_HEADERS)
+
+
+@case('filter_response_headers', sized=False)
+def setup_filter_response_headers(size, cleanups):
+    def run():
+        return [(header, value)
+                for header, value in RESPONSE_HEADERS.iteritems()
+                if not is_filtered_response_header(header)]
+    return run
+
+
+def _time_batch(run, n):
+    gcEnabled = gc.isenabled()
+    gc.disable()
+    try:
+        startTime = default_timer()
+        for _ in xrange(n):
+            run()
+        return default_timer() - startTime
+    finally:
+        if gcEnabled:
+            gc.enable()
+
+
+def _median(values):
+    values = sorted(values)
+    mid = len(values) / 2
+    if len(values) % 2 == 1:
+        return values[mid]
+    return (values[mid - 1] + values[mid]) / 2.0
+
+
+def time_function(run, minTime, repeats):
+    """
+    Find a number of iterations that takes at least minTime, then time that
+    many repeats times. Returns the iterations and seconds per operation of
+    each repeat.
+    """
+    run()
+    n = 1
+    while True:
+        elapsed = _time_batch(run, n)
+        if elapsed >= minTime:
+            break
+        if elapsed <= 0:
+            n *= 10
+        else:
+            n = max(n + 1, min(n * 10, int(n * minTime * 1.2 / elapsed)))
+    return n, [_time_batch(run, n) / n for _ in xrange(repeats)]
+
+
+def run_case(benchCase, size, minTime, repeats):
+    cleanups = []
+    try:
+        run = benchCase.setup(size, cleanups)
+        n, timings = time_function(run, minTime, repeats)
+    finally:
+        for cleanup in cleanups:
+            cleanup()
+
+    median = _median(timings)
+    deviation = _median([abs(x - median) for x in timings])
+    result = OrderedDict([
+        ('name', benchCase.name),
+        ('size', size),
+        ('iterations', n),
+        ('repeats', repeats),
+        ('medianMicros', median * 1e6),
+        ('minMicros', min(timings) * 1e6),
+        # Median absolute deviation, relative to the median
+        ('spread', deviation / median if median > 0 else 0.0),
+    ])
+    if size:
+        result['mbPerSec'] = size / float(2 ** 20) / median
+    return result
+
+
+def get_result_key(result):
+    if result['size'] is None:
+        return result['name']
+    return '%s/%d' % (result['name'], result['size'])
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    """Print changes from the baseline and return the regressed results"""
+    baselineResults = {get_result_key(x): x for x in baseline['results']}
+    regressions = []
+    print
+    print 'Compared to the baseline (tolerance %d%%):' % (tolerance * 100)
+    for result in results:
+        key = get_result_key(result)
+        base = baselineResults.get(key)
+        if base is None:
+            print '  %-40s (not in the baseline)' % key
+            continue
+        change = result['medianMicros'] / base['medianMicros'] - 1
+        status = ''
+        if change > tolerance:
+            status = 'REGRESSED'
+            regressions.append(result)
+        elif change < -tolerance:
+            status = 'improved'
+        print '  %-40s %+7.1f%% %s' % (key, change * 100, status)
+    return regressions
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--filter', '-f', type=str,
+                        help='Regex of the cases to run')
+    parser.add_argument('--list', '-l', action='store_true',
+                        help='List the cases and exit')
+    parser.add_argument('--sizes', '-s', type=str, default=DEFAULT_SIZES,
+                        help='Comma separated payload sizes in bytes')
+    parser.add_argument('--min-time', type=float, default=DEFAULT_MIN_TIME,
+                        dest='minTime',
+                        help='Seconds that each repeat should take at least')
+    parser.add_argument('--repeats', '-r', type=int, default=DEFAULT_REPEATS,
+                        help='Timed repeats of each case')
+    parser.add_argument('--save', type=str, dest='saveFile',
+                        help='File to write the results to, for use as a '
+                             'baseline')
+    parser.add_argument('--baseline', type=str, dest='baselineFile',
+                        help='Results of an earlier run to compare to')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='Relative slowdown of a median that counts as '
+                             'a regression')
+    return parser.parse_args()
+
+
+def main(args):
+    cases = [x for x in CASES.itervalues()
+             if args.filter is None or re.search(args.filter, x.name)]
+    if args.list:
+        for benchCase in cases:
+            print benchCase.name
+        return 0
+
+    sizes = [int(x) for x in args.sizes.split(',')]
+    print '%-40s %12s %12s %8s %10s' % ('case', 'median us', 'min us',
+                                        'spread', 'MB/s')
+    results = []
+    for benchCase in cases:
+        for size in (sizes if benchCase.sized else [None]):
+            result = run_case(benchCase, size, args.minTime, args.repeats)
+            results.append(result)
+            print '%-40s %12.2f %12.2f %7.1f%% %10s' % (
+                get_result_key(result), result['medianMicros'],
+                result['minMicros'], result['spread'] * 100,
+                '%.1f' % result['mbPerSec'] if 'mbPerSec' in result else '-')
+            sys.stdout.flush()
+
+    if args.saveFile is not None:
+        with open(args.saveFile, 'w') as ofs:
+            json.dump(OrderedDict([
+                ('time', time.time()),
+                ('python', platform.python_version()),
+                ('machine', platform.machine()),
+                ('results', results),
+            ]), ofs, indent=4)
+
+    if args.baselineFile is not None:
+        with open(args.baselineFile, 'r') as ifs:
+            baseline = json.load(ifs)
+        if compare_to_baseline(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(get_args()))
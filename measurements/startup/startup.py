@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+"""
+Time how long the daemon takes to start in each mode: until it accepts
+connections, and until the first request through it is answered. Each mode
+is started --repeats times, with the lambdas in the local stand-in unless
+--aws is given, and the medians are written as JSON.
+"""
+
+import argparse
+import json
+import os
+import shlex
+import shutil
+import sys
+import tempfile
+import time
+
+import requests
+
+from collections import OrderedDict
+
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, 'measurements', 'benchmark'))
+
+from benchmark import DEFAULT_PROXY_PORT, MITM_CERT_FILE, MODES, \
+    ORIGIN_CERT_FILE, Daemon, generate_certs, start_origin
+from gen_rsa_kp import generate_key_pair, PRIVATE_KEY_FILE, PUBLIC_KEY_FILE
+
+DEFAULT_REPEATS = 3
+DEFAULT_TOLERANCE = 0.2
+DEFAULT_OUTPUT = 'startup.json'
+
+REQUEST_TIMEOUT = 60
+REQUEST_SIZE = 1024
+
+COMPARED_RESULTS = ['listenMillis', 'firstResponseMillis']
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--modes', type=str, default=','.join(MODES),
+                        help='Comma separated modes to run, from %s'
+                             % ', '.join(MODES))
+    parser.add_argument('--repeats', '-r', type=int, default=DEFAULT_REPEATS,
+                        help='Times to start the daemon in each mode')
+    parser.add_argument('--port', '-p', type=int, default=DEFAULT_PROXY_PORT,
+                        help='Port for the daemon to listen on')
+    parser.add_argument('--aws', action='store_true', dest='useAws',
+                        help='Use the lambdas on AWS, given with -f in '
+                             '--daemon-args, instead of the local stand-in')
+    parser.add_argument('--daemon-args', type=str, default='',
+                        dest='daemonArgs',
+                        help='More arguments for main.py, in every mode')
+    parser.add_argument('--output', '-o', type=str, default=DEFAULT_OUTPUT,
+                        dest='outputFile', help='File to write results to')
+    parser.add_argument('--baseline', '-b', type=str, dest='baselineFile',
+                        help='Results of an earlier run to compare to. '
+                             'Exits with 1 if anything regressed.')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='Fraction by which a result may be worse than '
+                             'the baseline')
+    return parser.parse_args()
+
+
+def _median(values):
+    values = sorted(values)
+    mid = len(values) / 2
+    if len(values) % 2 == 1:
+        return values[mid]
+    return (values[mid - 1] + values[mid]) / 2.0
+
+
+def start_once(name, daemonArgs, args, workDir, originUrl):
+    """Return the seconds until listening and until the first response"""
+    startTime = time.time()
+    daemon = Daemon(name, daemonArgs, args.port, workDir)
+    try:
+        proxyUrl = 'http://localhost:%d' % args.port
+        response = requests.get(
+            '%s/%d' % (originUrl, REQUEST_SIZE),
+            proxies={'http': proxyUrl, 'https': proxyUrl},
+            verify=os.path.join(workDir, MITM_CERT_FILE),
+            timeout=REQUEST_TIMEOUT)
+        firstResponseSeconds = time.time() - startTime
+        if response.status_code != 200 or \
+                len(response.content) != REQUEST_SIZE:
+            raise RuntimeError('First request failed with %d' %
+                               response.status_code)
+    finally:
+        daemon.stop()
+    return daemon.startSeconds, firstResponseSeconds
+
+
+def run_mode(name, args, workDir, origins):
+    mode = MODES[name]
+    daemonArgs = list(mode.args)
+    if mode.lambdas and not args.useAws:
+        daemonArgs.append('--local-aws')
+    daemonArgs.extend(shlex.split(args.daemonArgs))
+
+    print 'Starting %s %d times: main.py %s' % (name, args.repeats,
+                                               ' '.join(daemonArgs))
+    sys.stdout.flush()
+    scheme = 'https' if mode.https else 'http'
+    originUrl = '%s://localhost:%d' % (scheme,
+                                       origins[scheme].server_address[1])
+    listenTimes = []
+    firstResponseTimes = []
+    for _ in xrange(args.repeats):
+        listenSeconds, firstResponseSeconds = start_once(
+            name, daemonArgs, args, workDir, originUrl)
+        listenTimes.append(listenSeconds * 1000.0)
+        firstResponseTimes.append(firstResponseSeconds * 1000.0)
+
+    result = OrderedDict([
+        ('mode', name),
+        ('listenMillis', _median(listenTimes)),
+        ('firstResponseMillis', _median(firstResponseTimes)),
+        ('minListenMillis', min(listenTimes)),
+        ('minFirstResponseMillis', min(firstResponseTimes)),
+    ])
+    print '  listening after %.0fms, first response after %.0fms' % (
+        result['listenMillis'], result['firstResponseMillis'])
+    return result
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    """Return a description of each result slower than the baseline"""
+    baselineResults = {r['mode']: r for r in baseline['results']}
+    regressions = []
+    for result in results:
+        old = baselineResults.get(result['mode'])
+        if old is None:
+            continue
+        for name in COMPARED_RESULTS:
+            if old.get(name) and result[name] > old[name] * (1 + tolerance):
+                regressions.append('%s: %s %.0f, was %.0f' % (
+                    result['mode'], name, result[name], old[name]))
+    return regressions
+
+
+def main(args):
+    for name in args.modes.split(','):
+        if name not in MODES:
+            print >> sys.stderr, 'Unknown mode:', name
+            return 2
+
+    workDir = tempfile.mkdtemp(prefix='pod-startup')
+    generate_certs(workDir)
+    cwd = os.getcwd()
+    os.chdir(workDir)
+    try:
+        generate_key_pair(PRIVATE_KEY_FILE, PUBLIC_KEY_FILE)
+    finally:
+        os.chdir(cwd)
+
+    origins = {
+        'http': start_origin(),
+        'https': start_origin(os.path.join(workDir, ORIGIN_CERT_FILE)),
+    }
+    results = []
+    try:
+        for name in args.modes.split(','):
+            try:
+                results.append(run_mode(name, args, workDir, origins))
+            except (RuntimeError, requests.RequestException) as e:
+                print >> sys.stderr, '%s: %s' % (name, e)
+    finally:
+        for origin in origins.itervalues():
+            origin.shutdown()
+        shutil.rmtree(workDir)
+
+    config = OrderedDict([
+        ('repeats', args.repeats),
+        ('aws', args.useAws),
+        ('daemonArgs', args.daemonArgs),
+    ])
+    with open(args.outputFile, 'w') as ofs:
+        json.dump(OrderedDict([('time', time.time()), ('config', config),
+                               ('results', results)]), ofs, indent=2)
+    print 'Wrote results to', args.outputFile
+
+    if args.baselineFile is not None:
+        with open(args.baselineFile) as ifs:
+            baseline = json.load(ifs)
+        regressions = compare_to_baseline(results, baseline, args.tolerance)
+        if regressions:
+            print 'Regressions against %s:' % args.baselineFile
+            for regression in regressions:
+                print '  ' + regression
+            return 1
+        print 'No regressions against', args.baselineFile
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(get_args()))
@@ -5,10 +5,17 @@ trigger multiple lambdas.
 """
 
 import argparse
+import os
 import sys
 
-from threading import Thread, Lock
-from subprocess import check_output
+from threading import Lock
+
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, REPO_DIR)
+
+from lib.loadgen import LoadRequest, OpenLoopLoad, RequestMix
+
+DEFAULT_RATE = 100.0
 
 
 def get_args():
@@ -16,41 +23,45 @@ def get_args():
     parser.add_argument('hostAndPort', type=str)
     parser.add_argument('--num-requests', '-n', type=int, default=10, dest='n',
                         help='Number of parallel requests to make')
+    parser.add_argument('--rate', '-r', type=float, default=DEFAULT_RATE,
+                        help='Requests to start per second')
+    parser.add_argument('--proxy', '-p', type=str, dest='proxyHostAndPort',
+                        default='localhost:1080',
+                        help='Host and port of the proxy to use')
     return parser.parse_args()
 
 
-def single_request(hostAndPort):
-    args = [
-        'curl', '-s', '-x', 'localhost', hostAndPort
-    ]
-    ip, port = check_output(args).split(':')
-    return ip
-
-
-def take_measurements(hostAndPort, n):
+def take_measurements(hostAndPort, proxyHostAndPort, n, rate):
     print >> sys.stderr, 'Hitting %s %d times' % (hostAndPort, n)
+    if '://' not in hostAndPort:
+        hostAndPort = 'http://' + hostAndPort
     ipSet = set()
     ipSetLock = Lock()
+    errors = []
+
+    def on_response(request, response):
+        if response.status_code != 200:
+            errors.append(response.status_code)
+            return
+        ip, port = response.content.split(':')
+        with ipSetLock:
+            ipSet.add(ip)
 
-    def single_thread():
-        try:
-            ip = single_request(hostAndPort)
-            with ipSetLock:
-                ipSet.add(ip)
-        except Exception, e:
-            print >> sys.stderr, e
-
-    threads = []
-    for _ in xrange(n):
-        t = Thread(target=single_thread)
-        t.start()
-        threads.append(t)
-    for t in threads: t.join()
+    request = LoadRequest(url=hostAndPort, method='GET', headers={},
+                          body=None, weight=1)
+    load = OpenLoopLoad(RequestMix([request]),
+                        'http://%s' % proxyHostAndPort, maxConnections=n,
+                        uniform=True, onResponse=on_response)
+    result = load.run(rate, numRequests=n)
+    if result.numErrors or errors:
+        print >> sys.stderr, '%d requests failed' % (result.numErrors +
+                                                     len(errors))
     return ipSet
 
 
 def main(args):
-    uniqueIPs = take_measurements(args.hostAndPort, args.n)
+    uniqueIPs = take_measurements(args.hostAndPort, args.proxyHostAndPort,
+                                  args.n, args.rate)
     for ip in uniqueIPs:
         print ip
     print 'N: %d, Unique IPs: %d' % (args.n, len(uniqueIPs))
@@ -0,0 +1,166 @@
+"""
+Note: this file will be copied to the Lambda too. Do not
+add dependencies carelessly.
+"""
+
+import hashlib
+import json
+import time
+
+from calendar import timegm
+from email.utils import parsedate
+from urllib import urlencode
+from urlparse import parse_qsl, urlsplit, urlunsplit
+
+# Cached responses are stored under this prefix. Give it a lifecycle rule to
+# expire old objects, since they are not deleted after being read.
+CACHE_KEY_PREFIX = 'cache/'
+
+# Name of the S3 user metadata that holds the cached status and headers
+CACHE_META_NAME = 'pod-meta'
+
+# S3 limits user metadata to 2KB
+MAX_CACHE_META_SIZE = 1800
+
+CACHEABLE_METHODS = {'GET'}
+CACHEABLE_STATUS_CODES = {200}
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+# Responses that vary on request headers other than these are not cached
+CACHE_KEY_HEADERS = ['Accept-Encoding']
+
+
+def get_header(headers, name, default=None):
+    """Case insensitive header lookup"""
+    lowerName = name.lower()
+    for header, value in headers.iteritems():
+        if header.lower() == lowerName:
+            return value
+    return default
+
+
+def normalize_url(url):
+    """Lowercase the scheme and host, drop default ports and sort the query"""
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    host = parts.hostname.lower() if parts.hostname else ''
+    if parts.port is not None and parts.port != DEFAULT_PORTS.get(scheme):
+        host = '%s:%d' % (host, parts.port)
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, host, parts.path or '/', query, ''))
+
+
+def get_cache_key(url, requestHeaders):
+    md5 = hashlib.md5()
+    md5.update(normalize_url(url))
+    for header in CACHE_KEY_HEADERS:
+        md5.update('\n%s: %s' % (header.lower(),
+                                 get_header(requestHeaders, header, '')))
+    return CACHE_KEY_PREFIX + md5.hexdigest()
+
+
+def parse_cache_control(value):
+    """Return a dict of directives. Directives without values map to True"""
+    directives = {}
+    if not value:
+        return directives
+    for directive in value.split(','):
+        directive = directive.strip().lower()
+        if not directive:
+            continue
+        if '=' in directive:
+            name, arg = directive.split('=', 1)
+            directives[name.strip()] = arg.strip().strip('"')
+        else:
+            directives[directive] = True
+    return directives
+
+
+def _parse_http_date(value):
+    if not value:
+        return None
+    parsed = parsedate(value)
+    if parsed is None:
+        return None
+    return timegm(parsed)
+
+
+def get_freshness_lifetime(responseHeaders):
+    """Seconds the response may be served from a shared cache"""
+    cacheControl = parse_cache_control(
+        get_header(responseHeaders, 'Cache-Control'))
+    for directive in ('s-maxage', 'max-age'):
+        if directive in cacheControl:
+            try:
+                return max(int(cacheControl[directive]), 0)
+            except ValueError:
+                return 0
+    expires = _parse_http_date(get_header(responseHeaders, 'Expires'))
+    if expires is None:
+        return 0
+    date = _parse_http_date(get_header(responseHeaders, 'Date'))
+    if date is None:
+        date = time.time()
+    return max(expires - date, 0)
+
+
+def get_validators(responseHeaders):
+    """Request headers to revalidate a cached response with the origin"""
+    validators = {}
+    etag = get_header(responseHeaders, 'ETag')
+    if etag:
+        validators['If-None-Match'] = etag
+    lastModified = get_header(responseHeaders, 'Last-Modified')
+    if lastModified:
+        validators['If-Modified-Since'] = lastModified
+    return validators
+
+
+def is_cacheable_request(method, requestHeaders, body):
+    if method.upper() not in CACHEABLE_METHODS or body:
+        return False
+    if get_header(requestHeaders, 'Authorization') is not None:
+        return False
+    cacheControl = parse_cache_control(
+        get_header(requestHeaders, 'Cache-Control'))
+    return 'no-store' not in cacheControl
+
+
+def is_cacheable_response(statusCode, responseHeaders):
+    if statusCode not in CACHEABLE_STATUS_CODES:
+        return False
+    if get_header(responseHeaders, 'Set-Cookie') is not None:
+        return False
+    cacheControl = parse_cache_control(
+        get_header(responseHeaders, 'Cache-Control'))
+    if ('no-store' in cacheControl or 'private' in cacheControl
+            or 'no-cache' in cacheControl):
+        return False
+    vary = get_header(responseHeaders, 'Vary')
+    if vary:
+        allowed = {h.lower() for h in CACHE_KEY_HEADERS}
+        for header in vary.split(','):
+            if header.strip().lower() not in allowed:
+                return False
+    # Responses that cannot be revalidated are only worth caching if fresh
+    return (get_freshness_lifetime(responseHeaders) > 0
+            or len(get_validators(responseHeaders)) > 0)
+
+
+def encode_cache_meta(statusCode, responseHeaders, expireTime):
+    """Return the metadata to store, or None if it is too large"""
+    meta = json.dumps({
+        'statusCode': statusCode,
+        'headers': responseHeaders,
+        'expires': expireTime
+    }).encode('zlib').encode('base64').replace('\n', '')
+    if len(meta) > MAX_CACHE_META_SIZE:
+        return None
+    return meta
+
+
+def decode_cache_meta(meta):
+    """Return (statusCode, headers, expireTime)"""
+    decoded = json.loads(meta.decode('base64').decode('zlib'))
+    return decoded['statusCode'], decoded['headers'], decoded['expires']
@@ -0,0 +1,128 @@
+"""
+Note: this file will be copied to the Lambda too. Do not
+add dependencies carelessly.
+"""
+
+import json
+import select
+import struct
+
+from threading import Lock
+
+# Frame header: length of the JSON metadata, length of the binary data
+FRAME_HEADER = struct.Struct('!II')
+
+# Control messages exchanged on a worker channel
+DRAIN_CONTROL = 'drain'
+DRAINED_CONTROL = 'drained'
+
+# Path prefix used by workers to connect to the reverse connection server
+WORKER_CHANNEL_PATH = 'worker/'
+
+
+class ChannelMessage(object):
+    """Quacks like a boto3 SQS message"""
+
+    def __init__(self, messageId, body, messageAttributes, control=None):
+        self.message_id = messageId
+        self.body = body
+        self.message_attributes = messageAttributes if messageAttributes \
+            else None
+        self.control = control
+
+
+class MessageChannel(object):
+    """
+    Sends and receives SQS style messages over a persistent socket. Each
+    message is sent as a single frame, with binary attributes appended
+    after the JSON metadata to avoid base64 inflation.
+    """
+
+    def __init__(self, sock):
+        self.__sock = sock
+        self.__sendLock = Lock()
+        self.__bytesSent = 0
+        self.__bytesReceived = 0
+
+    @property
+    def bytesSent(self):
+        return self.__bytesSent
+
+    @property
+    def bytesReceived(self):
+        return self.__bytesReceived
+
+    def __recv_exactly(self, n):
+        chunks = []
+        remaining = n
+        while remaining > 0:
+            chunk = self.__sock.recv(min(remaining, 65536))
+            if chunk == b'':
+                if remaining == n:
+                    return None
+                raise IOError('Channel closed mid-frame')
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        self.__bytesReceived += n
+        return b''.join(chunks)
+
+    def __send_frame(self, meta, binaryValues):
+        encodedMeta = json.dumps(meta)
+        dataLen = sum(len(v) for v in binaryValues)
+        with self.__sendLock:
+            self.__sock.sendall(
+                FRAME_HEADER.pack(len(encodedMeta), dataLen) + encodedMeta)
+            for value in binaryValues:
+                self.__sock.sendall(value)
+            self.__bytesSent += FRAME_HEADER.size + len(encodedMeta) + dataLen
+
+    def send_message(self, MessageBody, MessageAttributes=None,
+                     MessageId=None):
+        attributes = {}
+        binaryNames = []
+        binaryValues = []
+        if MessageAttributes:
+            for name, attribute in MessageAttributes.iteritems():
+                if 'BinaryValue' in attribute:
+                    binaryNames.append([name, len(attribute['BinaryValue'])])
+                    binaryValues.append(attribute['BinaryValue'])
+                else:
+                    attributes[name] = attribute
+        self.__send_frame({
+            'id': MessageId,
+            'body': MessageBody,
+            'attrs': attributes,
+            'bin': binaryNames
+        }, binaryValues)
+        return {'MessageId': MessageId}
+
+    def send_control(self, control):
+        self.__send_frame({'ctl': control}, [])
+
+    def poll(self, timeout):
+        """Return True if a message is ready to be received"""
+        ins, _, _ = select.select([self.__sock], [], [], timeout)
+        return len(ins) > 0
+
+    def receive_message(self):
+        """Return the next message, or None if the channel was closed"""
+        header = self.__recv_exactly(FRAME_HEADER.size)
+        if header is None:
+            return None
+        metaLen, dataLen = FRAME_HEADER.unpack(header)
+        meta = json.loads(self.__recv_exactly(metaLen))
+        data = self.__recv_exactly(dataLen) if dataLen > 0 else b''
+
+        attributes = meta.get('attrs', {})
+        offset = 0
+        for name, length in meta.get('bin', []):
+            attributes[name] = {
+                'BinaryValue': data[offset:offset + length],
+                'DataType': 'Binary'
+            }
+            offset += length
+        return ChannelMessage(meta.get('id'), meta.get('body'), attributes,
+                              control=meta.get('ctl'))
+
+    def close(self):
+        self.__sock.close()
@@ -2,25 +2,233 @@
 Note: this file will be copied to the Lambda too. Do not
 add dependencies carelessly.
 """
+import hashlib
+import hmac
+import struct
+
 from Crypto.Cipher import AES
 
+from shared.profiling import hook
+
 
 PRIVATE_KEY_ENV_VAR = 'RSA_PRIVATE_KEY'
 
-# Since a new symmetric key is generated for each request, we can hard code
-# these nonces.
+# Labels of the parts of a request that are encrypted. Legacy clients that
+# generate a new symmetric key for each request use them as fixed nonces.
 REQUEST_META_NONCE = 'requestMeta'
 REQUEST_BODY_NONCE = 'requestBody'
 RESPONSE_META_NONCE = 'responseMeta'
 RESPONSE_BODY_NONCE = 'responseBody'
 
+# Session keys are reused, so each request sends a random nonce from which
+# a nonce is derived for each label
+REQUEST_NONCE_LENGTH = 16
+GCM_NONCE_LENGTH = 12
+
+# Framed bodies are split into chunks that are authenticated separately, so
+# they can be encrypted and decrypted incrementally. Each frame is a header
+# (ciphertext length, flags), the ciphertext, and the tag. The header is
+# authenticated, and the frame's index is part of its nonce, so frames
+# cannot be reordered, and the final flag detects truncation. Each body is
+# encrypted with its own key, derived from the request's nonce for the
+# label, so the frame indexes need not be unique across bodies.
+FRAME_KEY_INFO = 'frameKey'
+FRAME_HEADER = struct.Struct('!IB')
+FRAME_FINAL_FLAG = 0x1
+FRAME_TAG_LENGTH = 16
+FRAME_OVERHEAD = FRAME_HEADER.size + FRAME_TAG_LENGTH
+FRAME_CHUNK_SIZE = 64 * 1024
+
 
 def encrypt_with_gcm(key, cleartext, nonce):
-    cipher = AES.new(key, AES.MODE_GCM, nonce)
-    ciphertext, tag = cipher.encrypt_and_digest(cleartext)
+    with hook('crypto'):
+        cipher = AES.new(key, AES.MODE_GCM, nonce)
+        ciphertext, tag = cipher.encrypt_and_digest(cleartext)
     return ciphertext, tag
 
 
 def decrypt_with_gcm(key, ciphertext, tag, nonce):
-    cipher = AES.new(key, AES.MODE_GCM, nonce)
-    return cipher.decrypt_and_verify(ciphertext, tag)
+    with hook('crypto'):
+        cipher = AES.new(key, AES.MODE_GCM, nonce)
+        return cipher.decrypt_and_verify(ciphertext, tag)
+
+
+def derive_nonce(requestNonce, label):
+    return hashlib.sha256(requestNonce + label).digest()[:GCM_NONCE_LENGTH]
+
+
+def derive_frame_key(key, nonce):
+    """The key for the frames of the body with this nonce"""
+    return hmac.new(key, FRAME_KEY_INFO + nonce,
+                    hashlib.sha256).digest()[:len(key)]
+
+
+def _get_frame_nonce(index):
+    return struct.pack('!8xI', index)
+
+
+def _seal_frame(frameKey, index, cleartext, final):
+    header = FRAME_HEADER.pack(len(cleartext),
+                               FRAME_FINAL_FLAG if final else 0)
+    with hook('crypto'):
+        cipher = AES.new(frameKey, AES.MODE_GCM, _get_frame_nonce(index))
+        cipher.update(header)
+        ciphertext, tag = cipher.encrypt_and_digest(cleartext)
+    return header + ciphertext + tag
+
+
+def get_framed_length(framedLength):
+    """
+    Length of the cleartext in a framed body of the given length. Every
+    frame but the last holds FRAME_CHUNK_SIZE bytes, which ChunkedDecryptor
+    checks.
+    """
+    frameSize = FRAME_CHUNK_SIZE + FRAME_OVERHEAD
+    numFrames = max((framedLength + frameSize - 1) / frameSize, 1)
+    return framedLength - numFrames * FRAME_OVERHEAD
+
+
+def iter_encrypted_frames(frameKey, chunks, chunkSize=FRAME_CHUNK_SIZE):
+    """Encrypt an iterable of strings, yielding the frames"""
+    index = 0
+    pending = b''
+    for chunk in chunks:
+        if pending:
+            chunk = pending + chunk
+        offset = 0
+        # The last chunk is held back, since it may be the final one
+        while len(chunk) - offset > chunkSize:
+            yield _seal_frame(frameKey, index,
+                              chunk[offset:offset + chunkSize], False)
+            offset += chunkSize
+            index += 1
+        pending = chunk[offset:]
+    yield _seal_frame(frameKey, index, pending, True)
+
+
+class ChunkedDecryptor(object):
+    """
+    Decrypts a framed body as it arrives. Every frame but the final one must
+    hold frameLength bytes.
+    """
+
+    def __init__(self, frameKey, frameLength=FRAME_CHUNK_SIZE):
+        self.__frameKey = frameKey
+        self.__frameLength = frameLength
+        self.__buffer = b''
+        self.__index = 0
+        self.__done = False
+
+    @property
+    def done(self):
+        return self.__done
+
+    def __open_frame(self, data, offset):
+        length, flags = FRAME_HEADER.unpack_from(data, offset)
+        if length > self.__frameLength:
+            raise ValueError('Frame too large: %d' % length)
+        if length < self.__frameLength and not flags & FRAME_FINAL_FLAG:
+            raise ValueError('Frame too small: %d' % length)
+        end = offset + FRAME_HEADER.size + length + FRAME_TAG_LENGTH
+        if len(data) < end:
+            return None, offset
+        if self.__done:
+            raise ValueError('Data after the final frame')
+        with hook('crypto'):
+            cipher = AES.new(self.__frameKey, AES.MODE_GCM,
+                             _get_frame_nonce(self.__index))
+            cipher.update(data[offset:offset + FRAME_HEADER.size])
+            tagOffset = end - FRAME_TAG_LENGTH
+            cleartext = cipher.decrypt_and_verify(
+                data[offset + FRAME_HEADER.size:tagOffset],
+                data[tagOffset:end])
+        self.__index += 1
+        self.__done = (flags & FRAME_FINAL_FLAG) != 0
+        return cleartext, end
+
+    def update(self, data):
+        """Return the cleartext of the frames completed by the data"""
+        if self.__buffer:
+            data = self.__buffer + data
+        offset = 0
+        cleartexts = []
+        while len(data) - offset >= FRAME_HEADER.size:
+            cleartext, offset = self.__open_frame(data, offset)
+            if cleartext is None:
+                break
+            cleartexts.append(cleartext)
+        self.__buffer = data[offset:]
+        return b''.join(cleartexts)
+
+    def finish(self):
+        if not self.__done or self.__buffer:
+            raise ValueError('Framed body is truncated')
+
+
+def get_key_id(wrappedKey):
+    """Identifies a session key by its RSA encrypted form"""
+    return hashlib.sha256(wrappedKey).hexdigest()
+
+
+class RequestCipher(object):
+    """
+    Encrypts the parts of a single request. Without a requestNonce, the
+    labels are used as nonces, which is only safe if the key is not reused.
+    """
+
+    def __init__(self, key, requestNonce=None):
+        self.__key = key
+        self.__requestNonce = requestNonce
+        self.__nonces = {}
+
+    @property
+    def key(self):
+        return self.__key
+
+    @property
+    def requestNonce(self):
+        return self.__requestNonce
+
+    def nonce(self, label):
+        if self.__requestNonce is None:
+            return label
+        nonce = self.__nonces.get(label)
+        if nonce is None:
+            nonce = derive_nonce(self.__requestNonce, label)
+            self.__nonces[label] = nonce
+        return nonce
+
+    def encrypt(self, label, cleartext):
+        return encrypt_with_gcm(self.__key, cleartext, self.nonce(label))
+
+    def decrypt(self, label, ciphertext, tag):
+        return decrypt_with_gcm(self.__key, ciphertext, tag,
+                                self.nonce(label))
+
+    def __frame_key(self, label):
+        return derive_frame_key(self.__key, self.nonce(label))
+
+    def encrypt_frames(self, label, chunks):
+        """Return a generator of the frames of a body"""
+        return iter_encrypted_frames(self.__frame_key(label), chunks)
+
+    def encrypt_framed(self, label, cleartext):
+        return b''.join(self.encrypt_frames(label, [cleartext]))
+
+    def decryptor(self, label):
+        return ChunkedDecryptor(self.__frame_key(label))
+
+    def decrypt_frames(self, label, chunks):
+        """Return a generator of the cleartext of a framed body"""
+        decryptor = self.decryptor(label)
+        for chunk in chunks:
+            cleartext = decryptor.update(chunk)
+            if cleartext:
+                yield cleartext
+        decryptor.finish()
+
+    def decrypt_framed(self, label, framed):
+        decryptor = self.decryptor(label)
+        cleartext = decryptor.update(framed)
+        decryptor.finish()
+        return cleartext
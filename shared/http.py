@@ -0,0 +1,316 @@
+"""
+Note: this file will be copied to the Lambda too. Do not
+add dependencies carelessly.
+"""
+
+import socket
+
+DEFAULT_MAX_HEAD_SIZE = 64 * 1024
+MAX_CHUNK_LINE_SIZE = 4096
+
+INITIAL_BUFFER_SIZE = 16 * 1024
+RECV_SIZE = 64 * 1024
+
+HEAD_TERMINATOR = b'\r\n\r\n'
+LINE_TERMINATOR = b'\r\n'
+
+# States of a chunked body
+_CHUNK_SIZE = 0
+_CHUNK_DATA = 1
+_CHUNK_DATA_END = 2
+_CHUNK_TRAILERS = 3
+
+
+class HttpParseError(IOError):
+    pass
+
+
+class HttpHead(object):
+    """The start line and headers of a request or response"""
+
+    def __init__(self, startLine, headers, size):
+        self.startLine = startLine
+        self.headers = headers
+        self.size = size
+
+    def get_header(self, name, default=None):
+        """Case insensitive lookup. Repeated headers are joined."""
+        lowerName = name.lower()
+        values = [v for k, v in self.headers if k.lower() == lowerName]
+        if not values:
+            return default
+        return ', '.join(values)
+
+    @property
+    def contentLength(self):
+        value = self.get_header('Content-Length')
+        if value is None:
+            return None
+        try:
+            contentLength = int(value)
+        except ValueError:
+            raise HttpParseError('Bad Content-Length: %s' % value)
+        if contentLength < 0:
+            raise HttpParseError('Bad Content-Length: %s' % value)
+        return contentLength
+
+    @property
+    def isChunked(self):
+        value = self.get_header('Transfer-Encoding')
+        return value is not None and \
+            value.rsplit(',', 1)[-1].strip().lower() == 'chunked'
+
+    def parse_request_line(self):
+        """Return (method, path, httpVersion)"""
+        try:
+            method, path, httpVersion = self.startLine.split(' ', 2)
+        except ValueError:
+            raise HttpParseError('Bad request line: %s' % self.startLine)
+        return method, path, httpVersion
+
+    def parse_status_line(self):
+        """Return (httpVersion, statusCode, reason)"""
+        parts = self.startLine.split(' ', 2)
+        try:
+            return parts[0], int(parts[1]), parts[2] if len(parts) > 2 else ''
+        except (IndexError, ValueError):
+            raise HttpParseError('Bad status line: %s' % self.startLine)
+
+
+class HttpParser(object):
+    """
+    Parses consecutive HTTP/1.1 messages from a stream of bytes. Data is
+    received into a reusable buffer, and each byte is scanned once, so large
+    bodies and pipelined messages are parsed in linear time. Call parse_head
+    and then parse_body as data arrives; both return None until the next
+    part of the message is complete.
+    """
+
+    def __init__(self, maxHeadSize=DEFAULT_MAX_HEAD_SIZE):
+        self.__maxHeadSize = maxHeadSize
+        self.__buf = bytearray(INITIAL_BUFFER_SIZE)
+        self.__start = 0
+        self.__end = 0
+
+        # Bytes after start that are known not to end the head
+        self.__scanned = 0
+
+        # Body being parsed
+        self.__chunks = None
+        self.__chunkState = _CHUNK_SIZE
+        self.__chunkRemaining = 0
+
+    def __len__(self):
+        """Bytes received but not yet parsed"""
+        return self.__end - self.__start
+
+    def __reserve(self, size):
+        if self.__end + size <= len(self.__buf):
+            return
+        # Move the unparsed bytes to the front, then grow if needed
+        numBytes = self.__end - self.__start
+        if self.__start > 0:
+            self.__buf[:numBytes] = self.__buf[self.__start:self.__end]
+            self.__start = 0
+            self.__end = numBytes
+        if numBytes + size > len(self.__buf):
+            newSize = len(self.__buf)
+            while newSize < numBytes + size:
+                newSize *= 2
+            self.__buf.extend(bytearray(newSize - len(self.__buf)))
+
+    def feed(self, data):
+        self.__reserve(len(data))
+        self.__buf[self.__end:self.__end + len(data)] = data
+        self.__end += len(data)
+
+    def recv_from(self, sock, size=RECV_SIZE):
+        """Receive directly into the buffer. Returns the bytes received."""
+        self.__reserve(size)
+        view = memoryview(self.__buf)[self.__end:self.__end + size]
+        numBytes = sock.recv_into(view, size)
+        self.__end += numBytes
+        return numBytes
+
+    def take(self, size=None):
+        """Consume unparsed bytes, such as those after a CONNECT"""
+        if size is None:
+            size = len(self)
+        data = bytes(self.__buf[self.__start:self.__start + size])
+        self.__start += len(data)
+        self.__scanned = 0
+        return data
+
+    def __find(self, sub, start):
+        return self.__buf.find(sub, start, self.__end)
+
+    def parse_head(self):
+        """Return the next HttpHead, or None if it is not complete"""
+        scanFrom = max(self.__start,
+                       self.__start + self.__scanned - len(HEAD_TERMINATOR) + 1)
+        idx = self.__find(HEAD_TERMINATOR, scanFrom)
+        if idx < 0:
+            self.__scanned = len(self)
+            if self.__scanned > self.__maxHeadSize:
+                raise HttpParseError('Head exceeds %d bytes' %
+                                     self.__maxHeadSize)
+            return None
+
+        size = idx + len(HEAD_TERMINATOR) - self.__start
+        if size > self.__maxHeadSize:
+            raise HttpParseError('Head exceeds %d bytes' % self.__maxHeadSize)
+        lines = str(self.__buf[self.__start:idx]).split('\r\n')
+        self.__start += size
+        self.__scanned = 0
+
+        # Ignore empty lines before the start line
+        while lines and not lines[0]:
+            lines.pop(0)
+        if not lines:
+            raise HttpParseError('Empty head')
+
+        headers = []
+        for line in lines[1:]:
+            if line[:1] in (' ', '\t') and headers:
+                # Obsolete line folding
+                name, value = headers[-1]
+                headers[-1] = (name, value + ' ' + line.strip())
+                continue
+            name, sep, value = line.partition(':')
+            if not sep or not name or name != name.strip():
+                raise HttpParseError('Bad header: %s' % line)
+            headers.append((name, value.strip()))
+        return HttpHead(lines[0], headers, size)
+
+    def parse_body(self, contentLength=None, chunked=False):
+        """
+        Return the body once it is complete, or None. A chunked body is
+        decoded as it arrives, and parsing resumes on the next call.
+        """
+        if chunked:
+            return self.__parse_chunked()
+        if not contentLength:
+            return b''
+        if len(self) < contentLength:
+            return None
+        return self.take(contentLength)
+
+    def __take_line(self):
+        idx = self.__find(LINE_TERMINATOR, self.__start)
+        if idx < 0:
+            if len(self) > MAX_CHUNK_LINE_SIZE:
+                raise HttpParseError('Chunk line exceeds %d bytes' %
+                                     MAX_CHUNK_LINE_SIZE)
+            return None
+        line = str(self.__buf[self.__start:idx])
+        self.__start = idx + len(LINE_TERMINATOR)
+        return line
+
+    def __parse_chunked(self):
+        if self.__chunks is None:
+            self.__chunks = []
+            self.__chunkState = _CHUNK_SIZE
+        while True:
+            if self.__chunkState == _CHUNK_SIZE:
+                line = self.__take_line()
+                if line is None:
+                    return None
+                try:
+                    # Ignore chunk extensions
+                    self.__chunkRemaining = int(line.split(';', 1)[0], 16)
+                except ValueError:
+                    raise HttpParseError('Bad chunk size: %s' % line)
+                self.__chunkState = _CHUNK_TRAILERS \
+                    if self.__chunkRemaining == 0 else _CHUNK_DATA
+
+            elif self.__chunkState == _CHUNK_DATA:
+                if len(self) == 0:
+                    return None
+                numBytes = min(len(self), self.__chunkRemaining)
+                self.__chunks.append(self.take(numBytes))
+                self.__chunkRemaining -= numBytes
+                if self.__chunkRemaining == 0:
+                    self.__chunkState = _CHUNK_DATA_END
+
+            elif self.__chunkState == _CHUNK_DATA_END:
+                line = self.__take_line()
+                if line is None:
+                    return None
+                if line:
+                    raise HttpParseError('Missing CRLF after chunk')
+                self.__chunkState = _CHUNK_SIZE
+
+            else:
+                # Trailers are dropped, up to the empty line
+                line = self.__take_line()
+                if line is None:
+                    return None
+                if not line:
+                    body = b''.join(self.__chunks)
+                    self.__chunks = None
+                    return body
+
+
+def read_head(parser, sock):
+    """Return the next head, or None if the socket closed before it began"""
+    while True:
+        head = parser.parse_head()
+        if head is not None:
+            return head
+        if parser.recv_from(sock) == 0:
+            if len(parser) > 0:
+                raise HttpParseError('Connection closed in the head')
+            return None
+
+
+def read_body(parser, sock, head):
+    """Return the body that follows the head"""
+    contentLength = head.contentLength
+    chunked = head.isChunked
+    while True:
+        body = parser.parse_body(contentLength, chunked)
+        if body is not None:
+            return body
+        if parser.recv_from(sock) == 0:
+            raise HttpParseError('Connection closed in the body')
+
+
+def read_chunked_body(readline):
+    """Decode a chunked body from a buffered file's readline"""
+    parser = HttpParser()
+    while True:
+        body = parser.parse_body(chunked=True)
+        if body is not None:
+            return body
+        line = readline(RECV_SIZE)
+        if not line:
+            raise HttpParseError('Connection closed in the body')
+        parser.feed(line)
+
+
+def read_head_unbuffered(sock, maxHeadSize=DEFAULT_MAX_HEAD_SIZE):
+    """
+    Read a head without consuming any bytes after it, for sockets that are
+    handed off once the head is read.
+    """
+    parser = HttpParser(maxHeadSize)
+    while True:
+        peeked = sock.recv(RECV_SIZE, socket.MSG_PEEK)
+        if not peeked:
+            raise HttpParseError('Connection closed in the head')
+        numParsed = len(parser)
+        parser.feed(peeked)
+        head = parser.parse_head()
+        if head is not None:
+            # Consume exactly the rest of the head
+            _recv_exactly(sock, head.size - numParsed)
+            return head
+        _recv_exactly(sock, len(peeked))
+
+
+def _recv_exactly(sock, size):
+    while size > 0:
+        data = sock.recv(size)
+        if not data:
+            raise HttpParseError('Connection closed in the head')
+        size -= len(data)
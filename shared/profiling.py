@@ -0,0 +1,33 @@
+"""
+Note: this file will be copied to the Lambda too. Do not
+add dependencies carelessly.
+"""
+
+# Called with the name of each hook point that is entered, while a
+# profiler is running. It returns a context manager for the block.
+_listener = None
+
+
+class _NullHook(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+_NULL_HOOK = _NullHook()
+
+
+def set_hook_listener(listener):
+    global _listener
+    _listener = listener
+
+
+def hook(name):
+    """Mark a block as a named hot spot, for the profiler if one is running"""
+    listener = _listener
+    if listener is None:
+        return _NULL_HOOK
+    return listener(name)
@@ -5,10 +5,14 @@ add dependencies carelessly.
 
 import errno
 import select
+import socket
 
 from collections import namedtuple
 from requests import request
 
+from shared.profiling import hook
+from shared.timing import NULL_TIMER
+
 # These are content encodings that requests decodes automatically
 AUTO_DECODED_CONTENTS = {'gzip', 'deflate'}
 
@@ -19,6 +23,9 @@ MIN_COMPRESS_SIZE = 4096
 # overhead
 MAX_LAMBDA_BODY_SIZE = int(5.8 * 1024 * 1024) / 4 * 3
 
+# Size of the chunks read from the server when streaming a body
+STREAM_CHUNK_SIZE = 64 * 1024
+
 # Header types
 ACCEPT_ENCODING = 'Accept-Encoding'
 TRANSFER_ENCODING = 'Transfer-Encoding'
@@ -30,43 +37,81 @@ CONTENT_TYPE = 'Content-Type'
 ProxyResponse = namedtuple('ProxyResponse', ['statusCode', 'headers', 'content'])
 
 
-def proxy_single_request(method, url, headers, body, gzipResult=False):
-    """Proxy a single request using the requests library"""
+def open_single_request(method, url, headers, body):
+    """Make a request, leaving the response body unread"""
     kwargs = {
         'headers': headers,
         'allow_redirects': False,
+        'stream': True,
     }
     if body:
         kwargs['data'] = body
+    return request(method, url, **kwargs)
+
+
+def get_content_length(response):
+    """Length of the body as sent by the server, or None if unknown"""
+    try:
+        return int(response.headers[CONTENT_LENGTH])
+    except (KeyError, ValueError):
+        return None
+
+
+def get_streamed_response_headers(response):
+    """Headers for forwarding the body exactly as sent by the server"""
+    responseHeaders = {k: response.headers[k] for k in response.headers}
+    for header in responseHeaders.keys():
+        if TRANSFER_ENCODING.lower() == header.lower():
+            del responseHeaders[header]
+    return responseHeaders
+
+
+def iter_raw_content(response, chunkSize=STREAM_CHUNK_SIZE):
+    """Iterate over the body without decoding its content encoding"""
+    return response.raw.stream(chunkSize, decode_content=False)
 
-    with request(method, url, **kwargs) as response:
-        statusCode = response.status_code
-        responseHeaders = {k: response.headers[k] for k in response.headers}
+
+def proxy_single_request(method, url, headers, body, gzipResult=False,
+                         timer=NULL_TIMER):
+    """Proxy a single request using the requests library"""
+    with hook('proxy_single_request'):
+        with timer.phase('fetch'):
+            response = open_single_request(method, url, headers, body)
+        with response:
+            return read_proxy_response(response, gzipResult, timer)
+
+
+def read_proxy_response(response, gzipResult=False, timer=NULL_TIMER):
+    """Read the full body of a response opened with open_single_request"""
+    statusCode = response.status_code
+    responseHeaders = {k: response.headers[k] for k in response.headers}
+    with timer.phase('read'):
         responseBody = response.content
 
-        # TODO: this does not handle nested encoding
-        hasContentEncoding = False
-        for header in responseHeaders.keys():
-            if (TRANSFER_ENCODING.lower() == header.lower()
-                and responseHeaders[header] == 'chunked'):
-                del responseHeaders[header]
+    # TODO: this does not handle nested encoding
+    hasContentEncoding = False
+    for header in responseHeaders.keys():
+        if (TRANSFER_ENCODING.lower() == header.lower()
+            and responseHeaders[header] == 'chunked'):
+            del responseHeaders[header]
 
-            if (CONTENT_ENCODING.lower() == header.lower()):
-                if responseHeaders[header] in AUTO_DECODED_CONTENTS:
-                    del responseHeaders[header]
-                else:
-                    hasContentEncoding = True
-
-        if gzipResult and len(responseBody) > MIN_COMPRESS_SIZE:
-            if (ACCEPT_ENCODING in responseHeaders
-                and 'gzip' in responseHeaders[ACCEPT_ENCODING]
-                and not hasContentEncoding):
-                if (CONTENT_TYPE in responseHeaders
-                    and 'text' in responseHeaders[CONTENT_TYPE]):
+        if (CONTENT_ENCODING.lower() == header.lower()):
+            if responseHeaders[header] in AUTO_DECODED_CONTENTS:
+                del responseHeaders[header]
+            else:
+                hasContentEncoding = True
+
+    if gzipResult and len(responseBody) > MIN_COMPRESS_SIZE:
+        if (ACCEPT_ENCODING in responseHeaders
+            and 'gzip' in responseHeaders[ACCEPT_ENCODING]
+            and not hasContentEncoding):
+            if (CONTENT_TYPE in responseHeaders
+                and 'text' in responseHeaders[CONTENT_TYPE]):
+                with timer.phase('compress'):
                     responseBody = responseBody.encode('zlib')
-                    responseHeaders[CONTENT_ENCODING] = 'gzip'
+                responseHeaders[CONTENT_ENCODING] = 'gzip'
 
-        responseHeaders[CONTENT_LENGTH] = len(responseBody)
+    responseHeaders[CONTENT_LENGTH] = len(responseBody)
 
     return ProxyResponse(statusCode=statusCode,
                          headers=responseHeaders,
@@ -74,6 +119,11 @@ def proxy_single_request(method, url, headers, body, gzipResult=False):
 
 
 def proxy_sockets(sock1, sock2, idleTimeout):
+    with hook('proxy_sockets'):
+        return _proxy_sockets(sock1, sock2, idleTimeout)
+
+
+def _proxy_sockets(sock1, sock2, idleTimeout):
     bytes1 = 0
     bytes2 = 0
     error = None
@@ -83,29 +133,39 @@ def proxy_sockets(sock1, sock2, idleTimeout):
     idleSecs = 0.0
 
     try:
-        while True:
+        # Until both sides have finished sending
+        while rlist:
             idleSecs += waitSecs
             (ins, _, exs) = select.select(rlist, wlist, rlist, waitSecs)
             if exs: break
-            if ins:
-                for i in ins:
-                    out = sock1 if i is sock2 else sock2
-                    data = i.recv(8192)
-                    if data:
-                        try:
-                            out.send(data)
-                            if out is sock1:
-                                bytes1 += len(data)
-                            else:
-                                bytes2 += len(data)
-                        except IOError as e:
-                            if e.errno == errno.EPIPE:
-                                break
-                            else:
-                                error = e
-                                break
-                    idleSecs = 0.0
+            for i in ins:
+                out = sock1 if i is sock2 else sock2
+                data = i.recv(8192)
+                if not data:
+                    # Pass the half-close on, and keep relaying the other way
+                    rlist.remove(i)
+                    _shutdown_write(out)
+                    continue
+                try:
+                    out.sendall(data)
+                    if out is sock1:
+                        bytes1 += len(data)
+                    else:
+                        bytes2 += len(data)
+                except IOError as e:
+                    if e.errno != errno.EPIPE:
+                        error = e
+                    return error, bytes1, bytes2
+                idleSecs = 0.0
             if idleSecs >= idleTimeout: break
     except Exception as e:
         error = e
     return error, bytes1, bytes2
+
+
+def _shutdown_write(sock):
+    try:
+        sock.shutdown(socket.SHUT_WR)
+    except socket.error:
+        # Already closed by the peer
+        pass
@@ -0,0 +1,85 @@
+"""
+Note: this file will be copied to the Lambda too. Do not
+add dependencies carelessly.
+"""
+
+import time
+
+# Key of the phase timings in a lambda's response metadata
+TIMING_KEY = 'timing'
+
+# Set until the first request in a container is timed
+_coldStart = True
+
+
+def take_cold_start():
+    """Return True the first time it is called in the container"""
+    global _coldStart
+    coldStart, _coldStart = _coldStart, False
+    return coldStart
+
+
+class _Phase(object):
+
+    def __init__(self, timer, name):
+        self.__timer = timer
+        self.__name = name
+
+    def __enter__(self):
+        self.__startTime = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.__timer.record(self.__name, self.__startTime, time.time())
+
+
+class PhaseTimer(object):
+    """
+    Times the phases of handling a request, relative to when it started, so
+    the client can place them within its own timeline.
+    """
+
+    def __init__(self):
+        self.__startTime = time.time()
+        self.__coldStart = take_cold_start()
+        self.__phases = []
+
+    def phase(self, name):
+        return _Phase(self, name)
+
+    def record(self, name, startTime, endTime):
+        self.__phases.append([name,
+                              int((startTime - self.__startTime) * 1000000),
+                              int((endTime - startTime) * 1000000)])
+
+    def to_dict(self):
+        """Offsets and durations are in microseconds"""
+        return {
+            'phases': self.__phases,
+            'total': int((time.time() - self.__startTime) * 1000000),
+            'coldStart': self.__coldStart
+        }
+
+
+class _NullPhase(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+class _NullTimer(object):
+
+    __phase = _NullPhase()
+
+    def phase(self, name):
+        return self.__phase
+
+    def record(self, name, startTime, endTime):
+        pass
+
+
+# For callers that do not time their phases
+NULL_TIMER = _NullTimer()
@@ -0,0 +1,37 @@
+"""
+Note: this file will be copied to the Lambda too. Do not
+add dependencies carelessly.
+"""
+
+# Ways to return a body that may not fit in a Lambda or SQS response
+INLINE_TRANSPORT = 'inline'
+FRAGMENTS_TRANSPORT = 'fragments'
+MESSAGE_TRANSPORT = 'message'
+S3_TRANSPORT = 's3'
+
+
+def estimate_transfer_time(size, estimate):
+    """Seconds to transfer size bytes given a latency/throughput estimate"""
+    return estimate['latency'] + float(size) / estimate['throughput']
+
+
+def choose_transport(size, candidates, estimates=None):
+    """
+    Return the candidate with the lowest estimated transfer time. Without
+    estimates for any candidate, the first one is chosen.
+    """
+    if not candidates:
+        return None
+    bestTransport = None
+    bestTime = None
+    if estimates:
+        for transport in candidates:
+            if transport not in estimates:
+                continue
+            transferTime = estimate_transfer_time(size, estimates[transport])
+            if bestTime is None or transferTime < bestTime:
+                bestTransport = transport
+                bestTime = transferTime
+    if bestTransport is None:
+        bestTransport = candidates[0]
+    return bestTransport
@@ -1,19 +1,55 @@
 #!/usr/bin/env python
 
+import gzip
 import json
 import unittest
 import os
 import random
+import socket
+import shutil
+import subprocess
 import sys
+import tempfile
+import time
 
 from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from StringIO import StringIO
 from threading import Thread
 
-from lib.stats import Stats, ProxyStatsModel
+from concurrent.futures import ThreadPoolExecutor
+
+from lib.aws import deferred_resource, set_backend
+from lib.capture import TrafficRecorder, read_traffic_trace, record_requests
+from lib.certs import get_cert_name, is_valid_cert_name
+from lib.crawler import Crawler, CrawlCheckpoint, CrawlRecordWriter, \
+    CrawlTask
+from lib.headers import filter_request_headers
+from lib.loadgen import LoadRequest, OpenLoopLoad, RequestMix
+from lib.local_aws import LocalAwsBackend
+from lib.metrics import format_prometheus, get_snapshot
+from lib.profiler import SamplingProfiler
+from lib.proxy import AbstractRequestProxy, ProxyResponse
+from lib.proxies.aws_short import ShortLivedLambdaProxy
+from lib.replay import ReplayOrigin, get_replay_schedule
+from lib.s3 import RangedS3Content
+from lib.servers.messages import MessageStore
+from lib.servers.reverse import MessageStream
+from lib.stats import Stats, CrawlStatsModel, LatencyHistogram, \
+    ProxyStatsModel, ShardedCounter, SqsStatsModel, TransferCounter
+from lib.trace import Tracer, span
+from lib.transport import TransportSelector
 
 import shared.crypto as crypto
 import shared.proxy as proxy
 
+from shared.cache import get_cache_key, get_freshness_lifetime, \
+    is_cacheable_response
+from shared.channel import MessageChannel
+from shared.http import HttpParser, HttpParseError
+from shared.profiling import hook
+from shared.transport import choose_transport
+from shared.workers import LambdaSqsResult
+
 from main import DEFAULT_MAX_LAMBDAS, DEFAULT_PORT, build_local_proxy, \
     build_lambda_proxy, build_handler
 from gen_rsa_kp import generate_key_pair
@@ -40,6 +76,36 @@ class TestCrypto(unittest.TestCase):
         decrypted = crypto.decrypt_with_gcm(key, ciphertext, tag, nonce)
         self.assertEqual(cleartext, decrypted)
 
+    def test_request_cipher_nonces(self):
+        key = 'a' * 16
+        cipher = crypto.RequestCipher(key, 'r' * 16)
+        otherCipher = crypto.RequestCipher(key, 's' * 16)
+        ciphertext, tag = cipher.encrypt(crypto.REQUEST_BODY_NONCE, 'Hello')
+        self.assertEqual(
+            cipher.decrypt(crypto.REQUEST_BODY_NONCE, ciphertext, tag),
+            'Hello')
+        self.assertNotEqual(
+            ciphertext,
+            otherCipher.encrypt(crypto.REQUEST_BODY_NONCE, 'Hello')[0])
+        self.assertRaises(ValueError, cipher.decrypt,
+                          crypto.RESPONSE_BODY_NONCE, ciphertext, tag)
+
+    def test_framed_encrypt_decrypt(self):
+        cipher = crypto.RequestCipher('a' * 16, 'r' * 16)
+        cleartext = os.urandom(crypto.FRAME_CHUNK_SIZE * 2 + 100)
+        framed = cipher.encrypt_framed(crypto.RESPONSE_BODY_NONCE, cleartext)
+        self.assertEqual(crypto.get_framed_length(len(framed)),
+                         len(cleartext))
+
+        chunks = [framed[i:i + 1000] for i in xrange(0, len(framed), 1000)]
+        self.assertEqual(''.join(cipher.decrypt_frames(
+            crypto.RESPONSE_BODY_NONCE, chunks)), cleartext)
+
+        # Dropping the final frame must be detected
+        frameSize = crypto.FRAME_CHUNK_SIZE + crypto.FRAME_OVERHEAD
+        self.assertRaises(ValueError, cipher.decrypt_framed,
+                          crypto.RESPONSE_BODY_NONCE, framed[:frameSize * 2])
+
 
 def _start_test_server(port, numRequests):
 
@@ -113,6 +179,541 @@ class TestProxy(unittest.TestCase):
         self.assertEqual(response.content,
                          TestProxy.EXPECTED_RESPONSE_BODY)
 
+    def test_proxy_sockets(self):
+        cliSock, proxyCliSock = socket.socketpair()
+        servSock, proxyServSock = socket.socketpair()
+        results = []
+        t = Thread(target=lambda: results.append(proxy.proxy_sockets(
+            proxyCliSock, proxyServSock, idleTimeout=30)))
+        t.daemon = True
+        t.start()
+        def recv_all(sock):
+            sock.settimeout(5)
+            received = b''
+            while True:
+                data = sock.recv(65536)
+                if not data:
+                    return received
+                received += data
+
+        try:
+            data = os.urandom(100000)
+            cliSock.sendall(data)
+            cliSock.shutdown(socket.SHUT_WR)
+            self.assertEqual(recv_all(servSock), data)
+
+            # The other direction still flows after a half-close
+            reply = os.urandom(100000)
+            servSock.sendall(reply)
+            servSock.close()
+            self.assertEqual(recv_all(cliSock), reply)
+
+            # Returns once both sides are done, well before the idle timeout
+            t.join(5)
+            self.assertFalse(t.is_alive())
+            err, bytes1, bytes2 = results[0]
+            self.assertIsNone(err)
+            self.assertEqual((bytes1, bytes2), (len(reply), len(data)))
+        finally:
+            for sock in (cliSock, servSock, proxyCliSock, proxyServSock):
+                sock.close()
+
+    def test_filter_request_headers(self):
+        headers = filter_request_headers([
+            ('host', 'example.com'), ('proxy-connection', 'keep-alive'),
+            ('Connection', 'close'), ('transfer-encoding', 'chunked'),
+            ('accept', 'text/html'), ('accept', '*/*')], chunked=True)
+        self.assertEqual(headers, {'host': 'example.com',
+                                   'accept': 'text/html, */*'})
+
+
+class TestMessageChannel(unittest.TestCase):
+
+    def test_send_receive(self):
+        sock1, sock2 = socket.socketpair()
+        sender, receiver = MessageChannel(sock1), MessageChannel(sock2)
+        try:
+            result = LambdaSqsResult(taskId='task')
+            result.add_binary_attribute('data', b'\x00\xff' * 1000)
+            result.set_body('body')
+            sender.send_message(MessageBody=result.body,
+                                MessageAttributes=result.messageAttributes,
+                                MessageId='id')
+            sender.send_control('ctl')
+
+            message = receiver.receive_message()
+            self.assertEqual(message.message_id, 'id')
+            received = LambdaSqsResult.from_message(message)
+            self.assertEqual(received.taskId, 'task')
+            self.assertEqual(received.body, 'body')
+            self.assertEqual(received.get_binary_attribute('data'),
+                             b'\x00\xff' * 1000)
+            self.assertEqual(receiver.receive_message().control, 'ctl')
+
+            sender.close()
+            self.assertIsNone(receiver.receive_message())
+        finally:
+            receiver.close()
+
+
+class TestMessageStore(unittest.TestCase):
+
+    def test_spill_and_expire(self):
+        store = MessageStore(messageTimeout=5, maxMemoryBytes=60,
+                             spillThreshold=50)
+        store.put('small', 'a' * 40)
+        store.receive('big', StringIO('b' * 60), 60)
+        store.put('overBudget', 'c' * 40, timeout=10)
+        store.put('inMemory', 'd' * 10)
+        self.assertEqual(store.memoryBytes, 50)
+        self.assertEqual(store.spilledBytes, 100)
+
+        message = store.get('big')
+        self.assertTrue(message.isSpilled)
+        self.assertEqual(''.join(message.open_content()), 'b' * 60)
+        self.assertIsNone(store.get('big'))
+        message.close()
+        self.assertRaises((TypeError, ValueError), str, message.content)
+
+        now = message.receiveTime
+        self.assertEqual(store.expire(now + 6), 2)
+        self.assertIsNone(store.get('small'))
+        self.assertEqual(str(store.get('overBudget').content), 'c' * 40)
+        self.assertEqual(store.memoryBytes, 0)
+        self.assertEqual(store.spilledBytes, 0)
+
+    def test_stream_write_timeout(self):
+        stream = MessageStream({}, maxBufferSize=10, writeTimeout=0.1)
+        stream.write('a' * 10)
+        # Nothing reads the stream, so the next write gives up
+        self.assertRaises(IOError, stream.write, 'b')
+        stream.finish(error='aborted')
+        self.assertRaises(IOError, stream.read)
+
+
+class TestHttpParser(unittest.TestCase):
+
+    def test_pipelined_and_chunked(self):
+        data = ('GET /a HTTP/1.1\r\nHost: x\r\nX-Folded: a\r\n b\r\n\r\n'
+                'POST /b HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n'
+                '3;ext=1\r\nabc\r\n2\r\nde\r\n0\r\nTrailer: y\r\n\r\n'
+                'PUT /c HTTP/1.1\r\nContent-Length: 4\r\n\r\nwxyz')
+        parser = HttpParser()
+        results = []
+        # Feed a byte at a time to exercise resuming
+        for i in xrange(len(data)):
+            parser.feed(data[i])
+            if len(results) % 2 == 0:
+                head = parser.parse_head()
+                if head is not None:
+                    results.append(head)
+            if len(results) % 2 == 1:
+                body = parser.parse_body(head.contentLength, head.isChunked)
+                if body is not None:
+                    results.append(body)
+        self.assertEqual(len(results), 6)
+        self.assertEqual(results[0].parse_request_line(),
+                         ('GET', '/a', 'HTTP/1.1'))
+        self.assertEqual(results[0].get_header('x-folded'), 'a b')
+        self.assertEqual(results[1], '')
+        self.assertEqual(results[3], 'abcde')
+        self.assertEqual(results[5], 'wxyz')
+        self.assertEqual(len(parser), 0)
+
+        parser = HttpParser(maxHeadSize=32)
+        parser.feed('GET / HTTP/1.1\r\n' + 'X' * 64)
+        self.assertRaises(HttpParseError, parser.parse_head)
+
+
+class TestCrawler(unittest.TestCase):
+
+    class FlakyProxy(AbstractRequestProxy):
+
+        def __init__(self):
+            self.attempts = {}
+
+        def request(self, method, url, headers, body):
+            self.attempts[url] = self.attempts.get(url, 0) + 1
+            if url.endswith('/flaky') and self.attempts[url] == 1:
+                return proxy.ProxyResponse(503, {}, '')
+            return proxy.ProxyResponse(200, {}, 'body of ' + url)
+
+    def test_crawl_and_resume(self):
+        tmpDir = tempfile.mkdtemp()
+        try:
+            outputFile = os.path.join(tmpDir, 'out.warc.gz')
+            checkpointFile = outputFile + '.checkpoint'
+            urls = ['http://a.com/1', 'http://a.com/flaky', 'http://b.com/2']
+            tasks = [CrawlTask(i, url, 'GET', {}, None, 0)
+                     for i, url in enumerate(urls)]
+
+            for expectedResponses in (3, 0):
+                stats = Stats()
+                stats.register_model('crawl', CrawlStatsModel())
+                requestProxy = TestCrawler.FlakyProxy()
+                checkpoint = CrawlCheckpoint(checkpointFile)
+                writer = CrawlRecordWriter(outputFile)
+                Crawler(requestProxy, writer, checkpoint, stats,
+                        maxConcurrency=4, retryBackoff=0.01,
+                        obeyRobots=False).run(tasks)
+                writer.close()
+                checkpoint.close()
+                crawlStats = stats.get_model('crawl')
+                self.assertEqual(crawlStats.totalResponses, expectedResponses)
+
+            self.assertEqual(crawlStats.totalResumed, 3)
+            with open(outputFile, 'rb') as ifs:
+                records = gzip.GzipFile(fileobj=ifs).read()
+            self.assertEqual(records.count('WARC/1.0'), 3)
+            self.assertIn('body of http://a.com/flaky', records)
+        finally:
+            shutil.rmtree(tmpDir)
+
+
+class TestStats(unittest.TestCase):
+
+    def test_estimate_message_size(self):
+        result = LambdaSqsResult(taskId='task', fragmentId=0, numFragments=1)
+        result.add_binary_attribute('data', b'\xff' * 100)
+        result.set_body('{}')
+        size = SqsStatsModel.estimate_message_size(
+            messageAttributes=result.messageAttributes,
+            messageBody=result.body)
+        # The body, then the name, type and value of each attribute
+        self.assertEqual(size, 2 + (4 + 6 + 100) + (7 + 6 + 4) +
+                         (7 + 6 + 1) + (7 + 6 + 1))
+
+    def test_counters_and_histograms(self):
+        counter = ShardedCounter()
+        histogram = LatencyHistogram()
+
+        def record(offset):
+            for i in xrange(1000):
+                counter.add()
+                histogram.record((offset + i) / 1000.0)
+
+        threads = [Thread(target=record, args=(1000 * i,)) for i in xrange(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        counter.add(5)
+        self.assertEqual(counter.value, 10005)
+
+        # Recorded 0s through 9.999s, once per millisecond
+        snapshot = histogram.snapshot()
+        self.assertEqual(snapshot.count, 10000)
+        for p, expected in [(50, 5000), (90, 9000), (99, 9900),
+                            (99.9, 9990)]:
+            self.assertAlmostEqual(snapshot.percentile(p), expected,
+                                   delta=expected * 0.02)
+        self.assertAlmostEqual(snapshot.mean, 4999.5, delta=1)
+
+    def test_metrics_export(self):
+        stats = Stats()
+        stats.register_model('proxy', ProxyStatsModel())
+        stats.register_gauge('queue_depth', lambda: 3, 'Tasks queued')
+        proxyModel = stats.get_model('proxy')
+        with proxyModel.record_delay():
+            pass
+        with self.assertRaises(ValueError):
+            with proxyModel.record_delay():
+                raise ValueError()
+        proxyModel.record_bytes_down(100)
+
+        lines = format_prometheus(stats).splitlines()
+        self.assertIn('pod_proxy_requests_total 1', lines)
+        self.assertIn('pod_bytes_total{model="proxy",direction="down"} 100',
+                      lines)
+        self.assertIn('pod_latency_seconds_count{model="proxy",name="delay"} 1',
+                      lines)
+        self.assertIn('# TYPE pod_queue_depth gauge', lines)
+        self.assertIn('pod_queue_depth 3', lines)
+
+        snapshot = json.loads(json.dumps(get_snapshot(stats)))
+        self.assertEqual(snapshot['gauges']['queue_depth'], 3)
+        latency = snapshot['models']['proxy']['latencies']['delay']
+        self.assertEqual(latency['count'], 1)
+
+    def test_trace(self):
+        tracer = Tracer(capacity=10)
+        with span('untraced'):
+            pass
+        with tracer.trace('GET', url='http://example.com/') as trace:
+            with span('invoke'):
+                pass
+            trace.add_lambda_timing(
+                {'timing': {'phases': [['fetch', 1000, 2000]],
+                            'total': 4000, 'coldStart': True}},
+                100.0, 100.01)
+
+        events = [e for e in tracer.to_chrome_trace()['traceEvents']
+                  if e['ph'] == 'X']
+        self.assertEqual(sorted(e['name'] for e in events),
+                         ['GET', 'fetch', 'handler (cold)', 'invoke'])
+        self.assertEqual(len(set(e['args']['traceId'] for e in events)), 1)
+        handler = [e for e in events if e['name'] == 'handler (cold)'][0]
+        self.assertEqual(handler['ts'], 100003000)
+        self.assertEqual(handler['dur'], 4000)
+        self.assertEqual(tracer.get_spans(0, 50), [])
+
+    def test_profiler(self):
+        def spin():
+            endTime = time.time() + 0.2
+            while time.time() < endTime:
+                pass
+
+        profiler = SamplingProfiler(interval=0.001)
+        profiler.start()
+        with hook('spin'):
+            spin()
+        profiler.stop()
+        # Hooks are free when the profiler is not running
+        with hook('spin'):
+            pass
+
+        self.assertGreater(profiler.numSamples, 0)
+        stacks = profiler.get_collapsed().splitlines()
+        self.assertTrue(any(
+            '[spin];%s:spin ' % __name__ in stack for stack in stacks),
+            stacks)
+        summary = profiler.get_hook_summary()
+        self.assertEqual(len(summary), 1)
+        self.assertIn('1 calls', summary[0])
+
+
+class TestLoadGen(unittest.TestCase):
+
+    def test_request_mix(self):
+        loadRequests = [
+            LoadRequest(url=url, method='GET', headers={}, body=None,
+                        weight=weight)
+            for url, weight in [('http://a/', 3), ('http://b/', 1)]
+        ]
+        mix = RequestMix(loadRequests, seed=0)
+        numA = sum(1 for _ in xrange(4000) if mix.next().url == 'http://a/')
+        self.assertAlmostEqual(numA / 4000.0, 0.75, delta=0.03)
+
+    def test_open_loop(self):
+        port = random.randint(9000, 10000)
+        _start_test_server(port, 20)
+        request = LoadRequest(url='http://localhost:%d/' % port,
+                              method='GET', headers={'A': '1'}, body=None,
+                              weight=1)
+        load = OpenLoopLoad(RequestMix([request]), maxConnections=4,
+                            uniform=True)
+        result = load.run(100, numRequests=20)
+        self.assertEqual(result.numSent, 20)
+        self.assertEqual(result.numErrors, 0)
+        self.assertEqual(result.statusCounts[200], 20)
+        # Sent at the rate, not as fast as the server responds
+        self.assertGreaterEqual(result.seconds, 0.19)
+        self.assertEqual(result.to_dict()['latency']['count'], 20)
+
+    def test_record_and_replay(self):
+
+        class FakeProxy(AbstractRequestProxy):
+            def request(self, method, url, headers, body):
+                if url.endswith('/missing'):
+                    return ProxyResponse(404, {'Server': 'x'}, 'not found')
+                return ProxyResponse(200, {'Content-Type': 'image/png',
+                                           'Set-Cookie': 'a=b'}, 'x' * 5000)
+
+        tmpDir = tempfile.mkdtemp()
+        try:
+            traceFile = os.path.join(tmpDir, 'trace.jsonl')
+            recorder = TrafficRecorder(traceFile)
+            proxy = record_requests(FakeProxy(), recorder)
+            proxy.request('GET', 'http://a/img.png', {'Cookie': 'c=d'}, None)
+            proxy.request('POST', 'http://a/missing', {}, 'body')
+            recorder.close()
+            entries = read_traffic_trace(traceFile)
+        finally:
+            shutil.rmtree(tmpDir)
+        self.assertEqual([x['method'] for x in entries], ['GET', 'POST'])
+        self.assertEqual(entries[0]['requestHeaders'], {'Cookie': 'xxx'})
+        self.assertEqual(entries[0]['responseBytes'], 5000)
+        self.assertEqual(entries[1]['requestBytes'], 4)
+
+        origin = ReplayOrigin(entries)
+        try:
+            load = OpenLoopLoad(None)
+            result = load.run_schedule(
+                get_replay_schedule(entries, origin.url, speed=0))
+        finally:
+            origin.shutdown()
+        self.assertEqual(result.numErrors, 0)
+        self.assertEqual(result.statusCounts, {200: 1, 404: 1})
+        self.assertEqual(result.bytesReceived, 5000 + 9)
+
+
+class TestLocalAws(unittest.TestCase):
+
+    def test_sqs(self):
+        backend = LocalAwsBackend()
+        sqs = backend.resource('sqs')
+        queue = sqs.create_queue(QueueName='tasks',
+                                 Attributes={'VisibilityTimeout': '0.1'})
+        queue.send_message(MessageBody='ping', MessageAttributes={
+            'A': {'StringValue': '1', 'DataType': 'String'}})
+
+        messages = queue.receive_messages(MessageAttributeNames=['All'],
+                                          MaxNumberOfMessages=10)
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0].body, 'ping')
+        self.assertEqual(messages[0].message_attributes['A']['StringValue'],
+                         '1')
+        self.assertEqual(queue.receive_messages(WaitTimeSeconds=0), [])
+
+        # Messages that are not deleted become visible again
+        redelivered = queue.receive_messages(WaitTimeSeconds=1)
+        self.assertEqual(redelivered[0].message_id, messages[0].message_id)
+        result = queue.delete_messages(Entries=[
+            {'Id': m.message_id, 'ReceiptHandle': m.receipt_handle}
+            for m in messages + redelivered])
+        self.assertEqual(len(result['Successful']), 1)
+        self.assertEqual(len(result['Failed']), 1)
+
+        # Long polls return as soon as a message arrives
+        Thread(target=lambda: (time.sleep(0.1),
+                               queue.send_message(MessageBody='pong'))).start()
+        startTime = time.time()
+        self.assertEqual(len(queue.receive_messages(WaitTimeSeconds=5)), 1)
+        self.assertLess(time.time() - startTime, 1)
+        backend.shutdown()
+
+    def test_deferred_client(self):
+        backend = LocalAwsBackend()
+        set_backend(backend)
+        try:
+            sqs = deferred_resource('sqs')
+            queue = sqs.create_queue(QueueName='tasks', Attributes={})
+            queue.send_message(MessageBody='ping')
+            self.assertEqual(queue.receive_messages()[0].body, 'ping')
+            # Errors from making the client are raised when it is used
+            self.assertRaises(NotImplementedError,
+                              deferred_resource('unknown').get)
+        finally:
+            set_backend(None)
+            backend.shutdown()
+
+    def test_short_lived_proxy(self):
+        port = random.randint(9000, 10000)
+        url = 'http://localhost:%d/' % port
+        _start_test_server(port, 2)
+
+        backend = LocalAwsBackend()
+        function = backend.add_function('proxy', concurrency=1)
+        set_backend(backend)
+        try:
+            stats = Stats()
+            proxy = ShortLivedLambdaProxy(
+                functions=['proxy'], maxParallelRequests=2,
+                s3Bucket='bucket', pubKeyFile=None, messageServer=None,
+                stats=stats)
+            for _ in xrange(2):
+                response = proxy.request(
+                    'GET', url, TestProxy.EXPECTED_REQUEST_HEADERS, None)
+                self.assertEqual(response.statusCode, 200)
+                self.assertEqual(response.content,
+                                 TestProxy.EXPECTED_RESPONSE_BODY)
+            # The second request ran in the warm container
+            self.assertEqual(function.numColdStarts, 1)
+            self.assertGreater(stats.get_model('lambda').cost, 0)
+        finally:
+            set_backend(None)
+            backend.shutdown()
+
+
+class TestTransportSelector(unittest.TestCase):
+
+    def test_choose_transport(self):
+        counter = TransferCounter()
+        selector = TransportSelector(refreshInterval=0, smoothing=1.0)
+        selector.register('s3', counter, latency=0.2, throughput=10)
+        selector.register('message', latency=0.05, throughput=10)
+
+        # Without estimates, the first candidate is chosen
+        self.assertEqual(choose_transport(100, ['s3', 'message']), 's3')
+        self.assertEqual(
+            choose_transport(100, ['s3', 'message'], selector.estimates()),
+            'message')
+
+        with counter.record() as transfer:
+            time.sleep(0.01)
+            transfer.first_byte()
+            transfer.size = 10 ** 9
+            # Time spent waiting for the reader is not counted
+            time.sleep(0.01)
+            transfer.adjust(-0.01)
+        estimates = selector.estimates()
+        self.assertGreater(estimates['s3']['throughput'], 10)
+        self.assertAlmostEqual(estimates['s3']['latency'], 0.01, delta=0.009)
+        self.assertEqual(
+            choose_transport(10 ** 6, ['s3', 'message'], estimates), 's3')
+        self.assertEqual(choose_transport(100, [], estimates), None)
+
+    def test_unclosed_s3_content(self):
+        counter = TransferCounter()
+        transfer = counter.record()
+        transfer.start()
+        closed = []
+        pool = ThreadPoolExecutor(2)
+        content = RangedS3Content(lambda start, end: 'b' * (end - start + 1),
+                                  'a' * 10, 30, 10, 2, pool, transfer,
+                                  lambda: closed.append(True))
+        self.assertEqual(''.join(content), 'a' * 10 + 'b' * 20)
+        self.assertEqual(counter.inFlight, 1)
+        # Dropped without being closed, as when the client went away
+        del content
+        self.assertEqual(counter.inFlight, 0)
+        self.assertEqual(closed, [True])
+        pool.shutdown()
+
+
+class TestCache(unittest.TestCase):
+
+    def test_cache_key_and_freshness(self):
+        headers = {'accept-encoding': 'gzip'}
+        self.assertEqual(get_cache_key('HTTP://Example.com:80/a?y=2&x=1',
+                                       headers),
+                         get_cache_key('http://example.com/a?x=1&y=2',
+                                       {'Accept-Encoding': 'gzip'}))
+        self.assertNotEqual(get_cache_key('http://example.com/a', headers),
+                            get_cache_key('http://example.com/a', {}))
+
+        self.assertEqual(get_freshness_lifetime(
+            {'Cache-Control': 'public, max-age=60, s-maxage=600'}), 600)
+        self.assertEqual(get_freshness_lifetime({
+            'Date': 'Mon, 01 Jan 2018 00:00:00 GMT',
+            'Expires': 'Mon, 01 Jan 2018 00:01:00 GMT'}), 60)
+        self.assertTrue(is_cacheable_response(200, {'ETag': '"abc"'}))
+        self.assertFalse(is_cacheable_response(
+            200, {'Cache-Control': 'private, max-age=60'}))
+        self.assertFalse(is_cacheable_response(
+            200, {'Cache-Control': 'max-age=60', 'Vary': 'Cookie'}))
+        self.assertFalse(is_cacheable_response(404, {'ETag': '"abc"'}))
+
+
+class TestCertificates(unittest.TestCase):
+
+    def test_cert_names(self):
+        self.assertEqual(get_cert_name('www.example.com'), 'www.example.com')
+        self.assertEqual(get_cert_name('www.example.com', wildcard=True),
+                         '*.example.com')
+        self.assertEqual(get_cert_name('www.bbc.co.uk', wildcard=True),
+                         '*.bbc.co.uk')
+        self.assertEqual(get_cert_name('example.com', wildcard=True),
+                         'example.com')
+        self.assertEqual(get_cert_name('a.b.example.com', wildcard=True),
+                         'a.b.example.com')
+        self.assertEqual(get_cert_name('10.0.0.1', wildcard=True),
+                         '10.0.0.1')
+        for name in ('www.example.com', '*.example.com', '10.0.0.1', '::1'):
+            self.assertTrue(is_valid_cert_name(name))
+        for name in ('../etc', 'a/b.com', '..', 'a..b.com', ''):
+            self.assertFalse(is_valid_cert_name(name))
+
 
 class TestRsaKeygen(unittest.TestCase):
 
@@ -139,9 +740,13 @@ class TestBuildProxy(unittest.TestCase):
         args.enableEncryption = False
         args.lambdaType = 'short'
         args.s3Bucket = None
+        args.s3Cache = False
         args.publicServerHostAndPort = None
         args.maxLambdas = DEFAULT_MAX_LAMBDAS
         args.enableMitm = False
+        args.mitmCertDir = None
+        args.mitmWildcardCerts = False
+        args.mitmHttp2 = False
         args.disableStats = False
         args.verbose = False
         return args, stats, None
@@ -172,6 +777,15 @@ class TestBuildProxy(unittest.TestCase):
         proxy = build_lambda_proxy(args, stats, reverseServer)
         build_handler(proxy, stats, verbose=True)
 
+    def test_import_main_without_boto(self):
+        # The modules imported above already load botocore, so check in a
+        # new interpreter
+        output = subprocess.check_output(
+            [sys.executable, '-c',
+             'import sys, main; print "botocore" in sys.modules'],
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(output.strip(), 'False')
+
 
 if __name__ == '__main__':
     unittest.main()